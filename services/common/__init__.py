@@ -0,0 +1,6 @@
+# services/common
+# Código compartilhado pelos microsserviços Flask (o servico-agentes-ia usa só o health):
+# clientes únicos por processo (Firebase, produtor Kafka), cliente de permissões,
+# verificação de ID tokens, montagem do health e
+# ganchos de instrumentação. Cada serviço importa os módulos diretamente, por exemplo:
+#     from common import firebase, kafka
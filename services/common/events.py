@@ -0,0 +1,75 @@
+# services/common/events.py
+# Codificação dos eventos publicados nos tópicos eventos_*.
+#
+# Formato binário: 1 byte mágico (0xCE), id do assunto e versão do schema (2 bytes cada,
+# big-endian) e, em msgpack, a lista de valores na ordem dos campos do schema. Os nomes
+# dos campos do envelope não viajam em cada mensagem. Mensagens JSON (produtores antigos,
+# tópicos sem schema ou KAFKA_EVENT_ENCODING=json) continuam sendo lidas por decode_event.
+import copy
+import json
+import os
+import struct
+
+from common.instrumentation import metrics
+from common.schema_registry import get_registry
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+EVENT_ENCODING = os.environ.get('KAFKA_EVENT_ENCODING', 'msgpack').lower()
+
+MAGIC_BYTE = b'\xce'  # nunca inicia um documento JSON
+HEADER = struct.Struct('>cHH')
+
+
+class EventDecodeError(ValueError):
+    pass
+
+
+def encode_json(event):
+    return json.dumps(event, default=str).encode('utf-8')
+
+
+def encode_event(topic, event, registry=None):
+    """Serializa o evento com o schema mais recente do tópico (ou em JSON, se não houver)."""
+    if EVENT_ENCODING != 'msgpack' or msgpack is None:
+        return encode_json(event)
+    registry = registry or get_registry()
+    try:
+        subject_id, schema = registry.latest(topic)
+    except KeyError:
+        return encode_json(event)
+    names = [field['name'] for field in schema['fields']]
+    if not set(event).issubset(names):
+        # Campo fora do schema: em JSON ele não se perde. Registre uma nova versão do schema.
+        metrics.increment('events.schema_mismatch')
+        return encode_json(event)
+    values = [event.get(field['name'], field.get('default')) for field in schema['fields']]
+    return HEADER.pack(MAGIC_BYTE, subject_id, schema['version']) + msgpack.packb(values, default=str, use_bin_type=True)
+
+
+def decode_event(value, registry=None):
+    """Devolve o evento como dict, qualquer que seja o formato da mensagem."""
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    try:
+        if value[:1] != MAGIC_BYTE:
+            return json.loads(value)
+        if msgpack is None:
+            raise EventDecodeError("Biblioteca msgpack não encontrada.")
+        # A versão do cabeçalho fica para diagnóstico; a leitura usa o schema mais recente.
+        _, subject_id, _ = HEADER.unpack_from(value)
+        _, schema = (registry or get_registry()).reader_schema(subject_id)
+        values = msgpack.unpackb(value[HEADER.size:], raw=False)
+    except EventDecodeError:
+        raise
+    except Exception as e:
+        raise EventDecodeError(f"Evento inválido: {e}") from e
+    event = {}
+    for i, field in enumerate(schema['fields']):
+        # Mensagem escrita com uma versão anterior: os campos que faltam recebem o default.
+        # Valores a mais (versão mais nova que a deste leitor) são ignorados.
+        event[field['name']] = values[i] if i < len(values) else copy.deepcopy(field.get('default'))
+    return event
@@ -0,0 +1,97 @@
+# services/common/firebase.py
+# Inicialização do Firebase Admin SDK, uma única vez por processo.
+import base64
+import json
+import os
+import threading
+
+from common.lazy import lazy_import
+
+firebase_admin = lazy_import('firebase_admin')
+credentials = lazy_import('firebase_admin.credentials')
+firestore = lazy_import('firebase_admin.firestore')
+bulk_writer_module = lazy_import('google.cloud.firestore_v1.bulk_writer')
+
+_lock = threading.Lock()
+_state = {"initialized": False, "client": None, "error": None}
+
+
+def _init_firestore():
+    if not firebase_admin:
+        return None, "Biblioteca firebase_admin não encontrada."
+    base64_sdk = os.environ.get('FIREBASE_ADMIN_SDK_BASE64')
+    if not base64_sdk:
+        error = "Variável de ambiente FIREBASE_ADMIN_SDK_BASE64 não encontrada."
+        print(error)
+        return None, error
+    try:
+        decoded_sdk = base64.b64decode(base64_sdk).decode('utf-8')
+        cred = credentials.Certificate(json.loads(decoded_sdk))
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(cred)
+        client = firestore.client()
+        print("Firebase inicializado com sucesso.")
+        return client, None
+    except Exception as e:
+        print(f"Erro ao inicializar o Firebase Admin SDK: {e}")
+        return None, str(e)
+
+
+def get_firestore_client():
+    """Devolve (cliente do Firestore, erro de inicialização), criando o app na primeira chamada."""
+    with _lock:
+        if not _state["initialized"]:
+            _state["client"], _state["error"] = _init_firestore()
+            _state["initialized"] = True
+        return _state["client"], _state["error"]
+
+
+# --- Leituras e escritas em lote ---
+FIRESTORE_BATCH_LIMIT = 500
+BULK_WRITE_MAX_ATTEMPTS = int(os.environ.get('BULK_WRITE_MAX_ATTEMPTS', 5))
+# Códigos gRPC transitórios: DEADLINE_EXCEEDED, RESOURCE_EXHAUSTED, ABORTED, INTERNAL, UNAVAILABLE.
+RETRYABLE_WRITE_CODES = {4, 8, 10, 13, 14}
+
+
+def is_document_id(value):
+    """Id vindo do cliente que pode ir direto para collection().document(): string não vazia, sem '/'."""
+    return isinstance(value, str) and bool(value) and '/' not in value
+
+
+def get_all_by_id(db, collection, ids, chunk_size=FIRESTORE_BATCH_LIMIT):
+    """Lê os documentos em lotes de get_all. Devolve {id: snapshot} só dos que existem."""
+    refs = [db.collection(collection).document(doc_id) for doc_id in ids]
+    found = {}
+    for start in range(0, len(refs), chunk_size):
+        for doc in db.get_all(refs[start:start + chunk_size]):
+            if doc.exists:
+                found[doc.id] = doc
+    return found
+
+
+def open_bulk_writer(db, on_success, on_failure, max_attempts=BULK_WRITE_MAX_ATTEMPTS, max_ops_per_second=None):
+    """BulkWriter que repete só os erros transitórios.
+
+    on_success(caminho do documento) e on_failure(caminho, mensagem) são chamados das
+    threads do BulkWriter; uma escrita repetida com sucesso chama on_success no fim.
+    max_ops_per_second limita o ritmo abaixo da rampa padrão do BulkWriter (500 ops/s
+    iniciais, +50% a cada 5 minutos), para escritas em massa de fundo."""
+    if max_ops_per_second:
+        options = bulk_writer_module.BulkWriterOptions(
+            initial_ops_per_second=min(500, max_ops_per_second),
+            max_ops_per_second=max_ops_per_second,
+        )
+        writer = db.bulk_writer(options=options)
+    else:
+        writer = db.bulk_writer()
+
+    def on_write_result(reference, write_result, bulk_writer):
+        on_success(reference.path)
+
+    def on_write_error(failure, bulk_writer):
+        on_failure(failure.operation.reference.path, failure.message)
+        return failure.code in RETRYABLE_WRITE_CODES and failure.attempts < max_attempts
+
+    writer.on_write_result(on_write_result)
+    writer.on_write_error(on_write_error)
+    return writer
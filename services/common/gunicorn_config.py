@@ -0,0 +1,45 @@
+# services/common/gunicorn_config.py
+# Configuração do servidor WSGI de produção, usada pelo gunicorn.conf.py de cada serviço.
+# Todos os valores podem ser ajustados por variáveis de ambiente, sem rebuild da imagem.
+import multiprocessing
+import os
+
+
+def settings(default_port):
+    """Valores do gunicorn, lidos do ambiente no momento em que o gunicorn.conf.py é carregado."""
+    return {
+        'bind': f"0.0.0.0:{os.environ.get('PORT', default_port)}",
+        # gthread: cada worker atende várias requisições em threads, o que combina com as
+        # chamadas bloqueantes de I/O (Firestore, Kafka, HTTP). Para usar gevent é preciso
+        # instalar o pacote e desligar o preload (GUNICORN_PRELOAD=false), já que o monkey
+        # patching tem de acontecer antes da importação da aplicação.
+        'worker_class': os.environ.get('GUNICORN_WORKER_CLASS', 'gthread'),
+        'workers': int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1)),
+        'threads': int(os.environ.get('GUNICORN_THREADS', 4)),
+        'worker_connections': int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000)),
+        # Com preload a aplicação é importada uma vez no master e compartilhada (copy-on-write)
+        # entre os workers, reduzindo memória e tempo de boot.
+        'preload_app': os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true',
+        'timeout': int(os.environ.get('GUNICORN_TIMEOUT', 30)),
+        'graceful_timeout': int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30)),
+        'keepalive': int(os.environ.get('GUNICORN_KEEPALIVE', 5)),
+        'max_requests': int(os.environ.get('GUNICORN_MAX_REQUESTS', 0)),
+        'max_requests_jitter': int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 0)),
+        'accesslog': '-',
+        'errorlog': '-',
+        'loglevel': os.environ.get('GUNICORN_LOG_LEVEL', 'info'),
+    }
+
+
+# Clientes externos (gRPC do Firestore, conexões do PostgreSQL, librdkafka) não sobrevivem
+# a um fork. A importação da aplicação não cria nenhum cliente, então o master continua
+# limpo com preload_app; cada worker cria os seus logo após o fork, antes do tráfego.
+def post_fork(server, worker):
+    from api import index
+    index.init_clients()
+
+
+def worker_exit(server, worker):
+    # Descarrega os eventos ainda no buffer do produtor Kafka antes de o worker sair.
+    from common import kafka
+    kafka.shutdown()
@@ -0,0 +1,56 @@
+# services/common/health.py
+# Blocos do /api/health e da readiness memoizada (/api/health/ready).
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+READINESS_CACHE_TTL_SECONDS = float(os.environ.get('HEALTH_READY_CACHE_TTL_SECONDS', 10))
+
+
+def env_var_status(names):
+    return {name: "present" if os.environ.get(name) else "missing" for name in names}
+
+
+def timed_check(check):
+    """Executa check() e devolve (erro ou None, latência em ms)."""
+    started = time.perf_counter()
+    try:
+        check()
+        error = None
+    except Exception as e:
+        error = str(e)
+    return error, round((time.perf_counter() - started) * 1000, 2)
+
+
+class ReadinessProbe:
+    """As verificações de dependências são reaproveitadas por alguns segundos. Depois que o
+    resultado expira, ele continua sendo servido enquanto uma única atualização roda em
+    segundo plano, de modo que as sondagens não geram carga extra nas dependências."""
+
+    def __init__(self, build_status, ttl_seconds=READINESS_CACHE_TTL_SECONDS):
+        # build_status() devolve o status já com a chave "status" ("ok" ou "degraded").
+        self.build_status = build_status
+        self.ttl_seconds = ttl_seconds
+        self.cache = {"status": None, "checked_at": 0.0}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self):
+        with self._refresh_lock:
+            status = self.build_status()
+            status["checked_at"] = datetime.now(timezone.utc).isoformat()
+            with self._lock:
+                self.cache["status"] = status
+                self.cache["checked_at"] = time.monotonic()
+            return status
+
+    def get_status(self):
+        with self._lock:
+            status = self.cache["status"]
+            age = time.monotonic() - self.cache["checked_at"]
+        if status is None:
+            return self.refresh()
+        if age >= self.ttl_seconds and not self._refresh_lock.locked():
+            threading.Thread(target=self.refresh, daemon=True).start()
+        return status
@@ -0,0 +1,126 @@
+# services/common/images.py
+# Processamento de imagens de produtos: download limitado, hashes para deduplicação e
+# miniaturas WebP. O hash de conteúdo (SHA-256) pega a mesma imagem enviada de novo; o
+# hash perceptual (dHash de 64 bits) pega a mesma foto recomprimida ou redimensionada.
+#
+# As URLs vêm dos usuários e o download roda nos nossos servidores: só http(s) para hosts
+# com endereço público (nada de rede interna, loopback ou o serviço de metadados da nuvem),
+# verificado de novo a cada redirecionamento.
+import hashlib
+import io
+import ipaddress
+import os
+import socket
+from urllib.parse import urljoin, urlsplit
+
+from common.lazy import lazy_import
+
+Image = lazy_import('PIL.Image')
+requests = lazy_import('requests')
+
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 40_000_000))
+IMAGE_FETCH_TIMEOUT_SECONDS = float(os.environ.get('IMAGE_FETCH_TIMEOUT_SECONDS', 10))
+IMAGE_FETCH_MAX_REDIRECTS = int(os.environ.get('IMAGE_FETCH_MAX_REDIRECTS', 3))
+BLOCKED_HOSTNAMES = ('localhost', 'metadata', 'metadata.google.internal')
+THUMBNAIL_SIZES = tuple(int(size) for size in os.environ.get('IMAGE_THUMBNAIL_SIZES', '128,320,640').split(','))
+THUMBNAIL_QUALITY = int(os.environ.get('IMAGE_THUMBNAIL_QUALITY', 80))
+
+
+class ImageError(ValueError):
+    pass
+
+
+def check_public_url(url):
+    """ImageError se a URL não for http(s) para um host que resolve só para endereços
+    públicos. Falhas de DNS são propagadas como vieram (podem ser transitórias)."""
+    try:
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+    except (TypeError, ValueError) as e:
+        raise ImageError(f"URL inválida: {e}") from e
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageError("a URL da imagem deve ser http(s).")
+    if parts.hostname.rstrip('.').lower() in BLOCKED_HOSTNAMES:
+        raise ImageError(f"host não permitido: {parts.hostname}")
+    for *_, sockaddr in socket.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM):
+        address = ipaddress.ip_address(sockaddr[0].split('%')[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise ImageError(f"host não permitido: {parts.hostname} ({address})")
+
+
+def fetch(url, max_bytes=IMAGE_MAX_BYTES, timeout=IMAGE_FETCH_TIMEOUT_SECONDS):
+    """Baixa a imagem em memória, uma única vez. ImageError se a URL (ou um redirecionamento)
+    não for pública ou se passar de max_bytes; erros de rede e HTTP (que podem ser
+    transitórios) são propagados como vieram."""
+    for _ in range(IMAGE_FETCH_MAX_REDIRECTS + 1):
+        check_public_url(url)
+        with requests.get(url, stream=True, timeout=timeout, allow_redirects=False) as response:
+            if response.is_redirect:
+                url = urljoin(url, response.headers['Location'])
+                continue
+            response.raise_for_status()
+            declared = response.headers.get('Content-Length')
+            if declared and declared.isdigit() and int(declared) > max_bytes:
+                raise ImageError(f"imagem maior que {max_bytes} bytes")
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(64 * 1024):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise ImageError(f"imagem maior que {max_bytes} bytes")
+                chunks.append(chunk)
+        return b''.join(chunks)
+    raise ImageError(f"mais de {IMAGE_FETCH_MAX_REDIRECTS} redirecionamentos")
+
+
+def open_image(content):
+    if Image is None:
+        raise ImageError("Biblioteca Pillow não encontrada.")
+    try:
+        image = Image.open(io.BytesIO(content))
+    except Exception as e:
+        raise ImageError(f"arquivo não é uma imagem válida: {e}") from e
+    # Só o cabeçalho foi lido: um arquivo pequeno não pode descomprimir em gigabytes.
+    if image.width * image.height > IMAGE_MAX_PIXELS:
+        raise ImageError(f"imagem maior que {IMAGE_MAX_PIXELS} pixels")
+    try:
+        image.load()
+    except Exception as e:
+        raise ImageError(f"arquivo não é uma imagem válida: {e}") from e
+    return image
+
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def perceptual_hash(image):
+    """dHash: compara cada pixel com o vizinho da direita numa miniatura 9x8 em cinza."""
+    small = image.convert('L').resize((9, 8), Image.LANCZOS)
+    pixels = small.tobytes()
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{bits:016x}"
+
+
+def hamming_distance(hash_a, hash_b):
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+
+def thumbnails(image, sizes=THUMBNAIL_SIZES, quality=THUMBNAIL_QUALITY):
+    """{lado maior: bytes WebP}. Imagens menores que um tamanho não são ampliadas."""
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    result = {}
+    for size in sizes:
+        thumb = image.copy()
+        thumb.thumbnail((size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        thumb.save(buffer, format='WEBP', quality=quality, method=4)
+        result[size] = buffer.getvalue()
+    return result
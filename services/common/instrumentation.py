@@ -0,0 +1,68 @@
+# services/common/instrumentation.py
+# Contadores e tempos de operação compartilhados (Kafka, permissões, ...). Os valores ficam
+# em memória e são expostos pelo /internal/metrics de cada serviço; ganchos registrados com
+# add_hook recebem cada medição, para encaminhá-la a um backend externo.
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+        self._hooks = []
+
+    def add_hook(self, hook):
+        """Registra hook(nome, tipo, valor), chamado a cada medição ('counter' ou 'timing')."""
+        with self._lock:
+            self._hooks.append(hook)
+
+    def _notify(self, name, kind, value):
+        for hook in list(self._hooks):
+            try:
+                hook(name, kind, value)
+            except Exception as e:
+                print(f"Erro no gancho de instrumentação para '{name}': {e}")
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+        self._notify(name, 'counter', value)
+
+    def observe(self, name, elapsed_ms):
+        with self._lock:
+            timing = self._timings.setdefault(name, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            timing["count"] += 1
+            timing["total_ms"] += elapsed_ms
+            timing["max_ms"] = max(timing["max_ms"], elapsed_ms)
+        self._notify(name, 'timing', elapsed_ms)
+
+    @contextmanager
+    def timer(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - started) * 1000)
+
+    def snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {}
+            for name, timing in self._timings.items():
+                timings[name] = {
+                    "count": timing["count"],
+                    "avg_ms": round(timing["total_ms"] / timing["count"], 3),
+                    "max_ms": round(timing["max_ms"], 3),
+                }
+        return {"counters": counters, "timings": timings}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
+
+
+metrics = Metrics()
@@ -0,0 +1,208 @@
+# services/common/kafka.py
+# Produtor Kafka único por processo e publicação de eventos no formato usado por todos os
+# serviços: {"event_type", "timestamp", "<entidade>_id", "data", "source_service"},
+# serializados por common.events (msgpack com id de schema; ver schemas/events.json).
+#
+# publish_event só enfileira a mensagem no buffer do librdkafka; o envio acontece em lotes
+# (linger.ms/batch.size, comprimidos com zstd) e os callbacks de entrega são atendidos por
+# uma thread de poll em segundo plano. Entregas e falhas viram contadores em
+# instrumentation.metrics em vez de um print por mensagem. Mensagens pendentes são
+# descarregadas (flush) no encerramento do processo e, em serverless, ao fim de cada
+# requisição, já que o processo pode ser congelado logo depois da resposta.
+import atexit
+import os
+import threading
+from datetime import datetime, timezone
+
+from common import events
+from common.instrumentation import metrics
+
+try:
+    from confluent_kafka import OFFSET_BEGINNING, Consumer, Producer
+except ImportError:
+    Consumer = Producer = None
+    OFFSET_BEGINNING = -2
+
+KAFKA_LINGER_MS = int(os.environ.get('KAFKA_LINGER_MS', 20))
+KAFKA_BATCH_SIZE = int(os.environ.get('KAFKA_BATCH_SIZE', 131072))
+KAFKA_COMPRESSION_TYPE = os.environ.get('KAFKA_COMPRESSION_TYPE', 'zstd')
+KAFKA_POLL_INTERVAL_SECONDS = float(os.environ.get('KAFKA_POLL_INTERVAL_SECONDS', 0.1))
+KAFKA_FLUSH_TIMEOUT_SECONDS = float(os.environ.get('KAFKA_FLUSH_TIMEOUT_SECONDS', 5))
+# No Vercel (variável VERCEL definida) o flush ao fim de cada requisição vem ligado por padrão.
+KAFKA_FLUSH_ON_TEARDOWN = os.environ.get(
+    'KAFKA_FLUSH_ON_TEARDOWN', 'true' if os.environ.get('VERCEL') else 'false'
+).lower() == 'true'
+
+_lock = threading.Lock()
+_state = {"initialized": False, "producer": None, "error": None, "poller": None}
+_stop_polling = threading.Event()
+
+
+def producer_config():
+    kafka_bootstrap_server = os.environ.get('KAFKA_BOOTSTRAP_SERVER')
+    if not kafka_bootstrap_server:
+        return None
+    # Configuração para ambiente local (Docker), sem SASL.
+    return {
+        'bootstrap.servers': kafka_bootstrap_server,
+        'linger.ms': KAFKA_LINGER_MS,
+        'batch.size': KAFKA_BATCH_SIZE,
+        'compression.type': KAFKA_COMPRESSION_TYPE,
+        # Idempotência exige acks=all e evita duplicatas nos reenvios do próprio produtor.
+        'acks': 'all',
+        'enable.idempotence': True,
+    }
+
+
+def _create_producer():
+    if not Producer:
+        return None, "Biblioteca confluent_kafka não encontrada."
+    conf = producer_config()
+    if not conf:
+        error = "Variável de ambiente KAFKA_BOOTSTRAP_SERVER não encontrada."
+        print(error)
+        return None, error
+    try:
+        producer = Producer(conf)
+        print("Produtor Kafka inicializado com sucesso.")
+        return producer, None
+    except Exception as e:
+        print(f"Erro ao inicializar Produtor Kafka: {e}")
+        return None, str(e)
+
+
+def _poll_loop(producer):
+    while not _stop_polling.is_set():
+        try:
+            producer.poll(KAFKA_POLL_INTERVAL_SECONDS)
+        except Exception as e:
+            metrics.increment('kafka.poll_errors')
+            print(f"Erro no poll do produtor Kafka: {e}")
+            _stop_polling.wait(KAFKA_POLL_INTERVAL_SECONDS)
+
+
+def get_producer():
+    """Devolve (produtor, erro de inicialização), criando o produtor na primeira chamada."""
+    with _lock:
+        if not _state["initialized"]:
+            producer, error = _create_producer()
+            _state["producer"], _state["error"] = producer, error
+            _state["initialized"] = True
+            if producer:
+                _stop_polling.clear()
+                poller = threading.Thread(target=_poll_loop, args=(producer,), name='kafka-producer-poll', daemon=True)
+                poller.start()
+                _state["poller"] = poller
+                atexit.register(shutdown)
+        return _state["producer"], _state["error"]
+
+
+def create_consumer(group_id, topics):
+    """Devolve (consumidor, erro). O commit dos offsets é manual: o chamador confirma
+    depois de persistir o efeito das mensagens (entrega "pelo menos uma vez")."""
+    if not Consumer:
+        return None, "Biblioteca confluent_kafka não encontrada."
+    kafka_bootstrap_server = os.environ.get('KAFKA_BOOTSTRAP_SERVER')
+    if not kafka_bootstrap_server:
+        return None, "Variável de ambiente KAFKA_BOOTSTRAP_SERVER não encontrada para o consumidor."
+    try:
+        consumer = Consumer({
+            'bootstrap.servers': kafka_bootstrap_server,
+            'group.id': group_id,
+            'auto.offset.reset': 'earliest',
+            'enable.auto.commit': False,
+        })
+        consumer.subscribe(topics)
+        print(f"Consumidor Kafka '{group_id}' inicializado com sucesso.")
+        return consumer, None
+    except Exception as e:
+        print(f"Erro ao inicializar Consumidor Kafka: {e}")
+        return None, str(e)
+
+
+def rewind_to_committed(consumer, timeout=10):
+    """Volta cada partição atribuída ao último offset confirmado.
+
+    Chamado quando um lote falha: a posição em memória do consumidor já passou das
+    mensagens lidas e, sem o seek, o próximo commit bem-sucedido as pularia."""
+    assignment = consumer.assignment()
+    if not assignment:
+        return
+    for partition in consumer.committed(assignment, timeout=timeout):
+        if partition.offset < 0:
+            # Nada confirmado ainda no grupo: volta ao início, como auto.offset.reset=earliest.
+            partition.offset = OFFSET_BEGINNING
+        consumer.seek(partition)
+
+
+def flush(timeout=KAFKA_FLUSH_TIMEOUT_SECONDS):
+    """Espera a entrega das mensagens pendentes. Devolve quantas ficaram na fila."""
+    producer = _state["producer"]
+    if not producer:
+        return 0
+    with metrics.timer('kafka.flush'):
+        remaining = producer.flush(timeout)
+    if remaining:
+        metrics.increment('kafka.flush_pending', remaining)
+        print(f"{remaining} mensagens Kafka ainda pendentes após o flush.")
+    return remaining
+
+
+def flush_if_serverless():
+    """Chamado no teardown das requisições: em serverless, não deixa mensagens no buffer."""
+    if KAFKA_FLUSH_ON_TEARDOWN:
+        return flush()
+    return 0
+
+
+def shutdown():
+    """Para a thread de poll e descarrega o buffer. Registrado no atexit e no worker_exit do gunicorn."""
+    _stop_polling.set()
+    poller = _state["poller"]
+    if poller and poller.is_alive() and poller is not threading.current_thread():
+        poller.join(KAFKA_POLL_INTERVAL_SECONDS * 10)
+    return flush()
+
+
+def delivery_report(err, msg):
+    if err is not None:
+        metrics.increment('kafka.delivery_failed')
+        print(f'Falha ao entregar mensagem Kafka: {err}')
+        return
+    metrics.increment('kafka.delivered')
+    latency = msg.latency() if msg is not None else None
+    if latency is not None:
+        metrics.observe('kafka.delivery', latency * 1000)
+
+
+def build_event(event_type, key_field, key, data, source_service, changes=None):
+    event = {
+        "event_type": event_type,
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        key_field: key,
+        "data": data,
+        "source_service": source_service
+    }
+    if changes:
+        event["changes"] = changes
+    return event
+
+
+def publish_event(producer, topic, event_type, key_field, key, data, source_service, changes=None):
+    if not producer:
+        print("Produtor Kafka não está inicializado. Evento não publicado.")
+        return
+    event = build_event(event_type, key_field, key, data, source_service, changes)
+    value = events.encode_event(topic, event)
+    try:
+        try:
+            producer.produce(topic, key=key, value=value, callback=delivery_report)
+        except BufferError:
+            # Fila local cheia: espera o envio de parte do lote e tenta mais uma vez.
+            metrics.increment('kafka.queue_full')
+            producer.poll(1)
+            producer.produce(topic, key=key, value=value, callback=delivery_report)
+        metrics.increment('kafka.published')
+    except Exception as e:
+        metrics.increment('kafka.publish_errors')
+        print(f"Erro ao publicar evento Kafka: {e}")
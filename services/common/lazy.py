@@ -0,0 +1,30 @@
+# services/common/lazy.py
+# Importações preguiçosas. Importar firebase_admin (e o cliente do Firestore que ele puxa)
+# custa centenas de ms; em serverless esse custo entraria em todo cold start, então o
+# módulo só é importado no primeiro acesso a um atributo.
+import importlib
+import importlib.util
+
+# Valor inicial dos clientes externos nos serviços: diferente de None para distinguir
+# "ainda não inicializado" de "inicialização falhou".
+NOT_INITIALIZED = object()
+
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+def lazy_import(name):
+    """Devolve um LazyModule, ou None quando o pacote não está instalado."""
+    if importlib.util.find_spec(name.split('.')[0]) is None:
+        return None
+    return LazyModule(name)
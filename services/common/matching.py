@@ -0,0 +1,95 @@
+# services/common/matching.py
+# Normalização de nomes de produtos e similaridade aproximada, para achar um produto
+# canônico parecido sem percorrer o catálogo.
+#
+# normalize_name dobra acentos, caixa e pontuação e reescreve quantidades em unidades base
+# ("Café 0,5 KG" e "cafe 500 gramas" viram "cafe 500g"). A similaridade é o coeficiente de
+# Jaccard entre os trigramas dos nomes normalizados. Para a busca, cada nome guarda as
+# chaves LSH de uma assinatura MinHash (lsh_keys): nomes com Jaccard alto compartilham ao
+# menos uma chave com alta probabilidade, então uma consulta array_contains_any nas chaves
+# devolve poucos candidatos, que são então ordenados pelo Jaccard exato.
+import random
+import re
+import unicodedata
+import zlib
+
+MINHASH_BANDS = 16
+MINHASH_ROWS = 2
+MINHASH_PERMUTATIONS = MINHASH_BANDS * MINHASH_ROWS
+_MERSENNE_PRIME = (1 << 61) - 1
+# Coeficientes fixos: as chaves gravadas precisam ser as mesmas em todos os processos.
+_rng = random.Random(20240601)
+_HASH_COEFFICIENTS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+                      for _ in range(MINHASH_PERMUTATIONS)]
+
+# Unidade escrita -> (unidade base, fator).
+UNITS = {
+    'g': ('g', 1), 'gr': ('g', 1), 'grs': ('g', 1), 'grama': ('g', 1), 'gramas': ('g', 1),
+    'kg': ('g', 1000), 'kgs': ('g', 1000), 'quilo': ('g', 1000), 'quilos': ('g', 1000),
+    'mg': ('mg', 1),
+    'ml': ('ml', 1), 'mls': ('ml', 1),
+    'l': ('ml', 1000), 'lt': ('ml', 1000), 'lts': ('ml', 1000), 'litro': ('ml', 1000), 'litros': ('ml', 1000),
+    'un': ('un', 1), 'und': ('un', 1), 'unid': ('un', 1), 'unidade': ('un', 1), 'unidades': ('un', 1),
+}
+_QUANTITY = re.compile(r'(\d+(?:[.,]\d+)?)\s*(' + '|'.join(sorted(UNITS, key=len, reverse=True)) + r')\b')
+
+
+def fold(text):
+    """Minúsculas, sem acentos e só com letras, dígitos, vírgula e ponto."""
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    return re.sub(r'[^a-z0-9.,]+', ' ', text)
+
+
+def _format_quantity(match):
+    number = float(match.group(1).replace(',', '.'))
+    unit, factor = UNITS[match.group(2)]
+    value = round(number * factor, 3)
+    return f" {int(value) if value == int(value) else value}{unit} "
+
+
+def normalize_name(name):
+    text = _QUANTITY.sub(_format_quantity, fold(name))
+    # Vírgulas e pontos que não fazem parte de um número viram espaço.
+    text = re.sub(r'(?<!\d)[.,]|[.,](?!\d)', ' ', text)
+    return ' '.join(text.split())
+
+
+def normalize_barcode(barcode):
+    """Só os dígitos do código de barras, ou None."""
+    digits = re.sub(r'\D', '', str(barcode or ''))
+    return digits or None
+
+
+def trigrams(normalized):
+    padded = f"  {normalized} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def similarity(name_a, name_b):
+    return jaccard(trigrams(normalize_name(name_a)), trigrams(normalize_name(name_b)))
+
+
+def minhash(shingles):
+    hashes = [zlib.crc32(shingle.encode('utf-8')) for shingle in shingles]
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _HASH_COEFFICIENTS]
+
+
+def lsh_keys(normalized):
+    """Uma chave por banda da assinatura MinHash, no formato 'banda:hash'."""
+    shingles = trigrams(normalized)
+    if not normalized or not shingles:
+        return []
+    signature = minhash(shingles)
+    keys = []
+    for band in range(MINHASH_BANDS):
+        rows = signature[band * MINHASH_ROWS:(band + 1) * MINHASH_ROWS]
+        digest = zlib.crc32(','.join(map(str, rows)).encode('ascii'))
+        keys.append(f"{band}:{digest:08x}")
+    return keys
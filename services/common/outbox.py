@@ -0,0 +1,154 @@
+# services/common/outbox.py
+# Outbox transacional para os serviços com PostgreSQL (lojas e usuarios).
+#
+# Em vez de publicar no Kafka depois do commit (e perder o evento se o processo cair no
+# meio), a rota grava o evento já serializado numa tabela de outbox, na mesma transação
+# das suas linhas. Um relay (worker.py do serviço ou a rota /internal/outbox/relay,
+# chamada pelo cron) lê as linhas pendentes em lotes, publica e apaga as que o broker
+# confirmou. A entrega é "pelo menos uma vez": consumidores devem ser idempotentes.
+#
+# Serviços só com Firestore (ofertas) usam a mesma ideia com uma coleção: o evento é um
+# documento gravado no mesmo batch das escritas (add_firestore_event) e relay_firestore_batch
+# publica e apaga os confirmados.
+import os
+from datetime import datetime, timezone
+
+from common import events, firebase, kafka
+from common.instrumentation import metrics
+
+try:
+    from sqlalchemy import BigInteger, Column, DateTime, Integer, LargeBinary, String, func
+except ImportError:
+    BigInteger = Column = DateTime = Integer = LargeBinary = String = func = None
+
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 500))
+
+
+def define_outbox_model(Base, table_name):
+    """Cria o modelo da outbox na declarative base do serviço.
+
+    Os serviços compartilham o mesmo banco, por isso cada um tem a sua tabela."""
+    class OutboxEvent(Base):
+        __tablename__ = table_name
+        id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+        topic = Column(String, nullable=False)
+        event_key = Column(String, nullable=False)
+        payload = Column(LargeBinary, nullable=False)
+        created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+        attempts = Column(Integer, nullable=False, default=0)
+        last_error = Column(String)
+
+    return OutboxEvent
+
+
+def add_event(session, model, topic, event_type, key_field, key, data, source_service, changes=None):
+    """Adiciona o evento à sessão; ele só existe para o relay depois do commit da rota."""
+    event = kafka.build_event(event_type, key_field, key, data, source_service, changes)
+    session.add(model(topic=topic, event_key=key, payload=events.encode_event(topic, event)))
+
+
+def relay_batch(session, model, producer, batch_size=OUTBOX_BATCH_SIZE, flush_timeout=kafka.KAFKA_FLUSH_TIMEOUT_SECONDS):
+    """Publica um lote de eventos pendentes. Devolve quantos foram confirmados pelo broker.
+
+    As linhas são travadas com SKIP LOCKED, então vários relays podem rodar ao mesmo tempo
+    sem publicar o mesmo evento duas vezes. Linhas sem confirmação ficam para o próximo lote."""
+    results = {}
+
+    def on_delivery(row_id):
+        def callback(err, msg):
+            kafka.delivery_report(err, msg)
+            results[row_id] = err
+        return callback
+
+    try:
+        with metrics.timer('outbox.relay_batch'):
+            rows = (session.query(model)
+                    .order_by(model.id)
+                    .limit(batch_size)
+                    .with_for_update(skip_locked=True)
+                    .all())
+            for row in rows:
+                producer.produce(row.topic, key=row.event_key, value=row.payload, callback=on_delivery(row.id))
+            if rows:
+                producer.flush(flush_timeout)
+
+            delivered = 0
+            for row in rows:
+                if row.id in results and results[row.id] is None:
+                    session.delete(row)
+                    delivered += 1
+                else:
+                    row.attempts = (row.attempts or 0) + 1
+                    row.last_error = str(results.get(row.id) or "sem confirmação do broker")
+            session.commit()
+    except Exception:
+        session.rollback()
+        metrics.increment('outbox.relay_errors')
+        raise
+
+    if delivered:
+        metrics.increment('outbox.relayed', delivered)
+    if len(rows) - delivered:
+        metrics.increment('outbox.relay_failed', len(rows) - delivered)
+    return delivered
+
+
+def add_firestore_event(batch, collection, topic, event_type, key_field, key, data, source_service, changes=None):
+    """Grava o evento no batch (ou transação) do Firestore, junto com as escritas da rota."""
+    event = kafka.build_event(event_type, key_field, key, data, source_service, changes)
+    batch.set(collection.document(), {
+        'topic': topic,
+        'event_key': key,
+        'payload': events.encode_event(topic, event),
+        'created_at': datetime.now(timezone.utc),
+        'attempts': 0,
+    })
+
+
+def relay_firestore_batch(db, collection_name, producer, batch_size=OUTBOX_BATCH_SIZE, flush_timeout=kafka.KAFKA_FLUSH_TIMEOUT_SECONDS):
+    """Publica os eventos mais antigos da coleção de outbox. Devolve quantos foram confirmados.
+
+    Sem o SKIP LOCKED do PostgreSQL, dois relays ao mesmo tempo podem publicar o mesmo
+    evento duas vezes; a entrega já é "pelo menos uma vez"."""
+    results = {}
+
+    def on_delivery(doc_id):
+        def callback(err, msg):
+            kafka.delivery_report(err, msg)
+            results[doc_id] = err
+        return callback
+
+    try:
+        with metrics.timer('outbox.relay_batch'):
+            docs = list(db.collection(collection_name)
+                        .order_by('created_at')
+                        .limit(min(batch_size, firebase.FIRESTORE_BATCH_LIMIT))
+                        .stream())
+            if not docs:
+                return 0
+            rows = [(doc, doc.to_dict()) for doc in docs]
+            for doc, row in rows:
+                producer.produce(row['topic'], key=row['event_key'], value=row['payload'], callback=on_delivery(doc.id))
+            producer.flush(flush_timeout)
+
+            delivered = 0
+            batch = db.batch()
+            for doc, row in rows:
+                if doc.id in results and results[doc.id] is None:
+                    batch.delete(doc.reference)
+                    delivered += 1
+                else:
+                    batch.update(doc.reference, {
+                        'attempts': (row.get('attempts') or 0) + 1,
+                        'last_error': str(results.get(doc.id) or "sem confirmação do broker"),
+                    })
+            batch.commit()
+    except Exception:
+        metrics.increment('outbox.relay_errors')
+        raise
+
+    if delivered:
+        metrics.increment('outbox.relayed', delivered)
+    if len(docs) - delivered:
+        metrics.increment('outbox.relay_failed', len(docs) - delivered)
+    return delivered
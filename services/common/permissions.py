@@ -0,0 +1,44 @@
+# services/common/permissions.py
+# Cliente do endpoint de permissões do servico-usuarios. Usa uma requests.Session para
+# reaproveitar as conexões HTTP entre chamadas em vez de abrir uma nova a cada verificação.
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.instrumentation import metrics
+
+PERMISSIONS_TIMEOUT_SECONDS = float(os.environ.get('PERMISSIONS_TIMEOUT_SECONDS', 5))
+PERMISSIONS_POOL_SIZE = int(os.environ.get('PERMISSIONS_POOL_SIZE', 10))
+
+
+class PermissionClient:
+    def __init__(self, base_url_env='SERVICO_USUARIOS_URL', timeout=PERMISSIONS_TIMEOUT_SECONDS, pool_size=PERMISSIONS_POOL_SIZE):
+        self.base_url_env = base_url_env
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def check(self, user_id, store_id):
+        """Verifica se o usuário pode gerenciar a loja. Devolve (permitido, detalhes)."""
+        servico_usuarios_url = os.environ.get(self.base_url_env)
+        if not servico_usuarios_url:
+            print(f"ERRO: {self.base_url_env} não configurado.")
+            return False, {"error": "URL do serviço de permissões não configurada."}
+
+        try:
+            with metrics.timer('permissions.check'):
+                response = self.session.get(
+                    f"{servico_usuarios_url}/api/permissions/check",
+                    params={'user_id': user_id, 'store_id': store_id},
+                    timeout=self.timeout
+                )
+            if response.status_code == 200:
+                return response.json().get('allow', False), response.json()
+            return False, response.json()
+        except requests.exceptions.RequestException as e:
+            metrics.increment('permissions.errors')
+            print(f"Erro ao contatar o serviço de permissões: {e}")
+            return False, {"error": "Falha ao contatar o serviço de permissões."}
@@ -0,0 +1,146 @@
+# services/common/schema_registry.py
+# Registro de schemas local, guardado em arquivo (schemas/events.json), no lugar de um
+# Schema Registry externo. Cada assunto (o nome do tópico) tem um id numérico e uma lista
+# de versões; cada versão é a lista ordenada dos campos do envelope. As mensagens levam
+# só os valores, na ordem dos campos, e o cabeçalho com id do assunto e versão.
+#
+# Regra de compatibilidade entre versões consecutivas de um assunto: a nova versão só pode
+# acrescentar campos no final, e todo campo novo precisa de "default". Assim leitores
+# antigos leem o prefixo que conhecem e leitores novos completam mensagens antigas.
+#
+#     python -m common.schema_registry          # valida o arquivo (usado no CI via testes)
+import copy
+import json
+import os
+import sys
+import threading
+
+DEFAULT_SCHEMAS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas', 'events.json')
+
+
+class SchemaCompatibilityError(ValueError):
+    pass
+
+
+def check_compatibility(old_fields, new_fields):
+    """Devolve a lista de problemas que impedem new_fields de suceder old_fields."""
+    problems = []
+    old_names = [field['name'] for field in old_fields]
+    new_names = [field['name'] for field in new_fields]
+    if new_names[:len(old_names)] != old_names:
+        problems.append(
+            f"campos existentes não podem ser removidos, renomeados ou reordenados "
+            f"(antes: {old_names}, depois: {new_names[:len(old_names)]})"
+        )
+    for field in new_fields[len(old_names):]:
+        if 'default' not in field:
+            problems.append(f"campo novo '{field['name']}' precisa de um valor default")
+    if len(set(new_names)) != len(new_names):
+        problems.append("nomes de campos duplicados")
+    return problems
+
+
+class SchemaRegistry:
+    def __init__(self, path=DEFAULT_SCHEMAS_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        with open(self.path, encoding='utf-8') as f:
+            self.subjects = json.load(f)
+        self._by_id = {entry['id']: subject for subject, entry in self.subjects.items()}
+
+    def latest(self, subject):
+        """Devolve (id do assunto, versão mais recente). KeyError se o assunto não existe."""
+        entry = self.subjects[subject]
+        return entry['id'], entry['versions'][-1]
+
+    def reader_schema(self, subject_id):
+        """Devolve (assunto, versão mais recente) para o id no cabeçalho de uma mensagem.
+
+        Como as versões só acrescentam campos no final, a versão mais recente conhecida
+        aqui lê mensagens de qualquer versão: as mais antigas são completadas com os
+        defaults e as mais novas (produtor atualizado antes do consumidor) são lidas só
+        até os campos conhecidos."""
+        subject = self._by_id.get(subject_id)
+        if subject is None:
+            raise KeyError(f"Schema com id {subject_id} não registrado.")
+        return subject, self.subjects[subject]['versions'][-1]
+
+    def validate(self):
+        """Verifica ids únicos e a compatibilidade entre todas as versões consecutivas."""
+        problems = []
+        ids = [entry['id'] for entry in self.subjects.values()]
+        if len(set(ids)) != len(ids):
+            problems.append("ids de assunto duplicados")
+        for subject, entry in self.subjects.items():
+            versions = entry['versions']
+            numbers = [schema['version'] for schema in versions]
+            if numbers != list(range(1, len(versions) + 1)):
+                problems.append(f"{subject}: versões devem ser 1, 2, 3... (encontrado {numbers})")
+            for old, new in zip(versions, versions[1:]):
+                for problem in check_compatibility(old['fields'], new['fields']):
+                    problems.append(f"{subject} v{new['version']}: {problem}")
+        return problems
+
+    def register(self, subject, fields, subject_id=None):
+        """Registra uma nova versão (ou um novo assunto) e grava o arquivo.
+
+        Devolve o número da versão. Se os campos forem iguais aos da versão mais recente,
+        nada é gravado. SchemaCompatibilityError se a mudança quebrar leitores."""
+        fields = copy.deepcopy(fields)
+        with self._lock:
+            entry = self.subjects.get(subject)
+            if entry is None:
+                if subject_id is None:
+                    subject_id = max(self._by_id, default=0) + 1
+                if subject_id in self._by_id:
+                    raise SchemaCompatibilityError(f"id {subject_id} já usado por '{self._by_id[subject_id]}'")
+                entry = {'id': subject_id, 'versions': []}
+            else:
+                latest = entry['versions'][-1]
+                if latest['fields'] == fields:
+                    return latest['version']
+                problems = check_compatibility(latest['fields'], fields)
+                if problems:
+                    raise SchemaCompatibilityError(f"{subject}: " + "; ".join(problems))
+            version = len(entry['versions']) + 1
+            entry['versions'].append({'version': version, 'fields': fields})
+            self.subjects[subject] = entry
+            self._by_id[entry['id']] = subject
+            self._save()
+            return version
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.subjects, f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        os.replace(tmp_path, self.path)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Registro padrão do processo, carregado do arquivo na primeira chamada."""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = SchemaRegistry()
+        return _registry
+
+
+def main():
+    problems = SchemaRegistry().validate()
+    for problem in problems:
+        print(problem)
+    if not problems:
+        print("Schemas de eventos compatíveis.")
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
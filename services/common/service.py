@@ -0,0 +1,71 @@
+# services/common/service.py
+# Estrutura comum dos serviços Flask: criação dos clientes sob demanda, o acesso das rotas
+# chamadas pelo cron e as rotas de liveness, readiness e métricas internas.
+#
+# Nada é conectado na importação do módulo, para que o cold start pague só o import. Os
+# clientes são criados na primeira requisição (exceto a liveness) e, no gunicorn, pelo
+# post_fork de cada worker (common/gunicorn_config.py). Cada serviço diz o que criar numa
+# função que só inicializa os globais que ainda valem NOT_INITIALIZED; ela roda sob um lock
+# tomado em toda requisição, para que nenhuma thread veja um cliente pela metade.
+import os
+import threading
+
+from flask import jsonify, request
+
+from common import health
+from common.instrumentation import metrics
+
+LIVENESS_ENDPOINT = 'liveness_check'
+
+
+def lazy_clients(app, create_clients):
+    """Registra o before_request que cria os clientes e devolve init_clients()."""
+    lock = threading.Lock()
+
+    def init_clients():
+        with lock:
+            create_clients()
+
+    @app.before_request
+    def load_clients():
+        if request.endpoint != LIVENESS_ENDPOINT:
+            init_clients()
+
+    return init_clients
+
+
+def is_cron_request():
+    """Rotas internas (cron do Vercel, métricas) exigem Authorization: Bearer CRON_SECRET."""
+    cron_secret = os.environ.get('CRON_SECRET')
+    return bool(cron_secret) and request.headers.get('Authorization') == f'Bearer {cron_secret}'
+
+
+def register_probe_routes(app, build_readiness_status):
+    """/api/health/live e /api/health/ready (memoizada). Devolve a ReadinessProbe."""
+    readiness = health.ReadinessProbe(build_readiness_status)
+
+    def liveness_check():
+        # Indica apenas que o processo está de pé; não faz nenhuma E/S.
+        return jsonify({"status": "ok"}), 200
+
+    def readiness_check():
+        status = readiness.get_status()
+        http_status = 200 if status["status"] == "ok" else 503
+        return jsonify(status), http_status
+
+    app.add_url_rule('/api/health/live', LIVENESS_ENDPOINT, liveness_check, methods=['GET'])
+    app.add_url_rule('/api/health/ready', 'readiness_check', readiness_check, methods=['GET'])
+    return readiness
+
+
+def register_metrics_route(app, token_verifier):
+    """/internal/metrics: cache de tokens e instrumentação, só para o cron/monitoramento."""
+    def internal_metrics():
+        if not is_cron_request():
+            return jsonify({"error": "Unauthorized"}), 401
+        return jsonify({
+            "token_verification": token_verifier.snapshot(),
+            "instrumentation": metrics.snapshot()
+        }), 200
+
+    app.add_url_rule('/internal/metrics', 'internal_metrics', internal_metrics, methods=['GET'])
@@ -0,0 +1,80 @@
+# services/common/storage.py
+# Armazenamento de arquivos gerados pelos serviços (miniaturas de imagens), escolhido por
+# IMAGE_STORAGE_BACKEND:
+#   local  grava em IMAGE_STORAGE_LOCAL_DIR e devolve IMAGE_STORAGE_PUBLIC_URL/<chave>.
+#          Nenhum serviço Flask serve a pasta: IMAGE_STORAGE_PUBLIC_URL é obrigatória e
+#          aponta para o servidor de arquivos estáticos (product-media no docker-compose)
+#          ou para o CDN. Não funciona no Vercel, cujo sistema de arquivos é somente leitura;
+#   s3     qualquer serviço compatível com S3 (AWS, R2, MinIO) via boto3 (no
+#          requirements.txt de quem usa o armazenamento): IMAGE_STORAGE_S3_BUCKET,
+#          IMAGE_STORAGE_S3_ENDPOINT_URL (opcional) e as credenciais padrão do boto3.
+# create_storage falha logo (RuntimeError) com a configuração incompleta, em vez de
+# gravar arquivos cujas URLs ninguém serve.
+import os
+import threading
+
+from common.lazy import lazy_import
+
+boto3 = lazy_import('boto3')
+
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+class LocalStorage:
+    def __init__(self, root, public_url):
+        self.root = root
+        self.public_url = public_url.rstrip('/')
+
+    def put(self, key, content, content_type):
+        path = os.path.join(self.root, *key.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        return f"{self.public_url}/{key}"
+
+
+class S3Storage:
+    def __init__(self, bucket, endpoint_url=None, public_url=None):
+        if not boto3:
+            raise RuntimeError("Biblioteca boto3 não encontrada.")
+        self.bucket = bucket
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        base = public_url or (f"{endpoint_url.rstrip('/')}/{bucket}" if endpoint_url else f"https://{bucket}.s3.amazonaws.com")
+        self.public_url = base.rstrip('/')
+
+    def put(self, key, content, content_type):
+        # As chaves derivam do hash do conteúdo, então o objeto nunca muda: cache longo.
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=content,
+                               ContentType=content_type, CacheControl=CACHE_CONTROL)
+        return f"{self.public_url}/{key}"
+
+
+def create_storage():
+    backend = os.environ.get('IMAGE_STORAGE_BACKEND', 'local').lower()
+    public_url = os.environ.get('IMAGE_STORAGE_PUBLIC_URL')
+    if backend == 's3':
+        bucket = os.environ.get('IMAGE_STORAGE_S3_BUCKET')
+        if not bucket:
+            raise RuntimeError("Variável de ambiente IMAGE_STORAGE_S3_BUCKET não encontrada.")
+        return S3Storage(bucket, os.environ.get('IMAGE_STORAGE_S3_ENDPOINT_URL'), public_url)
+    if backend == 'local':
+        if os.environ.get('VERCEL'):
+            raise RuntimeError("IMAGE_STORAGE_BACKEND=local não funciona no Vercel (sistema de arquivos somente leitura); use s3.")
+        if not public_url:
+            raise RuntimeError("Variável de ambiente IMAGE_STORAGE_PUBLIC_URL não encontrada.")
+        return LocalStorage(os.environ.get('IMAGE_STORAGE_LOCAL_DIR', '/app/media'), public_url)
+    raise RuntimeError(f"IMAGE_STORAGE_BACKEND desconhecido: {backend}")
+
+
+_lock = threading.Lock()
+_state = {"storage": None}
+
+
+def get_storage():
+    """Armazenamento do processo, criado na primeira chamada."""
+    with _lock:
+        if _state["storage"] is None:
+            _state["storage"] = create_storage()
+        return _state["storage"]
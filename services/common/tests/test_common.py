@@ -0,0 +1,586 @@
+import pytest
+from unittest.mock import patch, MagicMock
+from datetime import datetime, timezone
+import json
+import os
+import sys
+
+# Adiciona a pasta services/ ao path para importar o pacote common
+services_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+if services_root not in sys.path:
+    sys.path.insert(0, services_root)
+
+from common import events, firebase, gunicorn_config, health, images, kafka, matching, outbox, permissions, service, storage, tokens
+from common.schema_registry import SchemaRegistry, SchemaCompatibilityError, check_compatibility
+from common.instrumentation import Metrics, metrics
+from common.lazy import lazy_import, LazyModule
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+# --- Cache de verificação de tokens ---
+
+def test_token_verifier_caches_until_exp():
+    """Um token válido é verificado uma única vez enquanto não expira."""
+    exp = int(datetime.now(timezone.utc).timestamp()) + 3600
+    verify_fn = MagicMock(return_value={'uid': 'test_user_uid', 'exp': exp})
+    verifier = tokens.CachedTokenVerifier(verify_fn, max_entries=10, refresh_interval=600)
+
+    assert verifier.verify("token_a")['uid'] == 'test_user_uid'
+    assert verifier.verify("token_a")['uid'] == 'test_user_uid'
+
+    verify_fn.assert_called_once_with("token_a")
+    snapshot = verifier.snapshot()
+    assert snapshot["cache_hits"] == 1
+    assert snapshot["cache_misses"] == 1
+    assert snapshot["cache_size"] == 1
+
+def test_token_verifier_does_not_cache_expired_or_invalid_tokens():
+    exp = int(datetime.now(timezone.utc).timestamp()) - 10
+    verify_fn = MagicMock(return_value={'uid': 'test_user_uid', 'exp': exp})
+    verifier = tokens.CachedTokenVerifier(verify_fn, max_entries=10, refresh_interval=600)
+    verifier.verify("expired_token")
+    verifier.verify("expired_token")
+    assert verify_fn.call_count == 2
+
+    verify_fn.side_effect = Exception("Invalid token")
+    with pytest.raises(Exception):
+        verifier.verify("invalid_token")
+    assert verifier.snapshot()["verification_failures"] == 1
+    assert verifier.snapshot()["cache_size"] == 0
+
+def test_token_verifier_evicts_least_recently_used():
+    exp = int(datetime.now(timezone.utc).timestamp()) + 3600
+    verify_fn = MagicMock(return_value={'uid': 'test_user_uid', 'exp': exp})
+    verifier = tokens.CachedTokenVerifier(verify_fn, max_entries=2, refresh_interval=600)
+
+    verifier.verify("token_a")
+    verifier.verify("token_b")
+    verifier.verify("token_a") # token_a passa a ser o mais recente
+    verifier.verify("token_c") # token_b é descartado
+
+    verify_fn.reset_mock()
+    verifier.verify("token_a")
+    verifier.verify("token_b")
+    verify_fn.assert_called_once_with("token_b")
+
+def test_refresh_public_keys_uses_own_session():
+    from google.auth.transport.requests import Request
+    verifier = tokens.CachedTokenVerifier(MagicMock())
+    assert isinstance(verifier.certs_request(), Request)
+
+    verifier._certs_request = MagicMock(return_value=MagicMock(status=200))
+    verifier.refresh_public_keys()
+    assert verifier._certs_request.call_args.args == (tokens.FIREBASE_CERTS_URL,)
+    assert verifier.snapshot()["certs_refreshes"] == 1
+
+    verifier._certs_request.return_value = MagicMock(status=503)
+    verifier.refresh_public_keys()
+    assert verifier.snapshot()["certs_refresh_errors"] == 1
+
+# --- Kafka ---
+
+def test_publish_event_builds_standard_envelope():
+    producer = MagicMock()
+    kafka.publish_event(producer, 'eventos_lojas', 'StoreCreated', 'store_id', 'store_1', {'name': 'Loja'}, 'servico-lojas')
+
+    args, kwargs = producer.produce.call_args
+    assert args == ('eventos_lojas',)
+    assert kwargs['key'] == 'store_1'
+    assert kwargs['callback'] is kafka.delivery_report
+    assert kwargs['value'][:1] == events.MAGIC_BYTE
+    event = events.decode_event(kwargs['value'])
+    assert event['event_type'] == 'StoreCreated'
+    assert event['store_id'] == 'store_1'
+    assert event['data'] == {'name': 'Loja'}
+    assert event['source_service'] == 'servico-lojas'
+    assert event['changes'] is None
+    # O poll fica a cargo da thread em segundo plano.
+    producer.poll.assert_not_called()
+    assert metrics.snapshot()['counters']['kafka.published'] == 1
+
+def test_publish_event_without_producer_is_a_noop():
+    kafka.publish_event(None, 'eventos_lojas', 'StoreCreated', 'store_id', 'store_1', {}, 'servico-lojas')
+    assert 'kafka.published' not in metrics.snapshot()['counters']
+
+def test_delivery_report_counts_deliveries_and_latency():
+    kafka.delivery_report(Exception("broker down"), None)
+    kafka.delivery_report(None, MagicMock(latency=MagicMock(return_value=0.05)))
+    snapshot = metrics.snapshot()
+    assert snapshot['counters']['kafka.delivery_failed'] == 1
+    assert snapshot['counters']['kafka.delivered'] == 1
+    assert snapshot['timings']['kafka.delivery']['max_ms'] == 50.0
+
+def test_publish_event_retries_once_when_queue_is_full():
+    producer = MagicMock()
+    producer.produce.side_effect = [BufferError(), None]
+    kafka.publish_event(producer, 'eventos_lojas', 'StoreCreated', 'store_id', 'store_1', {}, 'servico-lojas')
+    assert producer.produce.call_count == 2
+    producer.poll.assert_called_once_with(1)
+    counters = metrics.snapshot()['counters']
+    assert counters['kafka.queue_full'] == 1
+    assert counters['kafka.published'] == 1
+
+def test_flush_if_serverless_only_flushes_when_enabled():
+    producer = MagicMock()
+    producer.flush.return_value = 2
+    with patch.dict(kafka._state, {"producer": producer}):
+        with patch.object(kafka, 'KAFKA_FLUSH_ON_TEARDOWN', False):
+            assert kafka.flush_if_serverless() == 0
+        producer.flush.assert_not_called()
+        with patch.object(kafka, 'KAFKA_FLUSH_ON_TEARDOWN', True):
+            assert kafka.flush_if_serverless() == 2
+    producer.flush.assert_called_once_with(kafka.KAFKA_FLUSH_TIMEOUT_SECONDS)
+    assert metrics.snapshot()['counters']['kafka.flush_pending'] == 2
+
+def test_rewind_to_committed_seeks_each_assigned_partition():
+    from confluent_kafka import TopicPartition
+    consumer = MagicMock()
+    consumer.assignment.return_value = [TopicPartition('t', 0), TopicPartition('t', 1)]
+    consumer.committed.return_value = [TopicPartition('t', 0, 42), TopicPartition('t', 1, -1001)]
+
+    kafka.rewind_to_committed(consumer)
+
+    sought = [call.args[0] for call in consumer.seek.call_args_list]
+    assert [(p.partition, p.offset) for p in sought] == [(0, 42), (1, kafka.OFFSET_BEGINNING)]
+
+def test_shutdown_stops_polling_and_flushes():
+    producer = MagicMock()
+    producer.flush.return_value = 0
+    with patch.dict(kafka._state, {"producer": producer, "poller": None}):
+        kafka.shutdown()
+    assert kafka._stop_polling.is_set()
+    producer.flush.assert_called_once()
+    kafka._stop_polling.clear()
+
+def test_get_producer_is_a_process_singleton():
+    with patch.dict(kafka._state, {"initialized": False, "producer": None, "error": None, "poller": None}), \
+         patch.dict(os.environ, {"KAFKA_BOOTSTRAP_SERVER": "dummy:9092"}), \
+         patch.object(kafka, 'Producer') as mock_producer_class, \
+         patch.object(kafka.threading, 'Thread') as mock_thread_class, \
+         patch.object(kafka.atexit, 'register'):
+        first = kafka.get_producer()
+        second = kafka.get_producer()
+    assert first == second == (mock_producer_class.return_value, None)
+    conf = mock_producer_class.call_args[0][0]
+    assert conf['bootstrap.servers'] == 'dummy:9092'
+    assert conf['compression.type'] == 'zstd'
+    assert conf['acks'] == 'all'
+    assert conf['enable.idempotence'] is True
+    assert conf['linger.ms'] > 0
+    mock_thread_class.return_value.start.assert_called_once()
+
+def test_get_producer_reports_missing_bootstrap_server():
+    with patch.dict(kafka._state, {"initialized": False, "producer": None, "error": None, "poller": None}), \
+         patch.dict(os.environ, {}, clear=True):
+        producer, error = kafka.get_producer()
+    assert producer is None
+    assert "KAFKA_BOOTSTRAP_SERVER" in error
+
+# --- Permissões ---
+
+def test_permission_client_reuses_session():
+    client = permissions.PermissionClient()
+    response = MagicMock(status_code=200)
+    response.json.return_value = {'allow': True}
+    with patch.dict(os.environ, {"SERVICO_USUARIOS_URL": "http://usuarios"}), \
+         patch.object(client.session, 'get', return_value=response) as mock_get:
+        assert client.check('user_1', 'store_1') == (True, {'allow': True})
+        assert client.check('user_1', 'store_2') == (True, {'allow': True})
+
+    assert mock_get.call_count == 2
+    mock_get.assert_called_with("http://usuarios/api/permissions/check", params={'user_id': 'user_1', 'store_id': 'store_2'}, timeout=client.timeout)
+    assert metrics.snapshot()['timings']['permissions.check']['count'] == 2
+
+def test_permission_client_without_url_denies():
+    client = permissions.PermissionClient()
+    with patch.dict(os.environ, {}, clear=True):
+        allowed, details = client.check('user_1', 'store_1')
+    assert allowed is False
+    assert "error" in details
+
+# --- Health ---
+
+def test_env_var_status():
+    with patch.dict(os.environ, {"PRESENT_VAR": "1"}, clear=True):
+        assert health.env_var_status(['PRESENT_VAR', 'MISSING_VAR']) == {"PRESENT_VAR": "present", "MISSING_VAR": "missing"}
+
+def test_timed_check_captures_errors():
+    error, elapsed_ms = health.timed_check(MagicMock(side_effect=Exception("boom")))
+    assert error == "boom"
+    assert elapsed_ms >= 0
+
+def test_readiness_probe_memoizes_within_ttl():
+    build_status = MagicMock(side_effect=lambda: {"status": "ok"})
+    probe = health.ReadinessProbe(build_status, ttl_seconds=60)
+    first = probe.get_status()
+    second = probe.get_status()
+    assert first is second
+    assert "checked_at" in first
+    build_status.assert_called_once()
+
+# --- Instrumentação e importações preguiçosas ---
+
+def test_metrics_hooks_receive_measurements():
+    local_metrics = Metrics()
+    hook = MagicMock()
+    local_metrics.add_hook(hook)
+    local_metrics.increment('events')
+    with local_metrics.timer('operation'):
+        pass
+    hook.assert_any_call('events', 'counter', 1)
+    assert hook.call_args_list[1][0][:2] == ('operation', 'timing')
+    snapshot = local_metrics.snapshot()
+    assert snapshot['counters'] == {'events': 1}
+    assert snapshot['timings']['operation']['count'] == 1
+
+def test_lazy_import():
+    assert lazy_import('pacote_que_nao_existe') is None
+    lazy_json = lazy_import('json')
+    assert isinstance(lazy_json, LazyModule)
+    assert lazy_json.dumps({'a': 1}) == '{"a": 1}'
+
+# --- Codificação de eventos e registro de schemas ---
+
+@pytest.fixture
+def registry(tmp_path):
+    path = tmp_path / 'events.json'
+    path.write_text(json.dumps({
+        "eventos_teste": {"id": 1, "versions": [{"version": 1, "fields": [
+            {"name": "event_type"}, {"name": "item_id"}, {"name": "data", "default": {}}
+        ]}]}
+    }))
+    return SchemaRegistry(str(path))
+
+def test_shipped_event_schemas_are_compatible():
+    assert SchemaRegistry().validate() == []
+
+def test_encoded_event_is_smaller_than_json_and_round_trips():
+    event = kafka.build_event('OfferCreated', 'offer_id', 'offer_1', {'product_id': 'prod_1', 'price': 9.9}, 'servico-ofertas')
+    encoded = events.encode_event('eventos_ofertas', event)
+    assert len(encoded) < len(json.dumps(event))
+    decoded = events.decode_event(encoded)
+    assert decoded['offer_id'] == 'offer_1'
+    assert decoded['data'] == {'product_id': 'prod_1', 'price': 9.9}
+
+def test_decode_event_still_reads_json():
+    assert events.decode_event(b'{"event_type": "UserCreated", "user_id": "u1"}')['user_id'] == 'u1'
+    with pytest.raises(events.EventDecodeError):
+        events.decode_event(events.MAGIC_BYTE + b'\x00')
+
+def test_topics_without_schema_or_unknown_fields_fall_back_to_json(registry):
+    assert json.loads(events.encode_event('outro_topico', {'a': 1}, registry)) == {'a': 1}
+    assert json.loads(events.encode_event('eventos_teste', {'extra': 1}, registry)) == {'extra': 1}
+    assert metrics.snapshot()['counters']['events.schema_mismatch'] == 1
+
+def test_registry_rejects_breaking_changes(registry):
+    with pytest.raises(SchemaCompatibilityError):
+        registry.register('eventos_teste', [{"name": "event_type"}, {"name": "data", "default": {}}])
+    with pytest.raises(SchemaCompatibilityError):
+        registry.register('eventos_teste', [
+            {"name": "event_type"}, {"name": "item_id"}, {"name": "data", "default": {}}, {"name": "source"}
+        ])
+    assert check_compatibility([{"name": "a"}], [{"name": "a"}, {"name": "b", "default": None}]) == []
+
+def test_old_and_new_readers_understand_each_other(registry):
+    old_reader = SchemaRegistry(registry.path)
+    old_message = events.encode_event('eventos_teste', {'event_type': 'Created', 'item_id': 'i1'}, registry)
+
+    new_fields = list(registry.latest('eventos_teste')[1]['fields']) + [{"name": "source", "default": "desconhecido"}]
+    assert registry.register('eventos_teste', new_fields) == 2
+    assert SchemaRegistry(registry.path).latest('eventos_teste')[1]['version'] == 2
+    new_message = events.encode_event('eventos_teste', {'event_type': 'Created', 'item_id': 'i2', 'source': 'x'}, registry)
+
+    # Leitor novo completa a mensagem antiga com o default.
+    assert events.decode_event(old_message, registry)['source'] == 'desconhecido'
+    # Leitor antigo lê a mensagem nova com os campos que conhece.
+    assert events.decode_event(new_message, old_reader) == {'event_type': 'Created', 'item_id': 'i2', 'data': {}}
+
+# --- Outbox ---
+
+@pytest.fixture
+def outbox_session():
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import declarative_base, sessionmaker
+    Base = declarative_base()
+    model = outbox.define_outbox_model(Base, 'outbox_teste')
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session, model
+    session.close()
+
+def test_outbox_rows_are_relayed_in_one_batch_and_deleted(outbox_session):
+    session, model = outbox_session
+    outbox.add_event(session, model, 'eventos_lojas', 'StoreCreated', 'store_id', 'store_1', {'name': 'Loja'}, 'servico-lojas')
+    outbox.add_event(session, model, 'eventos_lojas', 'StoreUpdated', 'store_id', 'store_1', {'name': 'Nova'}, 'servico-lojas')
+    session.commit()
+
+    producer = MagicMock()
+    def confirm_all(timeout):
+        for call in producer.produce.call_args_list:
+            call.kwargs['callback'](None, MagicMock(latency=MagicMock(return_value=None)))
+        return 0
+    producer.flush.side_effect = confirm_all
+
+    assert outbox.relay_batch(session, model, producer) == 2
+    producer.flush.assert_called_once()
+    assert [events.decode_event(call.kwargs['value'])['event_type'] for call in producer.produce.call_args_list] == ['StoreCreated', 'StoreUpdated']
+    assert session.query(model).count() == 0
+    assert metrics.snapshot()['counters']['outbox.relayed'] == 2
+
+def test_outbox_rows_without_delivery_stay_pending(outbox_session):
+    session, model = outbox_session
+    outbox.add_event(session, model, 'eventos_usuarios', 'UserCreated', 'user_id', 'user_1', {}, 'servico-usuarios')
+    session.commit()
+
+    producer = MagicMock()
+    producer.flush.return_value = 1 # nenhum callback chamado dentro do timeout
+    assert outbox.relay_batch(session, model, producer) == 0
+    row = session.query(model).one()
+    assert row.attempts == 1
+    assert row.last_error
+
+def outbox_firestore_doc(doc_id, event_type, attempts=0):
+    event = kafka.build_event(event_type, 'offer_id', doc_id, {}, 'servico-ofertas')
+    doc = MagicMock(id=doc_id)
+    doc.to_dict.return_value = {'topic': 'eventos_ofertas', 'event_key': doc_id,
+                                'payload': events.encode_event('eventos_ofertas', event), 'attempts': attempts}
+    return doc
+
+def test_firestore_outbox_event_is_written_in_the_given_batch():
+    batch, collection = MagicMock(), MagicMock()
+    outbox.add_firestore_event(batch, collection, 'eventos_ofertas', 'OfferExpired', 'offer_id', 'offer_1',
+                               {'store_id': 's1'}, 'servico-ofertas')
+
+    ref, data = batch.set.call_args.args
+    assert ref is collection.document.return_value
+    assert (data['topic'], data['event_key'], data['attempts']) == ('eventos_ofertas', 'offer_1', 0)
+    event = events.decode_event(data['payload'])
+    assert (event['event_type'], event['offer_id'], event['data']) == ('OfferExpired', 'offer_1', {'store_id': 's1'})
+
+def test_firestore_outbox_deletes_only_confirmed_events():
+    db = MagicMock()
+    docs = [outbox_firestore_doc('e1', 'OfferExpired'), outbox_firestore_doc('e2', 'OfferExpired', attempts=2)]
+    db.collection.return_value.order_by.return_value.limit.return_value.stream.return_value = docs
+
+    producer = MagicMock()
+    def confirm_first(timeout):
+        producer.produce.call_args_list[0].kwargs['callback'](None, MagicMock(latency=MagicMock(return_value=None)))
+        return 1
+    producer.flush.side_effect = confirm_first
+
+    assert outbox.relay_firestore_batch(db, '_outbox', producer) == 1
+    db.collection.assert_called_with('_outbox')
+    db.collection.return_value.order_by.assert_called_once_with('created_at')
+    batch = db.batch.return_value
+    batch.delete.assert_called_once_with(docs[0].reference)
+    ref, update = batch.update.call_args.args
+    assert ref is docs[1].reference
+    assert update['attempts'] == 3 and update['last_error']
+    batch.commit.assert_called_once()
+
+def test_firestore_outbox_without_events_does_nothing():
+    db = MagicMock()
+    db.collection.return_value.order_by.return_value.limit.return_value.stream.return_value = []
+    producer = MagicMock()
+
+    assert outbox.relay_firestore_batch(db, '_outbox', producer) == 0
+    producer.flush.assert_not_called()
+    db.batch.assert_not_called()
+
+
+def test_bulk_writer_retries_only_transient_errors():
+    db = MagicMock()
+    succeeded, failed = [], []
+    firebase.open_bulk_writer(db, succeeded.append, lambda path, message: failed.append((path, message)), max_attempts=3)
+    writer = db.bulk_writer.return_value
+    on_result = writer.on_write_result.call_args[0][0]
+    on_error = writer.on_write_error.call_args[0][0]
+
+    def failure(code, attempts):
+        f = MagicMock(code=code, message='erro', attempts=attempts)
+        f.operation.reference.path = 'offers/o1'
+        return f
+
+    assert on_error(failure(14, 1), writer) is True   # UNAVAILABLE
+    assert on_error(failure(14, 3), writer) is False  # tentativas esgotadas
+    assert on_error(failure(7, 1), writer) is False   # PERMISSION_DENIED
+    on_result(MagicMock(path='offers/o2'), MagicMock(), writer)
+    assert succeeded == ['offers/o2']
+    assert failed == [('offers/o1', 'erro')] * 3
+
+
+def test_get_all_by_id_reads_in_chunks_and_skips_missing():
+    db = MagicMock()
+    db.collection.return_value.document.side_effect = lambda doc_id: MagicMock(id=doc_id)
+    db.get_all.side_effect = lambda refs: [MagicMock(id=ref.id, exists=ref.id != 'b') for ref in refs]
+    found = firebase.get_all_by_id(db, 'products', ['a', 'b', 'c'], chunk_size=2)
+    assert sorted(found) == ['a', 'c']
+    assert db.get_all.call_count == 2
+
+
+def test_normalize_name_folds_accents_and_units():
+    assert matching.normalize_name('Café Pilão 0,5 KG') == 'cafe pilao 500g'
+    assert matching.normalize_name('cafe pilao 500 gramas') == 'cafe pilao 500g'
+    assert matching.normalize_name('Leite Integral 1.5 Litros') == 'leite integral 1500ml'
+    assert matching.normalize_name('Coca-Cola, lata.') == 'coca cola lata'
+    assert matching.normalize_barcode(' 789-1234 ') == '7891234'
+    assert matching.normalize_barcode('') is None
+
+
+def test_similar_names_share_lsh_keys():
+    a = matching.normalize_name('Leite Integral Itambé 1L')
+    b = matching.normalize_name('Leite Itambé integral 1 litro')
+    c = matching.normalize_name('Feijão Carioca Camil 1kg')
+    assert matching.similarity('Leite Integral Itambé 1L', 'Leite Itambé integral 1 litro') > 0.8
+    assert set(matching.lsh_keys(a)) & set(matching.lsh_keys(b))
+    assert not set(matching.lsh_keys(a)) & set(matching.lsh_keys(c))
+    assert matching.lsh_keys(a) == matching.lsh_keys(a)
+    assert matching.lsh_keys('') == []
+
+def sample_image(size=(400, 300)):
+    from PIL import Image
+    image = Image.new('RGB', size)
+    for x in range(size[0]):
+        for y in range(0, size[1], 10):
+            image.putpixel((x, y), (x % 256, y % 256, 128))
+    return image
+
+def test_perceptual_hash_survives_recompression_and_resizing():
+    pytest.importorskip('PIL')
+    import io
+    original = sample_image()
+    buffer = io.BytesIO()
+    original.resize((200, 150)).save(buffer, format='JPEG', quality=60)
+    copy = images.open_image(buffer.getvalue())
+    other = sample_image().rotate(90, expand=True)
+
+    assert images.hamming_distance(images.perceptual_hash(original), images.perceptual_hash(copy)) <= 6
+    assert images.hamming_distance(images.perceptual_hash(original), images.perceptual_hash(other)) > 6
+    with pytest.raises(images.ImageError):
+        images.open_image(b'not an image')
+
+def test_thumbnails_are_webp_and_never_upscaled(tmp_path):
+    pytest.importorskip('PIL')
+    thumbs = images.thumbnails(sample_image(), sizes=(128, 640))
+
+    assert images.open_image(thumbs[128]).format == 'WEBP'
+    assert images.open_image(thumbs[128]).size == (128, 96)
+    assert images.open_image(thumbs[640]).size == (400, 300)
+
+    local = storage.LocalStorage(str(tmp_path), 'https://cdn.example/media/')
+    url = local.put('products/p1/abc/128.webp', thumbs[128], 'image/webp')
+    assert url == 'https://cdn.example/media/products/p1/abc/128.webp'
+    assert (tmp_path / 'products' / 'p1' / 'abc' / '128.webp').read_bytes() == thumbs[128]
+
+def test_local_storage_requires_a_public_url():
+    with patch.dict(os.environ, {'IMAGE_STORAGE_BACKEND': 'local'}, clear=True):
+        with pytest.raises(RuntimeError, match='IMAGE_STORAGE_PUBLIC_URL'):
+            storage.create_storage()
+    with patch.dict(os.environ, {'IMAGE_STORAGE_BACKEND': 'local', 'IMAGE_STORAGE_PUBLIC_URL': 'https://cdn/x',
+                                 'VERCEL': '1'}, clear=True):
+        with pytest.raises(RuntimeError, match='Vercel'):
+            storage.create_storage()
+    with patch.dict(os.environ, {'IMAGE_STORAGE_PUBLIC_URL': 'http://localhost:8009/'}, clear=True):
+        assert storage.create_storage().public_url == 'http://localhost:8009'
+
+def resolves_to(*addresses):
+    return patch.object(images.socket, 'getaddrinfo',
+                        return_value=[(None, None, None, '', (address, 80)) for address in addresses])
+
+def test_fetch_stops_at_max_bytes():
+    response = MagicMock(headers={}, is_redirect=False)
+    response.iter_content.return_value = [b'x' * 600, b'x' * 600]
+    with patch.object(images, 'requests') as mock_requests, resolves_to('93.184.216.34'):
+        mock_requests.get.return_value.__enter__.return_value = response
+        with pytest.raises(images.ImageError):
+            images.fetch('http://img', max_bytes=1000)
+        assert images.fetch('http://img', max_bytes=2000) == b'x' * 1200
+
+@pytest.mark.parametrize('url, address', [
+    ('file:///etc/passwd', '93.184.216.34'),
+    ('ftp://img/a.jpg', '93.184.216.34'),
+    ('http://localhost/a.jpg', '93.184.216.34'),
+    ('http://img/a.jpg', '127.0.0.1'),
+    ('http://img/a.jpg', '10.0.0.5'),
+    ('http://img/a.jpg', '169.254.169.254'),
+    ('http://img/a.jpg', '::ffff:192.168.0.1'),
+])
+def test_check_public_url_blocks_internal_hosts(url, address):
+    with resolves_to(address), pytest.raises(images.ImageError):
+        images.check_public_url(url)
+
+def test_fetch_checks_every_redirect():
+    redirect = MagicMock(headers={'Location': 'http://interno/segredo'}, is_redirect=True)
+    with patch.object(images, 'requests') as mock_requests, \
+         patch.object(images.socket, 'getaddrinfo', side_effect=lambda host, *a, **k: [
+             (None, None, None, '', ('93.184.216.34' if host == 'img' else '10.0.0.5', 80))]):
+        mock_requests.get.return_value.__enter__.return_value = redirect
+        with pytest.raises(images.ImageError):
+            images.fetch('http://img/a.jpg')
+    assert mock_requests.get.call_count == 1
+    assert mock_requests.get.call_args.kwargs['allow_redirects'] is False
+
+def test_open_image_rejects_too_many_pixels():
+    pytest.importorskip('PIL')
+    import io
+    buffer = io.BytesIO()
+    sample_image().save(buffer, format='PNG')
+    with patch.object(images, 'IMAGE_MAX_PIXELS', 1000), pytest.raises(images.ImageError):
+        images.open_image(buffer.getvalue())
+
+# --- Estrutura comum dos serviços ---
+
+@pytest.fixture
+def service_app():
+    from flask import Flask
+    app = Flask(__name__)
+    created = []
+    init_clients = service.lazy_clients(app, lambda: created.append(True))
+    readiness = service.register_probe_routes(app, lambda: {"status": "ok"})
+    verifier = MagicMock()
+    verifier.snapshot.return_value = {"cache_size": 0}
+    service.register_metrics_route(app, verifier)
+    return app, created, init_clients, readiness
+
+def test_liveness_does_not_create_clients(service_app):
+    app, created, _, _ = service_app
+    client = app.test_client()
+
+    assert client.get('/api/health/live').status_code == 200
+    assert created == []
+    assert client.get('/api/health/ready').status_code == 200
+    assert created == [True]
+
+def test_metrics_route_requires_the_cron_secret(service_app, monkeypatch):
+    app, _, _, _ = service_app
+    client = app.test_client()
+    monkeypatch.setenv('CRON_SECRET', 's3cret')
+
+    assert client.get('/internal/metrics').status_code == 401
+    assert client.get('/internal/metrics', headers={'Authorization': 'Bearer errado'}).status_code == 401
+    response = client.get('/internal/metrics', headers={'Authorization': 'Bearer s3cret'})
+    assert response.status_code == 200
+    assert response.get_json()["token_verification"] == {"cache_size": 0}
+
+def test_cron_request_is_refused_without_a_configured_secret(monkeypatch):
+    from flask import Flask
+    monkeypatch.delenv('CRON_SECRET', raising=False)
+    with Flask(__name__).test_request_context(headers={'Authorization': 'Bearer '}):
+        assert service.is_cron_request() is False
+
+def test_gunicorn_settings_read_the_environment(monkeypatch):
+    monkeypatch.setenv('PORT', '9000')
+    monkeypatch.setenv('GUNICORN_WORKERS', '3')
+    monkeypatch.setenv('GUNICORN_PRELOAD', 'false')
+
+    settings = gunicorn_config.settings(default_port='8007')
+
+    assert settings['bind'] == '0.0.0.0:9000'
+    assert settings['workers'] == 3
+    assert settings['preload_app'] is False
+    assert settings['worker_class'] == 'gthread'
@@ -0,0 +1,117 @@
+# services/common/tokens.py
+# Verificação de ID tokens do Firebase com cache. Tokens já verificados ficam em um LRU
+# limitado (chaveado pelo hash do token) até o seu 'exp', evitando repetir a verificação
+# RSA a cada requisição de uma mesma sessão. Os certificados públicos do Firebase são
+# baixados periodicamente em segundo plano, numa sessão HTTP própria (com cache), e cada
+# download entra nas métricas: uma falha do endpoint aparece antes de virar 401.
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+TOKEN_CACHE_MAX_ENTRIES = int(os.environ.get('TOKEN_CACHE_MAX_ENTRIES', 10000))
+FIREBASE_CERTS_REFRESH_SECONDS = float(os.environ.get('FIREBASE_CERTS_REFRESH_SECONDS', 600))
+FIREBASE_CERTS_URL = 'https://www.googleapis.com/robot/v1/metadata/x509/securetoken@system.gserviceaccount.com'
+FIREBASE_CERTS_TIMEOUT_SECONDS = float(os.environ.get('FIREBASE_CERTS_TIMEOUT_SECONDS', 10))
+
+
+class CachedTokenVerifier:
+    def __init__(self, verify_fn, max_entries=TOKEN_CACHE_MAX_ENTRIES, refresh_interval=FIREBASE_CERTS_REFRESH_SECONDS):
+        # verify_fn faz a verificação real (normalmente auth.verify_id_token do serviço).
+        self.verify_fn = verify_fn
+        self.max_entries = max_entries
+        self.refresh_interval = refresh_interval
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._refresher = None
+        self._certs_request = None
+        self.metrics = {
+            "cache_hits": 0,
+            "cache_misses": 0,
+            "verification_failures": 0,
+            "verification_ms_total": 0.0,
+            "certs_refreshes": 0,
+            "certs_refresh_errors": 0,
+            "certs_last_refresh": None
+        }
+
+    def verify(self, id_token):
+        key = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry and entry[1] > now:
+                self._cache.move_to_end(key)
+                self.metrics["cache_hits"] += 1
+                return dict(entry[0])
+            if entry:
+                del self._cache[key]
+            self.metrics["cache_misses"] += 1
+
+        started = time.perf_counter()
+        try:
+            decoded_token = self.verify_fn(id_token)
+        except Exception:
+            with self._lock:
+                self.metrics["verification_failures"] += 1
+            raise
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.metrics["verification_ms_total"] += elapsed_ms
+
+        expires_at = decoded_token.get('exp') if isinstance(decoded_token, dict) else None
+        if isinstance(expires_at, (int, float)) and expires_at > now:
+            with self._lock:
+                self._cache[key] = (dict(decoded_token), expires_at)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        return decoded_token
+
+    def certs_request(self):
+        """Transporte do google-auth sobre uma sessão com cache HTTP, criado no primeiro uso."""
+        if self._certs_request is None:
+            import cachecontrol
+            import requests
+            from google.auth.transport.requests import Request
+            self._certs_request = Request(session=cachecontrol.CacheControl(requests.Session()))
+        return self._certs_request
+
+    def refresh_public_keys(self):
+        """Baixa de novo os certificados públicos do Firebase, ignorando o cache."""
+        try:
+            response = self.certs_request()(FIREBASE_CERTS_URL, method='GET', headers={'Cache-Control': 'no-cache'},
+                                            timeout=FIREBASE_CERTS_TIMEOUT_SECONDS)
+            if response.status != 200:
+                raise RuntimeError(f"HTTP {response.status}")
+            with self._lock:
+                self.metrics["certs_refreshes"] += 1
+                self.metrics["certs_last_refresh"] = datetime.now(timezone.utc).isoformat()
+        except Exception as e:
+            with self._lock:
+                self.metrics["certs_refresh_errors"] += 1
+            print(f"Erro ao atualizar certificados do Firebase: {e}")
+
+    def start_key_refresher(self):
+        if self._refresher and self._refresher.is_alive():
+            return
+
+        def refresh_loop():
+            while True:
+                self.refresh_public_keys()
+                time.sleep(self.refresh_interval)
+
+        self._refresher = threading.Thread(target=refresh_loop, name='firebase-certs-refresher', daemon=True)
+        self._refresher.start()
+
+    def snapshot(self):
+        with self._lock:
+            metrics = dict(self.metrics)
+            metrics["cache_size"] = len(self._cache)
+        verifications = metrics["cache_misses"]
+        metrics["verification_ms_avg"] = round(metrics["verification_ms_total"] / verifications, 3) if verifications else 0.0
+        metrics["verification_ms_total"] = round(metrics["verification_ms_total"], 3)
+        return metrics
@@ -0,0 +1,36 @@
+# services/common/workers.py
+# Laço dos processos de fundo dos serviços (worker.py): relay da outbox e consumidores
+# de eventos. No Vercel os mesmos passos são chamados pelo cron, uma vez por execução.
+import os
+import time
+
+WORKER_IDLE_SECONDS = float(os.environ.get('WORKER_IDLE_SECONDS', 0.5))
+
+
+def run_forever(steps, idle_seconds=WORKER_IDLE_SECONDS):
+    """Executa cada passo (que devolve quanto trabalho fez) e dorme um pouco quando
+    nenhum encontrou nada para fazer. Erros são registrados e o laço continua."""
+    while True:
+        busy = False
+        for step in steps:
+            try:
+                busy = bool(step()) or busy
+            except Exception as e:
+                print(f"Erro em {getattr(step, '__name__', step)}: {e}")
+        if not busy:
+            time.sleep(idle_seconds)
+
+
+def every(seconds, step):
+    """Passo que só executa step a cada `seconds` segundos (ex.: sweepers periódicos)."""
+    state = {"next_run": 0.0}
+
+    def periodic_step():
+        now = time.monotonic()
+        if now < state["next_run"]:
+            return 0
+        state["next_run"] = now + seconds
+        return step()
+
+    periodic_step.__name__ = getattr(step, '__name__', 'periodic_step')
+    return periodic_step
@@ -0,0 +1,91 @@
+# services/measure_import_time.py
+# Mede o tempo de importação de cada serviço (o custo que um cold start no Vercel paga
+# antes da primeira requisição). Cada medição roda em um processo Python novo, a partir
+# da pasta do serviço, como o runtime faz.
+#
+#     python services/measure_import_time.py                      # todos os serviços
+#     python services/measure_import_time.py servico-produtos -n 10 --top 15
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+SERVICES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_SERVICES = [
+    'servico-usuarios',
+    'servico-busca',
+    'servico-monitoramento',
+    'servico-lojas',
+    'servico-ofertas',
+    'servico-produtos',
+    'servico-healthcheck',
+]
+
+IMPORT_SNIPPET = (
+    "import time; start = time.perf_counter(); "
+    "from api import index; "
+    "print('IMPORT_MS', (time.perf_counter() - start) * 1000)"
+)
+
+
+def measure_once(service_dir):
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', IMPORT_SNIPPET],
+        cwd=service_dir,
+        capture_output=True,
+        text=True,
+        errors='replace',
+    )
+    import_ms = None
+    for line in result.stdout.splitlines():
+        if line.startswith('IMPORT_MS'):
+            import_ms = float(line.split()[1])
+    # Formato do -X importtime: "import time: self [us] | cumulative | imported package".
+    # Os filhos aparecem antes do pai, com dois espaços a mais de indentação.
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = len(name) - len(name.lstrip(' '))
+        entries.append((depth, int(cumulative) / 1000, name.strip()))
+    modules = []
+    for i, (depth, _, name) in enumerate(entries):
+        if name != 'api.index':
+            continue
+        # Só os imports feitos diretamente pelo módulo da API.
+        for child_depth, cumulative_ms, child in reversed(entries[:i]):
+            if child_depth <= depth:
+                break
+            if child_depth == depth + 2:
+                modules.append((cumulative_ms, child))
+    if import_ms is None:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'falha na importação')
+    return import_ms, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mede o tempo de importação dos serviços.")
+    parser.add_argument('services', nargs='*', default=DEFAULT_SERVICES)
+    parser.add_argument('-n', '--runs', type=int, default=5, help="Execuções por serviço (padrão: 5).")
+    parser.add_argument('--top', type=int, default=5, help="Imports mais caros a listar (padrão: 5).")
+    args = parser.parse_args()
+
+    for service in args.services:
+        service_dir = os.path.join(SERVICES_DIR, service)
+        try:
+            runs = [measure_once(service_dir) for _ in range(args.runs)]
+        except RuntimeError as e:
+            print(f"{service}: erro ao importar ({e})")
+            continue
+        timings = [import_ms for import_ms, _ in runs]
+        print(f"{service}: mediana {statistics.median(timings):.1f} ms "
+              f"(min {min(timings):.1f}, max {max(timings):.1f}, n={len(timings)})")
+        for cumulative_ms, name in sorted(runs[-1][1], reverse=True)[:args.top]:
+            print(f"    {cumulative_ms:8.1f} ms  {name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+# --- Shared package (services/common) ---
+# It lives in the service's parent folder, both in the repository and in the Docker image,
+# and is used by the API (health) and by the workers (image hashes).
+import os
+import sys
+
+SERVICE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+for common_parent in (os.path.dirname(SERVICE_ROOT), SERVICE_ROOT):
+    if os.path.isdir(os.path.join(common_parent, 'common')) and common_parent not in sys.path:
+        sys.path.insert(0, common_parent)
@@ -0,0 +1,29 @@
+import os
+from celery import Celery
+from kombu import Queue
+
+# --- Celery Configuration ---
+# Shared by the API, which only enqueues tasks by name, and by the workers in
+# celery_worker.py, which own the models. Importing this module loads no model.
+# The broker URL is taken from the environment variable set in docker-compose.yml
+celery_app = Celery(
+    'tasks',
+    broker=os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
+    backend=os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+)
+
+# Interactive requests (consumer image search) and bulk jobs (admin catalog feeding) go
+# to separate queues, consumed by separate workers, so a search never waits behind a
+# catalog import.
+QUEUE_INTERACTIVE = "ia_interativa"
+QUEUE_BULK = "ia_lote"
+PROCESS_PRODUCT_IMAGE = "process_product_image"
+
+celery_app.conf.task_queues = (Queue(QUEUE_INTERACTIVE), Queue(QUEUE_BULK))
+celery_app.conf.task_default_queue = QUEUE_BULK
+
+def enqueue_product_image(model_input: bytes, cache_keys: dict, queue: str = QUEUE_BULK):
+    """Sends an image to the vision workers. Returns the AsyncResult of the task."""
+    return celery_app.send_task(
+        PROCESS_PRODUCT_IMAGE, args=[model_input], kwargs={"cache_keys": cache_keys}, queue=queue
+    )
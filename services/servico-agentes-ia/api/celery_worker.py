@@ -1,46 +1,104 @@
 import os
-from celery import Celery
+import time
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from celery.signals import task_failure, task_success, worker_process_init, worker_process_shutdown
 from llama_cpp import Llama
-from llama_cpp.llama_chat_format import MoondreamChatFormat
+from llama_cpp.llama_chat_format import Llava15ChatHandler
 import instructor
 import cv2
 import numpy as np
-import base64
+from common import kafka
+from . import result_cache, task_events
+from .celery_app import celery_app, PROCESS_PRODUCT_IMAGE
 from .schemas import ProductData
 
-# --- Celery Configuration ---
-# The broker URL is taken from the environment variable set in docker-compose.yml
-celery_app = Celery(
-    'tasks',
-    broker=os.environ.get("REDIS_URL", "redis://localhost:6379/0"),
-    backend=os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+# --- Model processes ---
+# Each of the VISION_PROCESSES worker processes owns one model instance, loaded when the
+# process starts (never in the parent before the fork, nor in the API). The weights are
+# mmap'd, so the processes share the same page-cache copy of the GGUF file, and the CPU
+# cores are split between them through n_threads.
+# Start one worker per queue (see docker-compose.yml):
+#     celery -A api.celery_worker worker -Q ia_interativa
+#     celery -A api.celery_worker worker -Q ia_lote
+VISION_PROCESSES = int(os.environ.get("VISION_PROCESSES", 1))
+VISION_THREADS_PER_PROCESS = int(os.environ.get("N_THREADS", max(1, (os.cpu_count() or 1) // VISION_PROCESSES)))
+celery_app.conf.worker_concurrency = VISION_PROCESSES
+# A process takes a new task only when it is free, and the message is acknowledged after
+# the inference, so tasks of a process that dies go back to the queue.
+celery_app.conf.worker_prefetch_multiplier = 1
+celery_app.conf.task_acks_late = True
+
+# --- Batching ---
+# With VISION_BATCH_SIZE > 1 the worker collects up to that many queued images (or
+# whatever arrived within VISION_BATCH_WAIT_MS), preprocesses them in parallel threads
+# and runs the completions back to back on the already loaded model.
+VISION_BATCH_SIZE = int(os.environ.get("VISION_BATCH_SIZE", 1))
+VISION_BATCH_WAIT_MS = int(os.environ.get("VISION_BATCH_WAIT_MS", 250))
+VISION_PREPROCESS_THREADS = int(os.environ.get("VISION_PREPROCESS_THREADS", 4))
+MODEL_INPUT_SIZE = (336, 336)
+
+if VISION_BATCH_SIZE > 1:
+    # Batches holds the messages until the batch is flushed, so the worker must be allowed
+    # to prefetch at least a full batch.
+    celery_app.conf.worker_prefetch_multiplier = VISION_BATCH_SIZE
+
+# The instructions are the same for every image, so they go in the system message: the
+# rendered prompt then starts with an identical prefix and only the image and the short
+# user turn change between requests.
+SYSTEM_PROMPT = (
+    "You are an expert product cataloger. Analyze the image of a product "
+    "and generate the structured data based on the Pydantic schema. "
+    "Provide a concise, SEO-friendly product name, a standard high-level category, "
+    "a detailed description of at least 50 words, and a list of 3-5 key features."
 )
+USER_PROMPT = "Catalog this product."
+
+
+class InMemoryLlava15ChatHandler(Llava15ChatHandler):
+    """
+    Resolves mem://<key> image URLs from an in-process buffer table, so preprocessed
+    images reach the CLIP encoder as raw bytes instead of a base64 data URI.
+    """
+    buffers = {}
+
+    def load_image(self, image_url: str) -> bytes:
+        if image_url.startswith("mem://"):
+            return self.buffers[image_url[len("mem://"):]]
+        return super().load_image(image_url)
+
 
 # --- Global Model Variable ---
-# This dictionary will hold the loaded models. Loading happens once when the worker starts.
+# This dictionary will hold the loaded models of this process.
 models = {}
+models_lock = threading.Lock()
 
 def load_models():
     """
     Loads the LLM and VLM models into memory.
-    This function is called once when the Celery worker process starts.
+    This function is called once in each worker process, when it starts.
     """
-    print("Loading models into memory...")
-    
-    # Configure and load the Vision-Language-Model (BakLLaVA)
+    print(f"Loading models into memory (pid {os.getpid()}, {VISION_THREADS_PER_PROCESS} threads)...")
+
+    # Configure and load the Vision-Language-Model (BakLLaVA, a LLaVA 1.5 model)
     # The projector file (mmproj) is crucial for the vision capabilities.
-    chat_handler = MoondreamChatFormat.from_gguf(
-        mmproj_path="/app/models/mmproj-model-f16.gguf"
+    chat_handler = InMemoryLlava15ChatHandler(
+        clip_model_path="/app/models/mmproj-model-f16.gguf",
+        verbose=False
     )
-    
+
     models['vision_llm'] = Llama(
         model_path="/app/models/bakllava-1-7b.Q4_K_M.gguf",
         chat_handler=chat_handler,
         n_ctx=2048,
-        n_threads=int(os.environ.get("N_THREADS", 6)),
-        n_gpu_layers=int(os.environ.get("N_GPU_LAYERS", 0)) # 0 for CPU-only
+        n_threads=VISION_THREADS_PER_PROCESS,
+        n_gpu_layers=int(os.environ.get("N_GPU_LAYERS", 0)), # 0 for CPU-only
+        use_mmap=True,
+        use_mlock=os.environ.get("VISION_MLOCK", "false").lower() == "true"
     )
-    
+    models['chat_handler'] = chat_handler
+
     # Patch the client to enable structured output with Pydantic
     models['patched_vision_client'] = instructor.patch(
         client=models['vision_llm'],
@@ -48,70 +106,128 @@ def load_models():
     )
     print("Models loaded successfully.")
 
-# Load models when the worker starts
-load_models()
+def get_vision_client():
+    # Pools without child processes (solo, threads) don't send worker_process_init.
+    with models_lock:
+        if 'patched_vision_client' not in models:
+            load_models()
+    return models['patched_vision_client']
 
-@celery_app.task(name='process_product_image')
-def process_product_image(image_path: str) -> dict:
+@worker_process_init.connect
+def load_models_on_process_start(**kwargs):
+    # Warm the model before the process takes its first task.
+    get_vision_client()
+
+@worker_process_shutdown.connect
+def flush_result_events(**kwargs):
+    kafka.shutdown()
+
+def preprocess_image(image_bytes: bytes) -> bytes:
     """
-    Celery task to process a product image and generate structured data.
+    Decodes the image sent by the API (already reduced to the model input size) into an
+    uncompressed BMP: the encoder reads it without the cost (and the artifacts) of
+    another JPEG round trip.
     """
+    image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode the image.")
+    if (image.shape[1], image.shape[0]) != MODEL_INPUT_SIZE:
+        image = cv2.resize(image, MODEL_INPUT_SIZE, interpolation=cv2.INTER_AREA)
+    ok, buffer = cv2.imencode('.bmp', image)
+    if not ok:
+        raise ValueError("Could not encode the resized image.")
+    return buffer.tobytes()
+
+def run_inference(image_bytes: bytes) -> dict:
+    client = get_vision_client()
+    key = uuid.uuid4().hex
+    buffers = models['chat_handler'].buffers
+    buffers[key] = image_bytes
     try:
-        print(f"Processing image at path: {image_path}")
-        
-        # 1. Pre-process the image using OpenCV
-        image = cv2.imread(image_path)
-        if image is None:
-            raise ValueError("Could not read image from path.")
-            
-        # Example pre-processing: resize
-        # A real implementation would have more steps as per the plan (normalization, etc.)
-        image = cv2.resize(image, (336, 336))
-        
-        # Convert to base64 to pass to the model
-        _, buffer = cv2.imencode('.jpg', image)
-        image_b64 = base64.b64encode(buffer).decode('utf-8')
-        
-        # 2. Run inference using the loaded and patched model
-        client = models.get('patched_vision_client')
-        if not client:
-            raise RuntimeError("Vision model is not loaded.")
-
-        prompt = (
-            "You are an expert product cataloger. Analyze the following image of a product "
-            "and generate the structured data based on the Pydantic schema. "
-            "Provide a concise, SEO-friendly product name, a standard high-level category, "
-            "a detailed description of at least 50 words, and a list of 3-5 key features."
-        )
-        
         response = client.chat.completions.create(
             response_model=ProductData,
             messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
                 {
                     "role": "user",
                     "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_b64}"
-                            },
-                        },
+                        {"type": "image_url", "image_url": {"url": f"mem://{key}"}},
+                        {"type": "text", "text": USER_PROMPT},
                     ],
                 }
             ],
             max_retries=3, # Use instructor's retry mechanism
         )
-        
-        print("Inference successful. Cleaning up image file.")
-        os.remove(image_path) # Clean up the uploaded file
-        
-        return response.model_dump()
+    finally:
+        buffers.pop(key, None)
+    return response.model_dump()
 
+def cache_result(cache_keys, result: dict):
+    try:
+        result_cache.store(cache_keys, result)
     except Exception as e:
-        print(f"An error occurred in the Celery task: {e}")
-        # Clean up the file even if an error occurs
-        if os.path.exists(image_path):
-            os.remove(image_path)
-        # Re-raise the exception so Celery marks the task as FAILED
-        raise e
+        print(f"Could not cache the inference result: {e}")
+
+def process_images(images: list, cache_keys: list) -> list:
+    """
+    Preprocesses the images in parallel threads (OpenCV releases the GIL) and runs the
+    inferences one after the other as soon as each image is ready. Returns, for each image,
+    either the result dict or the exception raised for it.
+    """
+    started = time.perf_counter()
+    outcomes = []
+    with ThreadPoolExecutor(max_workers=max(1, min(VISION_PREPROCESS_THREADS, len(images)))) as pool:
+        futures = [pool.submit(preprocess_image, image_bytes) for image_bytes in images]
+        for position, (keys, future) in enumerate(zip(cache_keys, futures)):
+            try:
+                outcomes.append(run_inference(future.result()))
+                cache_result(keys, outcomes[-1])
+            except Exception as e:
+                print(f"An error occurred processing image {position + 1}/{len(images)}: {e}")
+                outcomes.append(e)
+    elapsed = max(time.perf_counter() - started, 1e-6)
+    print(f"Processed {len(images)} image(s) in {elapsed:.1f}s "
+          f"({len(images) * 60 / elapsed:.1f} images/min).")
+    return outcomes
+
+if VISION_BATCH_SIZE > 1:
+    from celery_batches import Batches
+
+    @celery_app.task(name=PROCESS_PRODUCT_IMAGE, base=Batches,
+                     flush_every=VISION_BATCH_SIZE, flush_interval=VISION_BATCH_WAIT_MS / 1000)
+    def process_product_image(requests):
+        """
+        Batched variant: receives every request collected for the batch and stores each
+        result (or failure) under its own task id.
+        """
+        outcomes = process_images([request.args[0] for request in requests],
+                                  [request.kwargs.get('cache_keys') for request in requests])
+        for request, outcome in zip(requests, outcomes):
+            # Stored before it is pushed: a client that subscribes late finds it in the backend.
+            if isinstance(outcome, Exception):
+                celery_app.backend.mark_as_failure(request.id, outcome, request=request)
+                task_events.publish_result(request.id, "FAILURE", error=str(outcome))
+            else:
+                celery_app.backend.mark_as_done(request.id, outcome, request=request)
+                task_events.publish_result(request.id, "SUCCESS", result=outcome)
+else:
+    @celery_app.task(name=PROCESS_PRODUCT_IMAGE)
+    def process_product_image(image_bytes: bytes, cache_keys: dict = None) -> dict:
+        """
+        Celery task to process a product image and generate structured data.
+        """
+        print(f"Processing image ({len(image_bytes)} bytes)")
+        outcome = process_images([image_bytes], [cache_keys])[0]
+        if isinstance(outcome, Exception):
+            # Re-raise the exception so Celery marks the task as FAILED
+            raise outcome
+        return outcome
+
+    # Celery sends these after storing the result in the backend.
+    @task_success.connect(sender=process_product_image)
+    def publish_success(sender=None, result=None, **kwargs):
+        task_events.publish_result(sender.request.id, "SUCCESS", result=result)
+
+    @task_failure.connect(sender=process_product_image)
+    def publish_failure(sender=None, task_id=None, exception=None, **kwargs):
+        task_events.publish_result(task_id, "FAILURE", error=str(exception))
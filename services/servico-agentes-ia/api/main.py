@@ -1,20 +1,34 @@
+import json
 import os
+import time
 import uuid
-import shutil
-from pathlib import Path
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, File, UploadFile, HTTPException, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from celery.result import AsyncResult
+import redis
+import redis.asyncio as aioredis
 
-from .celery_worker import process_product_image
+# services/common is put on sys.path by api/__init__.py.
+from common import health
+
+from . import preprocessing, result_cache, task_events
+from .celery_app import celery_app, enqueue_product_image, QUEUE_BULK, QUEUE_INTERACTIVE
 from .schemas import TaskTicket, TaskStatus
 
 # --- FastAPI App Initialization ---
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await close_task_events_redis()
+
 app = FastAPI(
     title="Serviço de Agentes de IA",
     description="API para processamento de catálogo de produtos com LLM local.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
 )
 
 # --- CORS Configuration ---
@@ -27,70 +41,266 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# --- Directory for Uploads ---
-# This path must be a shared volume in Docker
-UPLOAD_DIR = Path("/app/uploads")
-UPLOAD_DIR.mkdir(exist_ok=True)
+# --- Upload limits ---
+# Uploads are read in chunks and rejected past UPLOAD_MAX_BYTES. The middleware refuses
+# oversized requests from their Content-Length before the multipart body is parsed, and
+# stops bodies without one once they pass the limit.
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 10 * 1024 * 1024))
+UPLOAD_CHUNK_BYTES = 256 * 1024
+UPLOAD_PATHS = ("/api/agents/catalog-intake", "/api/agents/image-search")
+
+class UploadTooLarge(Exception):
+    pass
+
+class UploadSizeLimitMiddleware:
+    def __init__(self, app, max_bytes: int, paths: tuple):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_bytes:
+            await self.reject(scope, receive, send)
+            return
+
+        received = 0
+        too_large = False
+        response_started = False
+
+        async def limited_receive():
+            nonlocal received, too_large
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    too_large = True
+                    raise UploadTooLarge()
+            return message
+
+        async def guarded_send(message):
+            nonlocal response_started
+            # The form parser turns the interrupted body into a 400: that answer is dropped
+            # and replaced by the 413 below.
+            if too_large:
+                return
+            response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if not too_large:
+                raise
+        if too_large and not response_started:
+            await self.reject(scope, receive, send)
+
+    async def reject(self, scope, receive, send):
+        response = JSONResponse(status_code=413, content={"detail": f"Upload larger than {self.max_bytes} bytes."})
+        await response(scope, receive, send)
+
+app.add_middleware(UploadSizeLimitMiddleware, max_bytes=UPLOAD_MAX_BYTES, paths=UPLOAD_PATHS)
+
+async def read_upload(file: UploadFile) -> bytes:
+    chunks = []
+    size = 0
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > UPLOAD_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"Upload larger than {UPLOAD_MAX_BYTES} bytes.")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+def prepare_upload(content: bytes):
+    """Decodes the upload once: cache keys and the model input bytes for the worker."""
+    image = preprocessing.decode_image(content)
+    return result_cache.compute_keys(content, image), preprocessing.to_model_input(image)
 
 # --- API Endpoints ---
 
-@app.post("/api/agents/catalog-intake", response_model=TaskTicket, status_code=202)
-async def catalog_intake(file: UploadFile = File(...)):
+async def submit_image(file: UploadFile, queue: str):
     """
-    Accepts a product image, saves it, and dispatches a processing task to Celery.
+    Dispatches a processing task for the uploaded image to the given queue, unless the
+    same image (or a near-duplicate) was already processed: then the cached result is
+    returned as an already finished task.
     """
     try:
-        # Generate a unique filename to avoid collisions
-        file_extension = Path(file.filename).suffix
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = UPLOAD_DIR / unique_filename
+        content = await read_upload(file)
+        try:
+            cache_keys, model_input = await run_in_threadpool(prepare_upload, content)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
-        # Save the uploaded file to the shared volume
-        with file_path.open("wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        try:
+            cached = await run_in_threadpool(result_cache.lookup, cache_keys)
+        except Exception as e:
+            print(f"Inference cache lookup failed: {e}")
+            cached = None
+        if cached is not None:
+            # Stored in the result backend too, so task-status answers for this id.
+            task_id = str(uuid.uuid4())
+            await run_in_threadpool(celery_app.backend.store_result, task_id, cached, "SUCCESS")
+            await run_in_threadpool(task_events.publish_result, task_id, "SUCCESS", cached, None, True)
+            return JSONResponse(status_code=200, content={
+                "task_id": task_id, "status": "SUCCESS", "result": cached, "cached": True
+            })
 
-        # Dispatch the task to the Celery worker, passing the file path
-        task = process_product_image.delay(str(file_path))
+        # The 336x336 JPEG travels in the task message itself (kombu encodes bytes), so
+        # the worker needs no shared volume.
+        task = await run_in_threadpool(enqueue_product_image, model_input, cache_keys, queue)
 
         return {"task_id": task.id, "status": "PENDING"}
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to process file: {str(e)}")
 
 
+# 202 with a PENDING ticket when the task is queued; 200 with the result when it was cached.
+TICKET_RESPONSES = {200: {"model": TaskTicket, "description": "Cached result, returned as an already finished task."}}
+
+@app.post("/api/agents/catalog-intake", response_model=TaskTicket, status_code=202, responses=TICKET_RESPONSES)
+async def catalog_intake(file: UploadFile = File(...)):
+    """
+    Admin catalog feeding: the image goes to the bulk queue.
+    """
+    return await submit_image(file, QUEUE_BULK)
+
+
+@app.post("/api/agents/image-search", response_model=TaskTicket, status_code=202, responses=TICKET_RESPONSES)
+async def image_search(file: UploadFile = File(...)):
+    """
+    Consumer image search: same processing as catalog-intake, on the high-priority queue.
+    """
+    return await submit_image(file, QUEUE_INTERACTIVE)
+
+
+def read_task_status(task_id: str) -> dict:
+    task_result = AsyncResult(task_id, app=celery_app)
+
+    if task_result.ready():
+        if task_result.successful():
+            return task_events.status_payload(task_id, "SUCCESS", result=task_result.result)
+        # The result of a failed task is the exception that was raised
+        return task_events.status_payload(task_id, "FAILURE", error=str(task_result.result))
+    return task_events.status_payload(task_id, "PENDING")
+
+
 @app.get("/api/agents/task-status/{task_id}", response_model=TaskStatus)
 async def get_task_status(task_id: str):
     """
     Checks the status of a Celery task.
     """
-    task_result = AsyncResult(task_id)
+    return await run_in_threadpool(read_task_status, task_id)
 
-    if task_result.ready():
-        if task_result.successful():
-            return {
-                "task_id": task_id,
-                "status": "SUCCESS",
-                "result": task_result.result,
-                "error": None
-            }
-        else:
-            # The result of a failed task is the exception that was raised
-            error_info = str(task_result.result)
-            return {
-                "task_id": task_id,
-                "status": "FAILURE",
-                "result": None,
-                "error": error_info
-            }
-    else:
-        return {
-            "task_id": task_id,
-            "status": "PENDING",
-            "result": None,
-            "error": None
-        }
+
+# --- Pushed task results ---
+# Server-Sent Events: the client opens one request and receives the final status once,
+# as a "result" event with the task-status body. Comments keep the connection alive
+# while the task runs; after TASK_EVENTS_TIMEOUT_SECONDS a "timeout" event is sent and
+# the client may reconnect or fall back to task-status.
+#
+# All streams share one async Redis client; each stream only opens its own pubsub, which
+# holds one connection of the shared pool while it is subscribed. The pool is capped at
+# TASK_EVENTS_MAX_CONNECTIONS: past it a new stream fails and the client polls task-status.
+TASK_EVENTS_TIMEOUT_SECONDS = float(os.environ.get("TASK_EVENTS_TIMEOUT_SECONDS", 600))
+TASK_EVENTS_KEEPALIVE_SECONDS = 15.0
+TASK_EVENTS_MAX_CONNECTIONS = int(os.environ.get("TASK_EVENTS_MAX_CONNECTIONS", 500))
+task_events_redis = {"client": None}
+
+def get_task_events_redis() -> aioredis.Redis:
+    # Created on first use, inside the event loop; closed by the app's lifespan.
+    if task_events_redis["client"] is None:
+        task_events_redis["client"] = aioredis.Redis.from_url(
+            os.environ.get("REDIS_URL", "redis://localhost:6379/0"), max_connections=TASK_EVENTS_MAX_CONNECTIONS
+        )
+    return task_events_redis["client"]
+
+async def close_task_events_redis():
+    client, task_events_redis["client"] = task_events_redis["client"], None
+    if client is not None:
+        await client.aclose()
+
+def sse_message(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+async def wait_for_result(pubsub, task_id: str):
+    """Yields keep-alive comments until the task's message arrives, then the SSE message."""
+    deadline = time.monotonic() + TASK_EVENTS_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        message = await pubsub.get_message(
+            ignore_subscribe_messages=True,
+            timeout=min(TASK_EVENTS_KEEPALIVE_SECONDS, max(deadline - time.monotonic(), 0.0)),
+        )
+        if message and message["type"] == "message":
+            yield sse_message("result", json.loads(message["data"]))
+            return
+        yield ": keep-alive\n\n"
+    yield sse_message("timeout", task_events.status_payload(task_id, "PENDING"))
+
+@app.get("/api/agents/task-events/{task_id}")
+async def stream_task_result(task_id: str):
+    """
+    Pushes the final status of a task (Server-Sent Events) instead of being polled.
+    """
+    async def events():
+        pubsub = get_task_events_redis().pubsub()
+        try:
+            await pubsub.subscribe(task_events.channel(task_id))
+            # Checked after subscribing: a task that finished before the subscription is
+            # already in the backend, and one that finishes later is published to us.
+            status = await run_in_threadpool(read_task_status, task_id)
+            if status["status"] != "PENDING":
+                yield sse_message("result", status)
+                return
+            async for message in wait_for_result(pubsub, task_id):
+                yield message
+        finally:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.get("/api/health")
 def health_check():
     # A simple health check for the API itself
     return {"status": "ok"}
+
+# --- Liveness / Readiness ---
+# Readiness pings the Redis broker through common.health.ReadinessProbe, the same memoized
+# probe (and response shape) as the Flask services.
+def get_health_status() -> dict:
+    redis_error, redis_latency = health.timed_check(
+        lambda: redis.Redis.from_url(os.environ.get("REDIS_URL", "redis://localhost:6379/0"), socket_timeout=2).ping())
+    return {
+        "environment_variables": health.env_var_status(["REDIS_URL"]),
+        "dependencies": {"redis": "ok" if redis_error is None else "error"},
+        "initialization_errors": {"redis": redis_error},
+        "latencies_ms": {"redis": redis_latency},
+    }
+
+def build_readiness_status() -> dict:
+    status = get_health_status()
+    # REDIS_URL falls back to localhost, so only the ping decides readiness.
+    status["status"] = "ok" if status["dependencies"]["redis"] == "ok" else "degraded"
+    return status
+
+readiness = health.ReadinessProbe(build_readiness_status)
+
+@app.get("/api/health/live")
+def liveness_check():
+    # Process is up; no I/O performed
+    return {"status": "ok"}
+
+@app.get("/api/health/ready")
+def readiness_check():
+    status = readiness.get_status()
+    return JSONResponse(content=status, status_code=200 if status["status"] == "ok" else 503)
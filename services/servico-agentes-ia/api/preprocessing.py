@@ -0,0 +1,28 @@
+import io
+
+from PIL import Image, ImageOps
+
+# --- Upload preprocessing at the API edge ---
+# The model only ever sees MODEL_INPUT_SIZE pixels, so uploads are decoded once here,
+# oriented by their EXIF tag and reduced to the model input before being queued: the
+# Celery message carries a few tens of KB instead of the original photo.
+MODEL_INPUT_SIZE = (336, 336)
+MODEL_INPUT_QUALITY = 95
+
+def decode_image(content: bytes) -> Image.Image:
+    """Raises ValueError if the bytes are not an image."""
+    try:
+        image = Image.open(io.BytesIO(content))
+        # draft() lets the JPEG decoder skip most of the work for large photos.
+        image.draft("RGB", (MODEL_INPUT_SIZE[0] * 2, MODEL_INPUT_SIZE[1] * 2))
+        image.load()
+    except Exception as e:
+        raise ValueError(f"Uploaded file is not a valid image: {e}") from e
+    return ImageOps.exif_transpose(image)
+
+def to_model_input(image: Image.Image) -> bytes:
+    """The image resized to the model input (same stretch the worker used to apply), as JPEG."""
+    resized = image.convert("RGB").resize(MODEL_INPUT_SIZE, Image.LANCZOS)
+    buffer = io.BytesIO()
+    resized.save(buffer, format="JPEG", quality=MODEL_INPUT_QUALITY)
+    return buffer.getvalue()
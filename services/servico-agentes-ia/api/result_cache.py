@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+import redis
+from PIL import Image
+
+from common.images import content_hash, hamming_distance, perceptual_hash
+
+# --- Content-addressed cache of inference results ---
+# Uploads are keyed by the SHA-256 of their bytes (exact re-uploads) and by a 64-bit
+# perceptual hash (dHash, from common.images) for near-duplicates: the same photo recompressed, resized or
+# re-shot by the app. The perceptual hash is split into bands; two hashes within
+# PHASH_MAX_DISTANCE bits share at least one band (pigeonhole), so a lookup only compares
+# the hashes stored under the query's bands.
+#
+# Keys:
+#   ia:cache:result:<sha256>     ProductData JSON, expires after CACHE_TTL_SECONDS
+#   ia:cache:phash:<phash>       sha256 of the upload that produced it, same TTL
+#   ia:cache:band:<i>:<bits>     set of phashes with those bits in band i
+#   ia:cache:index               sorted set "<sha256>:<phash>" -> stored_at
+# The band sets have no TTL: store() removes an entry from them when the entry is evicted
+# (beyond CACHE_MAX_ENTRIES) or has expired, using the index to find it.
+CACHE_TTL_SECONDS = int(os.environ.get("INFERENCE_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+CACHE_MAX_ENTRIES = int(os.environ.get("INFERENCE_CACHE_MAX_ENTRIES", 10000)) # 0 disables the cache
+CACHE_MAX_RESULT_BYTES = int(os.environ.get("INFERENCE_CACHE_MAX_RESULT_BYTES", 16 * 1024))
+PHASH_MAX_DISTANCE = int(os.environ.get("INFERENCE_CACHE_PHASH_MAX_DISTANCE", 4))
+PHASH_BANDS = 8
+KEY_PREFIX = "ia:cache"
+
+_client_lock = threading.Lock()
+_client = {"redis": None}
+
+def get_redis() -> redis.Redis:
+    with _client_lock:
+        if _client["redis"] is None:
+            _client["redis"] = redis.Redis.from_url(
+                os.environ.get("REDIS_URL", "redis://localhost:6379/0"), socket_timeout=2
+            )
+        return _client["redis"]
+
+def band_keys(phash: str) -> list:
+    width = 16 // PHASH_BANDS
+    return [f"{KEY_PREFIX}:band:{i}:{phash[i * width:(i + 1) * width]}" for i in range(PHASH_BANDS)]
+
+def compute_keys(content: bytes, image: Image.Image) -> dict:
+    """Cache keys of an upload: hash of the original bytes and of the decoded image."""
+    return {"sha256": content_hash(content), "phash": perceptual_hash(image)}
+
+def lookup(keys: dict) -> Optional[dict]:
+    """Cached result for an exact or near-duplicate upload, or None."""
+    if CACHE_MAX_ENTRIES <= 0:
+        return None
+    client = get_redis()
+    cached = client.get(f"{KEY_PREFIX}:result:{keys['sha256']}")
+    if cached is None:
+        candidates = client.sunion(band_keys(keys["phash"]))
+        near = sorted(
+            (hamming_distance(keys["phash"], candidate.decode()), candidate.decode())
+            for candidate in candidates
+        )
+        for distance, phash in near:
+            if distance > PHASH_MAX_DISTANCE:
+                break
+            sha256 = client.get(f"{KEY_PREFIX}:phash:{phash}")
+            cached = sha256 and client.get(f"{KEY_PREFIX}:result:{sha256.decode()}")
+            if cached:
+                break
+    return json.loads(cached) if cached else None
+
+def store(keys: dict, result: dict):
+    """Caches a result and evicts the expired entries and the oldest beyond CACHE_MAX_ENTRIES."""
+    if CACHE_MAX_ENTRIES <= 0 or not keys:
+        return
+    payload = json.dumps(result)
+    if len(payload) > CACHE_MAX_RESULT_BYTES:
+        return
+    client = get_redis()
+    now = time.time()
+    pipe = client.pipeline()
+    pipe.set(f"{KEY_PREFIX}:result:{keys['sha256']}", payload, ex=CACHE_TTL_SECONDS)
+    pipe.set(f"{KEY_PREFIX}:phash:{keys['phash']}", keys["sha256"], ex=CACHE_TTL_SECONDS)
+    for band_key in band_keys(keys["phash"]):
+        pipe.sadd(band_key, keys["phash"])
+    pipe.zadd(f"{KEY_PREFIX}:index", {f"{keys['sha256']}:{keys['phash']}": now})
+    pipe.execute()
+
+    # The oldest entries are the expired ones, so a single pop covers both.
+    expired = client.zcount(f"{KEY_PREFIX}:index", "-inf", now - CACHE_TTL_SECONDS)
+    excess = client.zcard(f"{KEY_PREFIX}:index") - CACHE_MAX_ENTRIES
+    if max(expired, excess) > 0:
+        evict(client, [member.decode() for member, _ in client.zpopmin(f"{KEY_PREFIX}:index", max(expired, excess))])
+
+def evict(client, members: list):
+    """Deletes the entries popped from the index, and their phash from the band sets."""
+    if not members:
+        return
+    entries = [member.partition(":")[::2] for member in members]
+    owners = client.mget([f"{KEY_PREFIX}:phash:{phash}" for _, phash in entries])
+    pipe = client.pipeline()
+    for (sha256, phash), owner in zip(entries, owners):
+        pipe.delete(f"{KEY_PREFIX}:result:{sha256}")
+        # A later upload with the same perceptual hash may own the phash key by now.
+        if phash and (owner is None or owner.decode() == sha256):
+            pipe.delete(f"{KEY_PREFIX}:phash:{phash}")
+            for band_key in band_keys(phash):
+                pipe.srem(band_key, phash)
+    pipe.execute()
@@ -16,6 +16,8 @@ class TaskTicket(BaseModel):
     """
     task_id: str
     status: str = "PENDING"
+    result: Optional[ProductData] = None
+    cached: bool = False
 
 class TaskStatus(BaseModel):
     """
@@ -0,0 +1,63 @@
+import json
+import os
+import threading
+
+import redis
+
+from common import events, kafka
+
+# --- Task completion events ---
+# When a task finishes, the worker pushes its final status once:
+#   - on the Redis channel ia:task:<task_id>, which the API's SSE endpoint listens to, so
+#     clients wait for a single message instead of polling task-status;
+#   - on the resultados_ia Kafka topic, for consumers that react to analysis results. The
+#     event is built and encoded by services/common like the other services' events (the
+#     resultados_ia schema in common/schemas/events.json), through the process producer of
+#     common.kafka.
+CHANNEL_PREFIX = "ia:task:"
+RESULTS_TOPIC = "resultados_ia"
+SOURCE_SERVICE = "servico-agentes-ia"
+
+_clients_lock = threading.Lock()
+_clients = {"redis": None}
+
+def channel(task_id: str) -> str:
+    return f"{CHANNEL_PREFIX}{task_id}"
+
+def status_payload(task_id: str, status: str, result=None, error=None) -> dict:
+    """Same shape as the task-status response."""
+    return {"task_id": task_id, "status": status, "result": result, "error": error}
+
+def get_redis() -> redis.Redis:
+    with _clients_lock:
+        if _clients["redis"] is None:
+            _clients["redis"] = redis.Redis.from_url(
+                os.environ.get("REDIS_URL", "redis://localhost:6379/0"), socket_timeout=2
+            )
+        return _clients["redis"]
+
+def build_event(payload: dict, cached: bool = False) -> dict:
+    return kafka.build_event(
+        "ProductImageAnalyzed" if payload["status"] == "SUCCESS" else "ProductImageAnalysisFailed",
+        "task_id",
+        payload["task_id"],
+        {"result": payload["result"], "error": payload["error"], "cached": cached},
+        SOURCE_SERVICE,
+    )
+
+def publish_result(task_id: str, status: str, result=None, error=None, cached: bool = False):
+    """Pushes the final status of a task. Failures are logged: clients can still poll."""
+    payload = status_payload(task_id, status, result, error)
+    try:
+        get_redis().publish(channel(task_id), json.dumps(payload))
+    except Exception as e:
+        print(f"Could not publish the result of task {task_id} to Redis: {e}")
+
+    producer, _ = kafka.get_producer()
+    if producer is None:
+        return
+    try:
+        value = events.encode_event(RESULTS_TOPIC, build_event(payload, cached))
+        producer.produce(RESULTS_TOPIC, key=task_id, value=value, callback=kafka.delivery_report)
+    except Exception as e:
+        print(f"Could not publish the result of task {task_id} to Kafka: {e}")
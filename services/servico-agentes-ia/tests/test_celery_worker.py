@@ -0,0 +1,130 @@
+import importlib
+import io
+import pytest
+from types import ModuleType, SimpleNamespace
+from unittest.mock import patch, MagicMock
+import os
+import sys
+
+# Add the service's root directory to the path
+service_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if service_root not in sys.path:
+    sys.path.insert(0, service_root)
+
+# Preprocessing and batching run for real; only the model is replaced.
+pytest.importorskip('numpy')
+pytest.importorskip('cv2')
+pytest.importorskip('celery_batches')
+
+from PIL import Image
+from api.schemas import ProductData
+
+COLORS = [(200, 30, 30), (30, 200, 30), (30, 30, 200), (200, 200, 30)]
+
+
+class FakeLlava15ChatHandler:
+    def __init__(self, clip_model_path=None, verbose=False):
+        pass
+
+    def load_image(self, image_url):
+        raise AssertionError(f"Unexpected image URL: {image_url}")
+
+
+@pytest.fixture(scope="module")
+def worker_module():
+    """api.celery_worker in batching mode, imported once with a mocked Llama and instructor."""
+    llama_cpp = ModuleType('llama_cpp')
+    llama_cpp.Llama = MagicMock(name='Llama')
+    chat_format = ModuleType('llama_cpp.llama_chat_format')
+    chat_format.Llava15ChatHandler = FakeLlava15ChatHandler
+    instructor = ModuleType('instructor')
+    instructor.Mode = SimpleNamespace(JSON='json')
+    instructor.patch = lambda client, mode: client
+    with patch.dict(sys.modules, {'llama_cpp': llama_cpp, 'llama_cpp.llama_chat_format': chat_format,
+                                  'instructor': instructor}), \
+         patch.dict(os.environ, {'VISION_BATCH_SIZE': '4'}):
+        # Dropped from sys.modules with the fakes, after the tests of this file.
+        yield importlib.import_module('api.celery_worker')
+
+
+@pytest.fixture
+def worker(worker_module):
+    worker_module.Llama.reset_mock()
+    with patch.dict(worker_module.models, clear=True), \
+         patch.object(worker_module, 'celery_app', MagicMock()), \
+         patch.object(worker_module.task_events, 'publish_result'), \
+         patch.object(worker_module.result_cache, 'store'):
+        yield worker_module
+
+
+def jpeg(color):
+    buffer = io.BytesIO()
+    Image.new('RGB', (336, 336), color).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def fake_completion(worker, fail_on=None):
+    """Answers with the color of the image it receives; raises for the fail_on color."""
+    def create(response_model, messages, max_retries):
+        url = messages[1]["content"][0]["image_url"]["url"]
+        assert url.startswith("mem://")
+        # The buffer is there while the model reads it.
+        image = Image.open(io.BytesIO(worker.InMemoryLlava15ChatHandler.buffers[url[len("mem://"):]]))
+        color = image.convert('RGB').getpixel((168, 168))
+        closest = min(COLORS, key=lambda c: sum(abs(a - b) for a, b in zip(c, color)))
+        if closest == fail_on:
+            raise RuntimeError("model error")
+        return ProductData(product_name=f"Produto {COLORS.index(closest)}", category_standard="Teste",
+                           description_long="...", features_list=["a", "b", "c"])
+    return create
+
+
+def batch_requests(images):
+    return [SimpleNamespace(id=f"task-{i}", args=[image], kwargs={"cache_keys": {"sha256": str(i), "phash": "0" * 16}})
+            for i, image in enumerate(images)]
+
+
+def test_batch_returns_one_result_per_request_in_order(worker):
+    client = worker.get_vision_client()
+    client.chat.completions.create.side_effect = fake_completion(worker)
+
+    worker.process_product_image.run(batch_requests([jpeg(color) for color in COLORS]))
+
+    # One model for the whole batch.
+    worker.Llama.assert_called_once()
+    done = worker.celery_app.backend.mark_as_done.call_args_list
+    assert [c.args[0] for c in done] == ["task-0", "task-1", "task-2", "task-3"]
+    assert [c.args[1]["product_name"] for c in done] == ["Produto 0", "Produto 1", "Produto 2", "Produto 3"]
+    published = worker.task_events.publish_result.call_args_list
+    assert [(c.args[0], c.args[1]) for c in published] == [(f"task-{i}", "SUCCESS") for i in range(4)]
+    assert worker.result_cache.store.call_count == 4
+
+
+def test_failing_image_does_not_fail_the_batch(worker):
+    client = worker.get_vision_client()
+    client.chat.completions.create.side_effect = fake_completion(worker, fail_on=COLORS[2])
+    images = [jpeg(COLORS[0]), b"not an image", jpeg(COLORS[2]), jpeg(COLORS[3])]
+
+    worker.process_product_image.run(batch_requests(images))
+
+    done = worker.celery_app.backend.mark_as_done.call_args_list
+    assert [c.args[0] for c in done] == ["task-0", "task-3"]
+    assert [c.args[1]["product_name"] for c in done] == ["Produto 0", "Produto 3"]
+    failed = worker.celery_app.backend.mark_as_failure.call_args_list
+    assert [c.args[0] for c in failed] == ["task-1", "task-2"]
+    assert isinstance(failed[0].args[1], ValueError)
+    assert str(failed[1].args[1]) == "model error"
+    statuses = [c.args[1] for c in worker.task_events.publish_result.call_args_list]
+    assert statuses == ["SUCCESS", "FAILURE", "FAILURE", "SUCCESS"]
+    # Failed images are not cached.
+    assert worker.result_cache.store.call_count == 2
+
+
+def test_mem_buffers_are_released(worker):
+    client = worker.get_vision_client()
+    client.chat.completions.create.side_effect = fake_completion(worker, fail_on=COLORS[1])
+
+    worker.process_product_image.run(batch_requests([jpeg(color) for color in COLORS]))
+
+    assert client.chat.completions.create.call_count == 4
+    assert worker.InMemoryLlava15ChatHandler.buffers == {}
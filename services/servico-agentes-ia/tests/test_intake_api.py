@@ -0,0 +1,221 @@
+import io
+import pytest
+from unittest.mock import patch, AsyncMock, MagicMock
+import os
+import sys
+
+# Add the service's root directory to the path
+service_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if service_root not in sys.path:
+    sys.path.insert(0, service_root)
+
+from fastapi.testclient import TestClient
+from PIL import Image
+
+# The API enqueues tasks by name: importing it loads no model.
+from api import main
+
+# The autouse fixture below replaces publish_result; the envelope test calls the real one.
+real_publish_result = main.task_events.publish_result
+
+
+@pytest.fixture
+def client():
+    return TestClient(main.app)
+
+
+@pytest.fixture(autouse=True)
+def mock_dependencies():
+    with patch.object(main.result_cache, 'lookup', return_value=None) as mock_lookup, \
+         patch.object(main, 'enqueue_product_image', return_value=MagicMock(id='task-1')) as mock_enqueue, \
+         patch.object(main, 'celery_app', MagicMock()) as mock_celery_app, \
+         patch.object(main.task_events, 'publish_result') as mock_publish_result:
+        yield {"lookup": mock_lookup, "enqueue": mock_enqueue, "backend": mock_celery_app.backend,
+               "publish_result": mock_publish_result}
+
+
+def photo_bytes():
+    buffer = io.BytesIO()
+    Image.new('RGB', (1200, 900), (10, 120, 200)).save(buffer, format='JPEG')
+    return buffer.getvalue()
+
+
+def test_catalog_intake_sends_model_input_to_the_bulk_queue(client, mock_dependencies):
+    response = client.post('/api/agents/catalog-intake', files={"file": ("p.jpg", photo_bytes(), "image/jpeg")})
+
+    assert response.status_code == 202
+    assert response.json()["task_id"] == "task-1"
+    model_input, cache_keys, queue = mock_dependencies["enqueue"].call_args.args
+    assert queue == main.QUEUE_BULK
+    assert Image.open(io.BytesIO(model_input)).size == (336, 336)
+    assert set(cache_keys) == {"sha256", "phash"}
+    assert 'llama_cpp' not in sys.modules
+
+
+def test_image_search_uses_the_interactive_queue(client, mock_dependencies):
+    response = client.post('/api/agents/image-search', files={"file": ("p.jpg", photo_bytes(), "image/jpeg")})
+
+    assert response.status_code == 202
+    assert mock_dependencies["enqueue"].call_args.args[2] == main.QUEUE_INTERACTIVE
+
+
+def test_cached_result_is_returned_as_a_finished_task(client, mock_dependencies):
+    result = {"product_name": "Café", "category_standard": "Alimentos",
+              "description_long": "...", "features_list": ["a"]}
+    mock_dependencies["lookup"].return_value = result
+
+    response = client.post('/api/agents/catalog-intake', files={"file": ("p.jpg", photo_bytes(), "image/jpeg")})
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "SUCCESS"
+    assert response.json()["result"] == result
+    task_id, stored, state = mock_dependencies["backend"].store_result.call_args.args
+    assert (task_id, stored, state) == (response.json()["task_id"], result, "SUCCESS")
+    mock_dependencies["enqueue"].assert_not_called()
+    mock_dependencies["publish_result"].assert_called_once_with(task_id, "SUCCESS", result, None, True)
+    # Both status codes are part of the documented contract.
+    responses = client.get('/openapi.json').json()["paths"]["/api/agents/catalog-intake"]["post"]["responses"]
+    assert {"200", "202"} <= set(responses)
+
+
+def test_rejects_oversized_and_invalid_uploads(client, mock_dependencies):
+    with patch.object(main, 'UPLOAD_MAX_BYTES', 1000):
+        response = client.post('/api/agents/catalog-intake', files={"file": ("p.jpg", b"x" * 5000, "image/jpeg")})
+    assert response.status_code == 413
+
+    response = client.post('/api/agents/catalog-intake', files={"file": ("p.txt", b"not an image", "text/plain")})
+    assert response.status_code == 400
+
+
+def test_rejects_oversized_chunked_upload(mock_dependencies):
+    """Without Content-Length the limit is applied while the body is received."""
+    body = (b'--limite\r\nContent-Disposition: form-data; name="file"; filename="p.jpg"\r\n'
+            b'Content-Type: image/jpeg\r\n\r\n' + b"x" * 5000 + b'\r\n--limite--\r\n')
+
+    def chunks():
+        for start in range(0, len(body), 512):
+            yield body[start:start + 512]
+
+    limited = TestClient(main.UploadSizeLimitMiddleware(main.app, max_bytes=1000, paths=main.UPLOAD_PATHS))
+    response = limited.post('/api/agents/catalog-intake', content=chunks(),
+                            headers={"Content-Type": "multipart/form-data; boundary=limite"})
+
+    assert response.status_code == 413
+    mock_dependencies["enqueue"].assert_not_called()
+
+
+class FakePubSub:
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.subscribed = []
+
+    async def subscribe(self, channel):
+        self.subscribed.append(channel)
+
+    async def get_message(self, ignore_subscribe_messages=True, timeout=None):
+        return self.messages.pop(0) if self.messages else None
+
+    async def unsubscribe(self):
+        pass
+
+    async def aclose(self):
+        pass
+
+
+def stream_with(pubsub, status):
+    fake_redis = MagicMock()
+    fake_redis.pubsub.return_value = pubsub
+    fake_redis.aclose = AsyncMock()
+    return patch.dict(main.task_events_redis, {"client": fake_redis}), \
+        patch.object(main, 'read_task_status', return_value=status)
+
+
+def test_task_events_pushes_the_result_once_published(client):
+    done = main.task_events.status_payload("task-1", "SUCCESS", result={"product_name": "Café"})
+    pubsub = FakePubSub([None, {"type": "message", "data": main.json.dumps(done)}])
+    redis_patch, status_patch = stream_with(pubsub, main.task_events.status_payload("task-1", "PENDING"))
+    with redis_patch, status_patch:
+        response = client.get('/api/agents/task-events/task-1')
+
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert pubsub.subscribed == ["ia:task:task-1"]
+    assert response.text.endswith(f"event: result\ndata: {main.json.dumps(done)}\n\n")
+    assert ": keep-alive" in response.text
+
+
+def test_task_events_answers_at_once_for_finished_tasks(client):
+    failed = main.task_events.status_payload("task-2", "FAILURE", error="boom")
+    redis_patch, status_patch = stream_with(FakePubSub([]), failed)
+    with redis_patch, status_patch:
+        response = client.get('/api/agents/task-events/task-2')
+
+    assert response.text == f"event: result\ndata: {main.json.dumps(failed)}\n\n"
+
+
+def test_task_event_streams_share_one_redis_client(client):
+    done = main.task_events.status_payload("task-1", "SUCCESS")
+    fake_redis = MagicMock()
+    fake_redis.pubsub.side_effect = lambda: FakePubSub([])
+    fake_redis.aclose = AsyncMock()
+    with patch.dict(main.task_events_redis, {"client": None}), \
+         patch.object(main.aioredis.Redis, 'from_url', return_value=fake_redis) as mock_from_url, \
+         patch.object(main, 'read_task_status', return_value=done):
+        client.get('/api/agents/task-events/task-1')
+        client.get('/api/agents/task-events/task-2')
+        # Each stream has its own pubsub; the client is closed only at shutdown.
+        assert fake_redis.pubsub.call_count == 2
+        fake_redis.aclose.assert_not_called()
+
+    mock_from_url.assert_called_once()
+    assert mock_from_url.call_args.kwargs["max_connections"] == main.TASK_EVENTS_MAX_CONNECTIONS
+
+
+def test_shared_redis_client_is_closed_at_shutdown():
+    fake_redis = MagicMock()
+    fake_redis.aclose = AsyncMock()
+    with patch.dict(main.task_events_redis, {"client": fake_redis}):
+        with TestClient(main.app):
+            pass
+        fake_redis.aclose.assert_awaited_once()
+        assert main.task_events_redis["client"] is None
+
+
+def test_result_event_uses_the_service_envelope():
+    event = main.task_events.build_event(main.task_events.status_payload("t", "FAILURE", error="boom"))
+    assert event["event_type"] == "ProductImageAnalysisFailed"
+    assert event["task_id"] == "t"
+    assert event["data"] == {"result": None, "error": "boom", "cached": False}
+    assert event["source_service"] == "servico-agentes-ia"
+
+
+def test_result_event_is_encoded_like_the_other_services_events():
+    producer = MagicMock()
+    with patch.object(main.task_events.kafka, 'get_producer', return_value=(producer, None)), \
+         patch.object(main.task_events, 'get_redis'):
+        real_publish_result("t", "SUCCESS", result={"product_name": "Café"})
+
+    topic = producer.produce.call_args.args[0]
+    assert topic == "resultados_ia"
+    assert producer.produce.call_args.kwargs["key"] == "t"
+    event = main.task_events.events.decode_event(producer.produce.call_args.kwargs["value"])
+    assert event["event_type"] == "ProductImageAnalyzed"
+    assert event["task_id"] == "t"
+    assert event["data"]["result"] == {"product_name": "Café"}
+
+
+def test_readiness_uses_the_shared_probe(client):
+    probe = main.health.ReadinessProbe(main.build_readiness_status)
+    with patch.object(main, 'readiness', probe), \
+         patch.object(main.redis.Redis, 'from_url') as mock_from_url:
+        mock_from_url.return_value.ping.side_effect = ConnectionError("refused")
+        response = client.get('/api/health/ready')
+        # Served from the cache: Redis is pinged once.
+        client.get('/api/health/ready')
+
+    assert response.status_code == 503
+    body = response.json()
+    assert body["status"] == "degraded"
+    assert body["dependencies"] == {"redis": "error"}
+    assert body["initialization_errors"] == {"redis": "refused"}
+    assert set(body) >= {"environment_variables", "latencies_ms", "checked_at"}
+    assert mock_from_url.return_value.ping.call_count == 1
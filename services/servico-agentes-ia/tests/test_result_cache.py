@@ -0,0 +1,158 @@
+import io
+import pytest
+from unittest.mock import patch
+import os
+import sys
+
+# Add the service's root directory to the path
+service_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if service_root not in sys.path:
+    sys.path.insert(0, service_root)
+
+from PIL import Image
+from api import preprocessing, result_cache
+
+
+class FakeRedis:
+    """Just the Redis commands used by the cache, kept in dicts."""
+
+    def __init__(self):
+        self.values, self.sets, self.index = {}, {}, {}
+
+    def get(self, key):
+        value = self.values.get(key)
+        return value.encode() if isinstance(value, str) else value
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+    def sadd(self, key, member):
+        self.sets.setdefault(key, set()).add(member.encode())
+
+    def srem(self, key, member):
+        self.sets.get(key, set()).discard(member.encode())
+        if not self.sets.get(key, True):
+            del self.sets[key]
+
+    def sunion(self, keys):
+        return set().union(*(self.sets.get(key, set()) for key in keys))
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def zadd(self, key, mapping):
+        self.index.update(mapping)
+
+    def zcount(self, key, low, high):
+        return sum(1 for score in self.index.values() if score <= high)
+
+    def zcard(self, key):
+        return len(self.index)
+
+    def zpopmin(self, key, count):
+        oldest = sorted(self.index.items(), key=lambda item: item[1])[:count]
+        for member, _ in oldest:
+            del self.index[member]
+        return [(member.encode(), score) for member, score in oldest]
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
+
+
+@pytest.fixture
+def fake_redis():
+    fake = FakeRedis()
+    with patch.object(result_cache, 'get_redis', return_value=fake):
+        yield fake
+
+
+def photo_bytes(size=(400, 300), quality=90, flip=False):
+    image = Image.new('RGB', (400, 300))
+    for x in range(400):
+        for y in range(0, 300, 10):
+            image.putpixel((x, y), (x % 256, y % 256, 128))
+    image = image.resize(size)
+    if flip:
+        image = image.transpose(Image.FLIP_TOP_BOTTOM).rotate(90, expand=True)
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def keys_of(content):
+    return result_cache.compute_keys(content, preprocessing.decode_image(content))
+
+
+RESULT = {"product_name": "Café Pilão 500g", "category_standard": "Alimentos",
+          "description_long": "...", "features_list": ["a", "b", "c"]}
+
+
+def test_exact_and_near_duplicate_uploads_hit_the_cache(fake_redis):
+    original = keys_of(photo_bytes())
+    result_cache.store(original, RESULT)
+
+    assert result_cache.lookup(original) == RESULT
+    recompressed = keys_of(photo_bytes(size=(200, 150), quality=50))
+    assert recompressed["sha256"] != original["sha256"]
+    assert result_cache.lookup(recompressed) == RESULT
+    assert result_cache.lookup(keys_of(photo_bytes(flip=True))) is None
+
+
+def test_store_evicts_oldest_entries_and_skips_large_results(fake_redis):
+    keys = [{"sha256": f"sha{i}", "phash": phash}
+            for i, phash in enumerate(["0" * 16, "f" * 16, "0" * 8 + "f" * 8])]
+    with patch.object(result_cache, 'CACHE_MAX_ENTRIES', 2), \
+         patch.object(result_cache.time, 'time', side_effect=[1000.0, 1001.0, 1002.0]):
+        for entry in keys:
+            result_cache.store(entry, RESULT)
+
+    assert set(fake_redis.index) == {"sha1:" + "f" * 16, "sha2:" + "0" * 8 + "f" * 8}
+    assert result_cache.lookup(keys[0]) is None
+    assert result_cache.lookup(keys[2]) == RESULT
+    # The evicted phash leaves its band sets and its key.
+    assert fake_redis.get("ia:cache:phash:" + "0" * 16) is None
+    assert not any(b"0" * 16 in members for members in fake_redis.sets.values())
+    with patch.object(result_cache, 'CACHE_MAX_RESULT_BYTES', 10):
+        result_cache.store({"sha256": "big", "phash": "0f" * 8}, RESULT)
+    assert fake_redis.get("ia:cache:result:big") is None
+
+
+def test_store_drops_expired_entries_but_keeps_a_shared_phash(fake_redis):
+    old = {"sha256": "old", "phash": "0" * 16}
+    same_image = {"sha256": "recompressed", "phash": "0" * 16}
+    with patch.object(result_cache, 'CACHE_TTL_SECONDS', 100), \
+         patch.object(result_cache.time, 'time', side_effect=[1000.0, 1050.0, 1120.0, 1200.0]):
+        result_cache.store(old, RESULT)
+        result_cache.store(same_image, RESULT)
+        result_cache.store({"sha256": "new", "phash": "f" * 16}, RESULT)
+
+        # Only "old" expired; the later upload with the same phash still owns it.
+        assert set(fake_redis.index) == {"recompressed:" + "0" * 16, "new:" + "f" * 16}
+        assert fake_redis.get("ia:cache:result:old") is None
+        assert result_cache.lookup({"sha256": "other", "phash": "0" * 16}) == RESULT
+
+        result_cache.store({"sha256": "newer", "phash": "0f" * 8}, RESULT)
+
+    assert set(fake_redis.index) == {"new:" + "f" * 16, "newer:" + "0f" * 8}
+    assert fake_redis.get("ia:cache:phash:" + "0" * 16) is None
+    assert not any(b"0" * 16 in members for members in fake_redis.sets.values())
+
+
+def test_model_input_is_a_small_336px_jpeg():
+    photo = Image.new('RGB', (3000, 2000), (200, 30, 30))
+    buffer = io.BytesIO()
+    photo.save(buffer, format='JPEG')
+
+    model_input = preprocessing.to_model_input(preprocessing.decode_image(buffer.getvalue()))
+
+    assert Image.open(io.BytesIO(model_input)).size == (336, 336)
+    assert len(model_input) < 30 * 1024
+    with pytest.raises(ValueError):
+        preprocessing.decode_image(b"<html>")
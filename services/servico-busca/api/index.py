@@ -2,17 +2,25 @@ from dotenv import load_dotenv
 load_dotenv(dotenv_path='.env.local')
 
 import os
-import json
+import sys
+import time
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from elasticsearch import Elasticsearch
 from confluent_kafka  import Consumer, KafkaException
 
-try:
-    import firebase_admin
-    from firebase_admin import credentials, firestore
-except ImportError:
-    firebase_admin = None
+
+# --- Pacote compartilhado (services/common) ---
+# No repositório e nas imagens Docker o pacote fica na pasta pai do serviço; no deploy do
+# Vercel ele é copiado para dentro da pasta do serviço (ver .github/actions/deploy-service).
+SERVICE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+for common_parent in (os.path.dirname(SERVICE_ROOT), SERVICE_ROOT):
+    if os.path.isdir(os.path.join(common_parent, 'common')) and common_parent not in sys.path:
+        sys.path.insert(0, common_parent)
+
+from common import events, firebase, health, service
+from common.lazy import lazy_import, NOT_INITIALIZED
+
+firestore = lazy_import('firebase_admin.firestore')
 
 app = Flask(__name__)
 CORS(app, supports_credentials=True, origins=['https://frontend-tester-1foc8lpkl-jeanmnorhens-projects.vercel.app'])
@@ -23,72 +31,77 @@ es_init_error = None
 kafka_consumer_init_error = None
 
 # --- Firebase Admin SDK Initialization ---1
-db = None
-if firebase_admin:
-    try:
-        firebase_sdk_cred_base64 = os.environ.get('FIREBASE_ADMIN_SDK_BASE64')
-        if firebase_sdk_cred_base64:
-            import base64
-            decoded_sdk = base64.b64decode(firebase_sdk_cred_base64).decode('utf-8')
-            cred_dict = json.loads(decoded_sdk)
-            cred = credentials.Certificate(cred_dict)
-            if not firebase_admin._apps:
-                firebase_admin.initialize_app(cred)
-            db = firestore.client()
-            print("Firebase Admin SDK inicializado com sucesso.")
-        else:
-            firebase_init_error = "Variável FIREBASE_ADMIN_SDK_BASE64 não encontrada para reindexação."
-            print(firebase_init_error)
-    except Exception as e:
-        firebase_init_error = str(e)
-        print(f"Erro ao inicializar Firebase para reindexação: {e}")
-else:
-    firebase_init_error = "Biblioteca firebase_admin não encontrada."
+db = NOT_INITIALIZED
+
+def init_firebase():
+    global db, firebase_init_error
+    db, firebase_init_error = firebase.get_firestore_client()
 
 # --- Elasticsearch Configuration ---
-es = None
-try:
-    es_url = os.environ.get('ELASTICSEARCH_URL') # For local Docker
-    es_host_url = os.environ.get('ELASTIC_HOST')   # For cloud
-    es_api_key = os.environ.get('ELASTIC_API_KEY') # For cloud
-
-    if es_url:
-        es = Elasticsearch(hosts=[es_url])
-        print("Elasticsearch inicializado com sucesso via ELASTICSEARCH_URL (local).")
-    elif es_host_url and es_api_key:
-        es = Elasticsearch(hosts=[es_host_url], api_key=es_api_key)
-        print("Elasticsearch inicializado com sucesso via ELASTIC_HOST (cloud).")
-    else:
-        es_init_error = "Variáveis de ambiente para conexão com Elasticsearch não encontradas."
-        print(es_init_error)
-except Exception as e:
-    es_init_error = str(e)
-    print(f"Erro ao inicializar Elasticsearch: {e}")
+es = NOT_INITIALIZED
 
-# --- Kafka Consumer Configuration ---
-kafka_consumer_instance = None
-if Consumer:
+def init_elasticsearch():
+    global es, es_init_error
+    from elasticsearch import Elasticsearch
+    es = None
     try:
-        kafka_bootstrap_server = os.environ.get('KAFKA_BOOTSTRAP_SERVER')
-        if kafka_bootstrap_server:
-            # Local Docker Kafka configuration
-            print("Configurando consumidor Kafka para ambiente local (sem SASL)...")
-            kafka_conf = {
-                'bootstrap.servers': kafka_bootstrap_server,
-                'group.id': 'search_service_group_cron_v2',
-                'auto.offset.reset': 'earliest'
-            }
-            kafka_consumer_instance = Consumer(kafka_conf)
-            kafka_consumer_instance.subscribe(['eventos_usuarios', 'eventos_produtos', 'eventos_lojas', 'eventos_ofertas'])
-            print("Consumidor Kafka inicializado com sucesso.")
+        es_url = os.environ.get('ELASTICSEARCH_URL') # For local Docker
+        es_host_url = os.environ.get('ELASTIC_HOST')   # For cloud
+        es_api_key = os.environ.get('ELASTIC_API_KEY') # For cloud
+
+        if es_url:
+            es = Elasticsearch(hosts=[es_url])
+            print("Elasticsearch inicializado com sucesso via ELASTICSEARCH_URL (local).")
+        elif es_host_url and es_api_key:
+            es = Elasticsearch(hosts=[es_host_url], api_key=es_api_key)
+            print("Elasticsearch inicializado com sucesso via ELASTIC_HOST (cloud).")
         else:
-            kafka_consumer_init_error = "Variável de ambiente KAFKA_BOOTSTRAP_SERVER não encontrada para o consumidor."
-            print(kafka_consumer_init_error)
+            es_init_error = "Variáveis de ambiente para conexão com Elasticsearch não encontradas."
+            print(es_init_error)
     except Exception as e:
-        kafka_consumer_init_error = str(e)
-        print(f"Erro ao inicializar Consumidor Kafka: {e}")
-else:
-    kafka_consumer_init_error = "Biblioteca confluent_kafka não encontrada."
+        es_init_error = str(e)
+        print(f"Erro ao inicializar Elasticsearch: {e}")
+
+# --- Kafka Consumer Configuration ---
+kafka_consumer_instance = NOT_INITIALIZED
+
+def init_kafka_consumer():
+    global kafka_consumer_instance, kafka_consumer_init_error
+    kafka_consumer_instance = None
+    if Consumer:
+        try:
+            kafka_bootstrap_server = os.environ.get('KAFKA_BOOTSTRAP_SERVER')
+            if kafka_bootstrap_server:
+                # Local Docker Kafka configuration
+                print("Configurando consumidor Kafka para ambiente local (sem SASL)...")
+                kafka_conf = {
+                    'bootstrap.servers': kafka_bootstrap_server,
+                    'group.id': 'search_service_group_cron_v2',
+                    'auto.offset.reset': 'earliest'
+                }
+                kafka_consumer_instance = Consumer(kafka_conf)
+                kafka_consumer_instance.subscribe(['eventos_usuarios', 'eventos_produtos', 'eventos_lojas', 'eventos_ofertas'])
+                print("Consumidor Kafka inicializado com sucesso.")
+            else:
+                kafka_consumer_init_error = "Variável de ambiente KAFKA_BOOTSTRAP_SERVER não encontrada para o consumidor."
+                print(kafka_consumer_init_error)
+        except Exception as e:
+            kafka_consumer_init_error = str(e)
+            print(f"Erro ao inicializar Consumidor Kafka: {e}")
+    else:
+        kafka_consumer_init_error = "Biblioteca confluent_kafka não encontrada."
+
+# --- Inicialização dos clientes ---
+# Sob demanda, na primeira requisição e no post_fork do gunicorn (common/service.py).
+def create_clients():
+    if db is NOT_INITIALIZED:
+        init_firebase()
+    if es is NOT_INITIALIZED:
+        init_elasticsearch()
+    if kafka_consumer_instance is NOT_INITIALIZED:
+        init_kafka_consumer()
+
+init_clients = service.lazy_clients(app, create_clients)
 
 # --- API Routes ---
 
@@ -141,13 +154,14 @@ def reindex():
             stats[collection_name] = {"error": str(e)}
     return jsonify({"status": "Reindexação concluída", "details": stats}), 200
 
+# Eventos que removem o documento do índice em vez de reindexá-lo.
+REMOVAL_EVENT_TYPES = {'OfferExpired', 'OfferDeleted', 'ProductDeleted', 'StoreDeleted', 'UserDeleted'}
+
 @app.route('/api/search/consume', methods=['POST', 'GET'])
 def consume_events():
     print("DEBUG: consume_events called") # Depuração
     # 1. Segurança: Protege o endpoint com um token secreto
-    auth_header = request.headers.get('Authorization')
-    cron_secret = os.environ.get('CRON_SECRET')
-    if not cron_secret or auth_header != f'Bearer {cron_secret}':
+    if not service.is_cron_request():
         return jsonify({"error": "Unauthorized"}), 401
 
     if not kafka_consumer_instance:
@@ -167,7 +181,7 @@ def consume_events():
                 print(f"Kafka error: {msg.error()}")
                 continue
             
-            event_data = json.loads(msg.value().decode('utf-8'))
+            event_data = events.decode_event(msg.value())
             print(f"DEBUG: event_data: {event_data}") # Depuração
             topic = msg.topic()
             index_name = topic.split('_')[1]
@@ -184,7 +198,11 @@ def consume_events():
             data_to_index = event_data.get('data', {})
             print(f"DEBUG: doc_id: {doc_id}, data_to_index: {data_to_index}") # Depuração
 
-            if doc_id and data_to_index:
+            if doc_id and event_data.get('event_type') in REMOVAL_EVENT_TYPES:
+                # Ofertas vencidas e documentos apagados saem do índice.
+                es.options(ignore_status=404).delete(index=index_name, id=doc_id)
+                messages_processed += 1
+            elif doc_id and data_to_index:
                 es.index(index=index_name, id=doc_id, document=data_to_index)
                 messages_processed += 1
                 print(f"DEBUG: messages_processed: {messages_processed}") # Depuração
@@ -200,18 +218,20 @@ def consume_events():
     print(f"DEBUG: Final messages_processed: {messages_processed}") # Depuração
     return jsonify({"status": "ok", "messages_processed": messages_processed}), 200
 
-def get_health_status():
-    env_vars = {
-        "FIREBASE_ADMIN_SDK_BASE64": "present" if os.environ.get('FIREBASE_ADMIN_SDK_BASE64') else "missing",
-        "ELASTIC_HOST": "present" if os.environ.get('ELASTIC_HOST') else "missing",
-        "ELASTIC_API_KEY": "present" if os.environ.get('ELASTIC_API_KEY') else "missing",
-        "KAFKA_BOOTSTRAP_SERVER": "present" if os.environ.get('KAFKA_BOOTSTRAP_SERVER') else "missing",
-        "KAFKA_API_KEY": "present" if os.environ.get('KAFKA_API_KEY') else "missing",
-        "KAFKA_API_SECRET": "present" if os.environ.get('KAFKA_API_SECRET') else "missing"
-    }
+def get_health_status(include_latencies=False):
+    env_vars = health.env_var_status([
+        'FIREBASE_ADMIN_SDK_BASE64',
+        'ELASTIC_HOST',
+        'ELASTIC_API_KEY',
+        'KAFKA_BOOTSTRAP_SERVER',
+        'KAFKA_API_KEY',
+        'KAFKA_API_SECRET'
+    ])
 
+    latencies_ms = {}
     es_status = "error"
     if es:
+        started = time.perf_counter()
         try:
             if es.ping():
                 es_status = "ok"
@@ -219,6 +239,7 @@ def get_health_status():
                 es_status = "error (ping failed)"
         except Exception as e:
             es_status = f"error ({e})"
+        latencies_ms["elasticsearch"] = round((time.perf_counter() - started) * 1000, 2)
     else:
         es_status = "error (not initialized)"
 
@@ -235,21 +256,33 @@ def get_health_status():
             "kafka_consumer": kafka_consumer_init_error
         }
     }
+    if include_latencies:
+        status["latencies_ms"] = latencies_ms
     return status
 
-@app.route('/api/health', methods=['GET'])
-def health_check():
-    status = get_health_status()
-    
-    all_ok = (
+def is_healthy(status):
+    return (
         all(value == "present" for value in status["environment_variables"].values()) and
         status["dependencies"]["firestore"] == "ok" and
         status["dependencies"]["elasticsearch"] == "ok" and
         status["dependencies"]["kafka_consumer"] == "ok"
     )
-    http_status = 200 if all_ok else 503
+
+@app.route('/api/health', methods=['GET'])
+def health_check():
+    status = get_health_status()
+    http_status = 200 if is_healthy(status) else 503
     
     return jsonify(status), http_status
 
+# --- Readiness memoizada ---
+def build_readiness_status():
+    status = get_health_status(include_latencies=True)
+    status["status"] = "ok" if is_healthy(status) else "degraded"
+    return status
+
+readiness = service.register_probe_routes(app, build_readiness_status)
+readiness_cache = readiness.cache
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
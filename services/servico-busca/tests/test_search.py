@@ -179,3 +179,37 @@ def test_consume_events_success(client, mock_all_dependencies):
     assert response.json['status'] == 'ok'
     assert response.json['messages_processed'] == 2
     assert mock_es.index.call_count == 2 # Adicionar esta asserção
+
+def test_consume_expired_offer_removes_it_from_index(client, mock_all_dependencies):
+    mock_es = mock_all_dependencies["es"]
+    mock_msg = MagicMock()
+    mock_msg.error.return_value = None
+    mock_msg.value.return_value = json.dumps({"event_type": "OfferExpired", "offer_id": "offer1", "data": {"offer_id": "offer1"}}).encode('utf-8')
+    mock_msg.topic.return_value = "eventos_ofertas"
+    mock_all_dependencies["kafka_consumer_instance"].consume.return_value = [mock_msg]
+
+    response = client.post('/api/search/consume', headers={"Authorization": "Bearer dummy_cron_secret"})
+
+    assert response.json['messages_processed'] == 1
+    mock_es.options.return_value.delete.assert_called_once_with(index="ofertas", id="offer1")
+    mock_es.index.assert_not_called()
+
+def test_liveness_check(client):
+    """Liveness não depende de nenhuma dependência externa."""
+    response = client.get('/api/health/live')
+    assert response.status_code == 200
+    assert response.json == {"status": "ok"}
+
+def test_readiness_check_is_memoized(client, mock_all_dependencies):
+    """Readiness reaproveita o resultado das verificações dentro da janela de cache."""
+    with patch.dict(api_index.readiness_cache, {"status": None, "checked_at": 0.0}), \
+         patch.object(api_index, 'get_health_status', wraps=api_index.get_health_status) as spy:
+        first = client.get('/api/health/ready')
+        second = client.get('/api/health/ready')
+
+    assert first.status_code == second.status_code == 200
+    assert first.json["status"] == "ok"
+    assert "latencies_ms" in first.json
+    assert spy.call_count == 1
+    mock_all_dependencies["es"].ping.assert_called_once()
+    assert "elasticsearch" in first.json["latencies_ms"]
@@ -2,8 +2,12 @@ from dotenv import load_dotenv
 load_dotenv(dotenv_path='.env.local')
 
 import os
+import time
+import threading
 import requests
 import json
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, wait
 from flask import Flask, jsonify
 from flask_cors import CORS
 
@@ -11,7 +15,7 @@ app = Flask(__name__)
 CORS(app)
 
 # 1define a list of services to monitor and their environment variable names 
-# The health endpoint for all services is assumed to be /api/health 
+# Each service exposes a memoized readiness probe at /api/health/ready
 SERVICES_TO_MONITOR = {
     "servico_agentes_ia": "SERVICO_AGENTES_IA_URL",
     "servico_busca": "SERVICO_BUSCA_URL",
@@ -22,50 +26,120 @@ SERVICES_TO_MONITOR = {
     "servico_ofertas": "SERVICO_OFERTAS_URL"
 }
 
+# --- Configuração da verificação concorrente e do cache ---
+# Timeout de cada requisição individual e prazo total para a agregação.
+SERVICE_TIMEOUT_SECONDS = float(os.environ.get('HEALTHCHECK_SERVICE_TIMEOUT_SECONDS', 5))
+OVERALL_DEADLINE_SECONDS = float(os.environ.get('HEALTHCHECK_DEADLINE_SECONDS', 6))
+# Janela durante a qual o último resultado agregado é reutilizado (0 desativa o cache).
+CACHE_TTL_SECONDS = float(os.environ.get('HEALTHCHECK_CACHE_TTL_SECONDS', 15))
+# Se ativo, um resultado expirado é servido imediatamente enquanto é atualizado em segundo plano.
+BACKGROUND_REFRESH = os.environ.get('HEALTHCHECK_BACKGROUND_REFRESH', 'false').lower() in ('1', 'true', 'yes')
+
+executor = ThreadPoolExecutor(max_workers=len(SERVICES_TO_MONITOR), thread_name_prefix='healthcheck')
+
+health_cache = {"status": None, "checked_at": 0.0}
+health_cache_lock = threading.Lock()
+refresh_lock = threading.Lock()
+
+def check_service_health(env_var_name):
+    """Consulta o /api/health de um serviço. Retorna (status, ok)."""
+    service_url = os.environ.get(env_var_name)
+    if not service_url:
+        # Mark overall as not ok if any service URL is missing
+        return {"status": "unavailable", "details": "URL not configured"}, False
+
+    try:
+        health_path = "/api/health/ready"
+        health_endpoint = f"{service_url}{health_path}"
+        response = requests.get(health_endpoint, timeout=SERVICE_TIMEOUT_SECONDS)
+        response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
+
+        service_health_status = response.json()
+        service_ok = service_health_status.get("status") == "ok" or bool(
+            service_health_status.get("dependencies") and all(s == "ok" for s in service_health_status["dependencies"].values())
+        )
+        return service_health_status, service_ok
+
+    except requests.exceptions.Timeout:
+        return {"status": "timeout", "details": "Request timed out"}, False
+    except requests.exceptions.ConnectionError:
+        return {"status": "unreachable", "details": "Service is unreachable"}, False
+    except requests.exceptions.HTTPError as e:
+        return {"status": "error", "details": f"HTTP Error: {e.response.status_code} - {e.response.text}"}, False
+    except Exception as e:
+        return {"status": "error", "details": str(e)}, False
+
 def get_overall_health_status():
+    """Verifica todos os serviços em paralelo, respeitando o prazo total."""
     overall_status = {"status": "ok", "services": {}}
     all_services_ok = True
 
-    for service_name, env_var_name in SERVICES_TO_MONITOR.items():
-        service_url = os.environ.get(env_var_name)
-        service_health_status = {"status": "unavailable", "details": "URL not configured"}
-
-        if service_url:
-            try:
-                health_path = "/api/health"
-                health_endpoint = f"{service_url}{health_path}"
-                response = requests.get(health_endpoint, timeout=5)
-                response.raise_for_status() # Raise an exception for HTTP errors (4xx or 5xx)
-                
-                service_health_status = response.json()
-                if service_health_status.get("status") != "ok" and not (service_health_status.get("dependencies") and all(s == "ok" for s in service_health_status["dependencies"].values())):
-                    all_services_ok = False
-
-            except requests.exceptions.Timeout:
-                service_health_status = {"status": "timeout", "details": "Request timed out"}
-                all_services_ok = False
-            except requests.exceptions.ConnectionError:
-                service_health_status = {"status": "unreachable", "details": "Service is unreachable"}
-                all_services_ok = False
-            except requests.exceptions.HTTPError as e:
-                service_health_status = {"status": "error", "details": f"HTTP Error: {e.response.status_code} - {e.response.text}"}
-                all_services_ok = False
-            except Exception as e:
-                service_health_status = {"status": "error", "details": str(e)}
-                all_services_ok = False
+    futures = {
+        service_name: executor.submit(check_service_health, env_var_name)
+        for service_name, env_var_name in SERVICES_TO_MONITOR.items()
+    }
+    wait(futures.values(), timeout=OVERALL_DEADLINE_SECONDS)
+
+    for service_name, future in futures.items():
+        if future.done():
+            service_health_status, service_ok = future.result()
         else:
-            all_services_ok = False # Mark overall as not ok if any service URL is missing
+            future.cancel()
+            service_health_status = {"status": "timeout", "details": "Overall health check deadline exceeded"}
+            service_ok = False
 
+        if not service_ok:
+            all_services_ok = False
         overall_status["services"][service_name] = service_health_status
-    
+
     if not all_services_ok:
         overall_status["status"] = "degraded" # Or "error" depending on desired strictness
 
+    overall_status["checked_at"] = datetime.now(timezone.utc).isoformat()
     return overall_status
 
+def get_fresh_cached_status():
+    with health_cache_lock:
+        status = health_cache["status"]
+        age = time.monotonic() - health_cache["checked_at"]
+    if status is not None and age < CACHE_TTL_SECONDS:
+        return status
+    return None
+
+def refresh_health_cache():
+    """Executa a verificação e atualiza o cache. Apenas uma verificação roda por vez."""
+    with refresh_lock:
+        # Outra thread pode ter atualizado o cache enquanto aguardávamos o lock.
+        status = get_fresh_cached_status()
+        if status is not None:
+            return status
+        status = get_overall_health_status()
+        with health_cache_lock:
+            health_cache["status"] = status
+            health_cache["checked_at"] = time.monotonic()
+        return status
+
+def refresh_health_cache_in_background():
+    if refresh_lock.locked():
+        return # Já existe uma atualização em andamento
+    threading.Thread(target=refresh_health_cache, daemon=True).start()
+
+def get_cached_health_status():
+    status = get_fresh_cached_status()
+    if status is not None:
+        return status
+
+    with health_cache_lock:
+        stale_status = health_cache["status"]
+    if BACKGROUND_REFRESH and stale_status is not None:
+        refresh_health_cache_in_background()
+        return stale_status
+
+    return refresh_health_cache()
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    status = get_overall_health_status()
+    status = get_cached_health_status()
     # Imprime o status detalhado no console para depuração
     print(json.dumps(status, indent=2))
     http_status_code = 200 if status["status"] == "ok" else 503
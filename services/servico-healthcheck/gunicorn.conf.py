@@ -0,0 +1,30 @@
+# services/servico-healthcheck/gunicorn.conf.py
+# Configuração do servidor WSGI de produção. Todos os valores podem ser ajustados por
+# variáveis de ambiente, sem rebuild da imagem.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8008')}"
+
+# gthread: cada worker atende várias requisições em threads, o que combina com as
+# chamadas bloqueantes de I/O (Firestore, Kafka, HTTP). Para usar gevent é preciso
+# instalar o pacote e desligar o preload (GUNICORN_PRELOAD=false), já que o monkey
+# patching tem de acontecer antes da importação da aplicação.
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+# Com preload a aplicação é importada uma vez no master e compartilhada (copy-on-write)
+# entre os workers, reduzindo memória e tempo de boot.
+preload_app = os.environ.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 0))
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.environ.get('GUNICORN_LOG_LEVEL', 'info')
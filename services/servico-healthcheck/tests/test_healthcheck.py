@@ -3,12 +3,14 @@ import unittest.mock as mock
 import os
 import requests
 import sys
+import time
 
 # Adiciona o diretório raiz do serviço ao sys.path
 service_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 if service_root not in sys.path:
     sys.path.insert(0, service_root)
 
+from api import index as api_index
 from api.index import app, SERVICES_TO_MONITOR
 
 @pytest.fixture
@@ -31,6 +33,22 @@ def mock_env_vars():
     }):
         yield
 
+@pytest.fixture(autouse=True)
+def reset_health_cache():
+    # Cada teste começa com o cache vazio para não reaproveitar resultados de outro teste
+    with api_index.health_cache_lock:
+        api_index.health_cache["status"] = None
+        api_index.health_cache["checked_at"] = 0.0
+    yield
+
+def ok_response():
+    mock_response = mock.Mock()
+    mock_response.status_code = 200
+    mock_response.json.return_value = {"status": "ok"}
+    mock_response.text = '{"status": "ok"}'
+    mock_response.raise_for_status.return_value = None
+    return mock_response
+
 def test_health_check_all_services_ok(client):
     with mock.patch('api.index.requests.get') as mock_get:
         # Configure mock_get to return a successful response for all services
@@ -48,7 +66,7 @@ def test_health_check_all_services_ok(client):
         for service_name in SERVICES_TO_MONITOR.keys():
             assert response.json['services'][service_name]['status'] == 'ok'
             # Check that requests.get was called for each service
-            health_path = "/api/health"
+            health_path = "/api/health/ready"
             expected_url = os.environ.get(SERVICES_TO_MONITOR[service_name]) + health_path
             assert any(expected_url in call.args[0] for call in mock_get.call_args_list)
 
@@ -105,4 +123,57 @@ def test_health_check_service_url_not_configured(client):
             assert response.json['services']['servico_usuarios']['status'] == 'unavailable'
             assert response.json['services']['servico_usuarios']['details'] == 'URL not configured'
             # Ensure other services are still reported as ok
-            assert response.json['services']['servico_produtos']['status'] == 'ok'
\ No newline at end of file
+            assert response.json['services']['servico_produtos']['status'] == 'ok'
+
+def test_health_check_runs_services_concurrently(client):
+    # Cada serviço demora 0.3s; em sequência seriam mais de 2s
+    def slow_get(url, *args, **kwargs):
+        time.sleep(0.3)
+        return ok_response()
+
+    with mock.patch('api.index.requests.get', side_effect=slow_get):
+        started = time.monotonic()
+        response = client.get('/api/health')
+        elapsed = time.monotonic() - started
+
+    assert response.status_code == 200
+    assert elapsed < 0.3 * len(SERVICES_TO_MONITOR) / 2
+
+def test_health_check_overall_deadline(client):
+    def hanging_get(url, *args, **kwargs):
+        if "mock-ai-service" in url:
+            time.sleep(1)
+        return ok_response()
+
+    with mock.patch.object(api_index, 'OVERALL_DEADLINE_SECONDS', 0.2), \
+         mock.patch('api.index.requests.get', side_effect=hanging_get):
+        started = time.monotonic()
+        response = client.get('/api/health')
+        elapsed = time.monotonic() - started
+
+    assert elapsed < 1
+    assert response.status_code == 503
+    assert response.json['services']['servico_agentes_ia']['status'] == 'timeout'
+    assert response.json['services']['servico_busca']['status'] == 'ok'
+
+def test_health_check_uses_cache_within_ttl(client):
+    with mock.patch('api.index.requests.get', return_value=ok_response()) as mock_get:
+        first = client.get('/api/health')
+        second = client.get('/api/health')
+
+    assert first.status_code == second.status_code == 200
+    assert first.json['checked_at'] == second.json['checked_at']
+    assert mock_get.call_count == len(SERVICES_TO_MONITOR)
+
+def test_health_check_expired_cache_refreshed_in_background(client):
+    with mock.patch.object(api_index, 'CACHE_TTL_SECONDS', 0), \
+         mock.patch.object(api_index, 'BACKGROUND_REFRESH', True), \
+         mock.patch.object(api_index, 'refresh_health_cache_in_background') as mock_background, \
+         mock.patch('api.index.requests.get', return_value=ok_response()) as mock_get:
+        first = client.get('/api/health')
+        second = client.get('/api/health')
+
+    # O segundo acesso devolve o resultado anterior e agenda a atualização
+    assert second.json['checked_at'] == first.json['checked_at']
+    assert mock_get.call_count == len(SERVICES_TO_MONITOR)
+    mock_background.assert_called_once()
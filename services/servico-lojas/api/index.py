@@ -2,29 +2,15 @@ from dotenv import load_dotenv
 load_dotenv(dotenv_path='.env.local')
 
 import os
-import json
+import sys
 import uuid
-import requests
-from datetime import datetime, timezone
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import base64
 
 # --- Importações de dependências ---1
-try:
-    import firebase_admin
-    from firebase_admin import credentials, auth, firestore
-except ImportError:
-    firebase_admin = None
-
-try:
-    from confluent_kafka import Producer
-except ImportError:
-    Producer = None
-
 try:
     from sqlalchemy import create_engine, Column, String, MetaData, text
-    from sqlalchemy.orm import sessionmaker, declarative_base
+    from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base
     from sqlalchemy.exc import SQLAlchemyError
     from geoalchemy2 import Geography
     from geoalchemy2.shape import to_shape
@@ -33,7 +19,7 @@ except ImportError:
     SQLAlchemyError = None
     declarative_base = None
     create_engine = None
-    Column = String = MetaData = sessionmaker = Geography = to_shape = text = None
+    Column = String = MetaData = sessionmaker = scoped_session = Geography = to_shape = text = None
     urlparse = urlunparse = parse_qs = urlencode = None
 
 # --- Variáveis globais para erros de inicialização ---
@@ -42,65 +28,73 @@ postgres_init_error = None
 kafka_producer_init_error = None # Renamed for clarity
 db_init_error = None
 
+# --- Pacote compartilhado (services/common) ---
+# No repositório e nas imagens Docker o pacote fica na pasta pai do serviço; no deploy do
+# Vercel ele é copiado para dentro da pasta do serviço (ver .github/actions/deploy-service).
+SERVICE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+for common_parent in (os.path.dirname(SERVICE_ROOT), SERVICE_ROOT):
+    if os.path.isdir(os.path.join(common_parent, 'common')) and common_parent not in sys.path:
+        sys.path.insert(0, common_parent)
+
+from common import firebase, kafka, outbox, permissions, health, tokens, service
+from common.lazy import lazy_import, NOT_INITIALIZED
+
+auth = lazy_import('firebase_admin.auth')
+firestore = lazy_import('firebase_admin.firestore')
+
 # --- Configuração do Flask ---
 app = Flask(__name__)
 CORS(app, supports_credentials=True, origins=['http://localhost:3000', 'https://frontend-tester-1foc8lpkl-jeanmnorhens-projects.vercel.app'])
 
 # --- Configuração do Firebase (PADRONIZADO) ---
-db = None
-if firebase_admin:
-    try:
-        base64_sdk = os.environ.get('FIREBASE_ADMIN_SDK_BASE64')
-        if base64_sdk:
-            decoded_sdk = base64.b64decode(base64_sdk).decode('utf-8')
-            cred_dict = json.loads(decoded_sdk)
-            cred = credentials.Certificate(cred_dict)
-            if not firebase_admin._apps:
-                firebase_admin.initialize_app(cred)
-            db = firestore.client()
-            print("Firebase inicializado com sucesso.")
-        else:
-            firebase_init_error = "Variável de ambiente FIREBASE_ADMIN_SDK_BASE64 não encontrada."
-            print(firebase_init_error)
-    except Exception as e:
-        firebase_init_error = str(e)
-        print(f"Erro ao inicializar Firebase: {e}")
-else:
-    firebase_init_error = "Biblioteca firebase_admin não encontrada."
+db = NOT_INITIALIZED
+
+def init_firebase():
+    global db, firebase_init_error
+    db, firebase_init_error = firebase.get_firestore_client()
+
+# --- Verificação de ID tokens com cache ---
+def verify_id_token(id_token):
+    return auth.verify_id_token(id_token)
+
+token_verifier = tokens.CachedTokenVerifier(verify_id_token)
 
 # --- Configuração do PostgreSQL (PostGIS) (PADRONIZADO) ---
-db_session = None
+db_session = NOT_INITIALIZED
 engine = None
-if create_engine:
-    try:
-        db_url = os.environ.get('POSTGRES_POSTGRES_URL')
-        if db_url:
-            if db_url.startswith("postgres://"):
-                db_url = db_url.replace("postgres://", "postgresql://", 1)
-            
-            cleaned_url = db_url
-            if urlparse:
-                try:
-                    parsed_url = urlparse(db_url)
-                    query_params = parse_qs(parsed_url.query)
-                    query_params.pop('supa', None)
-                    new_query = urlencode(query_params, doseq=True)
-                    cleaned_url = urlunparse(parsed_url._replace(query=new_query))
-                except Exception:
-                    pass # Usa a URL original se o parse falhar
-
-            engine = create_engine(cleaned_url)
-            Session = sessionmaker(bind=engine)
-            db_session = Session()
-            print("Conexão com PostgreSQL (PostGIS) estabelecida com sucesso.")
-        else:
-            postgres_init_error = "Variável de ambiente POSTGRES_POSTGRES_URL não encontrada."
-            print(postgres_init_error)
-    except Exception as e:
-        postgres_init_error = str(e)
-        print(f"Erro ao conectar com PostgreSQL: {e}")
-else:
-    postgres_init_error = "SQLAlchemy não encontrado."
+
+def init_postgres():
+    global db_session, engine, postgres_init_error
+    db_session = None
+    if create_engine:
+        try:
+            db_url = os.environ.get('POSTGRES_POSTGRES_URL')
+            if db_url:
+                if db_url.startswith("postgres://"):
+                    db_url = db_url.replace("postgres://", "postgresql://", 1)
+
+                cleaned_url = db_url
+                if urlparse:
+                    try:
+                        parsed_url = urlparse(db_url)
+                        query_params = parse_qs(parsed_url.query)
+                        query_params.pop('supa', None)
+                        new_query = urlencode(query_params, doseq=True)
+                        cleaned_url = urlunparse(parsed_url._replace(query=new_query))
+                    except Exception:
+                        pass # Usa a URL original se o parse falhar
+
+                engine = create_engine(cleaned_url)
+                db_session = scoped_session(sessionmaker(bind=engine))
+                print("Conexão com PostgreSQL (PostGIS) estabelecida com sucesso.")
+            else:
+                postgres_init_error = "Variável de ambiente POSTGRES_POSTGRES_URL não encontrada."
+                print(postgres_init_error)
+        except Exception as e:
+            postgres_init_error = str(e)
+            print(f"Erro ao conectar com PostgreSQL: {e}")
+    else:
+        postgres_init_error = "SQLAlchemy não encontrado."
 
 # --- Definição do Modelo de Dados Geoespacial ---
 Base = declarative_base() if declarative_base else object
@@ -111,6 +105,9 @@ if Base != object and Geography:
         store_id = Column(String, primary_key=True)
         location = Column(Geography(geometry_type='POINT', srid=4326), nullable=False)
 
+    # Eventos gravados na mesma transação das linhas acima (ver common/outbox.py).
+    OutboxEvent = outbox.define_outbox_model(Base, 'outbox_lojas')
+
 def init_db():
     global db_init_error
     if not engine:
@@ -123,80 +120,56 @@ def init_db():
         return
     try:
         Base.metadata.create_all(engine)
-        print("Tabela 'store_locations' verificada/criada com sucesso.")
+        print("Tabelas 'store_locations' e 'outbox_lojas' verificadas/criadas com sucesso.")
     except Exception as e:
         db_init_error = str(e)
-        print(f"Erro ao criar tabela 'store_locations': {e}")
+        print(f"Erro ao criar tabelas do banco de dados: {e}")
 
 # --- Configuração do Kafka Producer ---
-producer = None
-if Producer:
-    try:
-        kafka_bootstrap_server = os.environ.get('KAFKA_BOOTSTRAP_SERVER')
-        if kafka_bootstrap_server:
-            # Local Docker Kafka configuration
-            print("Configurando produtor Kafka para ambiente local (sem SASL)...")
-            kafka_conf = {
-                'bootstrap.servers': kafka_bootstrap_server
-            }
-            producer = Producer(kafka_conf)
-            print("Produtor Kafka inicializado com sucesso.")
-        else:
-            kafka_producer_init_error = "Variáveis de ambiente do Kafka não encontradas."
-            print(kafka_producer_init_error)
-    except Exception as e:
-        kafka_producer_init_error = str(e)
-        print(f"Erro ao inicializar Produtor Kafka: {e}")
-else:
-    kafka_producer_init_error = "Biblioteca confluent_kafka não encontrada."
-
-def delivery_report(err, msg):
-    if err is not None:
-        print(f'Falha ao entregar mensagem Kafka: {err}')
-    else:
-        print(f'Mensagem Kafka entregue em {msg.topic()} [{msg.partition()}]')
-
-def publish_event(topic, event_type, store_id, data, changes=None):
-    if not producer:
-        print("Produtor Kafka não está inicializado. Evento não publicado.")
-        return
-    event = {
-        "event_type": event_type,
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "store_id": store_id,
-        "data": data,
-        "source_service": "servico-lojas"
-    }
-    if changes:
-        event["changes"] = changes
-    try:
-        event_value = json.dumps(event, default=str)
-        producer.produce(topic, key=store_id, value=event_value, callback=delivery_report)
-        producer.poll(0)
-        print(f"Evento '{event_type}' para a loja {store_id} publicado no tópico {topic}.")
-    except Exception as e:
-        print(f"Erro ao publicar evento Kafka: {e}")
+producer = NOT_INITIALIZED
+
+def init_kafka_producer():
+    global producer, kafka_producer_init_error
+    producer, kafka_producer_init_error = kafka.get_producer()
+
+# --- Inicialização dos clientes ---
+# Sob demanda, na primeira requisição e no post_fork do gunicorn (common/service.py).
+def create_clients():
+    if db is NOT_INITIALIZED:
+        init_firebase()
+        if db:
+            token_verifier.start_key_refresher()
+    if db_session is NOT_INITIALIZED:
+        init_postgres()
+    if producer is NOT_INITIALIZED:
+        init_kafka_producer()
+
+init_clients = service.lazy_clients(app, create_clients)
+
+@app.teardown_request
+def flush_kafka_producer(exception=None):
+    # Em serverless o processo pode ser congelado logo após a resposta; sem o flush os
+    # eventos da requisição ficariam presos no buffer do produtor.
+    kafka.flush_if_serverless()
+
+@app.teardown_appcontext
+def remove_db_session(exception=None):
+    # Cada thread do worker tem a sua própria sessão, descartada ao fim da requisição.
+    if db_session not in (None, NOT_INITIALIZED):
+        db_session.remove()
+
+def enqueue_event(topic, event_type, store_id, data, changes=None):
+    # Só é publicado pelo relay depois do commit de db_session.
+    outbox.add_event(db_session, OutboxEvent, topic, event_type, 'store_id', store_id, data, 'servico-lojas', changes)
+
+def relay_outbox_batch():
+    return outbox.relay_batch(db_session, OutboxEvent, producer)
+
+permission_client = permissions.PermissionClient()
 
 def check_permission(user_id, store_id):
     """Chama o servico-usuarios para verificar se um usuário tem permissão para gerenciar uma loja."""
-    servico_usuarios_url = os.environ.get('SERVICO_USUARIOS_URL')
-    if not servico_usuarios_url:
-        print("ERRO: SERVICO_USUARIOS_URL não configurado.")
-        return False, {"error": "URL do serviço de permissões não configurada."}
-
-    try:
-        response = requests.get(
-            f"{servico_usuarios_url}/api/permissions/check",
-            params={'user_id': user_id, 'store_id': store_id},
-            timeout=5
-        )
-        if response.status_code == 200:
-            return response.json().get('allow', False), response.json()
-        else:
-            return False, response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Erro ao contatar o serviço de permissões: {e}")
-        return False, {"error": "Falha ao contatar o serviço de permissões."}
+    return permission_client.check(user_id, store_id)
 
 # --- Rotas da API ---
 
@@ -238,7 +211,7 @@ def create_store():
 
     try:
         id_token = auth_header.split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = token_verifier.verify(id_token)
         uid = decoded_token['uid']
     except Exception as e:
         return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
@@ -266,23 +239,10 @@ def create_store():
 
         db.collection('stores').document(store_id).set(firestore_data)
 
-        # Etapa 2: Chamar servico-usuarios para atribuir o papel de 'owner'
-        servico_usuarios_url = os.environ.get('SERVICO_USUARIOS_URL')
-        internal_secret = os.environ.get('INTERNAL_SERVICE_SECRET')
-        if not servico_usuarios_url or not internal_secret:
-            raise Exception("URL do serviço de usuários ou segredo interno não configurado.")
-
-        role_payload = {'user_id': uid, 'store_id': store_id, 'role': 'owner'}
-        headers = {'Authorization': f'Bearer {internal_secret}', 'Content-Type': 'application/json'}
-        
-        response = requests.post(f"{servico_usuarios_url}/internal/roles", json=role_payload, headers=headers, timeout=5)
-        response.raise_for_status() # Lança uma exceção para status de erro (4xx ou 5xx)
-
-        # Etapa 3: Se tudo deu certo, commitar a transação no banco de dados local
+        # Etapa 2: Localização e evento StoreCreated no mesmo commit. O servico-usuarios
+        # atribui o papel de 'owner' ao consumir o evento (owner_uid).
+        enqueue_event('eventos_lojas', 'StoreCreated', store_id, {**store_data, 'owner_uid': uid})
         db_session.commit()
-
-        # Etapa 4: Publicar evento de sucesso
-        publish_event('eventos_lojas', 'StoreCreated', store_id, store_data)
         return jsonify({"message": "Store created successfully", "storeId": store_id}), 201
 
     except Exception as e:
@@ -291,7 +251,7 @@ def create_store():
         # Tentar deletar o documento no Firestore se ele já foi criado
         db.collection('stores').document(store_id).delete()
         print(f"ERRO na criação da loja: {e}")
-        return jsonify({"error": f"Erro ao criar loja ou atribuir papel: {e}"}), 500
+        return jsonify({"error": f"Erro ao criar loja: {e}"}), 500
 
 @app.route('/api/stores/<store_id>', methods=['GET'])
 def get_store(store_id):
@@ -327,7 +287,7 @@ def update_store(store_id):
 
     try:
         id_token = auth_header.split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = token_verifier.verify(id_token)
         uid = decoded_token['uid']
     except Exception as e:
         return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
@@ -366,9 +326,8 @@ def update_store(store_id):
         if firestore_data:
             store_ref.update(firestore_data)
 
+        enqueue_event('eventos_lojas', 'StoreUpdated', store_id, update_data)
         db_session.commit()
-
-        publish_event('eventos_lojas', 'StoreUpdated', store_id, update_data)
         return jsonify({"message": "Loja atualizada com sucesso.", "storeId": store_id}), 200
 
     except SQLAlchemyError as e:
@@ -389,7 +348,7 @@ def delete_store(store_id):
 
     try:
         id_token = auth_header.split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = token_verifier.verify(id_token)
         uid = decoded_token['uid']
     except Exception as e:
         return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
@@ -410,9 +369,8 @@ def delete_store(store_id):
             db_session.delete(location_record)
 
         store_ref.delete()
+        enqueue_event('eventos_lojas', 'StoreDeleted', store_id, {"store_id": store_id})
         db_session.commit()
-
-        publish_event('eventos_lojas', 'StoreDeleted', store_id, {"store_id": store_id})
         return '', 204
 
     except SQLAlchemyError as e:
@@ -422,24 +380,44 @@ def delete_store(store_id):
         db_session.rollback()
         return jsonify({"error": f"Erro ao deletar loja: {e}"}), 500
 
-def get_health_status():
-    env_vars = {
-        "FIREBASE_ADMIN_SDK_BASE64": "present" if os.environ.get('FIREBASE_ADMIN_SDK_BASE64') else "missing",
-        "POSTGRES_POSTGRES_URL": "present" if os.environ.get('POSTGRES_POSTGRES_URL') else "missing",
-        "KAFKA_BOOTSTRAP_SERVER": "present" if os.environ.get('KAFKA_BOOTSTRAP_SERVER') else "missing",
-        "KAFKA_API_KEY": "present" if os.environ.get('KAFKA_API_KEY') else "missing",
-        "KAFKA_API_SECRET": "present" if os.environ.get('KAFKA_API_SECRET') else "missing"
-    }
+@app.route('/internal/outbox/relay', methods=['POST', 'GET'])
+def relay_outbox():
+    # Chamada pelo cron (Vercel); em Docker o worker.py faz o mesmo em laço.
+    if not service.is_cron_request():
+        return jsonify({"error": "Unauthorized"}), 401
+
+    if not db_session or not producer:
+        return jsonify({"error": "Dependências de banco de dados ou Kafka não inicializadas."}), 503
+
+    try:
+        relayed = relay_outbox_batch()
+    except Exception as e:
+        return jsonify({"error": f"Erro ao publicar eventos da outbox: {e}"}), 500
+    return jsonify({"status": "ok", "events_relayed": relayed}), 200
 
+def ping_postgres():
+    try:
+        db_session.execute(text('SELECT 1'))
+    finally:
+        # A readiness roda em threads de fundo, e a sessão do scoped_session é por thread:
+        # sem o remove a conexão ficaria presa fora do pool.
+        db_session.remove()
+
+def get_health_status(include_latencies=False):
+    env_vars = health.env_var_status([
+        'FIREBASE_ADMIN_SDK_BASE64',
+        'POSTGRES_POSTGRES_URL',
+        'KAFKA_BOOTSTRAP_SERVER',
+        'KAFKA_API_KEY',
+        'KAFKA_API_SECRET'
+    ])
+
+    latencies_ms = {}
     pg_status = "error"
     pg_query_error = None
     if db_session and text:
-        try:
-            db_session.execute(text('SELECT 1'))
-            pg_status = "ok"
-        except Exception as e:
-            pg_query_error = str(e)
-            pg_status = f"error during query: {pg_query_error}"
+        pg_query_error, latencies_ms["postgresql_connection"] = health.timed_check(ping_postgres)
+        pg_status = f"error during query: {pg_query_error}" if pg_query_error else "ok"
 
     status = {
         "environment_variables": env_vars,
@@ -457,25 +435,36 @@ def get_health_status():
             "kafka_producer": kafka_producer_init_error
         }
     }
+    if include_latencies:
+        status["latencies_ms"] = latencies_ms
     return status
 
-@app.route('/api/health', methods=['GET'])
-def health_check():
-    status = get_health_status()
-    
-    all_ok = (
+def is_healthy(status):
+    return (
         all(value == "present" for value in status["environment_variables"].values()) and
         status["dependencies"]["firestore"] == "ok" and
         status["dependencies"]["kafka_producer"] == "ok" and
         status["dependencies"]["postgresql_connection"] == "ok" and
         status["dependencies"]["table_initialization"] == "ok"
     )
-    http_status = 200 if all_ok else 503
+
+@app.route('/api/health', methods=['GET'])
+def health_check():
+    status = get_health_status()
+    http_status = 200 if is_healthy(status) else 503
     
     return jsonify(status), http_status
 
-# --- Inicialização ---
-init_db()
+service.register_metrics_route(app, token_verifier)
+
+# --- Readiness memoizada ---
+def build_readiness_status():
+    status = get_health_status(include_latencies=True)
+    status["status"] = "ok" if is_healthy(status) else "degraded"
+    return status
+
+readiness = service.register_probe_routes(app, build_readiness_status)
+readiness_cache = readiness.cache
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,15 @@
+# services/servico-lojas/gunicorn.conf.py
+# Configuração do gunicorn: os valores e os ganchos de fork estão em common/gunicorn_config.py.
+import os
+import sys
+
+SERVICE_ROOT = os.path.dirname(os.path.abspath(__file__))
+for common_parent in (os.path.dirname(SERVICE_ROOT), SERVICE_ROOT):
+    if os.path.isdir(os.path.join(common_parent, 'common')) and common_parent not in sys.path:
+        sys.path.insert(0, common_parent)
+
+from common import gunicorn_config
+
+globals().update(gunicorn_config.settings(default_port='8005'))
+post_fork = gunicorn_config.post_fork
+worker_exit = gunicorn_config.worker_exit
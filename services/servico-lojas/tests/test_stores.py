@@ -55,7 +55,7 @@ def mock_dependencies():
          patch.object(api_index, 'producer', MagicMock()) as mock_producer, \
          patch.object(api_index, 'auth', MagicMock()) as mock_auth, \
          patch.object(api_index, 'check_permission', return_value=(True, "ok")) as mock_check_permission, \
-         patch.object(api_index, 'publish_event', MagicMock()) as mock_publish_event, \
+         patch.object(api_index, 'enqueue_event', MagicMock()) as mock_enqueue_event, \
          patch.object(api_index, 'to_shape', return_value=MockPoint(x=-46.6, y=-23.5)) as mock_to_shape, \
          patch.object(api_index, 'firebase_init_error', None), \
          patch.object(api_index, 'postgres_init_error', None), \
@@ -82,7 +82,7 @@ def mock_dependencies():
             "producer": mock_producer,
             "auth": mock_auth,
             "check_permission": mock_check_permission,
-            "publish_event": mock_publish_event,
+            "enqueue_event": mock_enqueue_event,
             "to_shape": mock_to_shape
         }
 
@@ -99,7 +99,7 @@ def test_update_store_success(client, mock_dependencies):
     assert response.json['storeId'] == 'test_store_123'
     mock_dependencies["check_permission"].assert_called_once_with('test_user_uid', 'test_store_123')
     mock_dependencies["db"].collection('stores').document('test_store_123').update.assert_called_once()
-    mock_dependencies["publish_event"].assert_called_once()
+    mock_dependencies["enqueue_event"].assert_called_once()
 
 def test_update_store_unauthorized(client, mock_dependencies):
     """Test updating a store by an unauthorized user."""
@@ -121,7 +121,7 @@ def test_delete_store_success(client, mock_dependencies):
     assert response.status_code == 204
     mock_dependencies["check_permission"].assert_called_once_with('test_user_uid', 'test_store_123')
     mock_dependencies["db"].collection('stores').document('test_store_123').delete.assert_called_once()
-    mock_dependencies["publish_event"].assert_called_once()
+    mock_dependencies["enqueue_event"].assert_called_once()
 
 def test_delete_store_unauthorized(client, mock_dependencies):
     """Test deleting a store by an unauthorized user."""
@@ -138,12 +138,32 @@ def test_delete_store_unauthorized(client, mock_dependencies):
 def test_create_store_with_location(client, mock_dependencies):
     """Test creating a store with location data."""
     headers = {"Authorization": "Bearer fake_token"}
-    with patch('api.index.requests.post') as mock_post:
-        mock_post.return_value.raise_for_status.return_value = None
-        store_data = {"name": "New Store", "location": {"latitude": -23.5, "longitude": -46.6}}
-        response = client.post('/api/stores', headers=headers, json=store_data)
-        assert response.status_code == 201
-        assert "storeId" in response.json
+    store_data = {"name": "New Store", "location": {"latitude": -23.5, "longitude": -46.6}}
+    response = client.post('/api/stores', headers=headers, json=store_data)
+    assert response.status_code == 201
+    assert "storeId" in response.json
+
+    # Localização e evento saem no mesmo commit; o papel de owner vem do StoreCreated.
+    mock_dependencies["db_session"].add.assert_called_once()
+    mock_dependencies["db_session"].commit.assert_called_once()
+    args, _ = mock_dependencies["enqueue_event"].call_args
+    assert args[:3] == ('eventos_lojas', 'StoreCreated', response.json["storeId"])
+    assert args[3]["owner_uid"] == 'test_user_uid'
+
+def test_create_store_rolls_back_when_commit_fails(client, mock_dependencies):
+    mock_dependencies["db_session"].commit.side_effect = Exception("db down")
+    response = client.post('/api/stores', headers={"Authorization": "Bearer fake_token"}, json={"name": "New Store"})
+    assert response.status_code == 500
+    mock_dependencies["db_session"].rollback.assert_called_once()
+    mock_dependencies["db"].collection('stores').document.return_value.delete.assert_called_once()
+
+def test_relay_outbox_requires_cron_secret(client):
+    with patch.dict(os.environ, {"CRON_SECRET": "cron"}):
+        assert client.post('/internal/outbox/relay').status_code == 401
+        with patch.object(api_index, 'relay_outbox_batch', return_value=3):
+            response = client.post('/internal/outbox/relay', headers={"Authorization": "Bearer cron"})
+    assert response.status_code == 200
+    assert response.json["events_relayed"] == 3
 
 def test_get_store_with_location(client, mock_dependencies):
     """Test getting a store who has a location in PostGIS."""
@@ -168,4 +188,33 @@ def test_health_check_pg_error(client, mock_dependencies):
     """Test health check when PostgreSQL is down."""
     mock_dependencies["db_session"].execute.side_effect = Exception("Connection failed")
     response = client.get('/api/health')
-    assert response.status_code == 503
\ No newline at end of file
+    assert response.status_code == 503
+
+def test_liveness_check(client):
+    """Liveness não depende de nenhuma dependência externa."""
+    response = client.get('/api/health/live')
+    assert response.status_code == 200
+    assert response.json == {"status": "ok"}
+
+def test_readiness_check_is_memoized(client, mock_dependencies):
+    """Readiness reaproveita o resultado das verificações dentro da janela de cache."""
+    with patch.dict(api_index.readiness_cache, {"status": None, "checked_at": 0.0}), \
+         patch.object(api_index, 'get_health_status', wraps=api_index.get_health_status) as spy:
+        first = client.get('/api/health/ready')
+        second = client.get('/api/health/ready')
+
+    assert first.status_code == second.status_code == 200
+    assert first.json["status"] == "ok"
+    assert "latencies_ms" in first.json
+    assert spy.call_count == 1
+    mock_dependencies["db_session"].execute.assert_called_once()
+    assert "postgresql_connection" in first.json["latencies_ms"]
+
+def test_postgres_ping_releases_the_thread_session():
+    """A readiness roda em threads de fundo: a sessão delas é descartada mesmo com erro."""
+    session = MagicMock()
+    session.execute.side_effect = Exception("Connection failed")
+    with patch.object(api_index, 'db_session', session):
+        error, _ = api_index.health.timed_check(api_index.ping_postgres)
+    assert error == "Connection failed"
+    session.remove.assert_called_once()
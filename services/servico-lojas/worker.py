@@ -0,0 +1,22 @@
+# services/servico-lojas/worker.py
+# Processo de fundo do serviço: publica no Kafka os eventos gravados na outbox
+# (tabela outbox_lojas). No Vercel o mesmo trabalho é feito pelo cron em /internal/outbox/relay.
+#     python worker.py
+import sys
+
+from api import index
+from common import workers
+
+
+def main():
+    index.init_clients()
+    if not index.db_session or not index.producer:
+        print(f"Worker não iniciado: {index.postgres_init_error or index.kafka_producer_init_error}")
+        return 1
+    print("Relay da outbox iniciado.")
+    workers.run_forever([index.relay_outbox_batch])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
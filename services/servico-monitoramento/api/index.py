@@ -2,16 +2,25 @@ from dotenv import load_dotenv
 load_dotenv(dotenv_path='.env.local')
 
 import os
-import json
+import sys
 from datetime import datetime, timezone
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
 from confluent_kafka import Consumer, KafkaException
 
 import requests
 
+# --- Pacote compartilhado (services/common) ---
+# No repositório e nas imagens Docker o pacote fica na pasta pai do serviço; no deploy do
+# Vercel ele é copiado para dentro da pasta do serviço (ver .github/actions/deploy-service).
+SERVICE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+for common_parent in (os.path.dirname(SERVICE_ROOT), SERVICE_ROOT):
+    if os.path.isdir(os.path.join(common_parent, 'common')) and common_parent not in sys.path:
+        sys.path.insert(0, common_parent)
+
+from common import events, health, service
+from common.lazy import NOT_INITIALIZED
+
 app = Flask(__name__)
 CORS(app, supports_credentials=True, origins=['https://frontend-tester-1foc8lpkl-jeanmnorhens-projects.vercel.app'])
 
@@ -20,59 +29,77 @@ influxdb_init_error = None
 kafka_consumer_init_error = None
 
 # --- InfluxDB Configuration ---
-influxdb_client = None
+influxdb_client = NOT_INITIALIZED
 influxdb_write_api = None
 influxdb_bucket = None
-try:
-    influxdb_url = os.environ.get('INFLUXDB_URL')
-    influxdb_token = os.environ.get('INFLUXDB_TOKEN')
-    influxdb_org = os.environ.get('INFLUXDB_ORG')
-    influxdb_bucket = os.environ.get('INFLUXDB_BUCKET')
-
-    if influxdb_url and influxdb_token and influxdb_org and influxdb_bucket:
-        influxdb_client = InfluxDBClient(url=influxdb_url, token=influxdb_token, org=influxdb_org)
-        influxdb_write_api = influxdb_client.write_api(write_options=SYNCHRONOUS)
-        print("InfluxDB inicializado com sucesso.")
-    else:
-        influxdb_init_error = "Variáveis de ambiente do InfluxDB não encontradas."
-        print(influxdb_init_error)
-except Exception as e:
-    influxdb_init_error = str(e)
-    print(f"Erro ao inicializar InfluxDB: {e}")
 
-# --- Kafka Consumer Configuration ---
-kafka_consumer_instance = None
-if Consumer:
+def init_influxdb():
+    global influxdb_client, influxdb_write_api, influxdb_bucket, influxdb_init_error
+    from influxdb_client import InfluxDBClient
+    from influxdb_client.client.write_api import SYNCHRONOUS
+    influxdb_client = None
     try:
-        kafka_bootstrap_server = os.environ.get('KAFKA_BOOTSTRAP_SERVER')
-        if kafka_bootstrap_server:
-            # Local Docker Kafka configuration
-            print("Configurando consumidor Kafka para ambiente local (sem SASL)...")
-            kafka_conf = {
-                'bootstrap.servers': kafka_bootstrap_server,
-                'group.id': 'monitoring_service_group_v2',
-                'auto.offset.reset': 'earliest'
-            }
-            kafka_consumer_instance = Consumer(kafka_conf)
-            kafka_consumer_instance.subscribe(['eventos_ofertas'])
-            print("Consumidor Kafka inicializado com sucesso.")
+        influxdb_url = os.environ.get('INFLUXDB_URL')
+        influxdb_token = os.environ.get('INFLUXDB_TOKEN')
+        influxdb_org = os.environ.get('INFLUXDB_ORG')
+        influxdb_bucket = os.environ.get('INFLUXDB_BUCKET')
+
+        if influxdb_url and influxdb_token and influxdb_org and influxdb_bucket:
+            influxdb_client = InfluxDBClient(url=influxdb_url, token=influxdb_token, org=influxdb_org)
+            influxdb_write_api = influxdb_client.write_api(write_options=SYNCHRONOUS)
+            print("InfluxDB inicializado com sucesso.")
         else:
-            kafka_consumer_init_error = "Variáveis de ambiente do Kafka não encontradas para o consumidor."
-            print(kafka_consumer_init_error)
+            influxdb_init_error = "Variáveis de ambiente do InfluxDB não encontradas."
+            print(influxdb_init_error)
     except Exception as e:
-        kafka_consumer_init_error = str(e)
-        print(f"Erro ao inicializar Consumidor Kafka: {e}")
-else:
-    kafka_consumer_init_error = "Biblioteca confluent_kafka não encontrada."
+        influxdb_init_error = str(e)
+        print(f"Erro ao inicializar InfluxDB: {e}")
+
+# --- Kafka Consumer Configuration ---
+kafka_consumer_instance = NOT_INITIALIZED
+
+def init_kafka_consumer():
+    global kafka_consumer_instance, kafka_consumer_init_error
+    kafka_consumer_instance = None
+    if Consumer:
+        try:
+            kafka_bootstrap_server = os.environ.get('KAFKA_BOOTSTRAP_SERVER')
+            if kafka_bootstrap_server:
+                # Local Docker Kafka configuration
+                print("Configurando consumidor Kafka para ambiente local (sem SASL)...")
+                kafka_conf = {
+                    'bootstrap.servers': kafka_bootstrap_server,
+                    'group.id': 'monitoring_service_group_v2',
+                    'auto.offset.reset': 'earliest'
+                }
+                kafka_consumer_instance = Consumer(kafka_conf)
+                kafka_consumer_instance.subscribe(['eventos_ofertas'])
+                print("Consumidor Kafka inicializado com sucesso.")
+            else:
+                kafka_consumer_init_error = "Variáveis de ambiente do Kafka não encontradas para o consumidor."
+                print(kafka_consumer_init_error)
+        except Exception as e:
+            kafka_consumer_init_error = str(e)
+            print(f"Erro ao inicializar Consumidor Kafka: {e}")
+    else:
+        kafka_consumer_init_error = "Biblioteca confluent_kafka não encontrada."
+
+# --- Inicialização dos clientes ---
+# Sob demanda, na primeira requisição e no post_fork do gunicorn (common/service.py).
+def create_clients():
+    if influxdb_client is NOT_INITIALIZED:
+        init_influxdb()
+    if kafka_consumer_instance is NOT_INITIALIZED:
+        init_kafka_consumer()
+
+init_clients = service.lazy_clients(app, create_clients)
 
 # --- API Routes ---
 
 @app.route('/api/monitoring/consume', methods=['POST', 'GET'])
 def consume_and_write_prices():
     # Security check for cron job
-    auth_header = request.headers.get('Authorization')
-    cron_secret = os.environ.get('CRON_SECRET')
-    if not cron_secret or auth_header != f'Bearer {cron_secret}':
+    if not service.is_cron_request():
         return jsonify({"error": "Unauthorized"}), 401
 
     if not influxdb_write_api:
@@ -81,6 +108,8 @@ def consume_and_write_prices():
     if not kafka_consumer_instance:
         return jsonify({"error": "Consumidor Kafka não pôde ser criado.", "details": kafka_consumer_init_error}), 503
 
+    from influxdb_client import Point
+
     messages_processed = 0
     try:
         msgs = kafka_consumer_instance.consume(num_messages=50, timeout=10.0)
@@ -94,7 +123,7 @@ def consume_and_write_prices():
                 continue
             
             try:
-                event_data = json.loads(msg.value().decode('utf-8'))
+                event_data = events.decode_event(msg.value())
                 data = event_data.get('data', {})
                 
                 product_id = data.get('product_id')
@@ -108,7 +137,7 @@ def consume_and_write_prices():
                         .time(timestamp)
                     points_to_write.append(point)
                     messages_processed += 1
-            except (json.JSONDecodeError, ValueError, TypeError) as e:
+            except (ValueError, TypeError) as e:
                 print(f"Erro ao processar mensagem: {e} - Mensagem: {msg.value()}")
 
         if points_to_write:
@@ -246,24 +275,22 @@ def get_price_averages():
     }
     return jsonify(mock_data), 200
 
-def get_health_status():
-    env_vars = {
-        "INFLUXDB_URL": "present" if os.environ.get('INFLUXDB_URL') else "missing",
-        "INFLUXDB_TOKEN": "present" if os.environ.get('INFLUXDB_TOKEN') else "missing",
-        "INFLUXDB_ORG": "present" if os.environ.get('INFLUXDB_ORG') else "missing",
-        "INFLUXDB_BUCKET": "present" if os.environ.get('INFLUXDB_BUCKET') else "missing",
-        "KAFKA_BOOTSTRAP_SERVER": "present" if os.environ.get('KAFKA_BOOTSTRAP_SERVER') else "missing",
-        "KAFKA_API_KEY": "present" if os.environ.get('KAFKA_API_KEY') else "missing",
-        "KAFKA_API_SECRET": "present" if os.environ.get('KAFKA_API_SECRET') else "missing"
-    }
-
+def get_health_status(include_latencies=False):
+    env_vars = health.env_var_status([
+        'INFLUXDB_URL',
+        'INFLUXDB_TOKEN',
+        'INFLUXDB_ORG',
+        'INFLUXDB_BUCKET',
+        'KAFKA_BOOTSTRAP_SERVER',
+        'KAFKA_API_KEY',
+        'KAFKA_API_SECRET'
+    ])
+
+    latencies_ms = {}
     influx_status = "error"
     if influxdb_client:
-        try:
-            influxdb_client.ping()
-            influx_status = "ok"
-        except Exception as e:
-            influx_status = f"error (ping failed: {e})"
+        ping_error, latencies_ms["influxdb"] = health.timed_check(influxdb_client.ping)
+        influx_status = f"error (ping failed: {ping_error})" if ping_error else "ok"
     else:
         influx_status = "error (not initialized)"
 
@@ -278,21 +305,33 @@ def get_health_status():
             "kafka_consumer": kafka_consumer_init_error
         }
     }
+    if include_latencies:
+        status["latencies_ms"] = latencies_ms
     return status
 
-@app.route('/api/health', methods=['GET'])
-def health_check():
-    status = get_health_status()
-    
-    all_ok = (
+def is_healthy(status):
+    return (
         all(value == "present" for value in status["environment_variables"].values()) and
         status["dependencies"]["influxdb"] == "ok" and
         status["dependencies"]["kafka_consumer"] == "ok"
     )
-    http_status = 200 if all_ok else 503
+
+@app.route('/api/health', methods=['GET'])
+def health_check():
+    status = get_health_status()
+    http_status = 200 if is_healthy(status) else 503
     
     return jsonify(status), http_status
 
+# --- Readiness memoizada ---
+def build_readiness_status():
+    status = get_health_status(include_latencies=True)
+    status["status"] = "ok" if is_healthy(status) else "degraded"
+    return status
+
+readiness = service.register_probe_routes(app, build_readiness_status)
+readiness_cache = readiness.cache
+
 @app.route('/api/metricas/gerais', methods=['GET'])
 def get_general_metrics():
     # URLs from environment variables (set in .env.local)
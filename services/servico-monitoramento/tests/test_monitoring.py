@@ -206,3 +206,23 @@ def test_get_price_averages(client):
     data = response.json
     assert data['product_id'] == 'prod123'
     assert data['region'] == 'sul'
+
+def test_liveness_check(client):
+    """Liveness não depende de nenhuma dependência externa."""
+    response = client.get('/api/health/live')
+    assert response.status_code == 200
+    assert response.json == {"status": "ok"}
+
+def test_readiness_check_is_memoized(client, mock_all_dependencies):
+    """Readiness reaproveita o resultado das verificações dentro da janela de cache."""
+    with patch.dict(api_index.readiness_cache, {"status": None, "checked_at": 0.0}), \
+         patch.object(api_index, 'get_health_status', wraps=api_index.get_health_status) as spy:
+        first = client.get('/api/health/ready')
+        second = client.get('/api/health/ready')
+
+    assert first.status_code == second.status_code == 200
+    assert first.json["status"] == "ok"
+    assert "latencies_ms" in first.json
+    assert spy.call_count == 1
+    mock_all_dependencies["influxdb_client"].ping.assert_called_once()
+    assert "influxdb" in first.json["latencies_ms"]
@@ -1,28 +1,36 @@
 from dotenv import load_dotenv
 load_dotenv(dotenv_path='.env.local')
 
+import csv
+import io
+import math
 import os
-import json
-import base64
-import requests
-from datetime import datetime, timezone
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 
-try:
-    import firebase_admin
-    from firebase_admin import credentials, auth, firestore
-except ImportError:
-    firebase_admin = None
-
-try:
-    from confluent_kafka import Producer
-except ImportError:
-    Producer = None
 
 #  --- Variáveis globais para erros de inicialização ---
 firebase_init_error = None
 kafka_producer_init_error = None
+kafka_consumer_init_error = None
+
+# --- Pacote compartilhado (services/common) ---
+# No repositório e nas imagens Docker o pacote fica na pasta pai do serviço; no deploy do
+# Vercel ele é copiado para dentro da pasta do serviço (ver .github/actions/deploy-service).
+SERVICE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+for common_parent in (os.path.dirname(SERVICE_ROOT), SERVICE_ROOT):
+    if os.path.isdir(os.path.join(common_parent, 'common')) and common_parent not in sys.path:
+        sys.path.insert(0, common_parent)
+
+from common import events, firebase, kafka, outbox, permissions, health, tokens, service
+from common.instrumentation import metrics
+from common.lazy import lazy_import, NOT_INITIALIZED
+
+auth = lazy_import('firebase_admin.auth')
+firestore = lazy_import('firebase_admin.firestore')
 
 # --- Configuração do Flask ---
 app = Flask(__name__)
@@ -30,95 +38,254 @@ CORS(app, supports_credentials=True, origins=['https://frontend-tester-1foc8lpkl
 
 # --- Funções Auxiliares ---1
 
+permission_client = permissions.PermissionClient()
+
 def check_permission(user_id, store_id):
-    servico_usuarios_url = os.environ.get('SERVICO_USUARIOS_URL')
-    if not servico_usuarios_url:
-        print("ERRO: SERVICO_USUARIOS_URL não configurado.")
-        return False, {"error": "URL do serviço de permissões não configurada."}
-    try:
-        response = requests.get(
-            f"{servico_usuarios_url}/api/permissions/check",
-            params={'user_id': user_id, 'store_id': store_id},
-            timeout=5
-        )
-        if response.status_code == 200:
-            return response.json().get('allow', False), response.json()
-        else:
-            return False, response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Erro ao contatar o serviço de permissões: {e}")
-        return False, {"error": "Falha ao contatar o serviço de permissões."}
+    """Chama o servico-usuarios para verificar se um usuário tem permissão para gerenciar uma loja."""
+    return permission_client.check(user_id, store_id)
 
 # --- Inicialização do Firebase Admin SDK (PADRONIZADO) ---
-db = None
-if firebase_admin:
-    try:
-        base64_sdk = os.environ.get('FIREBASE_ADMIN_SDK_BASE64')
-        if base64_sdk:
-            decoded_sdk = base64.b64decode(base64_sdk).decode('utf-8')
-            cred_dict = json.loads(decoded_sdk)
-            cred = credentials.Certificate(cred_dict)
-            if not firebase_admin._apps:
-                firebase_admin.initialize_app(cred)
-            db = firestore.client()
-            print("Firebase inicializado com sucesso via Base64.")
-        else:
-            firebase_init_error = "Variável de ambiente FIREBASE_ADMIN_SDK_BASE64 não encontrada."
-            print(firebase_init_error)
-    except Exception as e:
-        firebase_init_error = str(e)
-        print(f"Erro ao inicializar o Firebase Admin SDK: {e}")
-else:
-    firebase_init_error = "Biblioteca firebase_admin não encontrada."
+db = NOT_INITIALIZED
+
+def init_firebase():
+    global db, firebase_init_error
+    db, firebase_init_error = firebase.get_firestore_client()
+
+# --- Verificação de ID tokens com cache ---
+def verify_id_token(id_token):
+    return auth.verify_id_token(id_token)
+
+token_verifier = tokens.CachedTokenVerifier(verify_id_token)
 
 # --- Configuração do Kafka Producer ---
-producer = None
-if Producer:
-    try:
-        kafka_bootstrap_server = os.environ.get('KAFKA_BOOTSTRAP_SERVER')
-        if kafka_bootstrap_server:
-            # Local Docker Kafka configuration
-            print("Configurando produtor Kafka para ambiente local (sem SASL)...")
-            kafka_conf = {
-                'bootstrap.servers': kafka_bootstrap_server
-            }
-            producer = Producer(kafka_conf)
-            print("Produtor Kafka inicializado com sucesso.")
-        else:
-            kafka_producer_init_error = "Variáveis de ambiente do Kafka não encontradas."
-            print(kafka_producer_init_error)
-    except Exception as e:
-        kafka_producer_init_error = str(e)
-        print(f"Erro ao inicializar Produtor Kafka: {e}")
-else:
-    kafka_producer_init_error = "Biblioteca confluent_kafka não encontrada."
-
-def delivery_report(err, msg):
-    if err is not None:
-        print(f'Falha ao entregar mensagem Kafka: {err}')
-    else:
-        print(f'Mensagem Kafka entregue em {msg.topic()} [{msg.partition()}]')
+producer = NOT_INITIALIZED
+
+def init_kafka_producer():
+    global producer, kafka_producer_init_error
+    producer, kafka_producer_init_error = kafka.get_producer()
+
+# --- Inicialização dos clientes ---
+# Sob demanda, na primeira requisição e no post_fork do gunicorn (common/service.py).
+def create_clients():
+    if db is NOT_INITIALIZED:
+        init_firebase()
+        if db:
+            token_verifier.start_key_refresher()
+    if producer is NOT_INITIALIZED:
+        init_kafka_producer()
+
+init_clients = service.lazy_clients(app, create_clients)
+
+@app.teardown_request
+def flush_kafka_producer(exception=None):
+    # Em serverless o processo pode ser congelado logo após a resposta; sem o flush os
+    # eventos da requisição ficariam presos no buffer do produtor.
+    kafka.flush_if_serverless()
 
 def publish_event(topic, event_type, offer_id, data, changes=None):
-    if not producer:
-        print("Produtor Kafka não está inicializado. Evento não publicado.")
-        return
-    event = {
-        "event_type": event_type,
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "offer_id": offer_id,
-        "data": data,
-        "source_service": "servico-ofertas"
+    kafka.publish_event(producer, topic, event_type, 'offer_id', offer_id, data, 'servico-ofertas', changes)
+
+# --- Outbox ---
+# Eventos que precisam sair junto com uma escrita (OfferExpired) são gravados como
+# documentos de OUTBOX_COLLECTION no mesmo batch; relay_outbox_batch os publica depois.
+OUTBOX_COLLECTION = '_outbox'
+
+def enqueue_event(batch, topic, event_type, offer_id, data, changes=None):
+    outbox.add_firestore_event(batch, db.collection(OUTBOX_COLLECTION), topic, event_type,
+                               'offer_id', offer_id, data, 'servico-ofertas', changes)
+
+def relay_outbox_batch():
+    return outbox.relay_firestore_batch(db, OUTBOX_COLLECTION, producer)
+
+# --- Dados do produto copiados na oferta ---
+# Toda oferta guarda o store_id e um resumo do produto, para que as escritas (permissão) e
+# o feed de ofertas precisem de uma única leitura. O resumo é mantido pelos eventos de
+# produto (consume_product_events) e as ofertas antigas são preenchidas por backfill_offers.py.
+PRODUCT_SNAPSHOT_FIELDS = ('name', 'image_url', 'category')
+DENORMALIZED_OFFER_FIELDS = ('store_id', 'product')
+FIRESTORE_BATCH_LIMIT = firebase.FIRESTORE_BATCH_LIMIT
+
+def product_snapshot(product_data):
+    return {field: product_data.get(field) for field in PRODUCT_SNAPSHOT_FIELDS}
+
+def get_offer_store_id(offer_data):
+    """Devolve (store_id, resposta de erro). Ofertas ainda sem backfill caem na leitura do produto."""
+    store_id = offer_data.get('store_id')
+    if store_id:
+        return store_id, None
+    product_id = offer_data.get('product_id')
+    if not product_id:
+        return None, (jsonify({"error": "Oferta não tem um produto associado."}), 500)
+    product_doc = db.collection('products').document(product_id).get()
+    if not product_doc.exists:
+        return None, (jsonify({"error": "Produto associado à oferta não encontrado."}), 404)
+    metrics.increment('offers.store_id_fallback')
+    store_id = product_doc.to_dict().get('store_id')
+    if not store_id:
+        return None, (jsonify({"error": "Produto não tem uma loja associada."}), 500)
+    return store_id, None
+
+# --- Validade das ofertas ---
+# valid_until é um timestamp do Firestore. expiry_bucket (hora UTC, 'AAAAMMDDHH') e status
+# ('active'/'expired') permitem que o sweeper (expire_offers) percorra só as ofertas que
+# vencem em cada hora, com consultas de igualdade, e que o feed filtre as vencidas no índice.
+OFFER_DEFAULT_VALIDITY_DAYS = int(os.environ.get('OFFER_DEFAULT_VALIDITY_DAYS', 30))
+OFFER_EXPIRY_LOOKBACK_HOURS = int(os.environ.get('OFFER_EXPIRY_LOOKBACK_HOURS', 24 * 7))
+OFFER_EXPIRY_MAX_BATCHES = int(os.environ.get('OFFER_EXPIRY_MAX_BATCHES', 20))
+EXPIRY_BUCKET_FORMAT = '%Y%m%d%H'
+
+def parse_valid_until(value):
+    """Converte datetime ou string ISO 8601 em datetime UTC. ValueError se inválido."""
+    if isinstance(value, datetime):
+        parsed = value
+    elif isinstance(value, str) and value:
+        parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    else:
+        raise ValueError(f"data inválida: {value!r}")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+def expiry_bucket(valid_until):
+    return valid_until.strftime(EXPIRY_BUCKET_FORMAT)
+
+def expiry_fields(valid_until, now=None):
+    now = now or datetime.now(timezone.utc)
+    return {
+        'valid_until': valid_until,
+        'expiry_bucket': expiry_bucket(valid_until),
+        'status': 'active' if valid_until > now else 'expired',
     }
-    if changes:
-        event["changes"] = changes
+
+def requested_valid_until(data):
+    """valid_until (ou end_date, o campo antigo) enviado pelo cliente, ou None."""
+    value = data.get('valid_until') or data.get('end_date')
+    return parse_valid_until(value) if value else None
+
+def expire_offers(now=None, max_batches=OFFER_EXPIRY_MAX_BATCHES):
+    """Marca como vencidas as ofertas cujo valid_until passou e enfileira OfferExpired na outbox.
+
+    Percorre os buckets de hora desde o último concluído (guardado em
+    _sweepers/offer_expiry) até a hora atual, em batches de até 250 ofertas (cada uma
+    ocupa duas escritas: a oferta e o evento). Devolve
+    quantas ofertas venceram. Com max_batches atingido, o restante fica para a próxima vez."""
+    now = now or datetime.now(timezone.utc)
+    state_ref = db.collection('_sweepers').document('offer_expiry')
+    state_doc = state_ref.get()
+    last_bucket = (state_doc.to_dict() or {}).get('last_completed_bucket') if state_doc.exists else None
+    if last_bucket:
+        start = datetime.strptime(last_bucket, EXPIRY_BUCKET_FORMAT).replace(tzinfo=timezone.utc) + timedelta(hours=1)
+    else:
+        start = now - timedelta(hours=OFFER_EXPIRY_LOOKBACK_HOURS)
+    current_bucket = expiry_bucket(now)
+
+    expired = 0
+    batches = 0
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    while expiry_bucket(hour) <= current_bucket:
+        bucket = expiry_bucket(hour)
+        while True:
+            query = db.collection('offers').where('expiry_bucket', '==', bucket).where('status', '==', 'active')
+            if bucket == current_bucket:
+                # Hora em andamento: só o que já venceu (índice composto em firestore.indexes.json).
+                query = query.where('valid_until', '<=', now)
+            docs = list(query.limit(FIRESTORE_BATCH_LIMIT // 2).stream())
+            if not docs:
+                break
+            batch = db.batch()
+            for doc in docs:
+                offer = doc.to_dict()
+                batch.update(doc.reference, {
+                    'status': 'expired',
+                    'expired_at': firestore.SERVER_TIMESTAMP,
+                    'updated_at': firestore.SERVER_TIMESTAMP,
+                })
+                enqueue_event(batch, 'eventos_ofertas', 'OfferExpired', doc.id, {
+                    'offer_id': doc.id,
+                    'store_id': offer.get('store_id'),
+                    'product_id': offer.get('product_id'),
+                    'valid_until': offer.get('valid_until'),
+                })
+            # Oferta e evento no mesmo commit: ou os dois ficam gravados ou nenhum.
+            batch.commit()
+            expired += len(docs)
+            batches += 1
+            if batches >= max_batches:
+                metrics.increment('offers.expired', expired)
+                return expired
+        if bucket != current_bucket:
+            state_ref.set({'last_completed_bucket': bucket}, merge=True)
+        hour += timedelta(hours=1)
+    if expired:
+        metrics.increment('offers.expired', expired)
+    return expired
+
+# --- Consumidor de eventos de produtos ---
+# Criado só por quem consome (worker.py ou o cron), não pelos workers da API.
+product_events_consumer = None
+product_events_consumer_lock = threading.Lock()
+
+def get_product_events_consumer():
+    global product_events_consumer, kafka_consumer_init_error
+    with product_events_consumer_lock:
+        if product_events_consumer is None:
+            product_events_consumer, kafka_consumer_init_error = kafka.create_consumer('servico-ofertas-product-snapshots', ['eventos_produtos'])
+        return product_events_consumer
+
+def refresh_product_snapshots(product_id, changed):
+    """Atualiza o resumo do produto em todas as ofertas dele. Devolve quantas mudaram."""
+    updates = {f'product.{field}': value for field, value in changed.items()}
+    updates['updated_at'] = firestore.SERVER_TIMESTAMP
+    updated = 0
+    batch = db.batch()
+    pending = 0
+    for offer_doc in db.collection('offers').where('product_id', '==', product_id).stream():
+        batch.update(offer_doc.reference, updates)
+        pending += 1
+        updated += 1
+        if pending == FIRESTORE_BATCH_LIMIT:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+    if pending:
+        batch.commit()
+    return updated
+
+def consume_product_events(max_messages=100, timeout=1.0):
+    """Aplica ProductUpdated/ProductImageSetPrimary nas ofertas. Devolve quantas mensagens leu."""
+    consumer = get_product_events_consumer()
+    if not consumer:
+        raise RuntimeError(kafka_consumer_init_error)
+    msgs = consumer.consume(num_messages=max_messages, timeout=timeout)
+    if not msgs:
+        return 0
+    # Várias mudanças do mesmo produto no lote viram uma única atualização, na ordem das mensagens.
+    changes_by_product = {}
+    for msg in msgs:
+        if msg.error():
+            print(f"Kafka error: {msg.error()}")
+            continue
+        try:
+            event = events.decode_event(msg.value())
+        except ValueError as e:
+            print(f"Evento de produto ignorado: {e}")
+            continue
+        if event.get('event_type') not in ('ProductUpdated', 'ProductImageSetPrimary') or not event.get('product_id'):
+            continue
+        data = event.get('data') or {}
+        changed = {field: data[field] for field in PRODUCT_SNAPSHOT_FIELDS if field in data}
+        if changed:
+            changes_by_product.setdefault(event['product_id'], {}).update(changed)
     try:
-        event_value = json.dumps(event, default=str)
-        producer.produce(topic, key=offer_id, value=event_value, callback=delivery_report)
-        producer.poll(0)
-        print(f"Evento '{event_type}' para a oferta {offer_id} publicado no tópico {topic}.")
-    except Exception as e:
-        print(f"Erro ao publicar evento Kafka: {e}")
+        for product_id, changed in changes_by_product.items():
+            metrics.increment('offers.snapshots_refreshed', refresh_product_snapshots(product_id, changed))
+    except Exception:
+        # A próxima leitura recomeça do último offset confirmado, com as mensagens deste lote.
+        kafka.rewind_to_committed(consumer)
+        raise
+    # Offsets só são confirmados depois das escritas: em caso de falha as mensagens voltam.
+    consumer.commit(asynchronous=False)
+    return len(msgs)
 
 @app.route("/api/offers", methods=["POST"])
 def create_offer():
@@ -131,17 +298,26 @@ def create_offer():
 
     try:
         id_token = auth_header.split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = token_verifier.verify(id_token)
         uid = decoded_token['uid']
     except Exception as e:
         return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
 
     offer_data = request.get_json()
-    if not offer_data or not offer_data.get('product_id') or not offer_data.get('offer_price'):
+    if not isinstance(offer_data, dict) or not offer_data.get('product_id') or not offer_data.get('offer_price'):
         return jsonify({"error": "Product ID and offer price are required"}), 400
     
     product_id = offer_data['product_id']
 
+    try:
+        valid_until = requested_valid_until(offer_data)
+    except ValueError as e:
+        return jsonify({"error": "valid_until inválido; use ISO 8601.", "details": str(e)}), 400
+    if valid_until is None:
+        valid_until = datetime.now(timezone.utc) + timedelta(days=OFFER_DEFAULT_VALIDITY_DAYS)
+    # Uma data já passada cria a oferta como 'expired', fora do feed.
+    offer_data.update(expiry_fields(valid_until))
+
     try:
         product_ref = db.collection('products').document(product_id)
         product_doc = product_ref.get()
@@ -157,6 +333,7 @@ def create_offer():
             return jsonify({"error": "User is not authorized to create offers for this product's store", "details": reason}), 403
         
         offer_data['store_id'] = store_id
+        offer_data['product'] = product_snapshot(product_doc.to_dict())
 
     except Exception as e:
         return jsonify({"error": "Could not verify product ownership", "details": str(e)}), 500
@@ -172,6 +349,222 @@ def create_offer():
     except Exception as e:
         return jsonify({"error": "Could not create offer", "details": str(e)}), 500
 
+# --- Importação de ofertas em massa ---
+# Planilhas de preços de uma loja (CSV ou lista JSON) numa única requisição: um token, uma
+# verificação de permissão, leituras em lotes com get_all, escrita com o BulkWriter do
+# Firestore e os eventos publicados de uma vez (o produtor junta e comprime os lotes).
+OFFERS_BULK_MAX_ROWS = int(os.environ.get('OFFERS_BULK_MAX_ROWS', 2000))
+BULK_READ_ONLY_FIELDS = DENORMALIZED_OFFER_FIELDS + ('expiry_bucket', 'status', 'offer_id', 'created_at', 'updated_at')
+
+def parse_bulk_rows():
+    """Devolve (store_id, linhas) do corpo em CSV (text/csv) ou JSON. ValueError se inválido."""
+    store_id = request.args.get('store_id')
+    if request.mimetype == 'text/csv':
+        text = request.get_data().decode('utf-8-sig')
+        rows = []
+        for row in csv.DictReader(io.StringIO(text)):
+            # Células vazias não sobrescrevem campos existentes.
+            rows.append({key.strip(): value.strip() for key, value in row.items()
+                         if key and isinstance(value, str) and value.strip()})
+        return store_id, rows
+    body = request.get_json(silent=True)
+    if isinstance(body, dict):
+        store_id = store_id or body.get('store_id')
+        body = body.get('offers')
+    if not isinstance(body, list):
+        raise ValueError("Envie um CSV (text/csv) ou uma lista JSON de ofertas.")
+    return store_id, body
+
+def validate_bulk_row(row):
+    """Devolve (dados da oferta, valid_until ou None, erro) para uma linha da planilha."""
+    if not isinstance(row, dict):
+        return None, None, "A linha deve ser um objeto."
+    if not firebase.is_document_id(row.get('product_id')):
+        return None, None, "product_id é obrigatório e deve ser um id válido."
+    if row.get('offer_id') not in (None, '') and not firebase.is_document_id(row.get('offer_id')):
+        return None, None, "offer_id deve ser um id válido."
+    try:
+        price = float(row.get('offer_price'))
+    except (TypeError, ValueError):
+        return None, None, "offer_price inválido."
+    if not math.isfinite(price) or price <= 0:
+        return None, None, "offer_price deve ser maior que zero."
+    try:
+        valid_until = requested_valid_until(row)
+    except ValueError as e:
+        return None, None, f"valid_until inválido; use ISO 8601 ({e})."
+    offer = {key: value for key, value in row.items() if key not in BULK_READ_ONLY_FIELDS}
+    offer['offer_price'] = price
+    return offer, valid_until, None
+
+@app.route('/api/offers:bulk', methods=['POST'])
+def bulk_upsert_offers():
+    """Cria (linhas sem offer_id) ou atualiza (com offer_id) as ofertas de uma loja.
+
+    Responde 200 com o resultado de cada linha, na ordem da planilha, mesmo que algumas falhem."""
+    if not db:
+        return jsonify({"error": "Dependência do Firestore não inicializada."}), 503
+
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return jsonify({"error": "Authorization token is required"}), 401
+
+    try:
+        id_token = auth_header.split('Bearer ')[1]
+        decoded_token = token_verifier.verify(id_token)
+        uid = decoded_token['uid']
+    except Exception as e:
+        return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
+
+    try:
+        store_id, rows = parse_bulk_rows()
+    except (ValueError, csv.Error) as e:
+        return jsonify({"error": str(e)}), 400
+    if not firebase.is_document_id(store_id):
+        return jsonify({"error": "Parâmetro 'store_id' é obrigatório."}), 400
+    if not rows:
+        return jsonify({"error": "Nenhuma oferta enviada."}), 400
+    if len(rows) > OFFERS_BULK_MAX_ROWS:
+        return jsonify({"error": f"Máximo de {OFFERS_BULK_MAX_ROWS} ofertas por requisição."}), 413
+
+    allowed, reason = check_permission(uid, store_id)
+    if not allowed:
+        return jsonify({"error": "User is not authorized to manage offers for this store", "details": reason}), 403
+
+    results = [{"row": i + 1, "status": "error", "offer_id": None, "error": None} for i in range(len(rows))]
+    valid = []
+    seen_offer_ids = set()
+    for i, row in enumerate(rows):
+        offer, valid_until, error = validate_bulk_row(row)
+        offer_id = row.get('offer_id') if isinstance(row, dict) else None
+        if not error and offer_id and offer_id in seen_offer_ids:
+            error = "offer_id repetido na planilha."
+        if error:
+            results[i]["error"] = error
+            continue
+        if offer_id:
+            seen_offer_ids.add(offer_id)
+        results[i]["offer_id"] = offer_id
+        valid.append((i, offer_id, offer, valid_until))
+
+    try:
+        existing_offers = firebase.get_all_by_id(db, 'offers', sorted(seen_offer_ids))
+        product_ids = {offer['product_id'] for _, _, offer, _ in valid}
+        # Ofertas antigas sem store_id: a loja vem do produto, lido no mesmo lote.
+        for doc in existing_offers.values():
+            current = doc.to_dict()
+            if not current.get('store_id') and current.get('product_id'):
+                product_ids.add(current['product_id'])
+        products = firebase.get_all_by_id(db, 'products', sorted(product_ids))
+    except Exception as e:
+        return jsonify({"error": f"Erro ao ler produtos e ofertas: {e}"}), 500
+
+    now = datetime.now(timezone.utc)
+    writes = {}  # caminho do documento -> (índice da linha, tipo do evento, dados)
+
+    def on_success(path):
+        index, event_type, _ = writes[path]
+        results[index]["status"] = "created" if event_type == 'OfferCreated' else "updated"
+        results[index]["error"] = None
+
+    def on_failure(path, message):
+        results[writes[path][0]]["error"] = message
+
+    bulk_writer = firebase.open_bulk_writer(db, on_success, on_failure)
+
+    try:
+        for index, offer_id, offer, valid_until in valid:
+            product_doc = products.get(offer['product_id'])
+            if product_doc is None:
+                results[index]["error"] = "Produto não encontrado."
+                continue
+            product_data = product_doc.to_dict()
+            if product_data.get('store_id') != store_id:
+                results[index]["error"] = "Produto não pertence a esta loja."
+                continue
+            offer['store_id'] = store_id
+            offer['product'] = product_snapshot(product_data)
+            offer['updated_at'] = firestore.SERVER_TIMESTAMP
+
+            if offer_id:
+                offer_doc = existing_offers.get(offer_id)
+                if offer_doc is None:
+                    results[index]["error"] = "Oferta não encontrada."
+                    continue
+                current = offer_doc.to_dict()
+                current_store_id = current.get('store_id')
+                if not current_store_id and current.get('product_id') in products:
+                    current_store_id = products[current['product_id']].to_dict().get('store_id')
+                if current_store_id != store_id:
+                    results[index]["error"] = "Oferta não pertence a esta loja."
+                    continue
+                if current.get('product_id') != offer['product_id']:
+                    results[index]["error"] = "O produto de uma oferta não pode ser alterado."
+                    continue
+                if valid_until is not None:
+                    offer.update(expiry_fields(valid_until, now))
+                ref = db.collection('offers').document(offer_id)
+                writes[ref.path] = (index, 'OfferUpdated', offer)
+                bulk_writer.update(ref, offer)
+            else:
+                if valid_until is None:
+                    valid_until = now + timedelta(days=OFFER_DEFAULT_VALIDITY_DAYS)
+                offer.update(expiry_fields(valid_until, now))
+                offer['created_at'] = firestore.SERVER_TIMESTAMP
+                ref = db.collection('offers').document()
+                results[index]["offer_id"] = ref.id
+                writes[ref.path] = (index, 'OfferCreated', offer)
+                bulk_writer.create(ref, offer)
+    finally:
+        # Espera todas as escritas (e as novas tentativas) terminarem.
+        bulk_writer.close()
+
+    for index, event_type, offer in writes.values():
+        if results[index]["status"] != "error":
+            publish_event('eventos_ofertas', event_type, results[index]["offer_id"], offer)
+
+    summary = {"total": len(rows), "created": 0, "updated": 0, "failed": 0}
+    for result in results:
+        summary[result["status"] if result["status"] != "error" else "failed"] += 1
+    metrics.increment('offers.bulk_rows', len(rows))
+    if summary["failed"]:
+        metrics.increment('offers.bulk_failed', summary["failed"])
+    return jsonify({"store_id": store_id, "summary": summary, "results": results}), 200
+
+@app.route('/api/offers', methods=['GET'])
+def list_offers():
+    """Feed de ofertas ativas de uma loja ou de um produto. Cada oferta já traz o resumo do produto."""
+    if not db:
+        return jsonify({"error": "Dependência do Firestore não inicializada."}), 503
+
+    store_id = request.args.get('store_id')
+    product_id = request.args.get('product_id')
+    if not store_id and not product_id:
+        return jsonify({"error": "Parâmetro 'store_id' ou 'product_id' é obrigatório."}), 400
+    try:
+        limit = max(1, min(int(request.args.get('limit', 50)), 200))
+    except ValueError:
+        return jsonify({"error": "Parâmetro 'limit' inválido."}), 400
+
+    try:
+        query = db.collection('offers').where('status', '==', 'active')
+        if store_id:
+            query = query.where('store_id', '==', store_id)
+        if product_id:
+            query = query.where('product_id', '==', product_id)
+        now = datetime.now(timezone.utc)
+        offers = []
+        for doc in query.limit(limit).stream():
+            offer = doc.to_dict()
+            # Vencida desde a última passada do sweeper.
+            if offer.get('valid_until') and offer['valid_until'] <= now:
+                continue
+            offer['id'] = doc.id
+            offers.append(offer)
+        return jsonify({"offers": offers}), 200
+    except Exception as e:
+        return jsonify({"error": f"Erro ao listar ofertas: {e}"}), 500
+
 @app.route('/api/offers/<offer_id>', methods=['GET'])
 def get_offer(offer_id):
     if not db:
@@ -198,14 +591,24 @@ def update_offer(offer_id):
 
     try:
         id_token = auth_header.split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = token_verifier.verify(id_token)
         uid = decoded_token['uid']
     except Exception as e:
         return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
 
     update_data = request.get_json()
-    if not update_data:
+    if not update_data or not isinstance(update_data, dict):
         return jsonify({"error": "Dados para atualização são obrigatórios."}), 400
+    # store_id, o resumo do produto e os campos de validade são mantidos pelo serviço.
+    for field in DENORMALIZED_OFFER_FIELDS + ('expiry_bucket', 'status'):
+        update_data.pop(field, None)
+    try:
+        valid_until = requested_valid_until(update_data)
+    except ValueError as e:
+        return jsonify({"error": "valid_until inválido; use ISO 8601.", "details": str(e)}), 400
+    if valid_until is not None:
+        # Também reativa uma oferta vencida cuja validade foi estendida.
+        update_data.update(expiry_fields(valid_until))
 
     offer_ref = db.collection('offers').document(offer_id)
     
@@ -213,18 +616,14 @@ def update_offer(offer_id):
         offer_doc = offer_ref.get()
         if not offer_doc.exists:
             return jsonify({"error": "Oferta não encontrada."}), 404
-        
-        product_id = offer_doc.to_dict().get('product_id')
-        if not product_id:
-            return jsonify({"error": "Oferta não tem um produto associado."}), 500
 
-        product_doc = db.collection('products').document(product_id).get()
-        if not product_doc.exists:
-            return jsonify({"error": "Produto associado à oferta não encontrado."}), 404
-        
-        store_id = product_doc.to_dict().get('store_id')
+        offer_data = offer_doc.to_dict()
+        if 'product_id' in update_data and update_data['product_id'] != offer_data.get('product_id'):
+            return jsonify({"error": "O produto de uma oferta não pode ser alterado."}), 400
+
+        store_id, error_response = get_offer_store_id(offer_data)
         if not store_id:
-            return jsonify({"error": "Produto não tem uma loja associada."}), 500
+            return error_response
 
         allowed, reason = check_permission(uid, store_id)
         if not allowed:
@@ -250,7 +649,7 @@ def delete_offer(offer_id):
 
     try:
         id_token = auth_header.split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = token_verifier.verify(id_token)
         uid = decoded_token['uid']
     except Exception as e:
         return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
@@ -261,18 +660,10 @@ def delete_offer(offer_id):
         offer_doc = offer_ref.get()
         if not offer_doc.exists:
             return jsonify({"error": "Oferta não encontrada."}), 404
-        
-        product_id = offer_doc.to_dict().get('product_id')
-        if not product_id:
-            return jsonify({"error": "Oferta não tem um produto associado."}), 500
 
-        product_doc = db.collection('products').document(product_id).get()
-        if not product_doc.exists:
-            return jsonify({"error": "Produto associado à oferta não encontrado."}), 404
-        
-        store_id = product_doc.to_dict().get('store_id')
+        store_id, error_response = get_offer_store_id(offer_doc.to_dict())
         if not store_id:
-            return jsonify({"error": "Produto não tem uma loja associada."}), 500
+            return error_response
 
         allowed, reason = check_permission(uid, store_id)
         if not allowed:
@@ -286,13 +677,52 @@ def delete_offer(offer_id):
     except Exception as e:
         return jsonify({"error": f"Erro ao deletar oferta: {e}"}), 500
 
-def get_health_status():
-    env_vars = {
-        "FIREBASE_ADMIN_SDK_BASE64": "present" if os.environ.get('FIREBASE_ADMIN_SDK_BASE64') else "missing",
-        "KAFKA_BOOTSTRAP_SERVER": "present" if os.environ.get('KAFKA_BOOTSTRAP_SERVER') else "missing",
-        "KAFKA_API_KEY": "present" if os.environ.get('KAFKA_API_KEY') else "missing",
-        "KAFKA_API_SECRET": "present" if os.environ.get('KAFKA_API_SECRET') else "missing"
-    }
+@app.route('/internal/events/consume', methods=['POST', 'GET'])
+def consume_events():
+    # Chamada pelo cron (Vercel); em Docker o worker.py faz o mesmo em laço.
+    if not service.is_cron_request():
+        return jsonify({"error": "Unauthorized"}), 401
+    if not db:
+        return jsonify({"error": "Dependência do Firestore não inicializada."}), 503
+    try:
+        processed = consume_product_events(timeout=5.0)
+    except Exception as e:
+        return jsonify({"error": f"Erro durante o consumo de eventos: {e}"}), 500
+    return jsonify({"status": "ok", "messages_processed": processed}), 200
+
+@app.route('/internal/offers/expire', methods=['POST', 'GET'])
+def expire_offers_route():
+    # Chamada pelo cron (Vercel); em Docker o worker.py faz o mesmo em laço.
+    if not service.is_cron_request():
+        return jsonify({"error": "Unauthorized"}), 401
+    if not db:
+        return jsonify({"error": "Dependência do Firestore não inicializada."}), 503
+    try:
+        expired = expire_offers()
+    except Exception as e:
+        return jsonify({"error": f"Erro ao expirar ofertas: {e}"}), 500
+    return jsonify({"status": "ok", "offers_expired": expired}), 200
+
+@app.route('/internal/outbox/relay', methods=['POST', 'GET'])
+def relay_outbox():
+    # Chamada pelo cron (Vercel); em Docker o worker.py faz o mesmo em laço.
+    if not service.is_cron_request():
+        return jsonify({"error": "Unauthorized"}), 401
+    if not db or not producer:
+        return jsonify({"error": "Dependências do Firestore ou Kafka não inicializadas."}), 503
+    try:
+        relayed = relay_outbox_batch()
+    except Exception as e:
+        return jsonify({"error": f"Erro ao publicar eventos da outbox: {e}"}), 500
+    return jsonify({"status": "ok", "events_relayed": relayed}), 200
+
+def get_health_status(include_latencies=False):
+    env_vars = health.env_var_status([
+        'FIREBASE_ADMIN_SDK_BASE64',
+        'KAFKA_BOOTSTRAP_SERVER',
+        'KAFKA_API_KEY',
+        'KAFKA_API_SECRET'
+    ])
     status = {
         "environment_variables": env_vars,
         "dependencies": {
@@ -304,19 +734,34 @@ def get_health_status():
             "kafka_producer": kafka_producer_init_error
         }
     }
+    if include_latencies:
+        # Firestore e Kafka são avaliados apenas pelo estado de inicialização, sem E/S.
+        status["latencies_ms"] = {}
     return status
 
-@app.route('/api/health', methods=['GET'])
-def health_check():
-    status = get_health_status()
-    
-    all_ok = (
+def is_healthy(status):
+    return (
         all(value == "present" for value in status["environment_variables"].values()) and
         status["dependencies"]["firestore"] == "ok" and
         status["dependencies"]["kafka_producer"] == "ok"
     )
-    http_status = 200 if all_ok else 503
+
+@app.route('/api/health', methods=['GET'])
+def health_check():
+    status = get_health_status()
+    http_status = 200 if is_healthy(status) else 503
     return jsonify(status), http_status
 
+service.register_metrics_route(app, token_verifier)
+
+# --- Readiness memoizada ---
+def build_readiness_status():
+    status = get_health_status(include_latencies=True)
+    status["status"] = "ok" if is_healthy(status) else "degraded"
+    return status
+
+readiness = service.register_probe_routes(app, build_readiness_status)
+readiness_cache = readiness.cache
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
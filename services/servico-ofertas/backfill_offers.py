@@ -0,0 +1,110 @@
+# services/servico-ofertas/backfill_offers.py
+# Preenche store_id, o resumo do produto (campo product) e os campos de validade
+# (valid_until, expiry_bucket, status) nas ofertas criadas antes de esses campos existirem. Ofertas já completas não são alteradas, então o comando pode
+# ser executado de novo com segurança:
+#     python backfill_offers.py [--dry-run] [--page-size 500]
+import argparse
+import sys
+from datetime import datetime, timedelta, timezone
+
+from api import index
+
+
+def needs_product_fields(offer):
+    return not offer.get('store_id') or not isinstance(offer.get('product'), dict)
+
+
+def needs_expiry_fields(offer):
+    return not all(offer.get(field) for field in ('valid_until', 'expiry_bucket', 'status'))
+
+
+def needs_backfill(offer):
+    return needs_product_fields(offer) or needs_expiry_fields(offer)
+
+
+def legacy_valid_until(offer, now):
+    """end_date, se válido; senão created_at (ou agora) mais a validade padrão."""
+    for value in (offer.get('valid_until'), offer.get('end_date')):
+        try:
+            return index.parse_valid_until(value)
+        except ValueError:
+            pass
+    created_at = offer.get('created_at')
+    base = created_at if isinstance(created_at, datetime) else now
+    return index.parse_valid_until(base) + timedelta(days=index.OFFER_DEFAULT_VALIDITY_DAYS)
+
+
+def backfill(db, page_size=index.FIRESTORE_BATCH_LIMIT, dry_run=False):
+    """Percorre as ofertas em páginas: uma leitura em lote (get_all) dos produtos e um
+    batch de escrita por página."""
+    page_size = min(page_size, index.FIRESTORE_BATCH_LIMIT)
+    stats = {"scanned": 0, "updated": 0, "missing_product": 0}
+    last_doc = None
+    while True:
+        query = db.collection('offers').order_by('__name__').limit(page_size)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        docs = list(query.stream())
+        if not docs:
+            break
+        last_doc = docs[-1]
+        stats["scanned"] += len(docs)
+
+        pending = [(doc, doc.to_dict()) for doc in docs]
+        pending = [(doc, offer) for doc, offer in pending if needs_backfill(offer)]
+        product_ids = sorted({
+            offer.get('product_id') for _, offer in pending
+            if needs_product_fields(offer) and offer.get('product_id')
+        })
+        products = {}
+        if product_ids:
+            refs = [db.collection('products').document(product_id) for product_id in product_ids]
+            for snapshot in db.get_all(refs):
+                if snapshot.exists:
+                    products[snapshot.id] = snapshot.to_dict()
+
+        batch = db.batch()
+        writes = 0
+        now = datetime.now(timezone.utc)
+        for doc, offer in pending:
+            updates = {}
+            if needs_product_fields(offer):
+                product = products.get(offer.get('product_id'))
+                if product and product.get('store_id'):
+                    updates.update({'store_id': product['store_id'], 'product': index.product_snapshot(product)})
+                else:
+                    stats["missing_product"] += 1
+                    print(f"Oferta {doc.id}: produto {offer.get('product_id')} não encontrado ou sem loja.")
+            if needs_expiry_fields(offer):
+                # Ofertas já vencidas entram como 'expired' e não passam pelo sweeper.
+                updates.update(index.expiry_fields(legacy_valid_until(offer, now), now))
+            if updates:
+                batch.update(doc.reference, updates)
+                writes += 1
+        if writes and not dry_run:
+            batch.commit()
+        stats["updated"] += writes
+
+        if len(docs) < page_size:
+            break
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preenche store_id, o resumo do produto e a validade nas ofertas.")
+    parser.add_argument('--dry-run', action='store_true', help="Só conta, sem gravar.")
+    parser.add_argument('--page-size', type=int, default=index.FIRESTORE_BATCH_LIMIT)
+    args = parser.parse_args()
+
+    index.init_clients()
+    if not index.db:
+        print(f"Backfill não executado: {index.firebase_init_error}")
+        return 1
+    stats = backfill(index.db, page_size=args.page_size, dry_run=args.dry_run)
+    print(f"Ofertas lidas: {stats['scanned']}, atualizadas: {stats['updated']}, "
+          f"sem produto: {stats['missing_product']}" + (" (dry run)" if args.dry_run else ""))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,6 @@
 import pytest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, call
+import json
 from datetime import datetime, timezone
 from firebase_admin import firestore
 import os
@@ -118,6 +119,11 @@ def test_create_offer_success(client, mock_all_dependencies):
     # owner_uid is no longer stored on the offer, permission is checked via service call
     # assert actual_offer_data['owner_uid'] == user_uid
     assert actual_offer_data['store_id'] == store_id
+    assert actual_offer_data['product'] == {'name': 'Produto Teste', 'image_url': None, 'category': None}
+    # end_date (campo antigo) vira o valid_until indexado.
+    assert actual_offer_data['valid_until'] == datetime(2025, 10, 10, 23, 59, 59, tzinfo=timezone.utc)
+    assert actual_offer_data['expiry_bucket'] == '2025101023'
+    assert actual_offer_data['status'] == ('active' if actual_offer_data['valid_until'] > datetime.now(timezone.utc) else 'expired')
     assert isinstance(actual_offer_data['created_at'], type(firestore.SERVER_TIMESTAMP))
     assert isinstance(actual_offer_data['updated_at'], type(firestore.SERVER_TIMESTAMP))
 
@@ -185,12 +191,380 @@ def test_update_offer_success(client, mock_all_dependencies):
     assert response.json['offerId'] == 'test_offer_id'
 
     mock_all_dependencies["db"].collection.return_value.document.return_value.update.assert_called_once()
+    # O store_id vem da própria oferta: nenhuma leitura de produto.
+    assert call('products') not in mock_db.collection.call_args_list
+    mock_all_dependencies["check_permission"].assert_called_once_with(user_uid, 'test_store_id')
     mock_all_dependencies["publish_event"].assert_called_once()
     args, kwargs = mock_all_dependencies["publish_event"].call_args
     assert args[1] == 'OfferUpdated'
     assert args[2] == 'test_offer_id'
     assert args[3]['offer_price'] == 69.99
 
+def test_update_legacy_offer_reads_store_from_product(client, mock_all_dependencies):
+    """Ofertas ainda sem backfill continuam funcionando pela leitura do produto."""
+    mock_all_dependencies["auth"].verify_id_token.return_value = {'uid': 'test_owner_uid'}
+    mock_db = mock_all_dependencies["db"]
+    mock_fs_doc = MagicMock()
+    mock_fs_doc.exists = True
+    mock_fs_doc.to_dict.return_value = {'product_id': 'test_product_id', 'store_id': 'test_store_id'}
+    mock_legacy_offer = MagicMock()
+    mock_legacy_offer.exists = True
+    mock_legacy_offer.to_dict.return_value = {'product_id': 'test_product_id', 'offer_price': 79.99}
+    mock_db.collection.return_value.document.return_value.get.side_effect = [mock_legacy_offer, mock_fs_doc]
+
+    response = client.put('/api/offers/test_offer_id', headers={"Authorization": "Bearer t"}, json={"offer_price": 1.0})
+
+    assert response.status_code == 200
+    mock_db.collection.assert_any_call('products')
+    mock_all_dependencies["check_permission"].assert_called_once_with('test_owner_uid', 'test_store_id')
+
+@pytest.mark.parametrize("body", [["offer_price", 10], "texto", 42])
+def test_offer_writes_reject_bodies_that_are_not_objects(client, mock_all_dependencies, body):
+    mock_all_dependencies["auth"].verify_id_token.return_value = {'uid': 'test_owner_uid'}
+    headers = {"Authorization": "Bearer fake_token"}
+
+    assert client.put('/api/offers/test_offer_id', headers=headers, json=body).status_code == 400
+    assert client.post('/api/offers', headers=headers, json=body).status_code == 400
+
+def test_update_offer_keeps_denormalized_fields(client, mock_all_dependencies):
+    mock_all_dependencies["auth"].verify_id_token.return_value = {'uid': 'test_owner_uid'}
+    mock_db = mock_all_dependencies["db"]
+    mock_fs_doc = MagicMock()
+    mock_fs_doc.exists = True
+    mock_fs_doc.to_dict.return_value = {'product_id': 'test_product_id', 'store_id': 'test_store_id'}
+    mock_db.collection.return_value.document.return_value.get.return_value = mock_fs_doc
+    headers = {"Authorization": "Bearer t"}
+
+    response = client.put('/api/offers/test_offer_id', headers=headers, json={"product_id": "other_product"})
+    assert response.status_code == 400
+
+    response = client.put('/api/offers/test_offer_id', headers=headers, json={"offer_price": 5.0, "store_id": "other_store", "product": {}})
+    assert response.status_code == 200
+    update = mock_db.collection.return_value.document.return_value.update.call_args[0][0]
+    assert 'store_id' not in update and 'product' not in update
+
+def test_list_offers_by_store(client, mock_all_dependencies):
+    mock_db = mock_all_dependencies["db"]
+    offer_doc = MagicMock()
+    offer_doc.id = "offer_1"
+    offer_doc.to_dict.return_value = {'store_id': 's1', 'product_id': 'p1', 'product': {'name': 'Café'}}
+    stale_doc = MagicMock()
+    stale_doc.id = "offer_2"
+    stale_doc.to_dict.return_value = {'store_id': 's1', 'valid_until': datetime(2020, 1, 1, tzinfo=timezone.utc)}
+    active = mock_db.collection.return_value.where.return_value
+    query = active.where.return_value
+    query.limit.return_value.stream.return_value = [offer_doc, stale_doc]
+
+    response = client.get('/api/offers?store_id=s1&limit=10')
+
+    assert response.status_code == 200
+    assert [offer['id'] for offer in response.json['offers']] == ['offer_1']
+    assert response.json['offers'][0]['product']['name'] == 'Café'
+    mock_db.collection.return_value.where.assert_called_once_with('status', '==', 'active')
+    active.where.assert_called_once_with('store_id', '==', 's1')
+    query.limit.assert_called_once_with(10)
+    assert client.get('/api/offers').status_code == 400
+    # limit sem piso chegaria ao Firestore como 0 ou negativo.
+    assert client.get('/api/offers?store_id=s1&limit=0').status_code == 200
+    query.limit.assert_called_with(1)
+
+def test_expire_offers_sweeps_buckets_and_checkpoints(mock_all_dependencies):
+    mock_db = mock_all_dependencies["db"]
+    now = datetime(2026, 1, 1, 10, 30, tzinfo=timezone.utc)
+    state_doc = MagicMock(exists=True)
+    state_doc.to_dict.return_value = {'last_completed_bucket': '2026010108'}
+    mock_db.collection.return_value.document.return_value.get.return_value = state_doc
+
+    expired_offer = MagicMock(id='offer_1')
+    expired_offer.to_dict.return_value = {'store_id': 's1', 'product_id': 'p1', 'valid_until': now}
+    # Bucket 09: uma página com uma oferta e depois vazio. Bucket 10 (hora atual): vazio.
+    bucket_query = mock_db.collection.return_value.where.return_value.where.return_value
+    bucket_query.limit.return_value.stream.side_effect = [[expired_offer], []]
+    bucket_query.where.return_value.limit.return_value.stream.return_value = []
+
+    assert api_index.expire_offers(now=now) == 1
+
+    buckets = [c.args[2] for c in mock_db.collection.return_value.where.call_args_list]
+    assert buckets == ['2026010109', '2026010109', '2026010110']
+    # Na hora atual só entram as ofertas com valid_until <= agora.
+    bucket_query.where.assert_called_once_with('valid_until', '<=', now)
+    batch = mock_db.batch.return_value
+    batch.update.assert_called_once()
+    assert batch.update.call_args[0][1]['status'] == 'expired'
+    # O evento vai para a outbox no mesmo batch, antes do commit; nada é publicado direto.
+    outbox_doc = batch.set.call_args[0][1]
+    assert outbox_doc['topic'] == 'eventos_ofertas'
+    event = api_index.events.decode_event(outbox_doc['payload'])
+    assert (event['event_type'], event['offer_id']) == ('OfferExpired', 'offer_1')
+    mock_db.collection.assert_any_call(api_index.OUTBOX_COLLECTION)
+    assert batch.method_calls[-1] == call.commit()
+    mock_all_dependencies["publish_event"].assert_not_called()
+    # Só o bucket concluído vira checkpoint.
+    mock_db.collection.return_value.document.return_value.set.assert_called_once_with({'last_completed_bucket': '2026010109'}, merge=True)
+
+def test_outbox_relay_route_requires_cron_secret(client, mock_all_dependencies):
+    with patch.dict(os.environ, {"CRON_SECRET": "segredo"}), \
+         patch.object(api_index.outbox, 'relay_firestore_batch', return_value=3) as mock_relay:
+        assert client.post('/internal/outbox/relay').status_code == 401
+        response = client.post('/internal/outbox/relay', headers={"Authorization": "Bearer segredo"})
+
+    assert response.status_code == 200
+    assert response.json['events_relayed'] == 3
+    mock_relay.assert_called_once_with(mock_all_dependencies["db"], api_index.OUTBOX_COLLECTION, mock_all_dependencies["producer"])
+
+def test_update_offer_recomputes_expiry(client, mock_all_dependencies):
+    mock_all_dependencies["auth"].verify_id_token.return_value = {'uid': 'test_owner_uid'}
+    mock_db = mock_all_dependencies["db"]
+    mock_fs_doc = MagicMock()
+    mock_fs_doc.exists = True
+    mock_fs_doc.to_dict.return_value = {'product_id': 'test_product_id', 'store_id': 'test_store_id', 'status': 'expired'}
+    mock_db.collection.return_value.document.return_value.get.return_value = mock_fs_doc
+
+    response = client.put('/api/offers/test_offer_id', headers={"Authorization": "Bearer t"}, json={"valid_until": "2999-01-01T12:00:00Z"})
+    assert response.status_code == 200
+    update = mock_db.collection.return_value.document.return_value.update.call_args[0][0]
+    assert update['expiry_bucket'] == '2999010112'
+    assert update['status'] == 'active'
+
+    response = client.put('/api/offers/test_offer_id', headers={"Authorization": "Bearer t"}, json={"valid_until": "amanhã"})
+    assert response.status_code == 400
+
+def test_product_updated_refreshes_offer_snapshots(mock_all_dependencies):
+    mock_db = mock_all_dependencies["db"]
+    offers = [MagicMock(), MagicMock()]
+    mock_db.collection.return_value.where.return_value.stream.return_value = offers
+    messages = []
+    for event in (
+        {"event_type": "ProductUpdated", "product_id": "p1", "data": {"name": "Novo nome", "price": 3}},
+        {"event_type": "ProductImageSetPrimary", "product_id": "p1", "data": {"image_url": "http://img"}},
+        {"event_type": "ProductUpdated", "product_id": "p2", "data": {"price": 4}},
+    ):
+        message = MagicMock()
+        message.error.return_value = None
+        message.value.return_value = json.dumps(event).encode('utf-8')
+        messages.append(message)
+    consumer = MagicMock()
+    consumer.consume.return_value = messages
+
+    with patch.object(api_index, 'get_product_events_consumer', return_value=consumer):
+        assert api_index.consume_product_events() == 3
+
+    # Só p1 muda o resumo, numa única consulta e num único batch.
+    mock_db.collection.return_value.where.assert_called_once_with('product_id', '==', 'p1')
+    batch = mock_db.batch.return_value
+    assert batch.update.call_count == 2
+    update = batch.update.call_args[0][1]
+    assert update['product.name'] == 'Novo nome'
+    assert update['product.image_url'] == 'http://img'
+    batch.commit.assert_called_once()
+    consumer.commit.assert_called_once_with(asynchronous=False)
+
+def test_failed_product_events_batch_rewinds_consumer(mock_all_dependencies):
+    from confluent_kafka import TopicPartition
+    mock_db = mock_all_dependencies["db"]
+    mock_db.collection.return_value.where.return_value.stream.return_value = [MagicMock()]
+    mock_db.batch.return_value.commit.side_effect = Exception("firestore down")
+    message = MagicMock()
+    message.error.return_value = None
+    message.value.return_value = json.dumps({"event_type": "ProductUpdated", "product_id": "p1", "data": {"name": "x"}}).encode('utf-8')
+    consumer = MagicMock()
+    consumer.consume.return_value = [message]
+    consumer.assignment.return_value = [TopicPartition('eventos_produtos', 0)]
+    consumer.committed.return_value = [TopicPartition('eventos_produtos', 0, 7)]
+
+    with patch.object(api_index, 'get_product_events_consumer', return_value=consumer):
+        with pytest.raises(Exception, match="firestore down"):
+            api_index.consume_product_events()
+
+    # A posição volta ao offset confirmado: a próxima leitura traz a mensagem de novo.
+    consumer.commit.assert_not_called()
+    assert consumer.seek.call_args[0][0].offset == 7
+
+def test_backfill_fills_store_id_and_product_snapshot(mock_all_dependencies):
+    import backfill_offers
+    mock_db = mock_all_dependencies["db"]
+    complete = MagicMock()
+    complete.to_dict.return_value = {'product_id': 'p1', 'store_id': 's1', 'product': {'name': 'A'}}
+    legacy = MagicMock()
+    legacy.to_dict.return_value = {'product_id': 'p2'}
+    orphan = MagicMock()
+    orphan.to_dict.return_value = {'product_id': 'p3'}
+    mock_db.collection.return_value.order_by.return_value.limit.return_value.stream.return_value = [complete, legacy, orphan]
+    product = MagicMock(exists=True, id='p2')
+    product.to_dict.return_value = {'store_id': 's2', 'name': 'B', 'category': 'Bebidas'}
+    mock_db.get_all.return_value = [product, MagicMock(exists=False, id='p3')]
+
+    stats = backfill_offers.backfill(mock_db, page_size=100)
+
+    # A oferta completa só recebe os campos de validade; a órfã também.
+    assert stats == {"scanned": 3, "updated": 3, "missing_product": 1}
+    assert len(mock_db.get_all.call_args[0][0]) == 2
+    updates = {c.args[0]: c.args[1] for c in mock_db.batch.return_value.update.call_args_list}
+    assert updates[legacy.reference]['store_id'] == 's2'
+    assert updates[legacy.reference]['product'] == {'name': 'B', 'image_url': None, 'category': 'Bebidas'}
+    assert updates[legacy.reference]['status'] == 'active'
+    assert 'store_id' not in updates[complete.reference]
+    assert 'store_id' not in updates[orphan.reference]
+    mock_db.batch.return_value.commit.assert_called_once()
+
+def test_backfill_marks_past_offers_expired(mock_all_dependencies):
+    import backfill_offers
+    mock_db = mock_all_dependencies["db"]
+    old_offer = MagicMock()
+    old_offer.to_dict.return_value = {'product_id': 'p1', 'store_id': 's1', 'product': {}, 'end_date': '2020-05-01T10:00:00Z'}
+    mock_db.collection.return_value.order_by.return_value.limit.return_value.stream.return_value = [old_offer]
+
+    backfill_offers.backfill(mock_db)
+
+    mock_db.get_all.assert_not_called()
+    update = mock_db.batch.return_value.update.call_args[0][1]
+    assert update == {'valid_until': datetime(2020, 5, 1, 10, tzinfo=timezone.utc), 'expiry_bucket': '2020050110', 'status': 'expired'}
+
+class FakeBulkWriter:
+    """Executa as escritas no close() e chama os callbacks como o BulkWriter do Firestore."""
+    def __init__(self, failing_paths=()):
+        self.operations = []
+        self.failing_paths = set(failing_paths)
+
+    def on_write_result(self, callback):
+        self.success_callback = callback
+
+    def on_write_error(self, callback):
+        self.error_callback = callback
+
+    def create(self, ref, data):
+        self.operations.append(('create', ref, data))
+
+    def update(self, ref, data):
+        self.operations.append(('update', ref, data))
+
+    def close(self):
+        for _, ref, _ in self.operations:
+            if ref.path in self.failing_paths:
+                failure = MagicMock(code=7, message='PERMISSION_DENIED', attempts=1)
+                failure.operation.reference = ref
+                assert self.error_callback(failure, self) is False
+            else:
+                self.success_callback(ref, MagicMock(), self)
+
+def setup_bulk_db(mock_db, docs, failing_paths=()):
+    """Coleções com referências reais (path/id) e get_all respondendo a partir de docs."""
+    counter = iter(range(1000))
+
+    def document(collection, doc_id=None):
+        doc_id = doc_id or f"auto_{next(counter)}"
+        return MagicMock(id=doc_id, path=f"{collection}/{doc_id}")
+
+    def collection(name):
+        col = MagicMock()
+        col.document.side_effect = lambda doc_id=None: document(name, doc_id)
+        return col
+
+    def get_all(refs):
+        snapshots = []
+        for ref in refs:
+            data = docs.get(ref.path)
+            snapshot = MagicMock(id=ref.id, exists=data is not None)
+            snapshot.to_dict.return_value = data
+            snapshots.append(snapshot)
+        return snapshots
+
+    mock_db.collection.side_effect = collection
+    mock_db.get_all.side_effect = get_all
+    writer = FakeBulkWriter(failing_paths)
+    mock_db.bulk_writer.return_value = writer
+    return writer
+
+def test_bulk_offers_csv_creates_updates_and_reports_rows(client, mock_all_dependencies):
+    mock_all_dependencies["auth"].verify_id_token.return_value = {'uid': 'owner'}
+    writer = setup_bulk_db(mock_all_dependencies["db"], {
+        'products/p1': {'store_id': 's1', 'name': 'Café', 'image_url': None, 'category': 'bebidas'},
+        'products/p2': {'store_id': 'outra_loja', 'name': 'Arroz'},
+        'offers/o1': {'store_id': 's1', 'product_id': 'p1'},
+    })
+    sheet = (
+        "product_id,offer_price,valid_until,offer_id\n"
+        "p1,9.90,2999-01-01T00:00:00Z,\n"
+        "p1,8.50,,o1\n"
+        "p2,5.00,,\n"
+        "p3,5.00,,\n"
+        "p1,-1,,\n"
+        "p1,3.00,ontem,\n"
+    )
+
+    response = client.post('/api/offers:bulk?store_id=s1', headers={"Authorization": "Bearer t"},
+                           data=sheet.encode('utf-8'), content_type='text/csv')
+
+    assert response.status_code == 200
+    assert response.json['summary'] == {"total": 6, "created": 1, "updated": 1, "failed": 4}
+    results = response.json['results']
+    assert [r['status'] for r in results] == ['created', 'updated', 'error', 'error', 'error', 'error']
+    assert results[0]['offer_id'] == 'auto_0'
+    assert results[1]['offer_id'] == 'o1'
+    assert results[2]['error'] == "Produto não pertence a esta loja."
+    assert results[3]['error'] == "Produto não encontrado."
+    # Uma verificação de permissão e uma leitura em lote para todos os produtos.
+    mock_all_dependencies["check_permission"].assert_called_once_with('owner', 's1')
+    assert mock_all_dependencies["db"].get_all.call_count == 2
+
+    (kind, _, created), (_, _, updated) = writer.operations
+    assert kind == 'create'
+    assert created['offer_price'] == 9.9
+    assert created['store_id'] == 's1'
+    assert created['product'] == {'name': 'Café', 'image_url': None, 'category': 'bebidas'}
+    assert created['expiry_bucket'] == '2999010100'
+    assert 'expiry_bucket' not in updated
+    event_types = [c.args[1] for c in mock_all_dependencies["publish_event"].call_args_list]
+    assert event_types == ['OfferCreated', 'OfferUpdated']
+
+def test_bulk_offers_json_reports_write_failures(client, mock_all_dependencies):
+    mock_all_dependencies["auth"].verify_id_token.return_value = {'uid': 'owner'}
+    setup_bulk_db(mock_all_dependencies["db"], {
+        'products/p1': {'store_id': 's1', 'name': 'Café'},
+        'offers/o1': {'store_id': 'outra_loja', 'product_id': 'p1'},
+    }, failing_paths={'offers/auto_0'})
+    body = {"store_id": "s1", "offers": [
+        {"product_id": "p1", "offer_price": 10},
+        {"product_id": "p1", "offer_price": 11, "offer_id": "o1"},
+    ]}
+
+    response = client.post('/api/offers:bulk', headers={"Authorization": "Bearer t"}, json=body)
+
+    assert response.status_code == 200
+    results = response.json['results']
+    assert results[0]['error'] == 'PERMISSION_DENIED'
+    assert results[1]['error'] == "Oferta não pertence a esta loja."
+    assert response.json['summary']['failed'] == 2
+    mock_all_dependencies["publish_event"].assert_not_called()
+
+def test_bulk_offers_rejects_only_rows_with_invalid_ids(client, mock_all_dependencies):
+    mock_all_dependencies["auth"].verify_id_token.return_value = {'uid': 'owner'}
+    writer = setup_bulk_db(mock_all_dependencies["db"], {'products/p1': {'store_id': 's1', 'name': 'Café'}})
+    body = {"store_id": "s1", "offers": [
+        {"product_id": ["p1"], "offer_price": 10},
+        {"product_id": "p1", "offer_price": 10, "offer_id": ["o1"]},
+        {"product_id": "p1", "offer_price": 10, "offer_id": "ofertas/o1"},
+        {"product_id": "p1", "offer_price": 10},
+    ]}
+
+    response = client.post('/api/offers:bulk', headers={"Authorization": "Bearer t"}, json=body)
+
+    assert response.status_code == 200
+    assert response.json['summary'] == {"total": 4, "created": 1, "updated": 0, "failed": 3}
+    errors = [r['error'] for r in response.json['results']]
+    assert "product_id" in errors[0]
+    assert errors[1] == errors[2] == "offer_id deve ser um id válido."
+    assert len(writer.operations) == 1
+
+def test_bulk_offers_checks_permission_once(client, mock_all_dependencies):
+    mock_all_dependencies["auth"].verify_id_token.return_value = {'uid': 'intruso'}
+    mock_all_dependencies["check_permission"].return_value = (False, "sem papel")
+    response = client.post('/api/offers:bulk?store_id=s1', headers={"Authorization": "Bearer t"},
+                           json=[{"product_id": "p1", "offer_price": 1}])
+    assert response.status_code == 403
+    mock_all_dependencies["db"].bulk_writer.assert_not_called()
+    assert client.post('/api/offers:bulk', headers={"Authorization": "Bearer t"}, json=[{}]).status_code == 400
+
 def test_update_offer_unauthorized(client, mock_all_dependencies):
     """Testa a atualização de uma oferta por um usuário não autorizado."""
     unauthorized_uid = "unauthorized_user_uid"
@@ -280,3 +654,21 @@ def test_health_check_kafka_error(client, mock_all_dependencies):
         assert response.status_code == 503
         assert response.json["dependencies"]["kafka_producer"] == "error"
         assert response.json["initialization_errors"]["kafka_producer"] is not None
+
+def test_liveness_check(client):
+    """Liveness não depende de nenhuma dependência externa."""
+    response = client.get('/api/health/live')
+    assert response.status_code == 200
+    assert response.json == {"status": "ok"}
+
+def test_readiness_check_is_memoized(client, mock_all_dependencies):
+    """Readiness reaproveita o resultado das verificações dentro da janela de cache."""
+    with patch.dict(api_index.readiness_cache, {"status": None, "checked_at": 0.0}), \
+         patch.object(api_index, 'get_health_status', wraps=api_index.get_health_status) as spy:
+        first = client.get('/api/health/ready')
+        second = client.get('/api/health/ready')
+
+    assert first.status_code == second.status_code == 200
+    assert first.json["status"] == "ok"
+    assert "latencies_ms" in first.json
+    assert spy.call_count == 1
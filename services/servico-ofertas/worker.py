@@ -0,0 +1,31 @@
+# services/servico-ofertas/worker.py
+# Processo de fundo do serviço: mantém o resumo do produto nas ofertas a partir dos
+# eventos ProductUpdated/ProductImageSetPrimary, expira as ofertas vencidas e publica os
+# eventos gravados na outbox (coleção _outbox). No Vercel o mesmo trabalho é feito pelo
+# cron em /internal/events/consume, /internal/offers/expire e /internal/outbox/relay.
+#     python worker.py
+import os
+import sys
+
+from api import index
+from common import workers
+
+OFFER_EXPIRY_INTERVAL_SECONDS = float(os.environ.get('OFFER_EXPIRY_INTERVAL_SECONDS', 60))
+
+
+def main():
+    index.init_clients()
+    if not index.db:
+        print(f"Worker não iniciado: {index.firebase_init_error}")
+        return 1
+    print("Consumidor de eventos de produtos, sweeper de validade e relay da outbox iniciados.")
+    workers.run_forever([
+        index.consume_product_events,
+        workers.every(OFFER_EXPIRY_INTERVAL_SECONDS, index.expire_offers),
+        index.relay_outbox_batch,
+    ])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,121 +1,90 @@
 from dotenv import load_dotenv
 load_dotenv(dotenv_path='.env.local')
 
-import os
+import base64
 import json
-import requests
-from datetime import datetime, timezone
+import math
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import firebase_admin
-from firebase_admin import credentials, auth, firestore
-from confluent_kafka import Producer
-import base64
 
 
+# --- Pacote compartilhado (services/common) ---
+# No repositório e nas imagens Docker o pacote fica na pasta pai do serviço; no deploy do
+# Vercel ele é copiado para dentro da pasta do serviço (ver .github/actions/deploy-service).
+SERVICE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+for common_parent in (os.path.dirname(SERVICE_ROOT), SERVICE_ROOT):
+    if os.path.isdir(os.path.join(common_parent, 'common')) and common_parent not in sys.path:
+        sys.path.insert(0, common_parent)
+
+from common import events, firebase, images, kafka, matching, permissions, health, storage, tokens, service
+from common.instrumentation import metrics
+from common.lazy import lazy_import, NOT_INITIALIZED
+
+auth = lazy_import('firebase_admin.auth')
+firestore = lazy_import('firebase_admin.firestore')
+
 app = Flask(__name__)
 CORS(app, supports_credentials=True, origins=['https://frontend-tester-1foc8lpkl-jeanmnorhens-projects.vercel.app'])
 
 # --- Global Dependencies_ _(initiali zed to None) --- 
-db = None
-producer = None
+db = NOT_INITIALIZED
+producer = NOT_INITIALIZED
 firebase_init_error = None
 kafka_producer_init_error = None
+kafka_consumer_init_error = None
 
 # ---Inicialização do Firebase Admin SDK (PADRONIZADO) ---1
-if firebase_admin:
-    try:
-        base64_sdk = os.environ.get('FIREBASE_ADMIN_SDK_BASE64')
-        if base64_sdk:
-            decoded_sdk = base64.b64decode(base64_sdk).decode('utf-8')
-            cred_dict = json.loads(decoded_sdk)
-            cred = credentials.Certificate(cred_dict)
-            if not firebase_admin._apps:
-                firebase_admin.initialize_app(cred)
-            db = firestore.client()
-            print("Firebase inicializado com sucesso via Base64.")
-        else:
-            firebase_init_error = "Variável de ambiente FIREBASE_ADMIN_SDK_BASE64 não encontrada."
-            print(firebase_init_error)
-    except Exception as e:
-        firebase_init_error = str(e)
-        print(f"Erro ao inicializar o Firebase Admin SDK: {e}")
-else:
-    firebase_init_error = "Biblioteca firebase_admin não encontrada."
+
+def init_firebase():
+    global db, firebase_init_error
+    db, firebase_init_error = firebase.get_firestore_client()
+
+# --- Verificação de ID tokens com cache ---
+def verify_id_token(id_token):
+    return auth.verify_id_token(id_token)
+
+token_verifier = tokens.CachedTokenVerifier(verify_id_token)
 
 # --- Configuração do Kafka Producer ---
-if Producer:
-    try:
-        kafka_bootstrap_server = os.environ.get('KAFKA_BOOTSTRAP_SERVER')
-        if kafka_bootstrap_server:
-            # Local Docker Kafka configuration
-            print("Configurando produtor Kafka para ambiente local (sem SASL)...")
-            kafka_conf = {
-                'bootstrap.servers': kafka_bootstrap_server
-            }
-            producer = Producer(kafka_conf)
-            print("Produtor Kafka inicializado com sucesso.")
-        else:
-            kafka_producer_init_error = "Variável de ambiente KAFKA_BOOTSTRAP_SERVER não encontrada."
-            print(kafka_producer_init_error)
-    except Exception as e:
-        kafka_producer_init_error = str(e)
-        print(f"Erro ao inicializar Produtor Kafka: {e}")
-else:
-    kafka_producer_init_error = "Biblioteca confluent_kafka não encontrada."
 
-# --- Funções Auxiliares  ---
+def init_kafka_producer():
+    global producer, kafka_producer_init_error
+    producer, kafka_producer_init_error = kafka.get_producer()
+
+# --- Inicialização dos clientes ---
+# Sob demanda, na primeira requisição e no post_fork do gunicorn (common/service.py).
+def create_clients():
+    if db is NOT_INITIALIZED:
+        init_firebase()
+        if db:
+            token_verifier.start_key_refresher()
+    if producer is NOT_INITIALIZED:
+        init_kafka_producer()
 
-def delivery_report(err, msg):
-    if err is not None:
-        print(f'Falha ao entregar mensagem Kafka: {err}')
-    else:
-        print(f'Mensagem Kafka entregue em {msg.topic()} [{msg.partition()}]')
+init_clients = service.lazy_clients(app, create_clients)
+
+@app.teardown_request
+def flush_kafka_producer(exception=None):
+    # Em serverless o processo pode ser congelado logo após a resposta; sem o flush os
+    # eventos da requisição ficariam presos no buffer do produtor.
+    kafka.flush_if_serverless()
+
+# --- Funções Auxiliares  ---
 
 def publish_event(topic, event_type, product_id, data, changes=None):
-    if not producer:
-        print("Produtor Kafka não está inicializado. Evento não publicado.")
-        return
-    event = {
-        "event_type": event_type,
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "product_id": product_id,
-        "data": data,
-        "source_service": "servico-produtos"
-    }
-    if changes:
-        event["changes"] = changes
-    try:
-        event_value = json.dumps(event, default=str)
-        producer.produce(topic, key=product_id, value=event_value, callback=delivery_report)
-        producer.poll(0)
-        print(f"Evento '{event_type}' para o produto {product_id} publicado no tópico {topic}.")
-    except Exception as e:
-        print(f"Erro ao publicar evento Kafka: {e}")
+    kafka.publish_event(producer, topic, event_type, 'product_id', product_id, data, 'servico-produtos', changes)
+
 
+permission_client = permissions.PermissionClient()
 
 def check_permission(user_id, store_id):
     """Chama o servico-usuarios para verificar se um usuário tem permissão para gerenciar uma loja."""
-    servico_usuarios_url = os.environ.get('SERVICO_USUARIOS_URL')
-    if not servico_usuarios_url:
-        print("ERRO: SERVICO_USUARIOS_URL não configurado.")
-        return False, {"error": "URL do serviço de permissões não configurada."}
-
-    try:
-        # O token do usuário   original não é necessário aqui, pois usamos o segredo interno.
-        response = requests.get(
-            f"{servico_usuarios_url}/api/permissions/check",
-            params={'user_id': user_id, 'store_id': store_id},
-            timeout=5
-        )
-        if response.status_code == 200:
-            return response.json().get('allow', False), response.json()
-        else:
-            return False, response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Erro ao contatar o serviço de permissões: {e}")
-        return False, {"error": "Falha ao contatar o serviço de permissões."}
-
+    return permission_client.check(user_id, store_id)
 
 @app.route('/api/products', methods=['GET'])
 def list_all_products():
@@ -136,6 +105,29 @@ def list_all_products():
     except Exception as e:
         return jsonify({"error": f"Erro ao listar produtos: {e}"}), 500
 
+# --- Fila de pendentes ---
+# Ordenada por created_at (mais antigos primeiro) com paginação por cursor (keyset): a
+# página seguinte começa depois do último (created_at, id) da anterior, sem offset. Os
+# índices compostos das combinações de filtros estão em firestore.indexes.json. Pendentes
+# anteriores ao campo source só aparecem no filtro depois de backfill_pending_source.py.
+PRODUCT_SOURCES = ('ai', 'manual')
+PENDING_PAGE_SIZE = 50
+PENDING_MAX_PAGE_SIZE = 200
+
+def encode_cursor(doc, product_data):
+    created_at = product_data.get('created_at')
+    payload = {'created_at': created_at.isoformat() if isinstance(created_at, datetime) else None, 'id': doc.id}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    """Devolve os valores de start_after para o cursor. ValueError se inválido."""
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        created_at = datetime.fromisoformat(payload['created_at'])
+        return {'created_at': created_at, '__name__': db.collection('products').document(payload['id'])}
+    except Exception as e:
+        raise ValueError(f"cursor inválido: {e}")
+
 @app.route('/api/products/pending', methods=['GET'])
 def list_pending_products():
     if not db:
@@ -148,22 +140,44 @@ def list_pending_products():
     try:
         id_token = auth_header.split('Bearer ')[1]
         # Here you might want to check for a custom claim 'admin' in a real scenario
-        auth.verify_id_token(id_token)
+        token_verifier.verify(id_token)
     except Exception as e:
         return jsonify({"error": f"Invalid or expired token: {str(e)}"}), 401
 
+    source = request.args.get('source')
+    category = request.args.get('category')
+    if source and source not in PRODUCT_SOURCES:
+        return jsonify({"error": f"Parâmetro 'source' deve ser um de {list(PRODUCT_SOURCES)}."}), 400
     try:
-        products_ref = db.collection('products')
-        query = products_ref.where('status', '==', 'pending_approval')
-        docs = query.stream()
-        
+        limit = max(1, min(int(request.args.get('limit', PENDING_PAGE_SIZE)), PENDING_MAX_PAGE_SIZE))
+        cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError as e:
+        return jsonify({"error": f"Parâmetros de paginação inválidos: {e}"}), 400
+
+    try:
+        query = db.collection('products').where('status', '==', 'pending_approval')
+        if source:
+            query = query.where('source', '==', source)
+        if category:
+            query = query.where('category', '==', category)
+        # O total é uma agregação no servidor: nenhum documento é transferido.
+        total = query.count(alias='total').get()[0][0].value
+
+        page_query = query.order_by('created_at').order_by('__name__').limit(limit)
+        if cursor:
+            page_query = page_query.start_after(cursor)
         pending_products = []
-        for doc in docs:
+        next_cursor = None
+        for doc in page_query.stream():
             product_data = doc.to_dict()
+            product_data.pop('match', None)
+            next_cursor = encode_cursor(doc, product_data)
             product_data['id'] = doc.id
             pending_products.append(product_data)
-            
-        return jsonify({"products": pending_products}), 200
+        if len(pending_products) < limit:
+            next_cursor = None
+
+        return jsonify({"products": pending_products, "next_cursor": next_cursor, "total": total}), 200
     except Exception as e:
         return jsonify({"error": f"Erro ao listar produtos pendentes: {e}"}), 500
 
@@ -177,7 +191,7 @@ def approve_product(product_id):
         return jsonify({"error": "Authorization header missing"}), 401
     try:
         id_token = auth_header.split('Bearer ')[1]
-        auth.verify_id_token(id_token)
+        token_verifier.verify(id_token)
         # Add admin claim check here for production
     except Exception as e:
         return jsonify({"error": f"Invalid or expired token: {str(e)}"}), 401
@@ -209,7 +223,7 @@ def reject_product(product_id):
         return jsonify({"error": "Authorization header missing"}), 401
     try:
         id_token = auth_header.split('Bearer ')[1]
-        auth.verify_id_token(id_token)
+        token_verifier.verify(id_token)
         # Add admin claim check here for production
     except Exception as e:
         return jsonify({"error": f"Invalid or expired token: {str(e)}"}), 401
@@ -231,6 +245,101 @@ def reject_product(product_id):
     except Exception as e:
         return jsonify({"error": f"Erro ao rejeitar produto: {e}"}), 500
 
+# --- Moderação em massa da fila de pendentes ---
+PENDING_DECISIONS = {
+    'approve': ('approved', 'CanonicalProductApproved'),
+    'reject': ('rejected', 'CanonicalProductRejected'),
+}
+PENDING_BULK_MAX_DECISIONS = int(os.environ.get('PENDING_BULK_MAX_DECISIONS', 2000))
+
+@app.route('/api/products/pending:bulk-decision', methods=['POST'])
+def bulk_decide_pending_products():
+    """Aprova ou rejeita vários canônicos: {"decisions": [{"product_id", "decision": "approve"|"reject"}]}.
+
+    Uma leitura em lote, escritas pelo BulkWriter e os eventos publicados de uma vez. Cada
+    escrita exige que o produto não tenha mudado desde a leitura (last_update_time): uma
+    decisão concorrente faz falhar só aquele item, sem sobrescrever o status já decidido.
+    Responde 200 com o resultado de cada decisão, na ordem enviada."""
+    if not db:
+        return jsonify({"error": "Dependência do Firestore não inicializada."}), 503
+
+    auth_header = request.headers.get('Authorization')
+    if not auth_header:
+        return jsonify({"error": "Authorization header missing"}), 401
+    try:
+        id_token = auth_header.split('Bearer ')[1]
+        decoded_token = token_verifier.verify(id_token)
+    except Exception as e:
+        return jsonify({"error": f"Invalid or expired token: {str(e)}"}), 401
+    if not decoded_token.get('admin', False):
+        return jsonify({"error": "Only administrators can moderate canonical products."}), 403
+
+    decisions = (request.get_json(silent=True) or {}).get('decisions')
+    if not isinstance(decisions, list) or not decisions:
+        return jsonify({"error": "decisions é obrigatório."}), 400
+    if len(decisions) > PENDING_BULK_MAX_DECISIONS:
+        return jsonify({"error": f"Máximo de {PENDING_BULK_MAX_DECISIONS} decisões por requisição."}), 413
+
+    results = [{"item": i + 1, "product_id": None, "status": "error", "error": None} for i in range(len(decisions))]
+    valid = {}  # produto -> (índice, decisão)
+    for i, item in enumerate(decisions):
+        product_id = item.get('product_id') if isinstance(item, dict) else None
+        decision = item.get('decision') if isinstance(item, dict) else None
+        results[i]["product_id"] = product_id
+        if not firebase.is_document_id(product_id) or decision not in PENDING_DECISIONS:
+            results[i]["error"] = "product_id e decision ('approve' ou 'reject') são obrigatórios."
+        elif product_id in valid:
+            results[i]["error"] = "product_id repetido."
+        else:
+            valid[product_id] = (i, decision)
+
+    try:
+        docs = firebase.get_all_by_id(db, 'products', list(valid))
+    except Exception as e:
+        return jsonify({"error": f"Erro ao ler produtos: {e}"}), 500
+
+    writes = {}  # caminho do documento -> (produto, índice do item, decisão)
+
+    def on_success(path):
+        _, index, decision = writes[path]
+        results[index]["status"] = PENDING_DECISIONS[decision][0]
+        results[index]["error"] = None
+
+    def on_failure(path, message):
+        results[writes[path][1]]["error"] = f"Erro ao gravar (o produto pode ter sido moderado em paralelo): {message}"
+
+    bulk_writer = firebase.open_bulk_writer(db, on_success, on_failure)
+    try:
+        for product_id, (index, decision) in valid.items():
+            doc = docs.get(product_id)
+            if doc is None:
+                results[index]["error"] = "Produto não encontrado."
+            elif doc.to_dict().get('store_id'):
+                results[index]["error"] = "Apenas produtos canônicos passam pela moderação."
+            elif doc.to_dict().get('status') != 'pending_approval':
+                results[index]["error"] = "Produto não está pendente de aprovação."
+            else:
+                ref = db.collection('products').document(product_id)
+                writes[ref.path] = (product_id, index, decision)
+                bulk_writer.update(ref, {
+                    'status': PENDING_DECISIONS[decision][0],
+                    'updated_at': firestore.SERVER_TIMESTAMP,
+                }, option=db.write_option(last_update_time=doc.update_time))
+    finally:
+        bulk_writer.close()
+
+    published = [(product_id, decision) for product_id, index, decision in writes.values()
+                 if results[index]["status"] != "error"]
+    for product_id, decision in published:
+        status, event_type = PENDING_DECISIONS[decision]
+        publish_event('eventos_produtos', event_type, product_id, {'status': status, 'updated_at': firestore.SERVER_TIMESTAMP})
+
+    summary = {"total": len(decisions), "approved": 0, "rejected": 0, "failed": 0}
+    for result in results:
+        summary[result["status"] if result["status"] != "error" else "failed"] += 1
+    metrics.increment('products.pending_decisions', len(published))
+    return jsonify({"summary": summary, "results": results}), 200
+
 @app.route('/api/products/<product_id>/images', methods=['POST'])
 def add_product_image(product_id):
     if not db:
@@ -241,28 +350,51 @@ def add_product_image(product_id):
         return jsonify({"error": "Authorization header missing"}), 401
     try:
         id_token = auth_header.split('Bearer ')[1]
-        auth.verify_id_token(id_token)
-        # Add admin claim check here for production
+        decoded_token = token_verifier.verify(id_token)
+        uid = decoded_token['uid']
     except Exception as e:
         return jsonify({"error": f"Invalid or expired token: {str(e)}"}), 401
 
-    data = request.get_json()
+    data = request.get_json(silent=True) or {}
     image_url = data.get('image_url')
     source = data.get('source', 'manual_upload') # e.g., 'image_analysis', 'manual_upload'
 
-    if not image_url:
+    if not image_url or not isinstance(image_url, str):
         return jsonify({"error": "image_url é obrigatório."}), 400
+    # A imagem é baixada pelos nossos servidores: só URLs http(s) de hosts públicos.
+    try:
+        images.check_public_url(image_url)
+    except (ValueError, OSError) as e:
+        return jsonify({"error": f"image_url inválida: {e}"}), 400
 
     try:
         product_ref = db.collection('products').document(product_id)
-        if not product_ref.get().exists:
+        product_doc = product_ref.get()
+        if not product_doc.exists:
             return jsonify({"error": "Produto não encontrado."}), 404
 
+        # Imagens de produto de loja: dono da loja ou admin; de canônico: só admin.
+        if not decoded_token.get('admin', False):
+            store_id = product_doc.to_dict().get('store_id')
+            if not store_id:
+                return jsonify({"error": "Only administrators can add images to canonical products."}), 403
+            allowed, reason = check_permission(uid, store_id)
+            if not allowed:
+                return jsonify({"error": "User is not authorized to add images to this product", "details": reason}), 403
+
+        # A mesma URL não entra duas vezes; cópias com outra URL são pegas na ingestão.
+        existing = list(product_ref.collection('images').where('image_url', '==', image_url).limit(1).stream())
+        if existing:
+            return jsonify({"error": "Imagem já cadastrada para este produto.", "imageId": existing[0].id}), 409
+
         image_data = {
             'image_url': image_url,
             'source': source,
             'status': 'pending_review', # Admin needs to approve it
             'is_primary': False,
+            # Download, hashes e miniaturas ficam para ingest_pending_images.
+            'ingestion_status': 'pending',
+            'ingestion_attempts': 0,
             'created_at': firestore.SERVER_TIMESTAMP
         }
 
@@ -274,6 +406,109 @@ def add_product_image(product_id):
     except Exception as e:
         return jsonify({"error": f"Erro ao adicionar imagem: {e}"}), 500
 
+# --- Ingestão das imagens candidatas ---
+# Cada imagem nova (ingestion_status 'pending') é baixada uma vez pelo worker: SHA-256 e
+# hash perceptual para rejeitar duplicatas do mesmo produto, e miniaturas WebP gravadas no
+# armazenamento configurado (common.storage), com as URLs no documento da imagem. Imagens
+# do mesmo produto são processadas em sequência (a deduplicação vê as anteriores); produtos
+# diferentes em paralelo, com no máximo IMAGE_INGESTION_CONCURRENCY downloads ao mesmo tempo.
+IMAGE_INGESTION_BATCH_SIZE = int(os.environ.get('IMAGE_INGESTION_BATCH_SIZE', 20))
+IMAGE_INGESTION_CONCURRENCY = int(os.environ.get('IMAGE_INGESTION_CONCURRENCY', 4))
+IMAGE_INGESTION_MAX_ATTEMPTS = int(os.environ.get('IMAGE_INGESTION_MAX_ATTEMPTS', 3))
+IMAGE_PHASH_MAX_DISTANCE = int(os.environ.get('IMAGE_PHASH_MAX_DISTANCE', 6))
+
+def find_duplicate_image(product_ref, image_id, sha256, phash):
+    """Id de outra imagem do produto com o mesmo conteúdo ou quase a mesma foto, ou None."""
+    for other in product_ref.collection('images').select(['content_sha256', 'phash']).stream():
+        if other.id == image_id:
+            continue
+        other_data = other.to_dict()
+        if other_data.get('content_sha256') == sha256:
+            return other.id
+        if other_data.get('phash') and images.hamming_distance(other_data['phash'], phash) <= IMAGE_PHASH_MAX_DISTANCE:
+            return other.id
+    return None
+
+def ingest_image(image_doc):
+    """Processa uma imagem pendente. Devolve 'ready', 'duplicate', 'retry' ou 'failed'."""
+    image_ref = image_doc.reference
+    product_ref = image_ref.parent.parent
+    image_data = image_doc.to_dict()
+    try:
+        content = images.fetch(image_data['image_url'])
+        picture = images.open_image(content)
+        sha256 = images.content_hash(content)
+        phash = images.perceptual_hash(picture)
+        duplicate_of = find_duplicate_image(product_ref, image_doc.id, sha256, phash)
+        if duplicate_of:
+            image_ref.update({
+                'content_sha256': sha256,
+                'phash': phash,
+                'status': 'rejected',
+                'ingestion_status': 'duplicate',
+                'duplicate_of': duplicate_of,
+            })
+            return 'duplicate'
+        # Chaves derivadas do conteúdo: reprocessar grava os mesmos arquivos.
+        image_store = storage.get_storage()
+        thumbnails = {}
+        for size, thumbnail in images.thumbnails(picture).items():
+            key = f"products/{product_ref.id}/{sha256[:32]}/{size}.webp"
+            thumbnails[str(size)] = image_store.put(key, thumbnail, 'image/webp')
+        image_ref.update({
+            'content_sha256': sha256,
+            'phash': phash,
+            'width': picture.width,
+            'height': picture.height,
+            'size_bytes': len(content),
+            'thumbnails': thumbnails,
+            'ingestion_status': 'ready',
+            'processed_at': firestore.SERVER_TIMESTAMP,
+        })
+        return 'ready'
+    except Exception as e:
+        attempts = (image_data.get('ingestion_attempts') or 0) + 1
+        # Arquivo inválido ou grande demais não melhora com novas tentativas.
+        failed = isinstance(e, images.ImageError) or attempts >= IMAGE_INGESTION_MAX_ATTEMPTS
+        updates = {'ingestion_attempts': attempts, 'ingestion_error': str(e)}
+        if failed:
+            updates['ingestion_status'] = 'failed'
+        image_ref.update(updates)
+        print(f"Erro ao processar a imagem {image_doc.id} do produto {product_ref.id}: {e}")
+        return 'failed' if failed else 'retry'
+
+def ingest_pending_images(batch_size=IMAGE_INGESTION_BATCH_SIZE, concurrency=IMAGE_INGESTION_CONCURRENCY):
+    """Processa um lote de imagens pendentes. Devolve quantas foram lidas."""
+    query = db.collection_group('images').where('ingestion_status', '==', 'pending').limit(batch_size)
+    docs = list(query.stream())
+    if not docs:
+        return 0
+    by_product = {}
+    for doc in docs:
+        by_product.setdefault(doc.reference.parent.parent.id, []).append(doc)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for outcomes in pool.map(lambda group: [ingest_image(doc) for doc in group], by_product.values()):
+            for outcome in outcomes:
+                metrics.increment(f'products.images_{outcome}')
+    return len(docs)
+
+@app.route('/internal/images/ingest', methods=['POST', 'GET'])
+def ingest_images_route():
+    # Chamada pelo cron (Vercel); em Docker o worker.py faz o mesmo em laço.
+    if not service.is_cron_request():
+        return jsonify({"error": "Unauthorized"}), 401
+    if not db:
+        return jsonify({"error": "Dependência do Firestore não inicializada."}), 503
+    try:
+        storage.get_storage()
+    except RuntimeError as e:
+        return jsonify({"error": f"Armazenamento de imagens não configurado: {e}"}), 503
+    try:
+        processed = ingest_pending_images()
+    except Exception as e:
+        return jsonify({"error": f"Erro ao processar imagens: {e}"}), 500
+    return jsonify({"status": "ok", "images_processed": processed}), 200
+
 @app.route('/api/products/<product_id>/images/<image_id>/set-primary', methods=['POST'])
 def set_primary_product_image(product_id, image_id):
     if not db:
@@ -285,7 +520,7 @@ def set_primary_product_image(product_id, image_id):
 
     try:
         id_token = auth_header.split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = token_verifier.verify(id_token)
         uid = decoded_token['uid']
     except Exception as e:
         return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
@@ -318,22 +553,31 @@ def set_primary_product_image(product_id, image_id):
         if not primary_image_url:
             return jsonify({"error": "URL da imagem principal não encontrada."}), 500
 
-        # Iniciar uma transação para garantir atomicidade
+        # O produto guarda o id da imagem principal (primary_image_id): a transação lê só o
+        # produto e grava no máximo três documentos (imagem antiga, imagem nova e produto),
+        # sem consultar a subcoleção.
         transaction = db.transaction()
 
         @firestore.transactional
         def update_primary_image_transaction(transaction, product_ref, image_to_set_primary_ref, primary_image_url):
-            # Desmarcar todas as outras imagens como primárias
+            product_data = product_ref.get(transaction=transaction).to_dict() or {}
             images_ref = product_ref.collection('images')
-            current_primary_images = images_ref.where('is_primary', '==', True).stream(transaction=transaction)
-            for img_doc in current_primary_images:
-                transaction.update(img_doc.reference, {'is_primary': False})
-            
-            # Definir a nova imagem como primária
-            transaction.update(image_to_set_primary_ref, {'is_primary': True})
+            if 'primary_image_id' in product_data:
+                current_primary_id = product_data['primary_image_id']
+                if current_primary_id and current_primary_id != image_id:
+                    transaction.update(images_ref.document(current_primary_id), {'is_primary': False})
+            else:
+                # Produto ainda não migrado (migrate_primary_image_ids.py): desmarca pelo flag.
+                for img_doc in images_ref.where('is_primary', '==', True).stream(transaction=transaction):
+                    if img_doc.id != image_id:
+                        transaction.update(img_doc.reference, {'is_primary': False})
 
-            # Atualizar o campo image_url no documento principal do produto
-            transaction.update(product_ref, {'image_url': primary_image_url, 'updated_at': firestore.SERVER_TIMESTAMP})
+            transaction.update(image_to_set_primary_ref, {'is_primary': True})
+            transaction.update(product_ref, {
+                'primary_image_id': image_id,
+                'image_url': primary_image_url,
+                'updated_at': firestore.SERVER_TIMESTAMP,
+            })
 
         update_primary_image_transaction(transaction, product_ref, image_to_set_primary_ref, primary_image_url)
 
@@ -343,6 +587,98 @@ def set_primary_product_image(product_id, image_id):
     except Exception as e:
         return jsonify({"error": f"Erro ao definir imagem principal: {e}"}), 500
 
+# --- Índice de deduplicação do catálogo canônico ---
+# Produtos canônicos guardam o mapa match: código de barras só com dígitos, nome
+# normalizado e as chaves LSH do nome (common.matching). Produtos de loja não têm o mapa,
+# então as consultas em match.* só veem o catálogo canônico, sem percorrê-lo.
+CANONICAL_MATCH_MIN_SCORE = float(os.environ.get('CANONICAL_MATCH_MIN_SCORE', 0.5))
+CANONICAL_MATCH_CANDIDATES = int(os.environ.get('CANONICAL_MATCH_CANDIDATES', 50))
+
+def canonical_match_fields(product_data):
+    normalized = matching.normalize_name(product_data.get('name'))
+    return {
+        'barcode': matching.normalize_barcode(product_data.get('barcode')),
+        'name': normalized,
+        'lsh': matching.lsh_keys(normalized),
+    }
+
+# --- Unicidade do código de barras no catálogo canônico ---
+# Cada código de barras normalizado tem uma reserva em CANONICAL_BARCODES_COLLECTION (o id
+# do documento é o próprio código) apontando para o canônico que o usa. O cadastro lê a
+# reserva e grava reserva e produto na mesma transação: de dois cadastros simultâneos, o
+# que perde o commit repete a transação e encontra a reserva do outro. A reserva de um
+# canônico rejeitado, apagado ou cujo código mudou é reaproveitada.
+CANONICAL_BARCODES_COLLECTION = 'canonical_barcodes'
+
+def create_canonical_with_barcode(product_ref, product_to_create, barcode):
+    """Grava o canônico reservando o código. Devolve o id do canônico que já o usa, ou None."""
+    claim_ref = db.collection(CANONICAL_BARCODES_COLLECTION).document(barcode)
+
+    @firestore.transactional
+    def create_in_transaction(transaction):
+        claim_doc = claim_ref.get(transaction=transaction)
+        claimed_id = (claim_doc.to_dict() or {}).get('product_id') if claim_doc.exists else None
+        if claimed_id:
+            claimed_doc = db.collection('products').document(claimed_id).get(transaction=transaction)
+            claimed = (claimed_doc.to_dict() or {}) if claimed_doc.exists else {}
+            if claimed and claimed.get('status') != 'rejected' and (claimed.get('match') or {}).get('barcode') == barcode:
+                return claimed_id
+        transaction.set(claim_ref, {'product_id': product_ref.id})
+        transaction.set(product_ref, product_to_create)
+        return None
+
+    return create_in_transaction(db.transaction())
+
+def find_canonical_matches(barcode=None, name=None, limit=5):
+    """Canônicos parecidos (exceto rejeitados): código de barras exato e depois nomes
+    com similaridade de trigramas >= CANONICAL_MATCH_MIN_SCORE, do mais parecido ao menos."""
+    products = db.collection('products')
+    matches = {}
+    barcode = matching.normalize_barcode(barcode)
+    if barcode:
+        for doc in products.where('match.barcode', '==', barcode).limit(limit).stream():
+            matches[doc.id] = (1.0, 'barcode', doc.to_dict())
+    normalized = matching.normalize_name(name)
+    keys = matching.lsh_keys(normalized)
+    if keys:
+        query_trigrams = matching.trigrams(normalized)
+        query = products.where('match.lsh', 'array_contains_any', keys).limit(CANONICAL_MATCH_CANDIDATES)
+        for doc in query.stream():
+            if doc.id in matches:
+                continue
+            product = doc.to_dict()
+            score = matching.jaccard(query_trigrams, matching.trigrams((product.get('match') or {}).get('name', '')))
+            if score >= CANONICAL_MATCH_MIN_SCORE:
+                matches[doc.id] = (score, 'name', product)
+    ranked = sorted(matches.items(), key=lambda item: item[1][0], reverse=True)
+    return [
+        {"id": product_id, "name": product.get('name'), "barcode": product.get('barcode'),
+         "status": product.get('status'), "score": round(score, 3), "matched_on": matched_on}
+        for product_id, (score, matched_on, product) in ranked
+        if product.get('status') != 'rejected'
+    ][:limit]
+
+@app.route('/api/products/canonical/match', methods=['GET'])
+def match_canonical_products():
+    if not db:
+        return jsonify({"error": "Dependência do Firestore não inicializada."}), 503
+
+    barcode = request.args.get('barcode')
+    name = request.args.get('name')
+    if not barcode and not name:
+        return jsonify({"error": "Parâmetro 'barcode' ou 'name' é obrigatório."}), 400
+    try:
+        limit = max(1, min(int(request.args.get('limit', 5)), 20))
+    except ValueError:
+        return jsonify({"error": "Parâmetro 'limit' inválido."}), 400
+
+    try:
+        with metrics.timer('products.canonical_match'):
+            matches = find_canonical_matches(barcode, name, limit)
+        return jsonify({"matches": matches}), 200
+    except Exception as e:
+        return jsonify({"error": f"Erro ao buscar produtos parecidos: {e}"}), 500
+
 @app.route("/api/products/canonical", methods=["POST"])
 def create_canonical_product():
     if not db:
@@ -354,7 +690,7 @@ def create_canonical_product():
 
     try:
         id_token = auth_header.split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = token_verifier.verify(id_token)
         # Idealmente, verificar uma custom claim de admin
         # auth.get_user(decoded_token['uid']).custom_claims.get('admin')
     except Exception as e:
@@ -365,17 +701,40 @@ def create_canonical_product():
         return jsonify({"error": "Product name is required"}), 400
 
     try:
+        match_fields = canonical_match_fields(product_data)
+        duplicate_error = "Já existe um produto canônico com este código de barras."
+        if match_fields['barcode']:
+            # Canônicos cadastrados antes das reservas de código de barras só aparecem na
+            # consulta. Canônicos rejeitados não bloqueiam o cadastro, como em find_canonical_matches.
+            same_barcode = db.collection('products').where('match.barcode', '==', match_fields['barcode']).limit(5).stream()
+            existing = next((doc for doc in same_barcode if doc.to_dict().get('status') != 'rejected'), None)
+            if existing:
+                return jsonify({"error": duplicate_error, "productId": existing.id}), 409
+
         product_to_create = product_data.copy()
+        product_to_create['match'] = match_fields
+        # Origem para os filtros da fila de pendentes: 'ai' (catálogo gerado) ou 'manual'.
+        if product_to_create.get('source') not in PRODUCT_SOURCES:
+            product_to_create['source'] = 'manual'
         product_to_create['status'] = 'pending_approval' # Status padrão para novos produtos
+        product_to_create['primary_image_id'] = None
         product_to_create['created_at'] = firestore.SERVER_TIMESTAMP
         product_to_create['updated_at'] = firestore.SERVER_TIMESTAMP
         
         # Produtos canônicos não têm store_id
         product_to_create.pop('store_id', None)
 
-        _, doc_ref = db.collection('products').add(product_to_create)
-        
-        publish_event('eventos_produtos', 'CanonicalProductPending', doc_ref.id, product_to_create)
+        if match_fields['barcode']:
+            doc_ref = db.collection('products').document()
+            existing_id = create_canonical_with_barcode(doc_ref, product_to_create, match_fields['barcode'])
+            if existing_id:
+                return jsonify({"error": duplicate_error, "productId": existing_id}), 409
+        else:
+            _, doc_ref = db.collection('products').add(product_to_create)
+
+        # O mapa match é só para as consultas de deduplicação; não vai para os eventos.
+        event_data = {key: value for key, value in product_to_create.items() if key != 'match'}
+        publish_event('eventos_produtos', 'CanonicalProductPending', doc_ref.id, event_data)
         return jsonify({"message": "Canonical product created and awaiting approval", "productId": doc_ref.id}), 201
     except Exception as e:
         return jsonify({"error": "Could not create canonical product", "details": str(e)}), 500
@@ -406,7 +765,7 @@ def update_product(product_id):
 
     try:
         id_token = auth_header.split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = token_verifier.verify(id_token)
         uid = decoded_token['uid']
     except Exception as e:
         return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
@@ -422,19 +781,28 @@ def update_product(product_id):
         if not product_doc.exists:
             return jsonify({"error": "Produto não encontrado."}), 404
         
-        store_id = product_doc.to_dict().get('store_id')
-        if not store_id:
-            return jsonify({"error": "Produto não tem uma loja associada."}), 500
-
-        # Nova verificação de permissão
-        allowed, reason = check_permission(uid, store_id)
-        if not allowed:
-            return jsonify({"error": "User is not authorized to update this product", "details": reason}), 403
+        product_data = product_doc.to_dict()
+        store_id = product_data.get('store_id')
+        update_data.pop('match', None)
+        # A imagem principal só muda por set-primary, que mantém os flags is_primary.
+        update_data.pop('primary_image_id', None)
+        if store_id:
+            # Nova verificação de permissão
+            allowed, reason = check_permission(uid, store_id)
+            if not allowed:
+                return jsonify({"error": "User is not authorized to update this product", "details": reason}), 403
+        elif not decoded_token.get('admin', False):
+            # Correções do catálogo canônico: só admins. Os produtos de loja ligados a ele
+            # recebem a correção pelo consume_canonical_events.
+            return jsonify({"error": "Only administrators can update canonical products."}), 403
+        elif 'name' in update_data or 'barcode' in update_data:
+            update_data['match'] = canonical_match_fields({**product_data, **update_data})
 
         update_data['updated_at'] = firestore.SERVER_TIMESTAMP
         product_ref.update(update_data)
 
-        publish_event('eventos_produtos', 'ProductUpdated', product_id, update_data)
+        event_data = {key: value for key, value in update_data.items() if key != 'match'}
+        publish_event('eventos_produtos', 'ProductUpdated', product_id, event_data)
         return jsonify({"message": "Produto atualizado com sucesso.", "productId": product_id}), 200
     except Exception as e:
         return jsonify({"error": f"Erro ao atualizar produto: {e}"}), 500
@@ -450,7 +818,7 @@ def delete_product(product_id):
 
     try:
         id_token = auth_header.split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = token_verifier.verify(id_token)
         uid = decoded_token['uid']
     except Exception as e:
         return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
@@ -478,6 +846,41 @@ def delete_product(product_id):
     except Exception as e:
         return jsonify({"error": f"Erro ao deletar produto: {e}"}), 500
 
+# --- Produtos de loja a partir do catálogo canônico ---
+# O produto de uma loja tem id determinístico ({store_id}_{canonical_product_id}): o upsert
+# é um set(merge=True) idempotente, sem consulta de duplicados nem índice composto, e
+# chamadas concorrentes não criam dois documentos. Produtos criados antes disso são
+# migrados por migrate_store_product_ids.py (rodar antes de publicar esta versão).
+CANONICAL_FIELDS_COPIED = ('name', 'category', 'description', 'image_url', 'barcode')
+PRICING_BULK_MAX_ITEMS = int(os.environ.get('PRICING_BULK_MAX_ITEMS', 2000))
+FIRESTORE_BATCH_LIMIT = firebase.FIRESTORE_BATCH_LIMIT
+
+def store_product_id(store_id, canonical_product_id):
+    return f"{store_id}_{canonical_product_id}"
+
+def store_product_fields(canonical_product_id, canonical_product_data, store_id, price, is_new=True):
+    store_product_data = {
+        'canonical_product_id': canonical_product_id,
+        'store_id': store_id,
+        'price': price,
+    }
+    # Só o produto novo recebe as cópias do canônico: reprecificar não pode sobrescrever
+    # a imagem nem as outras edições que a loja já fez no seu produto.
+    if is_new:
+        for field in CANONICAL_FIELDS_COPIED:
+            store_product_data[field] = canonical_product_data.get(field)
+        store_product_data['primary_image_id'] = None
+        store_product_data['created_at'] = firestore.SERVER_TIMESTAMP
+    store_product_data['updated_at'] = firestore.SERVER_TIMESTAMP
+    return store_product_data
+
+def parse_price(value):
+    """Preço positivo como float. ValueError se inválido."""
+    price = float(value)
+    if not math.isfinite(price) or price <= 0:
+        raise ValueError("o preço deve ser maior que zero")
+    return price
+
 @app.route('/api/products/from_canonical', methods=['POST'])
 def create_product_from_canonical():
     if not db:
@@ -489,7 +892,7 @@ def create_product_from_canonical():
 
     try:
         id_token = auth_header.split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = token_verifier.verify(id_token)
         uid = decoded_token['uid']
     except Exception as e:
         return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
@@ -508,41 +911,23 @@ def create_product_from_canonical():
         return jsonify({"error": "User is not authorized to add products to this store", "details": reason}), 403
 
     try:
-        canonical_product_ref = db.collection('products').document(canonical_product_id)
-        canonical_product_doc = canonical_product_ref.get()
-        if not canonical_product_doc.exists:
+        # Canônico e produto da loja numa única leitura em lote.
+        product_id = store_product_id(store_id, canonical_product_id)
+        docs = firebase.get_all_by_id(db, 'products', [canonical_product_id, product_id])
+        canonical_product_doc = docs.get(canonical_product_id)
+        if canonical_product_doc is None:
             return jsonify({"error": "Produto canônico não encontrado."}), 404
-        
-        canonical_product_data = canonical_product_doc.to_dict()
-
-        store_product_data = {
-            'canonical_product_id': canonical_product_id,
-            'store_id': store_id,
-            'price': float(price),
-            'name': canonical_product_data.get('name'),
-            'category': canonical_product_data.get('category'),
-            'description': canonical_product_data.get('description'),
-            'image_url': canonical_product_data.get('image_url'),
-            'barcode': canonical_product_data.get('barcode'),
-            'created_at': firestore.SERVER_TIMESTAMP,
-            'updated_at': firestore.SERVER_TIMESTAMP
-        }
 
-        products_ref = db.collection('products')
-        query = products_ref.where('canonical_product_id', '==', canonical_product_id).where('store_id', '==', store_id).limit(1)
-        existing_docs = list(query.stream())
+        is_new = product_id not in docs
+        store_product_data = store_product_fields(canonical_product_id, canonical_product_doc.to_dict(), store_id, float(price), is_new)
+        db.collection('products').document(product_id).set(store_product_data, merge=True)
 
-        if existing_docs:
-            existing_doc_ref = existing_docs[0].reference
-            existing_doc_ref.update({'price': float(price), 'updated_at': firestore.SERVER_TIMESTAMP})
-            product_id = existing_doc_ref.id
-            message = "Preço do produto atualizado na sua loja."
-            event_type = 'ProductUpdated'
-        else:
-            _, new_doc_ref = products_ref.add(store_product_data)
-            product_id = new_doc_ref.id
+        if is_new:
             message = "Produto adicionado à sua loja com sucesso."
             event_type = 'ProductCreated'
+        else:
+            message = "Preço do produto atualizado na sua loja."
+            event_type = 'ProductUpdated'
 
         publish_event('eventos_produtos', event_type, product_id, store_product_data)
 
@@ -551,13 +936,228 @@ def create_product_from_canonical():
     except Exception as e:
         return jsonify({"error": f"Erro ao adicionar produto à loja: {e}"}), 500
 
-def get_health_status():
-    env_vars = {
-        "FIREBASE_ADMIN_SDK_BASE64": "present" if os.environ.get('FIREBASE_ADMIN_SDK_BASE64') else "missing",
-        "KAFKA_BOOTSTRAP_SERVER": "present" if os.environ.get('KAFKA_BOOTSTRAP_SERVER') else "missing",
-        "KAFKA_API_KEY": "present" if os.environ.get('KAFKA_API_KEY') else "missing",
-        "KAFKA_API_SECRET": "present" if os.environ.get('KAFKA_API_SECRET') else "missing"
-    }
+
+@app.route('/api/products/from_canonical:bulk', methods=['POST'])
+def create_products_from_canonical_bulk():
+    """Precifica vários produtos canônicos numa loja: {"store_id", "items": [{"canonical_product_id", "price"}]}.
+
+    Responde 200 com o resultado de cada item, na ordem enviada, mesmo que alguns falhem."""
+    if not db:
+        return jsonify({"error": "Dependência do Firestore não inicializada."}), 503
+
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return jsonify({"error": "Authorization token is required"}), 401
+
+    try:
+        id_token = auth_header.split('Bearer ')[1]
+        decoded_token = token_verifier.verify(id_token)
+        uid = decoded_token['uid']
+    except Exception as e:
+        return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
+
+    data = request.get_json(silent=True) or {}
+    store_id = data.get('store_id')
+    items = data.get('items')
+    if not firebase.is_document_id(store_id) or not isinstance(items, list) or not items:
+        return jsonify({"error": "store_id e items são obrigatórios."}), 400
+    if len(items) > PRICING_BULK_MAX_ITEMS:
+        return jsonify({"error": f"Máximo de {PRICING_BULK_MAX_ITEMS} itens por requisição."}), 413
+
+    allowed, reason = check_permission(uid, store_id)
+    if not allowed:
+        return jsonify({"error": "User is not authorized to add products to this store", "details": reason}), 403
+
+    results = [{"item": i + 1, "status": "error", "product_id": None, "error": None} for i in range(len(items))]
+    valid = {}  # canônico -> (índice, preço)
+    for i, item in enumerate(items):
+        canonical_product_id = item.get('canonical_product_id') if isinstance(item, dict) else None
+        if not firebase.is_document_id(canonical_product_id):
+            results[i]["error"] = "canonical_product_id é obrigatório e deve ser um id válido."
+            continue
+        try:
+            price = parse_price(item.get('price'))
+        except (TypeError, ValueError):
+            results[i]["error"] = "price inválido."
+            continue
+        if canonical_product_id in valid:
+            results[i]["error"] = "canonical_product_id repetido."
+            continue
+        valid[canonical_product_id] = (i, price)
+
+    try:
+        # Canônicos e produtos da loja (ids determinísticos) numa única leitura em lote.
+        docs = firebase.get_all_by_id(db, 'products', list(valid) + [store_product_id(store_id, cid) for cid in valid])
+    except Exception as e:
+        return jsonify({"error": f"Erro ao ler produtos canônicos: {e}"}), 500
+
+    writes = {}  # caminho do documento -> (índice do item, tipo do evento, dados)
+
+    def on_success(path):
+        index, event_type, _ = writes[path]
+        results[index]["status"] = "created" if event_type == 'ProductCreated' else "updated"
+        results[index]["error"] = None
+
+    def on_failure(path, message):
+        results[writes[path][0]]["error"] = message
+
+    bulk_writer = firebase.open_bulk_writer(db, on_success, on_failure)
+    try:
+        for canonical_product_id, (index, price) in valid.items():
+            canonical_doc = docs.get(canonical_product_id)
+            if canonical_doc is None:
+                results[index]["error"] = "Produto canônico não encontrado."
+                continue
+            product_id = store_product_id(store_id, canonical_product_id)
+            is_new = product_id not in docs
+            store_product_data = store_product_fields(canonical_product_id, canonical_doc.to_dict(), store_id, price, is_new)
+            ref = db.collection('products').document(product_id)
+            writes[ref.path] = (index, 'ProductCreated' if is_new else 'ProductUpdated', store_product_data)
+            bulk_writer.set(ref, store_product_data, merge=True)
+            results[index]["product_id"] = product_id
+    finally:
+        bulk_writer.close()
+
+    for index, event_type, store_product_data in writes.values():
+        if results[index]["status"] != "error":
+            publish_event('eventos_produtos', event_type, results[index]["product_id"], store_product_data)
+
+    summary = {"total": len(items), "created": 0, "updated": 0, "failed": 0}
+    for result in results:
+        summary[result["status"] if result["status"] != "error" else "failed"] += 1
+    metrics.increment('products.pricing_bulk_items', len(items))
+    return jsonify({"store_id": store_id, "summary": summary, "results": results}), 200
+
+# --- Propagação de correções do catálogo canônico ---
+# Produtos de loja guardam cópias de CANONICAL_FIELDS_COPIED. Quando um canônico muda
+# (ProductUpdated/ProductImageSetPrimary), consume_canonical_events relê o canônico e
+# reescreve as cópias nos produtos ligados a ele (consulta em canonical_product_id, índice
+# de campo único), em páginas, com o BulkWriter e um teto de escritas por segundo. Cada
+# produto de loja alterado publica o seu ProductUpdated (com canonical_product_id, que este
+# consumidor ignora), e as ofertas atualizam o resumo do produto a partir dele. Produtos
+# de loja com imagem principal própria (primary_image_id) mantêm o seu image_url.
+CANONICAL_PROPAGATION_PAGE_SIZE = int(os.environ.get('CANONICAL_PROPAGATION_PAGE_SIZE', 500))
+CANONICAL_PROPAGATION_MAX_OPS_PER_SECOND = int(os.environ.get('CANONICAL_PROPAGATION_MAX_OPS_PER_SECOND', 500))
+PROPAGATED_EVENT_TYPES = ('ProductUpdated', 'ProductImageSetPrimary')
+
+# Criado só por quem consome (worker.py ou o cron), não pelos workers da API.
+canonical_events_consumer = None
+canonical_events_consumer_lock = threading.Lock()
+
+def get_canonical_events_consumer():
+    global canonical_events_consumer, kafka_consumer_init_error
+    with canonical_events_consumer_lock:
+        if canonical_events_consumer is None:
+            canonical_events_consumer, kafka_consumer_init_error = kafka.create_consumer('servico-produtos-canonical-propagation', ['eventos_produtos'])
+        return canonical_events_consumer
+
+def propagate_canonical_product(canonical_product_id, canonical_data):
+    """Reescreve as cópias do canônico nos produtos de loja. Devolve quantos mudaram.
+
+    RuntimeError se alguma escrita falhar de vez; como as escritas são idempotentes, o
+    evento pode ser reprocessado inteiro."""
+    fields = {field: canonical_data.get(field) for field in CANONICAL_FIELDS_COPIED}
+    fields_without_image = {field: value for field, value in fields.items() if field != 'image_url'}
+
+    def fields_for(store_product_data):
+        return fields_without_image if store_product_data.get('primary_image_id') else fields
+
+    failed, succeeded = set(), set()
+    writer = firebase.open_bulk_writer(
+        db, succeeded.add, lambda path, message: failed.add(path),
+        max_ops_per_second=CANONICAL_PROPAGATION_MAX_OPS_PER_SECOND,
+    )
+    query = (db.collection('products')
+             .where('canonical_product_id', '==', canonical_product_id)
+             .order_by('__name__')
+             .select(('store_id', 'primary_image_id') + CANONICAL_FIELDS_COPIED)
+             .limit(CANONICAL_PROPAGATION_PAGE_SIZE))
+    propagated = 0
+    last_doc = None
+    try:
+        while True:
+            docs = list((query.start_after(last_doc) if last_doc is not None else query).stream())
+            if not docs:
+                break
+            last_doc = docs[-1]
+            # Produtos já atualizados (reprocessamento) não são reescritos.
+            changed = [doc for doc in docs
+                       if any(doc.to_dict().get(field) != value for field, value in fields_for(doc.to_dict()).items())]
+            for doc in changed:
+                writer.update(doc.reference, dict(fields_for(doc.to_dict()), updated_at=firestore.SERVER_TIMESTAMP))
+            writer.flush()
+            for doc in changed:
+                if doc.reference.path in succeeded:
+                    publish_event('eventos_produtos', 'ProductUpdated', doc.id, dict(
+                        fields_for(doc.to_dict()), canonical_product_id=canonical_product_id,
+                        store_id=doc.to_dict().get('store_id')))
+            propagated += len(changed)
+            if len(docs) < CANONICAL_PROPAGATION_PAGE_SIZE:
+                break
+    finally:
+        writer.close()
+    if failed - succeeded:
+        raise RuntimeError(f"{len(failed - succeeded)} produtos de loja não atualizados para o canônico {canonical_product_id}.")
+    return propagated
+
+def consume_canonical_events(max_messages=100, timeout=1.0):
+    """Propaga as correções de produtos canônicos. Devolve quantas mensagens leu."""
+    consumer = get_canonical_events_consumer()
+    if not consumer:
+        raise RuntimeError(kafka_consumer_init_error)
+    msgs = consumer.consume(num_messages=max_messages, timeout=timeout)
+    if not msgs:
+        return 0
+    # Várias mudanças do mesmo canônico no lote viram uma única propagação.
+    product_ids = []
+    for msg in msgs:
+        if msg.error():
+            print(f"Kafka error: {msg.error()}")
+            continue
+        try:
+            event = events.decode_event(msg.value())
+        except ValueError as e:
+            print(f"Evento de produto ignorado: {e}")
+            continue
+        data = event.get('data') or {}
+        if event.get('event_type') not in PROPAGATED_EVENT_TYPES or 'store_id' in data or 'canonical_product_id' in data:
+            continue
+        if event.get('product_id') and event['product_id'] not in product_ids:
+            product_ids.append(event['product_id'])
+    try:
+        for product_id, doc in firebase.get_all_by_id(db, 'products', product_ids).items():
+            canonical_data = doc.to_dict()
+            if canonical_data.get('store_id'):
+                continue
+            metrics.increment('products.canonical_propagated', propagate_canonical_product(product_id, canonical_data))
+    except Exception:
+        # A próxima leitura recomeça do último offset confirmado, com as mensagens deste lote.
+        kafka.rewind_to_committed(consumer)
+        raise
+    # Offsets só são confirmados depois das escritas: em caso de falha as mensagens voltam.
+    consumer.commit(asynchronous=False)
+    return len(msgs)
+
+@app.route('/internal/events/consume', methods=['POST', 'GET'])
+def consume_events():
+    # Chamada pelo cron (Vercel); em Docker o worker.py faz o mesmo em laço.
+    if not service.is_cron_request():
+        return jsonify({"error": "Unauthorized"}), 401
+    if not db:
+        return jsonify({"error": "Dependência do Firestore não inicializada."}), 503
+    try:
+        processed = consume_canonical_events(timeout=5.0)
+    except Exception as e:
+        return jsonify({"error": f"Erro durante o consumo de eventos: {e}"}), 500
+    return jsonify({"status": "ok", "messages_processed": processed}), 200
+
+def get_health_status(include_latencies=False):
+    env_vars = health.env_var_status([
+        'FIREBASE_ADMIN_SDK_BASE64',
+        'KAFKA_BOOTSTRAP_SERVER',
+        'KAFKA_API_KEY',
+        'KAFKA_API_SECRET'
+    ])
 
     status = {
         "environment_variables": env_vars,
@@ -570,20 +1170,35 @@ def get_health_status():
             "kafka_producer": kafka_producer_init_error
         }
     }
+    if include_latencies:
+        # Firestore e Kafka são avaliados apenas pelo estado de inicialização, sem E/S.
+        status["latencies_ms"] = {}
     return status
 
-@app.route('/api/health', methods=['GET'])
-def health_check():
-    status = get_health_status()
-    
-    all_ok = (
+def is_healthy(status):
+    return (
         all(value == "present" for value in status["environment_variables"].values()) and
         status["dependencies"]["firestore"] == "ok" and
         status["dependencies"]["kafka_producer"] == "ok"
     )
-    http_status = 200 if all_ok else 503
+
+@app.route('/api/health', methods=['GET'])
+def health_check():
+    status = get_health_status()
+    http_status = 200 if is_healthy(status) else 503
     
     return jsonify(status), http_status
 
+service.register_metrics_route(app, token_verifier)
+
+# --- Readiness memoizada ---
+def build_readiness_status():
+    status = get_health_status(include_latencies=True)
+    status["status"] = "ok" if is_healthy(status) else "degraded"
+    return status
+
+readiness = service.register_probe_routes(app, build_readiness_status)
+readiness_cache = readiness.cache
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,64 @@
+# services/servico-produtos/backfill_canonical_match.py
+# Preenche (ou recalcula, com --force) o mapa match dos produtos canônicos criados antes do
+# índice de deduplicação. Produtos de loja (com store_id) são ignorados. Pode ser executado
+# de novo com segurança:
+#     python backfill_canonical_match.py [--dry-run] [--force] [--page-size 500]
+import argparse
+import sys
+
+from api import index
+
+
+def backfill(db, page_size=index.FIRESTORE_BATCH_LIMIT, dry_run=False, force=False):
+    page_size = min(page_size, index.FIRESTORE_BATCH_LIMIT)
+    stats = {"scanned": 0, "updated": 0}
+    last_doc = None
+    while True:
+        query = db.collection('products').order_by('__name__').limit(page_size)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        docs = list(query.stream())
+        if not docs:
+            break
+        last_doc = docs[-1]
+        stats["scanned"] += len(docs)
+
+        batch = db.batch()
+        writes = 0
+        for doc in docs:
+            product = doc.to_dict()
+            if product.get('store_id'):
+                continue
+            match_fields = index.canonical_match_fields(product)
+            if not force and product.get('match') == match_fields:
+                continue
+            batch.update(doc.reference, {'match': match_fields})
+            writes += 1
+        if writes and not dry_run:
+            batch.commit()
+        stats["updated"] += writes
+
+        if len(docs) < page_size:
+            break
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preenche o índice de deduplicação dos produtos canônicos.")
+    parser.add_argument('--dry-run', action='store_true', help="Só conta, sem gravar.")
+    parser.add_argument('--force', action='store_true', help="Regrava mesmo os que já estão atualizados.")
+    parser.add_argument('--page-size', type=int, default=index.FIRESTORE_BATCH_LIMIT)
+    args = parser.parse_args()
+
+    index.init_clients()
+    if not index.db:
+        print(f"Backfill não executado: {index.firebase_init_error}")
+        return 1
+    stats = backfill(index.db, page_size=args.page_size, dry_run=args.dry_run, force=args.force)
+    print(f"Produtos lidos: {stats['scanned']}, canônicos atualizados: {stats['updated']}"
+          + (" (dry run)" if args.dry_run else ""))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+# services/servico-produtos/backfill_pending_source.py
+# Preenche o campo source ('manual') dos produtos pendentes criados antes dos filtros da
+# fila de pendentes: sem ele, não aparecem em /api/products/pending?source=... Produtos que
+# já têm uma origem válida não são tocados, então pode ser executado de novo com segurança:
+#     python backfill_pending_source.py [--dry-run] [--page-size 500]
+import argparse
+import sys
+
+from api import index
+
+
+def backfill(db, page_size=index.FIRESTORE_BATCH_LIMIT, dry_run=False):
+    page_size = min(page_size, index.FIRESTORE_BATCH_LIMIT)
+    stats = {"scanned": 0, "updated": 0}
+    last_doc = None
+    while True:
+        query = (db.collection('products')
+                 .where('status', '==', 'pending_approval')
+                 .order_by('__name__')
+                 .limit(page_size))
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        docs = list(query.stream())
+        if not docs:
+            break
+        last_doc = docs[-1]
+        stats["scanned"] += len(docs)
+
+        batch = db.batch()
+        writes = 0
+        for doc in docs:
+            if doc.to_dict().get('source') in index.PRODUCT_SOURCES:
+                continue
+            batch.update(doc.reference, {'source': 'manual'})
+            writes += 1
+        if writes and not dry_run:
+            batch.commit()
+        stats["updated"] += writes
+
+        if len(docs) < page_size:
+            break
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preenche a origem dos produtos pendentes antigos.")
+    parser.add_argument('--dry-run', action='store_true', help="Só conta, sem gravar.")
+    parser.add_argument('--page-size', type=int, default=index.FIRESTORE_BATCH_LIMIT)
+    args = parser.parse_args()
+
+    index.init_clients()
+    if not index.db:
+        print(f"Backfill não executado: {index.firebase_init_error}")
+        return 1
+    stats = backfill(index.db, page_size=args.page_size, dry_run=args.dry_run)
+    print(f"Pendentes lidos: {stats['scanned']}, origem preenchida: {stats['updated']}"
+          + (" (dry run)" if args.dry_run else ""))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,94 @@
+# services/servico-produtos/migrate_primary_image_ids.py
+# Preenche primary_image_id nos produtos criados antes do ponteiro e acerta os flags
+# is_primary da subcoleção images: fica marcada só a imagem apontada, que é a antiga
+# principal cujo image_url é o do produto ou, se não houver, a marcada mais recentemente.
+# Produtos sem imagem principal recebem primary_image_id None, para que set-primary não
+# precise mais consultar a subcoleção. Pode ser executado de novo com segurança:
+#     python migrate_primary_image_ids.py [--dry-run] [--force] [--page-size 500]
+import argparse
+import sys
+from datetime import datetime, timezone
+
+from api import index
+from migrate_store_product_ids import Writes
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def choose_primary(product, flagged):
+    """Id da imagem que deve ser a principal entre as marcadas com is_primary, ou None."""
+    current = product.get('primary_image_id')
+    if current and any(image.id == current for image in flagged):
+        return current
+    if not flagged:
+        return current
+    same_url = [image for image in flagged if image.to_dict().get('image_url') == product.get('image_url')]
+    candidates = same_url or flagged
+    return max(candidates, key=lambda image: image.to_dict().get('created_at') or EPOCH).id
+
+
+def reconcile(writes, doc, force=False):
+    """Acerta um produto. Devolve quantos flags is_primary foram desligados, ou None se
+    o produto já estava migrado."""
+    product = doc.to_dict()
+    if 'primary_image_id' in product and not force:
+        return None
+    flagged = list(doc.reference.collection('images').where('is_primary', '==', True).stream())
+    primary_id = choose_primary(product, flagged)
+    cleared = 0
+    for image in flagged:
+        if image.id != primary_id:
+            writes.add('update', image.reference, {'is_primary': False})
+            cleared += 1
+    if product.get('primary_image_id', False) != primary_id:
+        writes.add('update', doc.reference, {'primary_image_id': primary_id})
+    return cleared
+
+
+def migrate(db, page_size=index.FIRESTORE_BATCH_LIMIT, dry_run=False, force=False):
+    page_size = min(page_size, index.FIRESTORE_BATCH_LIMIT)
+    stats = {"scanned": 0, "migrated": 0, "flags_cleared": 0}
+    last_doc = None
+    while True:
+        query = db.collection('products').order_by('__name__').limit(page_size)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        docs = list(query.stream())
+        if not docs:
+            break
+        last_doc = docs[-1]
+        stats["scanned"] += len(docs)
+
+        writes = Writes(db, dry_run)
+        for doc in docs:
+            cleared = reconcile(writes, doc, force=force)
+            if cleared is not None:
+                stats["migrated"] += 1
+                stats["flags_cleared"] += cleared
+        writes.commit()
+
+        if len(docs) < page_size:
+            break
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preenche primary_image_id e acerta os flags is_primary.")
+    parser.add_argument('--dry-run', action='store_true', help="Só conta, sem gravar.")
+    parser.add_argument('--force', action='store_true', help="Reconcilia também os produtos que já têm o ponteiro.")
+    parser.add_argument('--page-size', type=int, default=index.FIRESTORE_BATCH_LIMIT)
+    args = parser.parse_args()
+
+    index.init_clients()
+    if not index.db:
+        print(f"Migração não executada: {index.firebase_init_error}")
+        return 1
+    stats = migrate(index.db, page_size=args.page_size, dry_run=args.dry_run, force=args.force)
+    print(f"Produtos lidos: {stats['scanned']}, migrados: {stats['migrated']}, "
+          f"flags is_primary desligados: {stats['flags_cleared']}"
+          + (" (dry run)" if args.dry_run else ""))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
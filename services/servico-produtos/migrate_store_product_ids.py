@@ -0,0 +1,127 @@
+# services/servico-produtos/migrate_store_product_ids.py
+# Move os produtos de loja criados com id aleatório para o id determinístico
+# {store_id}_{canonical_product_id}. Para cada documento antigo: grava os dados no id novo
+# (set com merge), copia a subcoleção images, aponta as ofertas (offers.product_id) para o
+# id novo e só então apaga o documento antigo. Duplicados da mesma loja e canônico viram um
+# só documento, com os dados do atualizado por último. Cada passo é idempotente, então o
+# comando pode ser executado de novo depois de uma falha:
+#     python migrate_store_product_ids.py [--dry-run] [--page-size 500]
+import argparse
+import sys
+from datetime import datetime, timezone
+
+from api import index
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def target_id(product):
+    if product.get('store_id') and product.get('canonical_product_id'):
+        return index.store_product_id(product['store_id'], product['canonical_product_id'])
+    return None
+
+
+class Writes:
+    """Batch de escrita que é enviado ao atingir o limite do Firestore."""
+
+    def __init__(self, db, dry_run):
+        self.db = db
+        self.dry_run = dry_run
+        self.batch = db.batch()
+        self.pending = 0
+
+    def add(self, method, *args, **kwargs):
+        getattr(self.batch, method)(*args, **kwargs)
+        self.pending += 1
+        if self.pending == index.FIRESTORE_BATCH_LIMIT:
+            self.commit()
+
+    def commit(self):
+        if self.pending and not self.dry_run:
+            self.batch.commit()
+        self.batch = self.db.batch()
+        self.pending = 0
+
+
+def migrate_group(db, new_id, docs, current=None, dry_run=False):
+    """Migra os documentos antigos de um mesmo produto de loja. Devolve quantas ofertas mudaram.
+
+    current é o documento que já existe no id novo (criado depois do deploy), se houver."""
+    new_ref = db.collection('products').document(new_id)
+    latest = max(docs + ([current] if current else []), key=lambda doc: doc.to_dict().get('updated_at') or EPOCH)
+    writes = Writes(db, dry_run)
+    if latest is not current:
+        writes.add('set', new_ref, latest.to_dict(), merge=True)
+    offers_moved = 0
+    for doc in docs:
+        for image in doc.reference.collection('images').stream():
+            writes.add('set', new_ref.collection('images').document(image.id), image.to_dict(), merge=True)
+        for offer in db.collection('offers').where('product_id', '==', doc.id).stream():
+            writes.add('update', offer.reference, {'product_id': new_id})
+            offers_moved += 1
+    # Os documentos antigos só saem depois que as cópias foram gravadas.
+    writes.commit()
+    for doc in docs:
+        for image in doc.reference.collection('images').stream():
+            writes.add('delete', image.reference)
+        writes.add('delete', doc.reference)
+    writes.commit()
+    if not dry_run:
+        index.publish_event('eventos_produtos', 'ProductUpdated' if current else 'ProductCreated', new_id, latest.to_dict())
+        for doc in docs:
+            index.publish_event('eventos_produtos', 'ProductDeleted', doc.id, {"product_id": doc.id})
+    return offers_moved
+
+
+def migrate(db, page_size=index.FIRESTORE_BATCH_LIMIT, dry_run=False):
+    """Percorre os produtos em páginas e agrupa os produtos de loja pelo id novo."""
+    page_size = min(page_size, index.FIRESTORE_BATCH_LIMIT)
+    stats = {"scanned": 0, "migrated": 0, "duplicates": 0, "offers": 0}
+    groups = {}
+    current = {}
+    last_doc = None
+    while True:
+        query = db.collection('products').order_by('__name__').limit(page_size)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        docs = list(query.stream())
+        if not docs:
+            break
+        last_doc = docs[-1]
+        stats["scanned"] += len(docs)
+        for doc in docs:
+            new_id = target_id(doc.to_dict())
+            if new_id == doc.id:
+                current[new_id] = doc
+            elif new_id:
+                groups.setdefault(new_id, []).append(doc)
+        if len(docs) < page_size:
+            break
+
+    for new_id, docs in groups.items():
+        stats["offers"] += migrate_group(db, new_id, docs, current.get(new_id), dry_run)
+        stats["migrated"] += len(docs)
+        stats["duplicates"] += len(docs) - (0 if new_id in current else 1)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migra os produtos de loja para ids determinísticos.")
+    parser.add_argument('--dry-run', action='store_true', help="Só conta, sem gravar.")
+    parser.add_argument('--page-size', type=int, default=index.FIRESTORE_BATCH_LIMIT)
+    args = parser.parse_args()
+
+    index.init_clients()
+    if not index.db:
+        print(f"Migração não executada: {index.firebase_init_error}")
+        return 1
+    stats = migrate(index.db, page_size=args.page_size, dry_run=args.dry_run)
+    index.kafka.flush()
+    print(f"Produtos lidos: {stats['scanned']}, migrados: {stats['migrated']} "
+          f"(duplicados: {stats['duplicates']}), ofertas apontadas: {stats['offers']}"
+          + (" (dry run)" if args.dry_run else ""))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
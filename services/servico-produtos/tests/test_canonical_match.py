@@ -0,0 +1,185 @@
+import pytest
+from unittest.mock import patch, MagicMock
+import os
+import sys
+
+# Add the service's root directory to the path to allow for relative imports
+service_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if service_root not in sys.path:
+    sys.path.insert(0, service_root)
+
+# Now we can import the app and its dependencies
+from api import index as api_index
+
+@pytest.fixture(autouse=True)
+def mock_env_vars():
+    """Mocks all necessary environment variables."""
+    with patch.dict(os.environ, {
+        "FIREBASE_ADMIN_SDK_BASE64": "mock_firebase_sdk_base64",
+        "KAFKA_BOOTSTRAP_SERVER": "dummy_kafka_server",
+        "SERVICO_USUARIOS_URL": "http://mock-user-service",
+    }):
+        yield
+
+@pytest.fixture
+def client():
+    """A test client for the app."""
+    app = api_index.app
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        yield client
+
+@pytest.fixture(autouse=True)
+def mock_dependencies():
+    """Mocks all external dependencies for all tests."""
+    with patch.object(api_index, 'db', MagicMock()) as mock_db, \
+         patch.object(api_index, 'producer', MagicMock()), \
+         patch.object(api_index, 'auth', MagicMock()) as mock_auth, \
+         patch.object(api_index, 'check_permission', return_value=(True, "ok")) as mock_check_permission, \
+         patch.object(api_index, 'publish_event', MagicMock()) as mock_publish_event, \
+         patch.object(api_index, 'firebase_init_error', None), \
+         patch.object(api_index, 'kafka_producer_init_error', None):
+        mock_auth.verify_id_token.return_value = {'uid': 'test_user_uid'}
+        yield {
+            "db": mock_db,
+            "auth": mock_auth,
+            "check_permission": mock_check_permission,
+            "publish_event": mock_publish_event,
+        }
+
+def product_doc(doc_id, name, barcode=None, status='approved'):
+    data = {'name': name, 'barcode': barcode, 'status': status,
+            'match': api_index.canonical_match_fields({'name': name, 'barcode': barcode})}
+    doc = MagicMock(id=doc_id)
+    doc.to_dict.return_value = data
+    return doc
+
+def test_match_by_barcode_and_similar_names(client, mock_dependencies):
+    products = mock_dependencies["db"].collection.return_value
+    by_barcode = MagicMock()
+    by_barcode.limit.return_value.stream.return_value = [product_doc('p1', 'Café Pilão 500g', '7891234')]
+    by_name = MagicMock()
+    by_name.limit.return_value.stream.return_value = [
+        product_doc('p1', 'Café Pilão 500g', '7891234'),
+        product_doc('p2', 'cafe pilao tradicional 0,5 kg'),
+        product_doc('p3', 'Café Melitta 1kg'),
+        product_doc('p4', 'Café Pilão 500 gramas', status='rejected'),
+    ]
+    products.where.side_effect = lambda field, op, value: by_barcode if field == 'match.barcode' else by_name
+
+    response = client.get('/api/products/canonical/match?barcode=789-1234&name=Cafe%20Pilao%20Tradicional%20500g')
+
+    assert response.status_code == 200
+    matches = response.json['matches']
+    assert [m['id'] for m in matches] == ['p1', 'p2']
+    assert matches[0] == {"id": "p1", "name": "Café Pilão 500g", "barcode": "7891234",
+                          "status": "approved", "score": 1.0, "matched_on": "barcode"}
+    assert matches[1]['matched_on'] == 'name'
+    products.where.assert_any_call('match.barcode', '==', '7891234')
+    lsh_call = [c for c in products.where.call_args_list if c.args[0] == 'match.lsh'][0]
+    assert lsh_call.args[1] == 'array_contains_any'
+    assert len(lsh_call.args[2]) <= 30  # limite do Firestore para array_contains_any
+    assert client.get('/api/products/canonical/match').status_code == 400
+
+def test_create_canonical_rejects_duplicate_barcode(client, mock_dependencies):
+    products = mock_dependencies["db"].collection.return_value
+    products.where.return_value.limit.return_value.stream.return_value = [MagicMock(id='existing')]
+
+    response = client.post('/api/products/canonical', headers={"Authorization": "Bearer t"},
+                           json={"name": "Café Pilão 500g", "barcode": "7891234"})
+
+    assert response.status_code == 409
+    assert response.json['productId'] == 'existing'
+    products.add.assert_not_called()
+
+def barcode_collections(mock_db, claim=None, claimed_product=None):
+    """products e canonical_barcodes separados; devolve (products, reserva, produto novo, transação)."""
+    products, barcodes = MagicMock(), MagicMock()
+    mock_db.collection.side_effect = lambda name: barcodes if name == api_index.CANONICAL_BARCODES_COLLECTION else products
+    products.where.return_value.limit.return_value.stream.return_value = []
+    new_ref = MagicMock(id='new_id')
+    claimed_ref = MagicMock()
+    products.document.side_effect = lambda doc_id=None: claimed_ref if doc_id else new_ref
+    claim_ref = barcodes.document.return_value
+    claim_ref.get.return_value = MagicMock(exists=claim is not None, **{'to_dict.return_value': claim})
+    claimed_ref.get.return_value = MagicMock(exists=claimed_product is not None,
+                                             **{'to_dict.return_value': claimed_product})
+    return products, claim_ref, new_ref, mock_db.transaction.return_value
+
+def test_create_canonical_ignores_rejected_barcode_duplicates(client, mock_dependencies):
+    products, claim_ref, new_ref, transaction = barcode_collections(mock_dependencies["db"])
+    products.where.return_value.limit.return_value.stream.return_value = [
+        product_doc('rejected_1', 'Café Pilão 500g', '7891234', status='rejected'),
+    ]
+
+    response = client.post('/api/products/canonical', headers={"Authorization": "Bearer t"},
+                           json={"name": "Café Pilão 500g", "barcode": "7891234"})
+
+    assert response.status_code == 201
+    assert response.json['productId'] == 'new_id'
+    transaction.set.assert_any_call(claim_ref, {'product_id': 'new_id'})
+    product_ref, created = transaction.set.call_args_list[1].args
+    assert product_ref is new_ref
+    assert created['match']['barcode'] == '7891234'
+    products.add.assert_not_called()
+
+def test_create_canonical_reserves_the_barcode_in_the_same_transaction(client, mock_dependencies):
+    # Outro cadastro reservou o código depois da consulta: a transação encontra a reserva.
+    existing = product_doc('p1', 'Café Pilão 500g', '789-1234').to_dict()
+    products, claim_ref, new_ref, transaction = barcode_collections(
+        mock_dependencies["db"], claim={'product_id': 'p1'}, claimed_product=existing)
+
+    response = client.post('/api/products/canonical', headers={"Authorization": "Bearer t"},
+                           json={"name": "Café Pilão 500g", "barcode": "7891234"})
+
+    assert response.status_code == 409
+    assert response.json['productId'] == 'p1'
+    mock_dependencies["db"].collection.assert_any_call(api_index.CANONICAL_BARCODES_COLLECTION)
+    claim_ref.get.assert_called_once_with(transaction=transaction)
+    transaction.set.assert_not_called()
+    mock_dependencies["publish_event"].assert_not_called()
+
+@pytest.mark.parametrize("claimed_product", [
+    None,
+    product_doc('p1', 'Café Pilão 500g', '7891234', status='rejected').to_dict(),
+    product_doc('p1', 'Café Pilão 500g', '7890000').to_dict(),
+])
+def test_create_canonical_reuses_stale_barcode_reservations(client, mock_dependencies, claimed_product):
+    products, claim_ref, new_ref, transaction = barcode_collections(
+        mock_dependencies["db"], claim={'product_id': 'p1'}, claimed_product=claimed_product)
+
+    response = client.post('/api/products/canonical', headers={"Authorization": "Bearer t"},
+                           json={"name": "Café Pilão 500g", "barcode": "7891234"})
+
+    assert response.status_code == 201
+    transaction.set.assert_any_call(claim_ref, {'product_id': 'new_id'})
+
+def test_create_canonical_stores_match_fields(client, mock_dependencies):
+    products = mock_dependencies["db"].collection.return_value
+    products.add.return_value = (MagicMock(), MagicMock(id='new_id'))
+
+    response = client.post('/api/products/canonical', headers={"Authorization": "Bearer t"},
+                           json={"name": "Leite Integral 1 Litro"})
+
+    assert response.status_code == 201
+    match = products.add.call_args.args[0]['match']
+    assert match['name'] == 'leite integral 1000ml'
+    assert match['barcode'] is None
+    assert len(match['lsh']) == 16
+    assert 'match' not in mock_dependencies["publish_event"].call_args.args[3]
+
+def test_backfill_canonical_match_skips_store_products(mock_dependencies):
+    import backfill_canonical_match
+    mock_db = mock_dependencies["db"]
+    canonical = MagicMock()
+    canonical.to_dict.return_value = {'name': 'Arroz 5kg'}
+    indexed = product_doc('p2', 'Feijão 1kg')
+    store_product = MagicMock()
+    store_product.to_dict.return_value = {'name': 'Arroz 5kg', 'store_id': 's1'}
+    mock_db.collection.return_value.order_by.return_value.limit.return_value.stream.return_value = [canonical, indexed, store_product]
+
+    stats = backfill_canonical_match.backfill(mock_db)
+
+    assert stats == {"scanned": 3, "updated": 1}
+    mock_db.batch.return_value.update.assert_called_once()
+    assert mock_db.batch.return_value.update.call_args.args[1]['match']['name'] == 'arroz 5000g'
@@ -0,0 +1,122 @@
+import io
+import pytest
+from unittest.mock import patch, MagicMock
+import os
+import sys
+
+# Add the service's root directory to the path to allow for relative imports
+service_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if service_root not in sys.path:
+    sys.path.insert(0, service_root)
+
+from api import index as api_index
+
+Image = pytest.importorskip('PIL.Image')
+
+def jpeg_bytes(resize=None, rotate=False, quality=90):
+    image = Image.new('RGB', (400, 300))
+    for x in range(400):
+        for y in range(0, 300, 10):
+            image.putpixel((x, y), (x % 256, y % 256, 128))
+    if resize:
+        image = image.resize(resize)
+    if rotate:
+        image = image.rotate(90, expand=True)
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+def pending_image(product_id, image_id, url, attempts=0):
+    doc = MagicMock(id=image_id)
+    doc.reference.parent.parent.id = product_id
+    doc.to_dict.return_value = {'image_url': url, 'ingestion_status': 'pending', 'ingestion_attempts': attempts}
+    return doc
+
+def stored_image(image_id, data):
+    doc = MagicMock(id=image_id)
+    doc.to_dict.return_value = data
+    return doc
+
+@pytest.fixture
+def mock_db():
+    with patch.object(api_index, 'db', MagicMock()) as mock_db, \
+         patch.object(api_index.storage, 'get_storage') as mock_get_storage:
+        mock_get_storage.return_value.put.side_effect = lambda key, content, content_type: f"https://cdn/{key}"
+        yield mock_db
+
+def run_ingestion(mock_db, pending, downloads):
+    mock_db.collection_group.return_value.where.return_value.limit.return_value.stream.return_value = pending
+    with patch.object(api_index.images, 'fetch', side_effect=lambda url: downloads[url]()):
+        return api_index.ingest_pending_images()
+
+def test_ingestion_stores_hashes_and_webp_thumbnails(mock_db):
+    doc = pending_image('p1', 'img1', 'http://x/a.jpg')
+    doc.reference.parent.parent.collection.return_value.select.return_value.stream.return_value = []
+    content = jpeg_bytes()
+
+    assert run_ingestion(mock_db, [doc], {'http://x/a.jpg': lambda: content}) == 1
+
+    mock_db.collection_group.assert_called_once_with('images')
+    update = doc.reference.update.call_args.args[0]
+    assert update['ingestion_status'] == 'ready'
+    assert update['content_sha256'] == api_index.images.content_hash(content)
+    assert (update['width'], update['height']) == (400, 300)
+    sha_prefix = update['content_sha256'][:32]
+    assert update['thumbnails']['128'] == f"https://cdn/products/p1/{sha_prefix}/128.webp"
+    assert set(update['thumbnails']) == {str(size) for size in api_index.images.THUMBNAIL_SIZES}
+
+def test_ingestion_rejects_near_duplicates_of_the_same_product(mock_db):
+    original = jpeg_bytes()
+    existing = {
+        'content_sha256': 'other',
+        'phash': api_index.images.perceptual_hash(api_index.images.open_image(original)),
+    }
+    copy = pending_image('p1', 'img2', 'http://x/copy.jpg')
+    different = pending_image('p1', 'img3', 'http://x/other.jpg')
+    siblings = copy.reference.parent.parent.collection.return_value.select.return_value
+    different.reference.parent.parent = copy.reference.parent.parent
+    siblings.stream.return_value = [stored_image('img1', existing)]
+    downloads = {
+        'http://x/copy.jpg': lambda: jpeg_bytes(resize=(200, 150), quality=60),
+        'http://x/other.jpg': lambda: jpeg_bytes(rotate=True),
+    }
+
+    run_ingestion(mock_db, [copy, different], downloads)
+
+    update = copy.reference.update.call_args.args[0]
+    assert update['ingestion_status'] == 'duplicate'
+    assert update['status'] == 'rejected'
+    assert update['duplicate_of'] == 'img1'
+    assert different.reference.update.call_args.args[0]['ingestion_status'] == 'ready'
+
+def test_ingestion_retries_transient_errors_and_gives_up_on_invalid_files(mock_db):
+    flaky = pending_image('p1', 'img1', 'http://x/flaky.jpg')
+    exhausted = pending_image('p2', 'img2', 'http://x/flaky.jpg', attempts=api_index.IMAGE_INGESTION_MAX_ATTEMPTS - 1)
+    broken = pending_image('p3', 'img3', 'http://x/broken.jpg')
+
+    def timeout():
+        raise TimeoutError("timeout")
+
+    run_ingestion(mock_db, [flaky, exhausted, broken], {'http://x/flaky.jpg': timeout, 'http://x/broken.jpg': lambda: b'html'})
+
+    assert flaky.reference.update.call_args.args[0] == {'ingestion_attempts': 1, 'ingestion_error': 'timeout'}
+    assert exhausted.reference.update.call_args.args[0]['ingestion_status'] == 'failed'
+    assert broken.reference.update.call_args.args[0]['ingestion_status'] == 'failed'
+
+def test_ingest_route_requires_cron_secret(mock_db):
+    client = api_index.app.test_client()
+    with patch.dict(os.environ, {"CRON_SECRET": "s3cret"}), \
+         patch.object(api_index, 'ingest_pending_images', return_value=3):
+        assert client.post('/internal/images/ingest').status_code == 401
+        response = client.get('/internal/images/ingest', headers={"Authorization": "Bearer s3cret"})
+    assert response.status_code == 200
+    assert response.json['images_processed'] == 3
+
+def test_ingest_route_refuses_to_run_without_storage(mock_db):
+    client = api_index.app.test_client()
+    with patch.dict(os.environ, {"CRON_SECRET": "s3cret"}), \
+         patch.object(api_index.storage, 'get_storage', side_effect=RuntimeError("IMAGE_STORAGE_PUBLIC_URL")), \
+         patch.object(api_index, 'ingest_pending_images') as mock_ingest:
+        response = client.get('/internal/images/ingest', headers={"Authorization": "Bearer s3cret"})
+    assert response.status_code == 503
+    mock_ingest.assert_not_called()
@@ -42,7 +42,8 @@ def mock_dependencies():
          patch.object(api_index, 'check_permission', return_value=(True, "ok")) as mock_check_permission, \
          patch.object(api_index, 'publish_event', MagicMock()) as mock_publish_event, \
          patch.object(api_index, 'firebase_init_error', None), \
-         patch.object(api_index, 'kafka_producer_init_error', None):
+         patch.object(api_index, 'kafka_producer_init_error', None), \
+         patch.object(api_index.images.socket, 'getaddrinfo', return_value=[(None, None, None, '', ('93.184.216.34', 80))]) as mock_getaddrinfo:
 
         # --- Configure Default Mock Behaviors ---
 
@@ -77,14 +78,17 @@ def mock_dependencies():
             "producer": mock_producer,
             "auth": mock_auth,
             "check_permission": mock_check_permission,
-            "publish_event": mock_publish_event
+            "publish_event": mock_publish_event,
+            "getaddrinfo": mock_getaddrinfo,
         }
 
 # --- Test Cases for New Features ---
 
 def test_list_pending_products_success(client, mock_dependencies):
     """Tests successful listing of pending products."""
-    mock_dependencies["db"].collection.return_value.where.return_value.stream.return_value = [
+    pending = mock_dependencies["db"].collection.return_value.where.return_value
+    pending.count.return_value.get.return_value = [[MagicMock(value=2)]]
+    pending.order_by.return_value.order_by.return_value.limit.return_value.stream.return_value = [
         MagicMock(id="prod1", to_dict=lambda: {"name": "Prod1", "status": "pending_approval"}),
         MagicMock(id="prod2", to_dict=lambda: {"name": "Prod2", "status": "pending_approval"}),
     ]
@@ -93,6 +97,70 @@ def test_list_pending_products_success(client, mock_dependencies):
     assert response.status_code == 200
     assert len(response.json['products']) == 2
     assert response.json['products'][0]['id'] == "prod1"
+    assert response.json['total'] == 2
+    assert response.json['next_cursor'] is None
+
+def test_list_pending_products_filters_and_paginates(client, mock_dependencies):
+    mock_db = mock_dependencies["db"]
+    created_at = datetime(2026, 3, 1, 12, 0, tzinfo=timezone.utc)
+    pending = mock_db.collection.return_value.where.return_value
+    filtered = pending.where.return_value.where.return_value
+    filtered.count.return_value.get.return_value = [[MagicMock(value=7)]]
+    page = filtered.order_by.return_value.order_by.return_value.limit.return_value
+    page.stream.return_value = [
+        MagicMock(id=f"prod{i}", to_dict=lambda i=i: {"name": f"Prod{i}", "created_at": created_at, "match": {}})
+        for i in range(2)
+    ]
+    headers = {"Authorization": "Bearer fake_admin_token"}
+
+    response = client.get('/api/products/pending?source=ai&category=Bebidas&limit=2', headers=headers)
+
+    assert response.status_code == 200
+    assert response.json['total'] == 7
+    assert 'match' not in response.json['products'][0]
+    mock_db.collection.return_value.where.assert_called_once_with('status', '==', 'pending_approval')
+    pending.where.assert_called_once_with('source', '==', 'ai')
+    pending.where.return_value.where.assert_called_once_with('category', '==', 'Bebidas')
+    filtered.order_by.assert_called_once_with('created_at')
+    cursor = response.json['next_cursor']
+    assert cursor
+
+    response = client.get(f'/api/products/pending?source=ai&category=Bebidas&limit=2&cursor={cursor}', headers=headers)
+    assert response.status_code == 200
+    start_after = page.start_after.call_args.args[0]
+    assert start_after['created_at'] == created_at
+    mock_db.collection.return_value.document.assert_called_with('prod1')
+
+    assert client.get('/api/products/pending?cursor=xyz', headers=headers).status_code == 400
+    assert client.get('/api/products/pending?source=robo', headers=headers).status_code == 400
+
+def test_list_pending_products_clamps_limit(client, mock_dependencies):
+    pending = mock_dependencies["db"].collection.return_value.where.return_value
+    pending.count.return_value.get.return_value = [[MagicMock(value=0)]]
+    pending.order_by.return_value.order_by.return_value.limit.return_value.stream.return_value = []
+    headers = {"Authorization": "Bearer fake_admin_token"}
+
+    for limit, expected in (('0', 1), ('-5', 1), ('1000', api_index.PENDING_MAX_PAGE_SIZE)):
+        assert client.get(f'/api/products/pending?limit={limit}', headers=headers).status_code == 200
+        pending.order_by.return_value.order_by.return_value.limit.assert_called_with(expected)
+
+def test_backfill_pending_source_fills_only_missing_sources(mock_dependencies):
+    import backfill_pending_source
+    mock_db = mock_dependencies["db"]
+
+    def pending(doc_id, data):
+        doc = MagicMock(id=doc_id)
+        doc.to_dict.return_value = data
+        return doc
+
+    docs = [pending('old', {'status': 'pending_approval'}), pending('ai', {'status': 'pending_approval', 'source': 'ai'}),
+            pending('legacy', {'status': 'pending_approval', 'source': 'manual_upload'})]
+    mock_db.collection.return_value.where.return_value.order_by.return_value.limit.return_value.stream.return_value = docs
+
+    assert backfill_pending_source.backfill(mock_db) == {"scanned": 3, "updated": 2}
+    mock_db.collection.return_value.where.assert_called_once_with('status', '==', 'pending_approval')
+    updates = mock_db.batch.return_value.update.call_args_list
+    assert [c.args for c in updates] == [(docs[0].reference, {'source': 'manual'}), (docs[2].reference, {'source': 'manual'})]
 
 def test_list_pending_products_unauthorized(client, mock_dependencies):
     """Tests listing pending products without authorization."""
@@ -127,6 +195,103 @@ def test_reject_product_unauthorized(client, mock_dependencies):
     response = client.post('/api/products/test_product_id/reject')
     assert response.status_code == 401
 
+class PreconditionBulkWriter:
+    """BulkWriter falso: no close() as escritas em conflicts falham, como um last_update_time vencido."""
+    def __init__(self, conflicts=()):
+        self.updates = []
+        self.conflicts = set(conflicts)
+
+    def on_write_result(self, callback):
+        self.success_callback = callback
+
+    def on_write_error(self, callback):
+        self.error_callback = callback
+
+    def update(self, ref, data, option=None):
+        self.updates.append((ref, data, option))
+
+    def close(self):
+        for ref, _, _ in self.updates:
+            if ref.id in self.conflicts:
+                failure = MagicMock(code=9, attempts=1, message="FAILED_PRECONDITION")
+                failure.operation.reference = ref
+                self.error_callback(failure, self)
+            else:
+                self.success_callback(ref, MagicMock(), self)
+
+def setup_pending(mock_db, pending, conflicts=()):
+    def get_all(refs):
+        docs = []
+        for ref in refs:
+            doc = MagicMock(id=ref.id, exists=ref.id in pending, update_time=f"t_{ref.id}")
+            doc.to_dict.return_value = pending.get(ref.id)
+            docs.append(doc)
+        return docs
+
+    mock_db.collection.return_value.document.side_effect = lambda doc_id: MagicMock(id=doc_id, path=f"products/{doc_id}")
+    mock_db.get_all.side_effect = get_all
+    mock_db.write_option.side_effect = lambda last_update_time: ('precondition', last_update_time)
+    writer = PreconditionBulkWriter(conflicts)
+    mock_db.bulk_writer.return_value = writer
+    return writer
+
+def test_bulk_decision_writes_in_bulk_and_reports_each_item(client, mock_dependencies):
+    mock_db = mock_dependencies["db"]
+    pending = {f"p{i}": {'name': f"Produto {i}", 'status': 'pending_approval'} for i in range(502)}
+    pending['loja_1'] = {'name': 'Produto de loja', 'store_id': 's1'}
+    pending['aprovado'] = {'name': 'Já aprovado', 'status': 'approved'}
+    mock_dependencies["auth"].verify_id_token.return_value = {'uid': 'admin_uid', 'admin': True}
+    writer = setup_pending(mock_db, pending)
+    decisions = [{"product_id": f"p{i}", "decision": "approve" if i % 2 == 0 else "reject"} for i in range(502)]
+    decisions += [{"product_id": "loja_1", "decision": "approve"}, {"product_id": "nao_existe", "decision": "approve"},
+                  {"product_id": "p0", "decision": "reject"}, {"product_id": "p9", "decision": "talvez"},
+                  {"product_id": "aprovado", "decision": "reject"}, {"product_id": ["p1"], "decision": "approve"},
+                  {"product_id": "a/b", "decision": "approve"}]
+
+    response = client.post('/api/products/pending:bulk-decision', headers={"Authorization": "Bearer t"}, json={"decisions": decisions})
+
+    assert response.status_code == 200
+    assert response.json['summary'] == {"total": 509, "approved": 251, "rejected": 251, "failed": 7}
+    errors = [r['error'] for r in response.json['results'][502:]]
+    invalid = "product_id e decision ('approve' ou 'reject') são obrigatórios."
+    assert errors == ["Apenas produtos canônicos passam pela moderação.", "Produto não encontrado.",
+                      "product_id repetido.", invalid, "Produto não está pendente de aprovação.", invalid, invalid]
+    # Uma leitura em lote (dois get_all de até 500); cada escrita condicionada ao update_time lido.
+    assert mock_db.get_all.call_count == 2
+    assert len(writer.updates) == 502
+    assert writer.updates[0][2] == ('precondition', 't_p0')
+    mock_db.batch.assert_not_called()
+    event_types = [c.args[1] for c in mock_dependencies["publish_event"].call_args_list]
+    assert event_types.count('CanonicalProductApproved') == 251
+    assert event_types.count('CanonicalProductRejected') == 251
+
+def test_bulk_decision_reports_concurrent_moderation_per_item(client, mock_dependencies):
+    pending = {'p1': {'name': 'Café', 'status': 'pending_approval'}, 'p2': {'name': 'Leite', 'status': 'pending_approval'}}
+    mock_dependencies["auth"].verify_id_token.return_value = {'uid': 'admin_uid', 'admin': True}
+    setup_pending(mock_dependencies["db"], pending, conflicts={'p1'})
+
+    response = client.post('/api/products/pending:bulk-decision', headers={"Authorization": "Bearer t"},
+                           json={"decisions": [{"product_id": "p1", "decision": "approve"},
+                                               {"product_id": "p2", "decision": "reject"}]})
+
+    assert response.status_code == 200
+    assert response.json['summary'] == {"total": 2, "approved": 0, "rejected": 1, "failed": 1}
+    assert "moderado em paralelo" in response.json['results'][0]['error']
+    mock_dependencies["publish_event"].assert_called_once()
+    assert mock_dependencies["publish_event"].call_args.args[1:3] == ('CanonicalProductRejected', 'p2')
+
+def test_bulk_decision_requires_token_and_decisions(client, mock_dependencies):
+    assert client.post('/api/products/pending:bulk-decision', json={"decisions": []}).status_code == 401
+    mock_dependencies["auth"].verify_id_token.return_value = {'uid': 'admin_uid', 'admin': True}
+    response = client.post('/api/products/pending:bulk-decision', headers={"Authorization": "Bearer t"}, json={})
+    assert response.status_code == 400
+
+def test_bulk_decision_requires_admin(client, mock_dependencies):
+    response = client.post('/api/products/pending:bulk-decision', headers={"Authorization": "Bearer t"},
+                           json={"decisions": [{"product_id": "p1", "decision": "approve"}]})
+    assert response.status_code == 403
+    mock_dependencies["db"].bulk_writer.assert_not_called()
+
 def test_add_product_image_success(client, mock_dependencies):
     """Tests successful addition of a product image."""
     headers = {"Authorization": "Bearer fake_admin_token"}
@@ -149,3 +314,54 @@ def test_add_product_image_missing_url(client, mock_dependencies):
     response = client.post('/api/products/test_product_id/images', headers=headers, json=image_data)
     assert response.status_code == 400
     assert "image_url é obrigatório." in response.json["error"]
+
+def test_add_product_image_requires_store_owner_or_admin(client, mock_dependencies):
+    headers = {"Authorization": "Bearer t"}
+    images = mock_dependencies["db"].collection.return_value.document.return_value.collection.return_value
+    mock_dependencies["check_permission"].return_value = (False, "sem papel")
+
+    response = client.post('/api/products/test_product_id/images', headers=headers, json={"image_url": "http://x/a.jpg"})
+    assert response.status_code == 403
+    mock_dependencies["check_permission"].assert_called_once_with('test_user_uid', 'test_store_id')
+
+    # Canônico (sem store_id): só admins.
+    product = mock_dependencies["db"].collection.return_value.document.return_value.get.return_value
+    product.to_dict.return_value = {'name': 'Café', 'status': 'approved'}
+    mock_dependencies["check_permission"].return_value = (True, "ok")
+    response = client.post('/api/products/test_product_id/images', headers=headers, json={"image_url": "http://x/a.jpg"})
+    assert response.status_code == 403
+    images.add.assert_not_called()
+
+    mock_dependencies["auth"].verify_id_token.return_value = {'uid': 'admin_uid', 'admin': True}
+    response = client.post('/api/products/test_product_id/images', headers=headers, json={"image_url": "http://x/a.jpg"})
+    assert response.status_code == 201
+
+@pytest.mark.parametrize('image_url, address', [
+    ('file:///etc/passwd', '93.184.216.34'),
+    ('http://x/a.jpg', '169.254.169.254'),
+    ('http://x/a.jpg', '127.0.0.1'),
+    ('https://x/a.jpg', '192.168.1.10'),
+])
+def test_add_product_image_rejects_non_public_urls(client, mock_dependencies, image_url, address):
+    mock_dependencies["getaddrinfo"].return_value = [(None, None, None, '', (address, 80))]
+    response = client.post('/api/products/test_product_id/images', headers={"Authorization": "Bearer t"},
+                           json={"image_url": image_url})
+    assert response.status_code == 400
+    mock_dependencies["db"].collection.return_value.document.return_value.collection.return_value.add.assert_not_called()
+
+def test_add_product_image_rejects_same_url_and_queues_ingestion(client, mock_dependencies):
+    headers = {"Authorization": "Bearer fake_admin_token"}
+    images = mock_dependencies["db"].collection.return_value.document.return_value.collection.return_value
+    images.where.return_value.limit.return_value.stream.return_value = [MagicMock(id='img_1')]
+
+    response = client.post('/api/products/test_product_id/images', headers=headers, json={"image_url": "http://x/a.jpg"})
+    assert response.status_code == 409
+    assert response.json['imageId'] == 'img_1'
+    images.add.assert_not_called()
+
+    images.where.return_value.limit.return_value.stream.return_value = []
+    response = client.post('/api/products/test_product_id/images', headers=headers, json={"image_url": "http://x/b.jpg"})
+    assert response.status_code == 201
+    stored = images.add.call_args.args[0]
+    assert stored['ingestion_status'] == 'pending'
+    assert stored['ingestion_attempts'] == 0
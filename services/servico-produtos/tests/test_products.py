@@ -94,7 +94,9 @@ def test_create_canonical_product_success(client, mock_dependencies):
         'name': 'Produto Canônico Teste',
         'category': 'Teste',
         'description': 'Descrição do produto canônico.',
+        'source': 'manual',
         'status': 'pending_approval',
+        'primary_image_id': None,
         'created_at': api_index.firestore.SERVER_TIMESTAMP,
         'updated_at': api_index.firestore.SERVER_TIMESTAMP
     })
@@ -177,4 +179,65 @@ def test_health_check_all_ok(client):
     }):
         response = client.get('/api/health')
         assert response.status_code == 200
-        assert response.json["dependencies"]["firestore"] == "ok"
\ No newline at end of file
+        assert response.json["dependencies"]["firestore"] == "ok"
+
+def test_liveness_check(client):
+    """Liveness não depende de nenhuma dependência externa."""
+    response = client.get('/api/health/live')
+    assert response.status_code == 200
+    assert response.json == {"status": "ok"}
+
+def test_readiness_check_is_memoized(client, mock_dependencies):
+    """Readiness reaproveita o resultado das verificações dentro da janela de cache."""
+    with patch.dict(api_index.readiness_cache, {"status": None, "checked_at": 0.0}), \
+         patch.object(api_index, 'get_health_status', wraps=api_index.get_health_status) as spy:
+        first = client.get('/api/health/ready')
+        second = client.get('/api/health/ready')
+
+    assert first.status_code == second.status_code == 200
+    assert first.json["status"] == "ok"
+    assert "latencies_ms" in first.json
+    assert spy.call_count == 1
+
+# --- Cache de verificação de tokens ---
+
+def test_internal_metrics_exposes_token_verification(client):
+    assert client.get('/internal/metrics').status_code == 401
+    with patch.dict(os.environ, {"CRON_SECRET": "cron"}):
+        response = client.get('/internal/metrics', headers={"Authorization": "Bearer cron"})
+    assert response.status_code == 200
+    assert "cache_hits" in response.json["token_verification"]
+    assert "verification_ms_avg" in response.json["token_verification"]
+    assert "counters" in response.json["instrumentation"]
+
+def test_gunicorn_post_fork_initializes_clients():
+    import runpy
+    with patch.dict(os.environ, {"GUNICORN_WORKERS": "3", "GUNICORN_THREADS": "8"}):
+        config = runpy.run_path(os.path.join(service_root, 'gunicorn.conf.py'))
+    assert config["workers"] == 3
+    assert config["threads"] == 8
+    assert config["worker_class"] == "gthread"
+    assert config["preload_app"] is True
+
+    with patch.object(api_index, 'init_clients') as mock_init_clients:
+        config["post_fork"](MagicMock(), MagicMock())
+    mock_init_clients.assert_called_once()
+
+def test_clients_are_initialized_lazily_on_first_request(client):
+    with patch.object(api_index, 'db', api_index.NOT_INITIALIZED), \
+         patch.object(api_index, 'producer', api_index.NOT_INITIALIZED), \
+         patch.object(api_index, 'init_firebase') as mock_init_firebase, \
+         patch.object(api_index, 'init_kafka_producer') as mock_init_kafka_producer:
+        client.get('/api/health/live')
+        mock_init_firebase.assert_not_called()
+
+        client.get('/api/health')
+        mock_init_firebase.assert_called_once()
+        mock_init_kafka_producer.assert_called_once()
+
+def test_clients_already_set_are_not_reinitialized(client, mock_dependencies):
+    with patch.object(api_index, 'init_firebase') as mock_init_firebase, \
+         patch.object(api_index, 'init_kafka_producer') as mock_init_kafka_producer:
+        client.get('/api/health')
+    mock_init_firebase.assert_not_called()
+    mock_init_kafka_producer.assert_not_called()
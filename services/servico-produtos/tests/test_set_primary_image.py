@@ -236,3 +236,57 @@ def test_set_primary_image_canonical_product_non_admin(client, mock_dependencies
 
     assert response.status_code == 403
     assert "Only administrators can set primary images for canonical products." in response.json['error']
+
+def test_set_primary_image_uses_pointer_without_querying(client, mock_dependencies):
+    """With primary_image_id on the product only the old image, the new one and the product are written."""
+    mock_db = mock_dependencies["db"]
+    mock_db.collection.return_value.document.return_value.get.return_value.to_dict.return_value = {
+        'name': 'Produto Teste',
+        'store_id': 'test_store_id',
+        'image_url': 'http://old-image.jpg',
+        'primary_image_id': 'old_image_id',
+    }
+    images = mock_db.collection.return_value.document.return_value.collection.return_value
+
+    response = client.post('/api/products/test_product_id/images/test_image_id/set-primary',
+                           headers={"Authorization": "Bearer fake_token"})
+
+    assert response.status_code == 200
+    images.where.assert_not_called()
+    updates = [c.args[1] for c in mock_dependencies["transaction"].update.call_args_list]
+    assert updates[0] == {'is_primary': False}
+    images.document.assert_any_call('old_image_id')
+    assert updates[1] == {'is_primary': True}
+    assert updates[2]['primary_image_id'] == 'test_image_id'
+    assert len(updates) == 3
+
+def test_migrate_primary_image_ids_keeps_one_flag_per_product():
+    import migrate_primary_image_ids
+    mock_db = MagicMock()
+
+    def image(image_id, url, created_at):
+        doc = MagicMock(id=image_id)
+        doc.to_dict.return_value = {'image_url': url, 'is_primary': True, 'created_at': created_at}
+        return doc
+
+    legacy = MagicMock(id='p1')
+    legacy.to_dict.return_value = {'image_url': 'http://b.jpg'}
+    legacy.reference.collection.return_value.where.return_value.stream.return_value = [
+        image('a', 'http://a.jpg', datetime(2024, 5, 1, tzinfo=timezone.utc)),
+        image('b', 'http://b.jpg', datetime(2024, 1, 1, tzinfo=timezone.utc)),
+    ]
+    no_images = MagicMock(id='p2')
+    no_images.to_dict.return_value = {'image_url': None}
+    no_images.reference.collection.return_value.where.return_value.stream.return_value = []
+    migrated = MagicMock(id='p3')
+    migrated.to_dict.return_value = {'primary_image_id': 'x'}
+    mock_db.collection.return_value.order_by.return_value.limit.return_value.stream.return_value = [legacy, no_images, migrated]
+
+    stats = migrate_primary_image_ids.migrate(mock_db)
+
+    assert stats == {"scanned": 3, "migrated": 2, "flags_cleared": 1}
+    batch = mock_db.batch.return_value
+    batch.update.assert_any_call(legacy.reference, {'primary_image_id': 'b'})
+    batch.update.assert_any_call(no_images.reference, {'primary_image_id': None})
+    assert batch.update.call_count == 3
+    migrated.reference.collection.assert_not_called()
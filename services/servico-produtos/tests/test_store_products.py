@@ -0,0 +1,368 @@
+import pytest
+import json
+from unittest.mock import patch, MagicMock
+from datetime import datetime, timezone
+import os
+import sys
+
+# Add the service's root directory to the path to allow for relative imports
+service_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if service_root not in sys.path:
+    sys.path.insert(0, service_root)
+
+# Now we can import the app and its dependencies
+from api import index as api_index
+
+@pytest.fixture(autouse=True)
+def mock_env_vars():
+    """Mocks all necessary environment variables."""
+    with patch.dict(os.environ, {
+        "FIREBASE_ADMIN_SDK_BASE64": "mock_firebase_sdk_base64",
+        "KAFKA_BOOTSTRAP_SERVER": "dummy_kafka_server",
+        "SERVICO_USUARIOS_URL": "http://mock-user-service",
+    }):
+        yield
+
+@pytest.fixture
+def client():
+    """A test client for the app."""
+    app = api_index.app
+    app.config['TESTING'] = True
+    with app.test_client() as client:
+        yield client
+
+@pytest.fixture(autouse=True)
+def mock_dependencies():
+    """Mocks all external dependencies for all tests."""
+    with patch.object(api_index, 'db', MagicMock()) as mock_db, \
+         patch.object(api_index, 'producer', MagicMock()), \
+         patch.object(api_index, 'auth', MagicMock()) as mock_auth, \
+         patch.object(api_index, 'check_permission', return_value=(True, "ok")) as mock_check_permission, \
+         patch.object(api_index, 'publish_event', MagicMock()) as mock_publish_event, \
+         patch.object(api_index, 'firebase_init_error', None), \
+         patch.object(api_index, 'kafka_producer_init_error', None):
+        mock_auth.verify_id_token.return_value = {'uid': 'test_user_uid'}
+        yield {
+            "db": mock_db,
+            "auth": mock_auth,
+            "check_permission": mock_check_permission,
+            "publish_event": mock_publish_event,
+        }
+
+class FakeBulkWriter:
+    """Executa as escritas no close() e chama os callbacks como o BulkWriter do Firestore."""
+    def __init__(self):
+        self.operations = []
+        self.flushed = 0
+
+    def on_write_result(self, callback):
+        self.success_callback = callback
+
+    def on_write_error(self, callback):
+        self.error_callback = callback
+
+    def set(self, ref, data, merge=False):
+        self.operations.append((ref, data, merge))
+
+    def update(self, ref, data):
+        self.operations.append((ref, data, None))
+
+    def flush(self):
+        for ref, _, _ in self.operations[self.flushed:]:
+            self.success_callback(ref, MagicMock(), self)
+        self.flushed = len(self.operations)
+
+    def close(self):
+        self.flush()
+
+def make_ref(collection, doc_id):
+    return MagicMock(id=doc_id, path=f"{collection}/{doc_id}")
+
+def setup_catalog(mock_db, docs):
+    """get_all responde a partir de docs ({id: dados}) na coleção products."""
+    def get_all(refs):
+        snapshots = []
+        for ref in refs:
+            snapshot = MagicMock(id=ref.id, exists=ref.id in docs)
+            snapshot.to_dict.return_value = docs.get(ref.id)
+            snapshots.append(snapshot)
+        return snapshots
+
+    mock_db.collection.return_value.document.side_effect = lambda doc_id: make_ref('products', doc_id)
+    mock_db.get_all.side_effect = get_all
+    writer = FakeBulkWriter()
+    mock_db.bulk_writer.return_value = writer
+    return writer
+
+def test_from_canonical_upserts_deterministic_id_without_query(client, mock_dependencies):
+    mock_db = mock_dependencies["db"]
+    setup_catalog(mock_db, {'c1': {'name': 'Café', 'barcode': '789'}})
+    headers = {"Authorization": "Bearer t"}
+
+    response = client.post('/api/products/from_canonical', headers=headers,
+                           json={"canonical_product_id": "c1", "store_id": "s1", "price": 10})
+
+    assert response.status_code == 201
+    assert response.json['productId'] == 's1_c1'
+    mock_db.get_all.assert_called_once()
+    mock_db.collection.return_value.where.assert_not_called()
+    mock_db.collection.return_value.document.assert_called_with('s1_c1')
+    assert mock_dependencies["publish_event"].call_args.args[1] == 'ProductCreated'
+
+def test_from_canonical_repricing_keeps_created_at(client, mock_dependencies):
+    mock_db = mock_dependencies["db"]
+    setup_catalog(mock_db, {'c1': {'name': 'Café'}, 's1_c1': {'price': 9}})
+    refs = []
+    mock_db.collection.return_value.document.side_effect = lambda doc_id: refs.append(make_ref('products', doc_id)) or refs[-1]
+
+    response = client.post('/api/products/from_canonical', headers={"Authorization": "Bearer t"},
+                           json={"canonical_product_id": "c1", "store_id": "s1", "price": 11})
+
+    assert response.status_code == 201
+    data = refs[-1].set.call_args.args[0]
+    assert refs[-1].set.call_args.kwargs == {'merge': True}
+    assert data['price'] == 11.0
+    assert 'created_at' not in data
+    assert mock_dependencies["publish_event"].call_args.args[1] == 'ProductUpdated'
+
+def test_repricing_keeps_store_custom_image(client, mock_dependencies):
+    mock_db = mock_dependencies["db"]
+    writer = setup_catalog(mock_db, {
+        'c1': {'name': 'Café', 'image_url': 'http://catalogo/cafe.jpg'},
+        's1_c1': {'name': 'Café da casa', 'price': 9, 'image_url': 'http://loja/foto.jpg'},
+    })
+    refs = []
+    mock_db.collection.return_value.document.side_effect = lambda doc_id: refs.append(make_ref('products', doc_id)) or refs[-1]
+
+    response = client.post('/api/products/from_canonical', headers={"Authorization": "Bearer t"},
+                           json={"canonical_product_id": "c1", "store_id": "s1", "price": 11})
+
+    assert response.status_code == 201
+    data = refs[-1].set.call_args.args[0]
+    assert data['price'] == 11.0
+    assert 'image_url' not in data
+    assert 'name' not in data
+
+    response = client.post('/api/products/from_canonical:bulk', headers={"Authorization": "Bearer t"},
+                           json={"store_id": "s1", "items": [{"canonical_product_id": "c1", "price": 12}]})
+
+    assert response.status_code == 200
+    (_, updated, merge), = writer.operations
+    assert merge is True
+    assert updated['price'] == 12.0
+    assert 'image_url' not in updated
+    assert 'name' not in updated
+
+def test_bulk_pricing_creates_and_updates_store_products(client, mock_dependencies):
+    writer = setup_catalog(mock_dependencies["db"], {
+        'c1': {'name': 'Café', 'category': 'bebidas', 'barcode': '789'},
+        'c2': {'name': 'Arroz'},
+        's1_c2': {'canonical_product_id': 'c2', 'store_id': 's1', 'price': 18},
+    })
+    body = {"store_id": "s1", "items": [
+        {"canonical_product_id": "c1", "price": "12.5"},
+        {"canonical_product_id": "c2", "price": 20},
+        {"canonical_product_id": "c3", "price": 1},
+        {"canonical_product_id": "c1", "price": 13},
+        {"canonical_product_id": "c4", "price": 0},
+    ]}
+
+    response = client.post('/api/products/from_canonical:bulk', headers={"Authorization": "Bearer t"}, json=body)
+
+    assert response.status_code == 200
+    assert response.json['summary'] == {"total": 5, "created": 1, "updated": 1, "failed": 3}
+    results = response.json['results']
+    assert [r['product_id'] for r in results[:2]] == ['s1_c1', 's1_c2']
+    assert results[2]['error'] == "Produto canônico não encontrado."
+    assert results[3]['error'] == "canonical_product_id repetido."
+    assert results[4]['error'] == "price inválido."
+    mock_dependencies["check_permission"].assert_called_once_with('test_user_uid', 's1')
+    # Canônicos e produtos da loja numa única leitura; nenhuma consulta.
+    mock_dependencies["db"].get_all.assert_called_once()
+    mock_dependencies["db"].collection.return_value.where.assert_not_called()
+
+    (_, created, merge), (_, updated, _) = writer.operations
+    assert merge is True
+    assert created['price'] == 12.5
+    assert created['barcode'] == '789'
+    assert 'created_at' in created
+    assert 'created_at' not in updated
+    event_types = [c.args[1] for c in mock_dependencies["publish_event"].call_args_list]
+    assert event_types == ['ProductCreated', 'ProductUpdated']
+
+def test_bulk_pricing_reports_invalid_ids_per_item(client, mock_dependencies):
+    writer = setup_catalog(mock_dependencies["db"], {'c1': {'name': 'Café'}})
+    body = {"store_id": "s1", "items": [
+        {"canonical_product_id": ["c1"], "price": 1},
+        {"canonical_product_id": {"id": "c1"}, "price": 1},
+        {"canonical_product_id": "lojas/c1", "price": 1},
+        {"canonical_product_id": "c1", "price": 2},
+    ]}
+
+    response = client.post('/api/products/from_canonical:bulk', headers={"Authorization": "Bearer t"}, json=body)
+
+    assert response.status_code == 200
+    assert response.json['summary'] == {"total": 4, "created": 1, "updated": 0, "failed": 3}
+    assert all("canonical_product_id" in r['error'] for r in response.json['results'][:3])
+    assert len(writer.operations) == 1
+
+    response = client.post('/api/products/from_canonical:bulk', headers={"Authorization": "Bearer t"},
+                           json={"store_id": ["s1"], "items": [{"canonical_product_id": "c1", "price": 1}]})
+    assert response.status_code == 400
+
+def test_migration_moves_store_products_to_deterministic_ids(mock_dependencies):
+    import migrate_store_product_ids
+    mock_db = mock_dependencies["db"]
+
+    def product(doc_id, data):
+        doc = MagicMock(id=doc_id)
+        doc.to_dict.return_value = data
+        doc.reference.collection.return_value.stream.return_value = [MagicMock(id='img1')] if doc_id == 'old_a' else []
+        return doc
+
+    canonical = product('c1', {'name': 'Café'})
+    old_a = product('old_a', {'store_id': 's1', 'canonical_product_id': 'c1', 'price': 5,
+                              'updated_at': datetime(2025, 1, 1, tzinfo=timezone.utc)})
+    old_b = product('old_b', {'store_id': 's1', 'canonical_product_id': 'c1', 'price': 6,
+                              'updated_at': datetime(2025, 6, 1, tzinfo=timezone.utc)})
+    migrated = product('s2_c1', {'store_id': 's2', 'canonical_product_id': 'c1', 'price': 7})
+    mock_db.collection.return_value.order_by.return_value.limit.return_value.stream.return_value = [canonical, old_a, old_b, migrated]
+    mock_db.collection.return_value.where.return_value.stream.return_value = [MagicMock()]
+
+    stats = migrate_store_product_ids.migrate(mock_db)
+
+    assert stats == {"scanned": 4, "migrated": 2, "duplicates": 1, "offers": 2}
+    batch = mock_db.batch.return_value
+    # O duplicado atualizado por último vence.
+    assert batch.set.call_args_list[0].args[1]['price'] == 6
+    mock_db.collection.return_value.document.assert_any_call('s1_c1')
+    assert batch.update.call_args.args[1] == {'product_id': 's1_c1'}
+    assert batch.delete.call_count == 3  # dois produtos antigos e uma imagem
+    published = [(c.args[1], c.args[2]) for c in mock_dependencies["publish_event"].call_args_list]
+    assert published == [('ProductCreated', 's1_c1'), ('ProductDeleted', 'old_a'), ('ProductDeleted', 'old_b')]
+
+def test_bulk_pricing_requires_permission(client, mock_dependencies):
+    mock_dependencies["check_permission"].return_value = (False, "sem papel")
+    response = client.post('/api/products/from_canonical:bulk', headers={"Authorization": "Bearer t"},
+                           json={"store_id": "s1", "items": [{"canonical_product_id": "c1", "price": 1}]})
+    assert response.status_code == 403
+    mock_dependencies["db"].bulk_writer.assert_not_called()
+
+def event_message(event):
+    message = MagicMock()
+    message.error.return_value = None
+    message.value.return_value = json.dumps(event).encode('utf-8')
+    return message
+
+def test_canonical_events_are_propagated_once_per_product(mock_dependencies):
+    setup_catalog(mock_dependencies["db"], {
+        'c1': {'name': 'Café Pilão', 'image_url': 'http://nova.jpg'},
+        's1_c9': {'store_id': 's1', 'canonical_product_id': 'c9'},
+    })
+    consumer = MagicMock()
+    consumer.consume.return_value = [
+        event_message({"event_type": "ProductUpdated", "product_id": "c1", "data": {"name": "Café Pilão"}}),
+        event_message({"event_type": "ProductImageSetPrimary", "product_id": "c1", "data": {"image_url": "http://nova.jpg"}}),
+        # Eventos dos próprios produtos de loja não voltam a propagar.
+        event_message({"event_type": "ProductUpdated", "product_id": "s1_c1", "data": {"name": "Café Pilão", "canonical_product_id": "c1", "store_id": "s1"}}),
+        event_message({"event_type": "ProductImageSetPrimary", "product_id": "s1_c9", "data": {"image_url": "http://x.jpg"}}),
+        event_message({"event_type": "ProductCreated", "product_id": "c2", "data": {}}),
+    ]
+
+    with patch.object(api_index, 'get_canonical_events_consumer', return_value=consumer), \
+         patch.object(api_index, 'propagate_canonical_product', return_value=3) as propagate:
+        assert api_index.consume_canonical_events() == 5
+
+    propagate.assert_called_once_with('c1', {'name': 'Café Pilão', 'image_url': 'http://nova.jpg'})
+    consumer.commit.assert_called_once_with(asynchronous=False)
+
+def test_failed_propagation_rewinds_consumer(mock_dependencies):
+    from confluent_kafka import TopicPartition
+    setup_catalog(mock_dependencies["db"], {'c1': {'name': 'Café Pilão'}})
+    consumer = MagicMock()
+    consumer.consume.return_value = [event_message({"event_type": "ProductUpdated", "product_id": "c1", "data": {"name": "Café Pilão"}})]
+    consumer.assignment.return_value = [TopicPartition('eventos_produtos', 0)]
+    consumer.committed.return_value = [TopicPartition('eventos_produtos', 0, 12)]
+
+    with patch.object(api_index, 'get_canonical_events_consumer', return_value=consumer), \
+         patch.object(api_index, 'propagate_canonical_product', side_effect=Exception("firestore down")):
+        with pytest.raises(Exception, match="firestore down"):
+            api_index.consume_canonical_events()
+
+    # A posição volta ao offset confirmado: a próxima leitura traz o evento de novo.
+    consumer.commit.assert_not_called()
+    assert consumer.seek.call_args[0][0].offset == 12
+
+def test_propagation_rewrites_only_stale_store_products(mock_dependencies):
+    mock_db = mock_dependencies["db"]
+    writer = FakeBulkWriter()
+    mock_db.bulk_writer.return_value = writer
+    canonical = {'name': 'Café Pilão', 'category': 'bebidas', 'description': None, 'image_url': 'http://nova.jpg', 'barcode': '789'}
+
+    def store_product(doc_id, data):
+        doc = MagicMock(id=doc_id, reference=make_ref('products', doc_id))
+        doc.to_dict.return_value = data
+        return doc
+
+    stale = store_product('s1_c1', {'store_id': 's1', 'name': 'Cafe Pilao', 'category': 'bebidas', 'image_url': None, 'barcode': '789'})
+    current = store_product('s2_c1', dict(canonical, store_id='s2'))
+    query = mock_db.collection.return_value.where.return_value.order_by.return_value.select.return_value.limit.return_value
+    query.stream.return_value = [stale, current]
+
+    with patch.object(api_index, 'CANONICAL_PROPAGATION_PAGE_SIZE', 10):
+        assert api_index.propagate_canonical_product('c1', canonical) == 1
+
+    mock_db.collection.return_value.where.assert_called_once_with('canonical_product_id', '==', 'c1')
+    options = mock_db.bulk_writer.call_args.kwargs['options']
+    assert options.max_ops_per_second == api_index.CANONICAL_PROPAGATION_MAX_OPS_PER_SECOND
+    (ref, update, _), = writer.operations
+    assert ref.id == 's1_c1'
+    assert update['name'] == 'Café Pilão'
+    assert update['image_url'] == 'http://nova.jpg'
+    args = mock_dependencies["publish_event"].call_args.args
+    assert args[1:3] == ('ProductUpdated', 's1_c1')
+    assert args[3]['canonical_product_id'] == 'c1'
+    assert args[3]['store_id'] == 's1'
+
+def test_propagation_keeps_the_image_chosen_by_the_store(mock_dependencies):
+    mock_db = mock_dependencies["db"]
+    writer = FakeBulkWriter()
+    mock_db.bulk_writer.return_value = writer
+    canonical = {'name': 'Café Pilão', 'category': 'bebidas', 'description': None, 'image_url': 'http://nova.jpg', 'barcode': '789'}
+    custom = MagicMock(id='s1_c1', reference=make_ref('products', 's1_c1'))
+    custom.to_dict.return_value = dict(canonical, store_id='s1', name='Cafe', image_url='http://loja/foto.jpg',
+                                       primary_image_id='img_loja')
+    only_image_differs = MagicMock(id='s2_c1', reference=make_ref('products', 's2_c1'))
+    only_image_differs.to_dict.return_value = dict(canonical, store_id='s2', image_url='http://loja2/foto.jpg',
+                                                   primary_image_id='img_loja2')
+    query = mock_db.collection.return_value.where.return_value.order_by.return_value.select.return_value.limit.return_value
+    query.stream.return_value = [custom, only_image_differs]
+
+    with patch.object(api_index, 'CANONICAL_PROPAGATION_PAGE_SIZE', 10):
+        assert api_index.propagate_canonical_product('c1', canonical) == 1
+
+    (ref, update, _), = writer.operations
+    assert ref.id == 's1_c1'
+    assert update['name'] == 'Café Pilão'
+    assert 'image_url' not in update
+    assert 'image_url' not in mock_dependencies["publish_event"].call_args.args[3]
+
+def test_only_admins_update_canonical_products(client, mock_dependencies):
+    mock_db = mock_dependencies["db"]
+    canonical = MagicMock(exists=True)
+    canonical.to_dict.return_value = {'name': 'Cafe', 'barcode': '789'}
+    product_ref = mock_db.collection.return_value.document.return_value
+    product_ref.get.return_value = canonical
+    headers = {"Authorization": "Bearer t"}
+
+    response = client.put('/api/products/c1', headers=headers, json={"name": "Café Pilão 500g"})
+    assert response.status_code == 403
+
+    mock_dependencies["auth"].verify_id_token.return_value = {'uid': 'admin_uid', 'admin': True}
+    response = client.put('/api/products/c1', headers=headers, json={"name": "Café Pilão 500g"})
+    assert response.status_code == 200
+    update = product_ref.update.call_args.args[0]
+    assert update['match']['name'] == 'cafe pilao 500g'
+    assert update['match']['barcode'] == '789'
+    assert 'match' not in mock_dependencies["publish_event"].call_args.args[3]
+    mock_dependencies["check_permission"].assert_not_called()
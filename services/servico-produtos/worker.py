@@ -0,0 +1,30 @@
+# services/servico-produtos/worker.py
+# Processo de fundo do serviço: propaga as correções dos produtos canônicos
+# (ProductUpdated/ProductImageSetPrimary) para os produtos de loja ligados a eles e processa
+# as imagens candidatas novas (hashes, duplicatas e miniaturas). No Vercel o mesmo trabalho
+# é feito pelos crons em /internal/events/consume e /internal/images/ingest.
+#     python worker.py
+import sys
+
+from api import index
+from common import storage, workers
+
+
+def main():
+    index.init_clients()
+    if not index.db:
+        print(f"Worker não iniciado: {index.firebase_init_error}")
+        return 1
+    try:
+        # Configuração incompleta do armazenamento falha aqui, não a cada imagem.
+        storage.get_storage()
+    except RuntimeError as e:
+        print(f"Worker não iniciado: {e}")
+        return 1
+    print("Worker do catálogo iniciado (propagação de correções e ingestão de imagens).")
+    workers.run_forever([index.consume_canonical_events, index.ingest_pending_images])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,28 +2,17 @@ from dotenv import load_dotenv
 load_dotenv(dotenv_path='.env.local')
 
 import os
-import json
+import sys
+import threading
 import uuid
 from datetime import datetime, timezone
 from flask import Flask, request, jsonify
-import base64
 
 # --- Importações de  dependências ---
-try:
-    from firebase_admin import credentials, firestore, initialize_app, auth
-    import firebase_admin
-except ImportError:
-    firebase_admin = None
-
-try:
-    from confluent_kafka import Producer
-except ImportError:
-    Producer = None
-
 
 try:
     from sqlalchemy import create_engine, Column, String, MetaData, text, func
-    from sqlalchemy.orm import sessionmaker, declarative_base
+    from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base
     from sqlalchemy.exc import SQLAlchemyError
     from sqlalchemy.dialects.postgresql import JSON
     from geoalchemy2 import Geography
@@ -33,7 +22,7 @@ except ImportError:
     SQLAlchemyError = None
     declarative_base = None
     create_engine = None
-    Column = String = MetaData = sessionmaker = Geography = to_shape = text = func = None
+    Column = String = MetaData = sessionmaker = scoped_session = Geography = to_shape = text = func = None
     urlparse = urlunparse = parse_qs = urlencode = None
     JSON = None
 
@@ -43,67 +32,76 @@ from flask_cors import CORS
 firebase_init_error = None
 postgres_init_error = None
 kafka_producer_init_error = None # Renamed for clarity    
+kafka_consumer_init_error = None
 db_init_error = None
 
+# --- Pacote compartilhado (services/common) ---
+# No repositório e nas imagens Docker o pacote fica na pasta pai do serviço; no deploy do
+# Vercel ele é copiado para dentro da pasta do serviço (ver .github/actions/deploy-service).
+SERVICE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+for common_parent in (os.path.dirname(SERVICE_ROOT), SERVICE_ROOT):
+    if os.path.isdir(os.path.join(common_parent, 'common')) and common_parent not in sys.path:
+        sys.path.insert(0, common_parent)
+
+from common import events, firebase, kafka, outbox, health, tokens, service
+from common.lazy import lazy_import, NOT_INITIALIZED
+
+auth = lazy_import('firebase_admin.auth')
+firestore = lazy_import('firebase_admin.firestore')
+
 # --- Configuração do Flask ---
 app = Flask(__name__)
 CORS(app, supports_credentials=True, origins=['http://localhost:3000', 'https://frontend-tester-1foc8lpkl-jeanmnorhens-projects.vercel.app'])
 
 # --- Configuração do Firebase ---
-db = None
-if firebase_admin:
-    try:
-        base64_sdk = os.environ.get('FIREBASE_ADMIN_SDK_BASE64')
-        if base64_sdk:
-            decoded_sdk = base64.b64decode(base64_sdk).decode('utf-8')
-            cred_dict = json.loads(decoded_sdk)
-            cred = credentials.Certificate(cred_dict)
-            if not firebase_admin._apps:
-                initialize_app(cred)
-            db = firestore.client()
-            print("Firebase inicializado com sucesso.")
-        else:
-            firebase_init_error = "Variável de ambiente FIREBASE_ADMIN_SDK_BASE64 não encontrada."
-            print(firebase_init_error)
-    except Exception as e:
-        firebase_init_error = str(e)
-        print(f"Erro ao inicializar Firebase: {e}")
-else:
-    firebase_init_error = "Biblioteca firebase_admin não encontrada."
+db = NOT_INITIALIZED
+
+def init_firebase():
+    global db, firebase_init_error
+    db, firebase_init_error = firebase.get_firestore_client()
+
+# --- Verificação de ID tokens com cache ---
+def verify_id_token(id_token):
+    return auth.verify_id_token(id_token)
+
+token_verifier = tokens.CachedTokenVerifier(verify_id_token)
 
 # --- Configuração do PostgreSQL (PostGIS) ---
-db_session = None
+db_session = NOT_INITIALIZED
 engine = None
-if create_engine:
-    try:
-        db_url = os.environ.get('POSTGRES_POSTGRES_URL')
-        if db_url:
-            if db_url.startswith("postgres://"):
-                db_url = db_url.replace("postgres://", "postgresql://", 1)
-
-            cleaned_url = db_url
-            if urlparse:
-                try:
-                    parsed_url = urlparse(db_url)
-                    query_params = parse_qs(parsed_url.query)
-                    query_params.pop('supa', None)
-                    new_query = urlencode(query_params, doseq=True)
-                    cleaned_url = urlunparse(parsed_url._replace(query=new_query))
-                except Exception:
-                    pass
-
-            engine = create_engine(cleaned_url)
-            Session = sessionmaker(bind=engine)
-            db_session = Session()
-            print("Conexão com PostgreSQL (PostGIS) estabelecida com sucesso.")
-        else:
-            postgres_init_error = "Variável de ambiente POSTGRES_POSTGRES_URL não encontrada."
-            print(postgres_init_error)
-    except Exception as e:
-        postgres_init_error = str(e)
-        print(f"Erro ao conectar com PostgreSQL: {e}")
-else:
-    postgres_init_error = "SQLAlchemy não encontrado."
+
+def init_postgres():
+    global db_session, engine, postgres_init_error
+    db_session = None
+    if create_engine:
+        try:
+            db_url = os.environ.get('POSTGRES_POSTGRES_URL')
+            if db_url:
+                if db_url.startswith("postgres://"):
+                    db_url = db_url.replace("postgres://", "postgresql://", 1)
+
+                cleaned_url = db_url
+                if urlparse:
+                    try:
+                        parsed_url = urlparse(db_url)
+                        query_params = parse_qs(parsed_url.query)
+                        query_params.pop('supa', None)
+                        new_query = urlencode(query_params, doseq=True)
+                        cleaned_url = urlunparse(parsed_url._replace(query=new_query))
+                    except Exception:
+                        pass
+
+                engine = create_engine(cleaned_url)
+                db_session = scoped_session(sessionmaker(bind=engine))
+                print("Conexão com PostgreSQL (PostGIS) estabelecida com sucesso.")
+            else:
+                postgres_init_error = "Variável de ambiente POSTGRES_POSTGRES_URL não encontrada."
+                print(postgres_init_error)
+        except Exception as e:
+            postgres_init_error = str(e)
+            print(f"Erro ao conectar com PostgreSQL: {e}")
+    else:
+        postgres_init_error = "SQLAlchemy não encontrado."
 
 # --- Definição do Modelo de Dados Geoespacial ---
 Base = declarative_base() if declarative_base else object
@@ -135,6 +133,9 @@ if Base != object and Geography:
         status = Column(String, default='PENDENTE') # PENDENTE, RESOLVIDA, REJEITADA
         criado_em = Column(String, default=lambda: datetime.now(timezone.utc).isoformat())
 
+    # Eventos gravados na mesma transação das linhas acima (ver common/outbox.py).
+    OutboxEvent = outbox.define_outbox_model(Base, 'outbox_usuarios')
+
 
 def init_db():
     global db_init_error
@@ -154,53 +155,94 @@ def init_db():
         print(f"Erro ao criar tabelas do banco de dados: {e}")
 
 # --- Configuração do Kafka Producer ---
-producer = None
-if Producer:
+producer = NOT_INITIALIZED
+
+def init_kafka_producer():
+    global producer, kafka_producer_init_error
+    producer, kafka_producer_init_error = kafka.get_producer()
+
+# --- Inicialização dos clientes ---
+# Sob demanda, na primeira requisição e no post_fork do gunicorn (common/service.py).
+def create_clients():
+    if db is NOT_INITIALIZED:
+        init_firebase()
+        if db:
+            token_verifier.start_key_refresher()
+    if db_session is NOT_INITIALIZED:
+        init_postgres()
+    if producer is NOT_INITIALIZED:
+        init_kafka_producer()
+
+init_clients = service.lazy_clients(app, create_clients)
+
+@app.teardown_request
+def flush_kafka_producer(exception=None):
+    # Em serverless o processo pode ser congelado logo após a resposta; sem o flush os
+    # eventos da requisição ficariam presos no buffer do produtor.
+    kafka.flush_if_serverless()
+
+@app.teardown_appcontext
+def remove_db_session(exception=None):
+    # Cada thread do worker tem a sua própria sessão, descartada ao fim da requisição.
+    if db_session not in (None, NOT_INITIALIZED):
+        db_session.remove()
+
+def enqueue_event(topic, event_type, user_id, data, changes=None):
+    # Só é publicado pelo relay depois do commit de db_session.
+    outbox.add_event(db_session, OutboxEvent, topic, event_type, 'user_id', user_id, data, 'servico-usuarios', changes)
+
+def relay_outbox_batch():
+    return outbox.relay_batch(db_session, OutboxEvent, producer)
+
+# --- Consumidor de eventos de lojas ---
+# O papel de 'owner' é atribuído a partir do StoreCreated (ver consume_store_events). O
+# consumidor só é criado por quem consome (worker.py ou o cron), não pelos workers da API.
+store_events_consumer = None
+store_events_consumer_lock = threading.Lock()
+
+def get_store_events_consumer():
+    global store_events_consumer, kafka_consumer_init_error
+    with store_events_consumer_lock:
+        if store_events_consumer is None:
+            store_events_consumer, kafka_consumer_init_error = kafka.create_consumer('servico-usuarios-store-roles', ['eventos_lojas'])
+        return store_events_consumer
+
+def save_role(user_id, store_id, role, shifts=None):
+    # merge faz o UPSERT, então reprocessar o mesmo evento não duplica o papel.
+    db_session.merge(UserStoreRole(user_id=user_id, store_id=store_id, role=role, shifts=shifts))
+    enqueue_event('eventos_funcionarios', 'UserRoleAssigned', user_id,
+                  {'user_id': user_id, 'store_id': store_id, 'role': role, 'shifts': shifts})
+
+def consume_store_events(max_messages=50, timeout=1.0):
+    """Atribui o papel de owner para cada StoreCreated. Devolve quantas mensagens leu."""
+    consumer = get_store_events_consumer()
+    if not consumer:
+        raise RuntimeError(kafka_consumer_init_error)
+    msgs = consumer.consume(num_messages=max_messages, timeout=timeout)
+    if not msgs:
+        return 0
     try:
-        kafka_bootstrap_server = os.environ.get('KAFKA_BOOTSTRAP_SERVER')
-        if kafka_bootstrap_server:
-            # Configuração para ambiente local (Docker)
-            print("Configurando produtor Kafka para ambiente local (sem SASL)...")
-            kafka_conf = {
-                'bootstrap.servers': kafka_bootstrap_server
-            }
-            producer = Producer(kafka_conf)
-            print("Produtor Kafka inicializado com sucesso.")
-        else:
-            kafka_producer_init_error = "Variável de ambiente KAFKA_BOOTSTRAP_SERVER não encontrada."
-            print(kafka_producer_init_error)
-    except Exception as e:
-        kafka_producer_init_error = str(e)
-        print(f"Erro ao inicializar Produtor Kafka: {e}")
-else:
-    kafka_producer_init_error = "Biblioteca confluent_kafka não encontrada."
-
-def delivery_report(err, msg):
-    if err is not None:
-        print(f'Falha ao entregar mensagem Kafka: {err}')
-    else:
-        print(f'Mensagem Kafka entregue em {msg.topic()} [{msg.partition()}]')
-
-def publish_event(topic, event_type, user_id, data, changes=None):
-    if not producer:
-        print("Produtor Kafka não está inicializado. Evento não publicado.")
-        return
-    event = {
-        "event_type": event_type,
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "user_id": user_id,
-        "data": data,
-        "source_service": "servico-usuarios"
-    }
-    if changes:
-        event["changes"] = changes
-    try:
-        event_value = json.dumps(event, default=str)
-        producer.produce(topic, key=user_id, value=event_value, callback=delivery_report)
-        producer.poll(0)
-        print(f"Evento '{event_type}' para o usuário {user_id} publicado no tópico {topic}.")
-    except Exception as e:
-        print(f"Erro ao publicar evento Kafka: {e}")
+        for msg in msgs:
+            if msg.error():
+                print(f"Kafka error: {msg.error()}")
+                continue
+            try:
+                event = events.decode_event(msg.value())
+            except ValueError as e:
+                print(f"Evento de loja ignorado: {e}")
+                continue
+            owner_uid = (event.get('data') or {}).get('owner_uid')
+            if event.get('event_type') == 'StoreCreated' and owner_uid and event.get('store_id'):
+                save_role(owner_uid, event['store_id'], 'owner')
+        db_session.commit()
+    except Exception:
+        db_session.rollback()
+        # A próxima leitura recomeça do último offset confirmado, com as mensagens deste lote.
+        kafka.rewind_to_committed(consumer)
+        raise
+    # Offsets só são confirmados depois do commit: em caso de falha as mensagens voltam.
+    consumer.commit(asynchronous=False)
+    return len(msgs)
 
 # --- Rotas da API ---
 
@@ -230,16 +272,19 @@ def create_user():
             db_session.add(new_location)
 
         db.collection('users').document(user_id).set(firestore_data)
+        # Localização e evento UserCreated no mesmo commit.
+        enqueue_event('eventos_usuarios', 'UserCreated', user_id, user_data)
         db_session.commit()
-
-        publish_event('eventos_usuarios', 'UserCreated', user_id, user_data)
         return jsonify({"id": user_id, "message": "Usuário criado com sucesso."}), 201
 
     except SQLAlchemyError as e:
         db_session.rollback()
+        # Sem o commit o usuário não existe para os outros serviços: desfaz o documento.
+        db.collection('users').document(user_id).delete()
         return jsonify({"error": f"Erro no banco de dados geoespacial: {e}"}), 500
     except Exception as e:
         db_session.rollback()
+        db.collection('users').document(user_id).delete()
         return jsonify({"error": f"Erro ao criar usuário: {e}"}), 500
 
 @app.route('/users/<user_id>', methods=['GET'])
@@ -298,9 +343,8 @@ def update_user(user_id):
         if firestore_data:
             user_ref.update(firestore_data)
 
+        enqueue_event('eventos_usuarios', 'UserUpdated', user_id, update_data)
         db_session.commit()
-
-        publish_event('eventos_usuarios', 'UserUpdated', user_id, update_data)
         return jsonify({"message": "Usuário atualizado com sucesso.", "id": user_id}), 200
 
     except SQLAlchemyError as e:
@@ -326,9 +370,8 @@ def delete_user(user_id):
             db_session.delete(location_record)
 
         user_ref.delete()
+        enqueue_event('eventos_usuarios', 'UserDeleted', user_id, {"user_id": user_id})
         db_session.commit()
-
-        publish_event('eventos_usuarios', 'UserDeleted', user_id, {"user_id": user_id})
         return '', 204
 
     except SQLAlchemyError as e:
@@ -421,7 +464,7 @@ def add_employee(store_id):
         return jsonify({"error": "Authorization token is required"}), 401
     try:
         id_token = auth_header.split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = token_verifier.verify(id_token)
         requestor_uid = decoded_token['uid']
     except Exception as e:
         return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
@@ -441,8 +484,8 @@ def add_employee(store_id):
             shifts=data['shifts']
         )
         db_session.merge(new_employee_role)
+        enqueue_event('eventos_funcionarios', 'EmployeeAdded', data['employee_id'], {"store_id": store_id, **data})
         db_session.commit()
-        publish_event('eventos_funcionarios', 'EmployeeAdded', data['employee_id'], {"store_id": store_id, **data})
         return jsonify({"message": "Funcionário adicionado com sucesso."}), 201
     except Exception as e:
         db_session.rollback()
@@ -458,7 +501,7 @@ def list_employees(store_id):
         return jsonify({"error": "Authorization token is required"}), 401
     try:
         id_token = auth_header.split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = token_verifier.verify(id_token)
         requestor_uid = decoded_token['uid']
     except Exception as e:
         return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
@@ -494,7 +537,7 @@ def remove_employee(store_id, employee_id):
         return jsonify({"error": "Authorization token is required"}), 401
     try:
         id_token = auth_header.split('Bearer ')[1]
-        decoded_token = auth.verify_id_token(id_token)
+        decoded_token = token_verifier.verify(id_token)
         requestor_uid = decoded_token['uid']
     except Exception as e:
         return jsonify({"error": "Invalid or expired token", "details": str(e)}), 401
@@ -508,8 +551,8 @@ def remove_employee(store_id, employee_id):
             return jsonify({"error": "Vínculo de funcionário não encontrado."}), 404
         
         db_session.delete(role_to_delete)
+        enqueue_event('eventos_funcionarios', 'EmployeeRemoved', employee_id, {'store_id': store_id, 'employee_id': employee_id})
         db_session.commit()
-        publish_event('eventos_funcionarios', 'EmployeeRemoved', employee_id, {'store_id': store_id, 'employee_id': employee_id})
         return '', 204
     except Exception as e:
         db_session.rollback()
@@ -534,19 +577,9 @@ def assign_role():
         return jsonify({"error": "user_id, store_id, e role são obrigatórios."}), 400
 
     try:
-        # Usar merge para inserir ou atualizar o papel (UPSERT)
-        new_role = UserStoreRole(
-            user_id=data['user_id'],
-            store_id=data['store_id'],
-            role=data['role'],
-            shifts=data.get('shifts')  # Opcional, principalmente para funcionários
-        )
-        db_session.merge(new_role)
+        # shifts é opcional, principalmente para funcionários
+        save_role(data['user_id'], data['store_id'], data['role'], data.get('shifts'))
         db_session.commit()
-
-        # Publicar evento para notificar outros sistemas (opcional, mas bom para auditoria)
-        publish_event('eventos_funcionarios', 'UserRoleAssigned', data['user_id'], data)
-
         return jsonify({"message": f"Papel '{data['role']}' atribuído com sucesso."}), 201
 
     except SQLAlchemyError as e:
@@ -557,6 +590,31 @@ def assign_role():
         return jsonify({"error": f"Erro inesperado ao atribuir papel: {e}"}), 500
 
 
+@app.route('/internal/outbox/relay', methods=['POST', 'GET'])
+def relay_outbox():
+    # Chamada pelo cron (Vercel); em Docker o worker.py faz o mesmo em laço.
+    if not service.is_cron_request():
+        return jsonify({"error": "Unauthorized"}), 401
+    if not db_session or not producer:
+        return jsonify({"error": "Dependências de banco de dados ou Kafka não inicializadas."}), 503
+    try:
+        relayed = relay_outbox_batch()
+    except Exception as e:
+        return jsonify({"error": f"Erro ao publicar eventos da outbox: {e}"}), 500
+    return jsonify({"status": "ok", "events_relayed": relayed}), 200
+
+@app.route('/internal/events/consume', methods=['POST', 'GET'])
+def consume_events():
+    if not service.is_cron_request():
+        return jsonify({"error": "Unauthorized"}), 401
+    if not db_session:
+        return jsonify({"error": "Dependência do banco de dados não inicializada."}), 503
+    try:
+        processed = consume_store_events(timeout=5.0)
+    except Exception as e:
+        return jsonify({"error": f"Erro durante o consumo de eventos: {e}"}), 500
+    return jsonify({"status": "ok", "messages_processed": processed}), 200
+
 @app.route('/api/permissions/check', methods=['GET'])
 def check_permission():
     user_id = request.args.get('user_id')
@@ -619,24 +677,29 @@ def check_permission():
         return jsonify({"allow": False, "reason": f"internal_error: {e}"}), 500
 
 # --- Health Check (para Vercel) ---
-def get_health_status():
-    env_vars = {
-        "FIREBASE_ADMIN_SDK_BASE64": "present" if os.environ.get('FIREBASE_ADMIN_SDK_BASE64') else "missing",
-        "POSTGRES_POSTGRES_URL": "present" if os.environ.get('POSTGRES_POSTGRES_URL') else "missing",
-        "KAFKA_BOOTSTRAP_SERVER": "present" if os.environ.get('KAFKA_BOOTSTRAP_SERVER') else "missing",
-        "KAFKA_API_KEY": "present" if os.environ.get('KAFKA_API_KEY') else "missing",
-        "KAFKA_API_SECRET": "present" if os.environ.get('KAFKA_API_SECRET') else "missing"
-    }
-
+def ping_postgres():
+    try:
+        db_session.execute(text('SELECT 1'))
+    finally:
+        # A readiness roda em threads de fundo, e a sessão do scoped_session é por thread:
+        # sem o remove a conexão ficaria presa fora do pool.
+        db_session.remove()
+
+def get_health_status(include_latencies=False):
+    env_vars = health.env_var_status([
+        'FIREBASE_ADMIN_SDK_BASE64',
+        'POSTGRES_POSTGRES_URL',
+        'KAFKA_BOOTSTRAP_SERVER',
+        'KAFKA_API_KEY',
+        'KAFKA_API_SECRET'
+    ])
+
+    latencies_ms = {}
     pg_status = "error"
     pg_query_error = None
     if db_session and text:
-        try:
-            db_session.execute(text('SELECT 1'))
-            pg_status = "ok"
-        except Exception as e:
-            pg_query_error = str(e)
-            pg_status = f"error during query: {pg_query_error}"
+        pg_query_error, latencies_ms["postgresql_connection"] = health.timed_check(ping_postgres)
+        pg_status = f"error during query: {pg_query_error}" if pg_query_error else "ok"
 
     status = {
         "environment_variables": env_vars,
@@ -654,25 +717,36 @@ def get_health_status():
             "kafka_producer": kafka_producer_init_error # Renamed
         }
     }
+    if include_latencies:
+        status["latencies_ms"] = latencies_ms
     return status
 
-@app.route('/api/health', methods=['GET'])
-def health_check():
-    status = get_health_status()
-    
-    all_ok = (
+def is_healthy(status):
+    return (
         all(value == "present" for value in status["environment_variables"].values()) and
         status["dependencies"]["firestore"] == "ok" and
         status["dependencies"]["kafka_producer"] == "ok" and
         status["dependencies"]["postgresql_connection"] == "ok" and
         status["dependencies"]["table_initialization"] == "ok"
     )
-    http_status = 200 if all_ok else 503
+
+@app.route('/api/health', methods=['GET'])
+def health_check():
+    status = get_health_status()
+    http_status = 200 if is_healthy(status) else 503
     
     return jsonify(status), http_status
 
-# --- Inicialização ---
-init_db()
+service.register_metrics_route(app, token_verifier)
+
+# --- Readiness memoizada ---
+def build_readiness_status():
+    status = get_health_status(include_latencies=True)
+    status["status"] = "ok" if is_healthy(status) else "degraded"
+    return status
+
+readiness = service.register_probe_routes(app, build_readiness_status)
+readiness_cache = readiness.cache
 
 if __name__ == '__main__':
     app.run(debug=True)
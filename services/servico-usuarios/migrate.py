@@ -0,0 +1,22 @@
+# services/servico-usuarios/migrate.py
+# Cria as tabelas do PostgreSQL (PostGIS) usadas pelo serviço. A criação do schema não
+# acontece mais na importação da API; rode este comando uma vez a cada deploy:
+#     python migrate.py
+import sys
+
+from api import index
+
+
+def main():
+    index.init_postgres()
+    if index.postgres_init_error:
+        print(f"Migração não executada: {index.postgres_init_error}")
+        return 1
+    index.init_db()
+    if index.db_init_error:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
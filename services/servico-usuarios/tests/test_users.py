@@ -4,9 +4,10 @@ import pytest
 from pytest_mock import mocker
 from unittest.mock import MagicMock
 from datetime import datetime, timezone
+import json
 import os
 import sys
-from confluent_kafka import Producer
+from confluent_kafka import Producer, TopicPartition
 
 # Add the service's root directory to the path to allow for relative imports
 service_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -58,7 +59,7 @@ def mock_global_dependencies(mocker):
     mocker.patch('firebase_admin.initialize_app')
     mocker.patch('api.index.create_engine', return_value=mocker.MagicMock())
     mocker.patch('api.index.sessionmaker', return_value=mocker.MagicMock())
-    mocker.patch('api.index.Producer', return_value=mocker.MagicMock())
+    mocker.patch('common.kafka.Producer', return_value=mocker.MagicMock())
     mocker.patch('api.index.init_db')
     mocker.patch('api.index.text', return_value=mocker.MagicMock())
     
@@ -100,7 +101,7 @@ def test_create_user_with_location(client, firebase_mock_db, mocker):
     """Test creating a user with location data."""
     # Mocks specific to this test
     postgis_mock_session = mocker.patch('api.index.db_session', mocker.MagicMock())
-    publish_event_mock = mocker.patch('api.index.publish_event')
+    enqueue_event_mock = mocker.patch('api.index.enqueue_event')
 
     user_data = {
         "email": "new@example.com",
@@ -115,8 +116,8 @@ def test_create_user_with_location(client, firebase_mock_db, mocker):
     postgis_mock_session.add.assert_called_once()
     postgis_mock_session.commit.assert_called_once()
     firebase_mock_db.collection.return_value.document.return_value.set.assert_called_once()
-    publish_event_mock.assert_called_once()
-    args, kwargs = publish_event_mock.call_args
+    enqueue_event_mock.assert_called_once()
+    args, kwargs = enqueue_event_mock.call_args
     assert args[1] == 'UserCreated'
 
 def test_create_user_without_location(client, firebase_mock_db, mocker):
@@ -128,10 +129,98 @@ def test_create_user_without_location(client, firebase_mock_db, mocker):
 
     assert response.status_code == 201
     
-    postgis_mock_session.add.assert_not_called()
+    # Só a linha da outbox é adicionada, no mesmo commit.
+    postgis_mock_session.add.assert_called_once()
+    assert isinstance(postgis_mock_session.add.call_args[0][0], api_index.OutboxEvent)
     postgis_mock_session.commit.assert_called_once()
     firebase_mock_db.collection.return_value.document.return_value.set.assert_called_once()
 
+def test_consume_store_created_assigns_owner_role(client, mocker):
+    postgis_mock_session = mocker.patch('api.index.db_session', mocker.MagicMock())
+    enqueue_event_mock = mocker.patch('api.index.enqueue_event')
+    event = {"event_type": "StoreCreated", "store_id": "store_1", "data": {"name": "Loja", "owner_uid": "owner_1"}}
+    message = mocker.MagicMock()
+    message.error.return_value = None
+    message.value.return_value = json.dumps(event).encode('utf-8')
+    consumer = mocker.MagicMock()
+    consumer.consume.return_value = [message]
+    mocker.patch('api.index.get_store_events_consumer', return_value=consumer)
+    mocker.patch.dict(os.environ, {"CRON_SECRET": "cron"})
+
+    response = client.post('/internal/events/consume', headers={"Authorization": "Bearer cron"})
+
+    assert response.status_code == 200
+    assert response.json["messages_processed"] == 1
+    role = postgis_mock_session.merge.call_args[0][0]
+    assert (role.user_id, role.store_id, role.role) == ("owner_1", "store_1", "owner")
+    assert enqueue_event_mock.call_args[0][1] == 'UserRoleAssigned'
+    postgis_mock_session.commit.assert_called_once()
+    consumer.commit.assert_called_once_with(asynchronous=False)
+
+def test_consume_store_events_does_not_commit_offsets_on_db_error(client, mocker):
+    postgis_mock_session = mocker.patch('api.index.db_session', mocker.MagicMock())
+    postgis_mock_session.commit.side_effect = Exception("db down")
+    mocker.patch('api.index.enqueue_event')
+    message = mocker.MagicMock()
+    message.error.return_value = None
+    message.value.return_value = json.dumps({"event_type": "StoreCreated", "store_id": "s", "data": {"owner_uid": "o"}}).encode('utf-8')
+    consumer = mocker.MagicMock()
+    consumer.consume.return_value = [message]
+    mocker.patch('api.index.get_store_events_consumer', return_value=consumer)
+    mocker.patch.dict(os.environ, {"CRON_SECRET": "cron"})
+
+    response = client.post('/internal/events/consume', headers={"Authorization": "Bearer cron"})
+
+    assert response.status_code == 500
+    postgis_mock_session.rollback.assert_called_once()
+    consumer.commit.assert_not_called()
+
+class FakePartitionConsumer:
+    """Uma partição: posição em memória, offset confirmado, commit e seek."""
+    def __init__(self, messages):
+        self.log = messages
+        self.position = 0
+        self.committed_offset = -1001
+
+    def consume(self, num_messages=1, timeout=-1):
+        batch = self.log[self.position:self.position + num_messages]
+        self.position += len(batch)
+        return batch
+
+    def assignment(self):
+        return [TopicPartition('eventos_lojas', 0)]
+
+    def committed(self, partitions, timeout=None):
+        return [TopicPartition(p.topic, p.partition, self.committed_offset) for p in partitions]
+
+    def seek(self, partition):
+        self.position = 0 if partition.offset < 0 else partition.offset
+
+    def commit(self, asynchronous=True):
+        self.committed_offset = self.position
+
+def test_consume_store_events_retries_failed_batch(client, mocker):
+    postgis_mock_session = mocker.patch('api.index.db_session', mocker.MagicMock())
+    postgis_mock_session.commit.side_effect = [Exception("db down"), None]
+    save_role_mock = mocker.patch('api.index.save_role')
+    message = mocker.MagicMock()
+    message.error.return_value = None
+    message.value.return_value = json.dumps({"event_type": "StoreCreated", "store_id": "s", "data": {"owner_uid": "o"}}).encode('utf-8')
+    consumer = FakePartitionConsumer([message])
+    mocker.patch('api.index.get_store_events_consumer', return_value=consumer)
+    mocker.patch.dict(os.environ, {"CRON_SECRET": "cron"})
+
+    first = client.post('/internal/events/consume', headers={"Authorization": "Bearer cron"})
+    second = client.post('/internal/events/consume', headers={"Authorization": "Bearer cron"})
+
+    assert first.status_code == 500
+    assert second.status_code == 200
+    # A mensagem do lote que falhou é lida de novo e só então confirmada.
+    assert second.json["messages_processed"] == 1
+    assert save_role_mock.call_count == 2
+    save_role_mock.assert_called_with("o", "s", "owner")
+    assert consumer.committed_offset == 1
+
 def test_get_user_with_location(client, firebase_mock_db, mocker):
     """Test getting a user who has a location in PostGIS."""
     postgis_mock_session = mocker.patch('api.index.db_session', mocker.MagicMock())
@@ -176,7 +265,7 @@ def test_update_user_location(client, firebase_mock_db, mocker):
     postgis_mock_session = mocker.patch('api.index.db_session', mocker.MagicMock())
     mock_location_record = MockUserLocation('test_user_123', 'POINT(-46.6 -23.5)')
     postgis_mock_session.query.return_value.filter_by.return_value.first.return_value = mock_location_record
-    publish_event_mock = mocker.patch('api.index.publish_event')
+    enqueue_event_mock = mocker.patch('api.index.enqueue_event')
 
     update_data = {"location": {"latitude": -10.0, "longitude": -20.0}}
     response = client.put('/users/test_user_123', json=update_data)
@@ -186,8 +275,8 @@ def test_update_user_location(client, firebase_mock_db, mocker):
     assert mock_location_record.location == 'POINT(-20.0 -10.0)'
     postgis_mock_session.commit.assert_called_once()
 
-    publish_event_mock.assert_called_once()
-    args, kwargs = publish_event_mock.call_args
+    enqueue_event_mock.assert_called_once()
+    args, kwargs = enqueue_event_mock.call_args
     assert args[1] == 'UserUpdated'
     assert args[2] == 'test_user_123'
     assert args[3] == update_data
@@ -197,7 +286,7 @@ def test_delete_user(client, firebase_mock_db, mocker):
     postgis_mock_session = mocker.patch('api.index.db_session', mocker.MagicMock())
     mock_location_record = MockUserLocation('test_user_123', 'POINT(-46.6 -23.5)')
     postgis_mock_session.query.return_value.filter_by.return_value.first.return_value = mock_location_record
-    publish_event_mock = mocker.patch('api.index.publish_event')
+    enqueue_event_mock = mocker.patch('api.index.enqueue_event')
 
     response = client.delete('/users/test_user_123')
 
@@ -206,7 +295,7 @@ def test_delete_user(client, firebase_mock_db, mocker):
     postgis_mock_session.delete.assert_called_once_with(mock_location_record)
     postgis_mock_session.commit.assert_called_once()
     firebase_mock_db.collection.return_value.document.return_value.delete.assert_called_once()
-    publish_event_mock.assert_called_once()
+    enqueue_event_mock.assert_called_once()
 
 def test_health_check_all_ok(client, firebase_mock_db, kafka_mock_producer, mocker):
     """Test health check when all services are up."""
@@ -238,6 +327,25 @@ def test_health_check_pg_error(client, mocker):
     assert response.json["dependencies"]["postgresql_connection"] == "error during query: Connection failed"
     assert response.json["initialization_errors"]["postgresql_query"] == "Connection failed"
 
+def test_liveness_check(client):
+    """Liveness não depende de nenhuma dependência externa."""
+    response = client.get('/api/health/live')
+    assert response.status_code == 200
+    assert response.json == {"status": "ok"}
+
+def test_readiness_check_is_memoized(client, firebase_mock_db, kafka_mock_producer, mocker):
+    """Readiness reaproveita o resultado das verificações dentro da janela de cache."""
+    postgis_mock_session = mocker.patch('api.index.db_session', mocker.MagicMock())
+    mocker.patch.dict(api_index.readiness_cache, {"status": None, "checked_at": 0.0})
+
+    first = client.get('/api/health/ready')
+    second = client.get('/api/health/ready')
+
+    assert first.status_code == second.status_code == 200
+    assert first.json["status"] == "ok"
+    assert "postgresql_connection" in first.json["latencies_ms"]
+    postgis_mock_session.execute.assert_called_once()
+
 # --- Testes para Críticas de Produtos ---
 
 @pytest.fixture
@@ -316,3 +424,11 @@ def test_get_criticas_no_criticas(client, mock_db_session_add_commit):
 
     assert response.status_code == 200
     assert len(response.json) == 0
+
+def test_postgres_ping_releases_the_thread_session(mocker):
+    """A readiness roda em threads de fundo: a sessão delas é descartada mesmo com erro."""
+    session = mocker.patch('api.index.db_session', mocker.MagicMock())
+    session.execute.side_effect = Exception("Connection failed")
+    error, _ = api_index.health.timed_check(api_index.ping_postgres)
+    assert error == "Connection failed"
+    session.remove.assert_called_once()
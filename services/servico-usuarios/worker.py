@@ -0,0 +1,24 @@
+# services/servico-usuarios/worker.py
+# Processo de fundo do serviço: publica no Kafka os eventos gravados na outbox
+# (tabela outbox_usuarios) e atribui o papel de 'owner' a partir dos eventos StoreCreated.
+# No Vercel o mesmo trabalho é feito pelo cron em /internal/outbox/relay e
+# /internal/events/consume.
+#     python worker.py
+import sys
+
+from api import index
+from common import workers
+
+
+def main():
+    index.init_clients()
+    if not index.db_session or not index.producer:
+        print(f"Worker não iniciado: {index.postgres_init_error or index.kafka_producer_init_error}")
+        return 1
+    print("Relay da outbox e consumidor de eventos de lojas iniciados.")
+    workers.run_forever([index.relay_outbox_batch, index.consume_store_events])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())